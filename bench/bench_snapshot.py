@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""Benchmark the snapshot planning code on synthetic dataset trees
+
+Each case is run against a fake zfs command runner that answers `zfs list`,
+`zpool list` and `zpool status` from a generated dataset tree, so no pools are needed.
+Every case and size runs in a forked child process, so that the peak memory
+reported belongs to that case alone.
+
+One JSON object is written per line for each case and size, for example:
+
+    {"case": "userprop_plan", "size": 10000, "seconds": 0.21,
+     "times": [0.21, 0.22, 0.21], "maxrss_kb": 30212, "rss_growth_kb": 5120,
+     "python": "2.7.18"}
+
+`seconds` is the best of the repeated runs. `maxrss_kb` is the peak
+resident set size of the child, and `rss_growth_kb` how much of it was
+reached during the timed runs rather than while generating the input.
+Compare the output of two runs to spot regressions.
+
+The legacy quadratic functions are skipped above --legacy-max entries, and
+reported with "skipped": true.
+"""
+
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import traceback
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from zfs import util
+from zfs import snapshot
+from zfs.index import SnapshotIndex, INDEX_PROPERTIES
+from zfs.fake import FakeZfsCommandRunner
+
+SIZES=[1000, 10000, 100000, 1000000]
+LEGACY_MAX=5000
+LABELS=['hourly', 'daily', 'weekly']
+SNAPSHOTS_PER_DATASET=30
+
+class SyntheticTree(object):
+    """A generated tree of datasets and snapshots
+
+    Attributes:
+        datasets    dataset names, parents before children
+        excluded    set of datasets with auto-snapshot turned off
+        snapshots   list of (dataset, snapname) in creation order
+        pools       the pool names
+    """
+
+    def __init__(self, ndatasets, nsnapshots=0, fanout=10, seed=1):
+        rnd = random.Random(seed)
+        npools = max(1, ndatasets // 100000)
+        self.pools = ['pool%d' % i for i in range(npools)]
+        self.datasets = list(self.pools)
+        for i in range(npools, ndatasets):
+            parent = self.datasets[(i - npools) // fanout]
+            self.datasets.append('%s/fs%d' % (parent, i))
+        self.excluded = set(ds for ds in self.datasets
+                            if rnd.random() < 0.05)
+
+        # spread the snapshots round-robin over the datasets, oldest first
+        self.snapshots = []
+        for i in range(nsnapshots):
+            ds = self.datasets[i % len(self.datasets)]
+            n = i // len(self.datasets)
+            self.snapshots.append((ds, '%s_%s-2014-%02d-%02d-%02d00' % (
+                snapshot.PREFIX, LABELS[n % len(LABELS)], n // 672 % 12 + 1,
+                n // 24 % 28 + 1, n % 24)))
+
+    def userprop_rows(self):
+        """Rows of `zfs list -o name,com.sun:auto-snapshot,...:label`"""
+        return [[ds, 'false' if ds in self.excluded else 'true', '-']
+                for ds in sorted(self.datasets)]
+
+    def userprop_output(self):
+        return ''.join('\t'.join(row) + '\n' for row in self.userprop_rows())
+
+    def index_output(self, root):
+        """Output of the `zfs list -p` run by SnapshotIndex.load"""
+        prefix = root + '/'
+        lines = []
+        txg = 0
+        for ds in self.datasets:
+            if ds == root or ds.startswith(prefix):
+                txg += 1
+                lines.append('%s\tfilesystem\t%d\t%d\t%d\n' % (
+                    ds, txg, txg, 1400000000 + txg))
+        for ds, snapname in self.snapshots:
+            if ds == root or ds.startswith(prefix):
+                txg += 1
+                lines.append('%s@%s\tsnapshot\t%d\t%d\t%d\n' % (
+                    ds, snapname, txg, txg, 1400000000 + txg))
+        return ''.join(lines)
+
+class BenchZfsCommandRunner(util.ZfsCommandRunner):
+    """Answer zfs and zpool commands from a :py:class:`SyntheticTree`"""
+
+    def __init__(self, tree, syncing=(), pools=None):
+        super(BenchZfsCommandRunner, self).__init__()
+        self.tree = tree
+        self.syncing = set(syncing)
+        self.pools = tree.pools if pools is None else pools
+        self._outputs = {}
+
+    def prepare(self, roots=()):
+        """Generate the listings up front, so that the time taken to
+        generate them isn't counted in the benchmark
+
+        :param list roots: the datasets the snapshot index will load
+        """
+        self._output(('userprop',))
+        for root in roots:
+            self._output(('index', root))
+
+    def _output(self, key):
+        if key not in self._outputs:
+            if key[0] == 'index':
+                self._outputs[key] = self.tree.index_output(key[1])
+            else:
+                self._outputs[key] = self.tree.userprop_output()
+        return self._outputs[key]
+
+    def run_cmd(self, cmd, args, errorclass=None):
+        if cmd == 'zpool':
+            named = [a for a in args if a in self.pools]
+            pools = [p for p in self.pools if p in named or not named]
+            if 'status' in args:
+                return (''.join(self._pool_status(p) for p in pools), '', 0)
+            return (''.join('%s\t%d\tONLINE\t%d\t0\t%d\n' % (
+                p, i + 1, 1 << 40, 1 << 40) for i, p in enumerate(pools)),
+                    '', 0)
+        if 'list' in args:
+            columns = args[args.index('-o') + 1]
+            if columns == ','.join(INDEX_PROPERTIES):
+                return (self._output(('index', args[-1])), '', 0)
+            return (self._output(('userprop',)), '', 0)
+        raise ValueError('unexpected command %s %s' % (cmd, args))
+
+    def _pool_status(self, pool):
+        if pool in self.syncing:
+            scan = 'scrub in progress since Sun Nov 23'
+        else:
+            scan = 'none requested'
+        return '  pool: %s\n state: ONLINE\n  scan: %s\n\n' % (pool, scan)
+
+def _install_runner(runner):
+    util._LCR = runner
+
+def case_userprop_plan(size):
+    """get_userprop_datasets, including parsing the zfs list output"""
+    runner = BenchZfsCommandRunner(SyntheticTree(size))
+    runner.prepare()
+    _install_runner(runner)
+    return lambda: snapshot.get_userprop_datasets()
+
+def case_dataset_tree(size):
+    """DatasetTree on already parsed rows"""
+    rows = SyntheticTree(size).userprop_rows()
+    def run():
+        tree = snapshot.DatasetTree()
+        for row in rows:
+            tree.add(row[0], row[1] == 'false')
+        return tree.plan()
+    return run
+
+def case_narrow_recursive_filesystems(size):
+    """the legacy narrow_recursive_filesystems"""
+    tree = SyntheticTree(size)
+    candidates = [ds for ds in tree.datasets if ds not in tree.excluded]
+    return lambda: snapshot.narrow_recursive_filesystems(candidates)
+case_narrow_recursive_filesystems.legacy = True
+
+def case_can_recursive_snapshot(size):
+    """the legacy can_recursive_snapshot, for every dataset"""
+    tree = SyntheticTree(size)
+    excludes = sorted(tree.excluded)
+    return lambda: [snapshot.can_recursive_snapshot(ds, excludes)
+                    for ds in tree.datasets]
+case_can_recursive_snapshot.legacy = True
+
+def case_destroy_plan(size):
+    """indexing `size` snapshots and planning which to destroy"""
+    tree = SyntheticTree(max(1, size // SNAPSHOTS_PER_DATASET), size)
+    runner = BenchZfsCommandRunner(tree)
+    runner.prepare(tree.pools)
+    _install_runner(runner)
+    def run():
+        index = SnapshotIndex()
+        index.load(tree.pools)
+        return [snapshot.destroy_older_snapshots(ds, 5, 'hourly',
+                                                 dryrun=True, index=index)
+                for ds in tree.datasets]
+    return run
+
+def case_filter_syncing_pools(size):
+    """filter_syncing_pools over `size` filesystems on 100 pools"""
+    tree = SyntheticTree(size)
+    fsnames = ['pool%d/%s' % (i % 100, ds.split('/', 1)[-1])
+               for i, ds in enumerate(tree.datasets)]
+    _install_runner(BenchZfsCommandRunner(
+        tree, syncing=['pool%d' % i for i in range(0, 100, 7)],
+        pools=['pool%d' % i for i in range(100)]))
+    return lambda: snapshot.filter_syncing_pools(fsnames)
+
+def case_rolling_snapshot(size):
+    """RollingSnapshotter.take_snapshot('//') end to end, on a simulated
+    system holding `size` snapshots"""
+    tree = SyntheticTree(max(1, size // SNAPSHOTS_PER_DATASET))
+    fake = FakeZfsCommandRunner(seed=1)
+    for pool in tree.pools:
+        fake.add_pool(pool, props={snapshot.USERPROP_NAME: 'true'})
+    for ds in tree.datasets:
+        if ds not in tree.pools:
+            fake.add_dataset(ds, props={
+                snapshot.USERPROP_NAME:
+                    'false' if ds in tree.excluded else 'true'})
+    for pool in tree.pools:
+        fake.add_snapshots(pool, [
+            '%s_daily-2014-01-%02d-0000' % (snapshot.PREFIX, n + 1)
+            for n in range(SNAPSHOTS_PER_DATASET - 1)], recursive=True)
+    _install_runner(fake)
+    snapper = snapshot.RollingSnapshotter(label='daily', keep=10, jobs=4)
+    return lambda: snapper.take_snapshot('//')
+case_rolling_snapshot.repeat = 1
+
+CASES=[
+    ('userprop_plan', case_userprop_plan),
+    ('dataset_tree', case_dataset_tree),
+    ('narrow_recursive_filesystems', case_narrow_recursive_filesystems),
+    ('can_recursive_snapshot', case_can_recursive_snapshot),
+    ('destroy_plan', case_destroy_plan),
+    ('filter_syncing_pools', case_filter_syncing_pools),
+    ('rolling_snapshot', case_rolling_snapshot),
+]
+
+def _maxrss_kb():
+    """Peak resident set size of this process in kilobytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+def measure(case, size, repeat):
+    """Set up and time one case in this process
+
+    :return: the result record
+    :rtype: dict
+    """
+    run = case(size)
+    before = _maxrss_kb()
+    times = []
+    # cases that change their input can only be run once
+    repeat = min(repeat, getattr(case, 'repeat', repeat))
+    for n in range(repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    after = _maxrss_kb()
+    return {'seconds': min(times), 'times': times, 'maxrss_kb': after,
+            'rss_growth_kb': after - before}
+
+def measure_in_child(case, size, repeat):
+    """Run :py:func:`measure` in a forked child process
+
+    :return: the result record, or one with an "error" key if the child
+    failed
+    :rtype: dict
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            result = measure(case, size, repeat)
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        with os.fdopen(wfd, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+
+    os.close(wfd)
+    with os.fdopen(rfd) as f:
+        data = f.read()
+    pid, status = os.waitpid(pid, 0)
+    if not data:
+        return {'error': 'benchmark process exited with status %d' % status}
+    return json.loads(data)
+
+def main(args=None):
+    """Run the benchmarks and write the results as JSON lines"""
+    if args is None:
+        args = sys.argv
+
+    op = OptionParser(usage='usage: %prog [options]')
+    op.add_option('-s', '--sizes', dest='sizes',
+                  default=','.join(str(s) for s in SIZES),
+                  help='comma separated numbers of entries [%default]')
+    op.add_option('-c', '--cases', dest='cases',
+                  default=','.join(name for name, case in CASES),
+                  help='comma separated cases to run [%default]')
+    op.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                  help='times to run each case [%default]')
+    op.add_option('--legacy-max', dest='legacy_max', type='int',
+                  default=LEGACY_MAX,
+                  help='largest size to run the quadratic legacy functions '
+                       'with [%default]')
+    op.add_option('-o', '--output', dest='output',
+                  help='append the results to this file instead of stdout')
+    (options, args) = op.parse_args(args)
+
+    cases = dict(CASES)
+    names = options.cases.split(',')
+    for name in names:
+        if name not in cases:
+            op.error('Unknown case %s' % name)
+    try:
+        sizes = [int(s) for s in options.sizes.split(',')]
+    except ValueError:
+        op.error('Sizes must be numbers')
+    if options.repeat < 1:
+        op.error('repeat must be at least 1')
+
+    # The planning functions log at debug level; keep that out of the timings
+    logging.basicConfig(level=logging.WARNING)
+
+    out = open(options.output, 'a') if options.output else sys.stdout
+    failed = False
+    for name in names:
+        case = cases[name]
+        for size in sizes:
+            record = {'case': name, 'size': size,
+                      'python': platform.python_version()}
+            if getattr(case, 'legacy', False) and size > options.legacy_max:
+                record['skipped'] = True
+            else:
+                record.update(measure_in_child(case, size, options.repeat))
+                failed = failed or 'error' in record
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+            out.flush()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,5 +8,5 @@ setup(
     author_email = "geoff@ucsd.edu",
     license = "BSD",
     packages=['zfs',],
-    scripts=['zfsautosnap','zfspurgesnapshots'],
+    scripts=['zfsautosnap','zfspurgesnapshots','zfsbroker','zfsbuffer'],
 )
@@ -0,0 +1,91 @@
+from nose.tools import raises, assert_equal
+from zfs import *
+from zfs import asyncrunner
+
+def fake_runner(script, **kwargs):
+    """Return a local async runner that runs script with sh instead of zfs
+
+    The zfs command and its arguments are passed to the script as $0, $1..."""
+    return asyncrunner.AsyncLocalZfsCommandRunner(
+        command_prefix=['sh', '-c', script], **kwargs)
+
+def test_gather_zfs_list():
+    """test running several zfs list commands at once"""
+    runner = fake_runner('shift 4; printf "%s\\t0\\n" "$@"')
+    futures = [runner.zfs_list_async('tank/%d' % i) for i in range(5)]
+    r = runner.gather(futures)
+    assert_equal([list(x) for x in r],
+                 [[['tank/%d' % i, '0']] for i in range(5)])
+
+def test_max_concurrency():
+    """test that no more than max_concurrency commands run at once"""
+    runner = fake_runner('sleep 0.1', max_concurrency=2)
+    running = []
+    start_job = runner._start_job
+    def counting_start_job(*args):
+        running.append(len(runner._jobs) + 1)
+        return start_job(*args)
+    runner._start_job = counting_start_job
+    runner.gather([runner.zfs_create_async('tank/%d' % i) for i in range(5)])
+    assert_equal(len(running), 5)
+    assert_equal(max(running), 2)
+
+def test_errors():
+    """test that command errors are raised by the futures"""
+    runner = fake_runner(
+        'echo "cannot open \'tank\': dataset does not exist" >&2; exit 1')
+    r = runner.gather([runner.zfs_list_async('tank'),
+                       runner.zfs_snapshot_async('tank', 'foo')],
+                      return_exceptions=True)
+    assert isinstance(r[0], ZfsNoDatasetError)
+    assert isinstance(r[1], ZfsNoDatasetError)
+
+@raises(ZfsNoPoolError)
+def test_zpool_status_error():
+    """test zpool_status_async with a non existent pool name"""
+    runner = fake_runner('echo "cannot open \'failboat\': no such pool" >&2; '
+                         'exit 1')
+    runner.zpool_status_async('failboat').result()
+
+def test_blocking_interface():
+    """test that the blocking methods still work"""
+    runner = fake_runner('echo "tank	ONLINE"')
+    r = list(runner.zpool_list(properties=['name', 'health']))
+    assert_equal(r, [['tank', 'ONLINE']])
+
+def test_then():
+    """test chaining functions onto futures"""
+    runner = fake_runner('echo 21')
+    f = runner.submit('zfs', ['get']).then(lambda r: int(r[0]) * 2)
+    assert_equal(f.result(), 42)
+
+@raises(ZfsCommandNotFoundError)
+def test_command_not_found():
+    """test running a command that doesn't exist"""
+    runner = asyncrunner.AsyncLocalZfsCommandRunner(
+        command_prefix='/nonexistent/sudo')
+    runner.zfs_list_async().result()
+
+def test_zfs_create_many():
+    """test creating several filesystems at once"""
+    runner = fake_runner('echo "$@" >&2', max_concurrency=4)
+    created = runner.zfs_create_many(['tank/a', 'tank/a/b', 'tank/c'],
+                                     create_parents=True)
+    assert_equal(created, ['tank/a/b', 'tank/c'])
+
+@raises(ZfsDatasetExistsError)
+def test_zfs_create_many_error():
+    """test that a failed create is raised"""
+    runner = fake_runner(
+        'echo "cannot create \'tank/a\': dataset already exists" >&2; exit 1')
+    runner.zfs_create_many(['tank/a', 'tank/b'])
+
+def test_zfs_create_many_return_exceptions():
+    """test returning the error of each create"""
+    runner = fake_runner(
+        'case "$*" in *tank/a*) echo "cannot create \'tank/a\': '
+        'permission denied" >&2; exit 1;; esac')
+    r = runner.zfs_create_many(['tank/a', 'tank/b'], return_exceptions=True)
+    assert_equal([fs for fs, e in r], ['tank/a', 'tank/b'])
+    assert isinstance(r[0][1], ZfsPermissionError)
+    assert r[1][1] is None
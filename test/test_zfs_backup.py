@@ -0,0 +1,352 @@
+from zfs import *
+import paramiko
+import time
+import zfs.util
+import zfs.backup as zfsbackup
+from zfs.capabilities import CapabilityCache
+from zfs.fake import FakeZfsCommandRunner
+from zfs.index import SnapshotIndex
+from zfs.poolstate import PoolStateCache
+from zfs.workers import ReplicationJob
+from flexmock import flexmock
+from nose.tools import raises, assert_equal, with_setup
+
+_saved_runner = []
+
+def _use_fake():
+    """Make the local system a simulated one, with tank of guid 1234"""
+    fake = FakeZfsCommandRunner(seed=2)
+    fake.add_pool('tank', guid=1234)
+    fake.add_dataset('tank/foo')
+    fake.add_dataset('tank/bar/baz')
+    fake.add_snapshots('tank/foo', ['a', 'b', 'c'])
+    fake.add_snapshots('tank/bar', ['a', 'b'], recursive=True)
+    _saved_runner.append(zfs.util.set_default_runner(fake))
+
+def _restore_runner():
+    zfs.util.set_default_runner(_saved_runner.pop())
+
+def _backup(token=None):
+    """Return a backup whose remote side is a simulated system"""
+    flexmock(paramiko.SSHClient).should_receive('connect')
+    backup = zfsbackup.MbufferedSSHBackup(
+        label='daily', backup_host='backuphost', backup_dataset='zfsbackups',
+        backup_user='backup', buffer_size=None)
+    runner = FakeZfsCommandRunner(seed=1)
+    runner.add_pool('zfsbackups', guid=5678)
+    props = {}
+    if token is not None:
+        props['receive_resume_token'] = token
+    runner.add_dataset('zfsbackups/1234/tank/foo', props=props)
+    backup.runner = runner
+    backup.batch_runner = runner
+    backup.target_capabilities = CapabilityCache(runner)
+    return backup
+
+def test_resume_backup_nothing_to_resume():
+    """test that nothing is sent without a resume token"""
+    backup = _backup()
+    flexmock(backup).should_receive('_stream').never()
+    assert_equal(backup.resume_backup('zfsbackups/1234/tank/foo'), 0)
+
+def _valid_token(token):
+    flexmock(zfsbackup.util).should_receive('zfs_send_size')\
+            .with_args(None, resume_token=token).and_return(4096).once()
+
+def test_resume_backup():
+    """test resuming an interrupted send with its token"""
+    backup = _backup(token='1-abc-def')
+    _valid_token('1-abc-def')
+    flexmock(backup).should_receive('_stream')\
+            .with_args('zfsbackups/1234/tank/foo', resumable=True,
+                       snapshot=None, resume_token='1-abc-def')\
+            .and_return(4096).once()
+    assert_equal(backup.resume_backup('zfsbackups/1234/tank/foo'), 4096)
+
+def test_resume_backup_stale_token():
+    """test discarding the partial state when the send can't resume"""
+    backup = _backup(token='1-abc-def')
+    flexmock(zfsbackup.util).should_receive('zfs_send_size')\
+            .and_raise(ZfsUnknownError("cannot resume send: 'tank/foo@b' "
+                                       "used in the initial send no longer "
+                                       "exists"))
+    flexmock(backup).should_receive('_stream').never()
+    flexmock(backup.runner).should_receive('zfs_receive_abort')\
+            .with_args('zfsbackups/1234/tank/foo').once()
+    assert_equal(backup.resume_backup('zfsbackups/1234/tank/foo'), 0)
+
+@raises(ZfsReplicationError)
+def test_resume_backup_interrupted_again():
+    """test that the partial state is kept when the transfer breaks"""
+    backup = _backup(token='1-abc-def')
+    _valid_token('1-abc-def')
+    # the pipeline kills zfs send when the connection is lost
+    flexmock(backup).should_receive('_stream')\
+            .and_raise(ZfsReplicationError('lost', send_rc=-15,
+                                           recv_rc=None))
+    flexmock(backup.runner).should_receive('zfs_receive_abort').never()
+    backup.resume_backup('zfsbackups/1234/tank/foo')
+
+def test_send_backup_resumable():
+    """test that only non-recursive streams are received resumably"""
+    backup = _backup()
+    flexmock(backup).should_receive('_stream')\
+            .with_args('zfsbackups/1234/tank/foo', force=True,
+                       resumable=True, snapshot='tank/foo@b',
+                       incremental_source=None, recursive=False)\
+            .and_return(1).once()
+    flexmock(backup).should_receive('_stream')\
+            .with_args('zfsbackups/1234/tank/foo', force=False,
+                       resumable=False, snapshot='tank/foo@b',
+                       incremental_source='@a', recursive=True)\
+            .and_return(1).once()
+    backup.send_backup('tank/foo@b', 'zfsbackups/1234/tank/foo')
+    backup.send_backup('tank/foo@b', 'zfsbackups/1234/tank/foo',
+                       incremental_source='@a', recursive=True)
+
+def test_send_backup_format():
+    """test that the stream format options reach zfs send"""
+    backup = _backup()
+    flexmock(backup).should_receive('_stream')\
+            .with_args('zfsbackups/1234/tank/foo', force=True,
+                       resumable=True, snapshot='tank/foo@b',
+                       incremental_source=None, recursive=False,
+                       compressed=True, large_blocks=True)\
+            .and_return(1).once()
+    backup.send_backup('tank/foo@b', 'zfsbackups/1234/tank/foo',
+                       send_options={'compressed': True,
+                                     'large_blocks': True})
+
+def test_take_backup_largest_first():
+    """test that the planned sends are run largest first"""
+    backup = _backup()
+    sizes = {'tank/a': 10, 'tank/b': None, 'tank/c': 5000}
+    flexmock(backup).should_receive('plan_backup').replace_with(
+        lambda fs, recursive, index, pools, replicas:
+        ReplicationJob(fs, sizes[fs], plan=flexmock(
+            remote_backup_path='zfsbackups/1234/' + fs)))
+    flexmock(backup).should_receive('remote_base_path')\
+            .and_return('zfsbackups/1234')
+    sent = []
+    flexmock(backup).should_receive('run_backup').replace_with(
+        lambda job, index, pools: sent.append(job.dataset) or job.size)
+    index = flexmock(load_pools=lambda fsnames: True)
+    r = backup.take_backup(['tank/a', 'tank/b', 'tank/c'], index=index,
+                           pools=object())
+    assert_equal(sent, ['tank/c', 'tank/a', 'tank/b'])
+    assert_equal([(x.dataset, x.result) for x in r],
+                 [('tank/a', 10), ('tank/b', None), ('tank/c', 5000)])
+    assert_equal(backup.metrics.get('datasets_processed'), 3)
+    assert_equal(backup.metrics.get('bytes_planned'), 5010)
+
+def test_estimate_send_size():
+    """test sizing a send with a dry run in its stream format"""
+    backup = _backup()
+    flexmock(zfsbackup.util).should_receive('zfs_send_size')\
+            .with_args('tank/foo@b', '@a', False, compressed=True)\
+            .and_return(4096).once()
+    assert_equal(backup.estimate_send_size('tank/foo@b', '@a',
+                                           send_options={'compressed': True}),
+                 4096)
+
+def test_estimate_send_size_failed():
+    """test that a failed dry run leaves the size unknown"""
+    backup = _backup()
+    flexmock(zfsbackup.util).should_receive('zfs_send_size')\
+            .and_raise(ZfsNoDatasetError(2, 'gone', 'tank/foo@b'))
+    assert backup.estimate_send_size('tank/foo@b') is None
+
+@with_setup(_use_fake, _restore_runner)
+def test_take_backup_planning():
+    """test planning from one listing per side and creating in one batch"""
+    backup = _backup()
+    remote = backup.runner
+    remote.add_snapshots('zfsbackups/1234/tank/foo', ['a', 'b'],
+                         guids=zfs.util._LCR.snapshot_guids('tank/foo')[:2])
+    sent = []
+    flexmock(backup).should_receive('run_backup').replace_with(
+        lambda job, index, pools: sent.append(job.plan) or 0)
+    flexmock(remote).should_receive('zfs_receive_resume_token').never()
+    flexmock(remote).should_receive('zfs_create').never()
+    flexmock(remote).should_receive('zfs_create_many')\
+            .with_args(['zfsbackups/1234/tank/bar'], create_parents=True,
+                       return_exceptions=True)\
+            .and_return([('zfsbackups/1234/tank/bar', None)]).once()
+    remote.commands = 0
+    backup.take_backup(['tank/foo', 'tank/bar'], snap_children=False,
+                       index=SnapshotIndex(), pools=PoolStateCache())
+    plans = dict((p.fs, p) for p in sent)
+    assert_equal(plans['tank/foo'].incremental_source, '@b')
+    assert_equal(plans['tank/foo'].snapshot, 'tank/foo@c')
+    assert_equal(plans['tank/foo'].remote_backup_path,
+                 'zfsbackups/1234/tank/foo')
+    assert plans['tank/bar'].incremental_source is None
+    # the capability probe, and one listing of zfsbackups/1234
+    assert_equal(remote.commands, 3)
+
+@with_setup(_use_fake, _restore_runner)
+def test_take_backup_create_failed():
+    """test that only the dataset whose remote filesystem failed to be
+    created is skipped"""
+    zfs.util._LCR.add_dataset('tank/qux')
+    zfs.util._LCR.add_snapshots('tank/qux', ['a'])
+    backup = _backup()
+    remote = backup.runner
+    error = ZfsPermissionError(1, 'permission denied',
+                               'zfsbackups/1234/tank/bar')
+    def zfs_create(fs, create_parents=False):
+        if fs == 'zfsbackups/1234/tank/bar':
+            raise error
+        remote.add_dataset(fs)
+    flexmock(remote).should_receive('zfs_create').replace_with(zfs_create)
+    sent = []
+    flexmock(backup).should_receive('run_backup').replace_with(
+        lambda job, index, pools: sent.append(job.dataset) or 0)
+    r = backup.take_backup(['tank/foo', 'tank/bar', 'tank/qux'],
+                           snap_children=False, index=SnapshotIndex(),
+                           pools=PoolStateCache())
+    assert_equal(sorted(sent), ['tank/foo', 'tank/qux'])
+    assert_equal([(x.dataset, x.error) for x in r],
+                 [('tank/foo', None), ('tank/bar', error), ('tank/qux', None)])
+    assert_equal(backup.metrics.get('dataset_failures'), 1)
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_resume_token():
+    """test that the resume token comes from the remote listing"""
+    backup = _backup(token='1-abc-def')
+    job = backup.plan_backup('tank/foo', False, SnapshotIndex(),
+                             PoolStateCache())
+    assert_equal(job.plan.resume_token, '1-abc-def')
+    assert job.plan.incremental_source is None
+
+def _remote_copy(backup, snapnames, guids):
+    backup.runner.add_snapshots('zfsbackups/1234/tank/foo', snapnames,
+                                guids=guids)
+    return backup.plan_backup('tank/foo', False, SnapshotIndex(),
+                              PoolStateCache())
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_common_snapshot_by_guid():
+    """test that a renamed snapshot is still used as the incremental base"""
+    backup = _backup()
+    guids = zfs.util._LCR.snapshot_guids('tank/foo')
+    job = _remote_copy(backup, ['renamed'], guids[1:2])
+    assert_equal(job.plan.incremental_source, '@b')
+    assert not job.plan.rollback
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_rollback():
+    """test rolling back remote snapshots the local side doesn't have"""
+    backup = _backup()
+    guids = zfs.util._LCR.snapshot_guids('tank/foo')
+    job = _remote_copy(backup, ['a', 'gone'], [guids[0], 99])
+    assert_equal(job.plan.incremental_source, '@a')
+    assert job.plan.rollback
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_up_to_date():
+    """test that nothing is sent when the newest snapshot is on both sides"""
+    backup = _backup()
+    guids = zfs.util._LCR.snapshot_guids('tank/foo')
+    assert _remote_copy(backup, ['a', 'b', 'c'], guids) is None
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_nothing_in_common():
+    """test that a target with no snapshot in common isn't sent to"""
+    backup = _backup()
+    flexmock(backup).should_receive('estimate_send_size').never()
+    assert _remote_copy(backup, ['x', 'y'], [98, 99]) is None
+    assert_equal(backup.metrics.get('dataset_failures'), 1)
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_intermediates():
+    """test sending every newer snapshot in one -I stream"""
+    backup = _backup()
+    guids = zfs.util._LCR.snapshot_guids('tank/foo')
+    job = _remote_copy(backup, ['a'], guids[:1])
+    assert_equal((job.plan.incremental_source, job.plan.snapshot),
+                 ('@a', 'tank/foo@c'))
+    assert job.plan.send_options['intermediates']
+    assert_equal(job.plan.steps, ())
+    # two transaction groups of the simulated dry run
+    assert_equal(job.size, 8192)
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_label_history():
+    """test sending only the snapshots of the backup's label, in turn"""
+    zfs.util._LCR.add_snapshots('tank/foo', [
+        'zfs-auto-snap_daily-2014-11-20-0000',
+        'zfs-auto-snap_hourly-2014-11-20-0100',
+        'zfs-auto-snap_daily-2014-11-21-0000'])
+    backup = _backup()
+    backup.history = 'label'
+    guids = zfs.util._LCR.snapshot_guids('tank/foo')
+    job = _remote_copy(backup, ['a', 'b', 'c'], guids[:3])
+    assert_equal(job.plan.incremental_source, '@c')
+    assert_equal(job.plan.steps,
+                 ('tank/foo@zfs-auto-snap_daily-2014-11-20-0000',))
+    assert_equal(job.plan.snapshot,
+                 'tank/foo@zfs-auto-snap_daily-2014-11-21-0000')
+    assert 'intermediates' not in job.plan.send_options
+    assert_equal(job.size,
+                 zfs.util.zfs_send_size(job.plan.steps[0], '@c') +
+                 zfs.util.zfs_send_size(job.plan.snapshot,
+                                        '@zfs-auto-snap_daily-2014-11-20-0000'))
+
+@with_setup(_use_fake, _restore_runner)
+def test_plan_backup_label_none():
+    """test that a filesystem without snapshots of the label is skipped"""
+    backup = _backup()
+    backup.history = 'label'
+    assert backup.plan_backup('tank/foo', False, SnapshotIndex(),
+                              PoolStateCache()) is None
+
+def test_run_backup_steps():
+    """test sending each step from the one before, rolling back once"""
+    backup = _backup()
+    plan = zfsbackup.BackupPlan(
+        'tank/foo', 'tank/foo@d', '@a', 'zfsbackups/1234/tank/foo', False,
+        None, None, {}, True, ('tank/foo@b', 'tank/foo@c'))
+    sent = []
+    flexmock(backup).should_receive('send_backup').replace_with(
+        lambda snapshot, incremental_source, rollback, **kwargs:
+        sent.append((snapshot, incremental_source, rollback)) or 10)
+    assert_equal(backup.run_backup(ReplicationJob('tank/foo', plan=plan),
+                                   None, None), 30)
+    assert_equal(sent, [('tank/foo@b', '@a', True),
+                        ('tank/foo@c', '@b', False),
+                        ('tank/foo@d', '@c', False)])
+
+@raises(ValueError)
+def test_bad_history():
+    """test that an unknown history mode is refused"""
+    flexmock(paramiko.SSHClient).should_receive('connect')
+    zfsbackup.MbufferedSSHBackup(
+        label='daily', backup_host='backuphost', backup_dataset='zfsbackups',
+        backup_user='backup', history='some')
+
+@with_setup(_use_fake, _restore_runner)
+def test_replication_lag():
+    """test that the lag is reported when planning, and after a send"""
+    backup = _backup()
+    local = zfs.util._LCR
+    guids = local.snapshot_guids('tank/foo')
+    now = int(time.time())
+    local.add_snapshots('tank/foo', ['d'], creation=now - 60)
+    # the newest snapshot the target has is c, made by _use_fake just now
+    job = _remote_copy(backup, ['a', 'b', 'c'], guids)
+    lag = backup.metrics.get('replication_lag_seconds', dataset='tank/foo')
+    assert 0 <= lag < 60
+    flexmock(backup).should_receive('send_backup').and_return(10)
+    backup.run_backup(job, None, None)
+    lag = backup.metrics.get('replication_lag_seconds', dataset='tank/foo')
+    assert lag >= 60
+
+@with_setup(_use_fake, _restore_runner)
+def test_replication_lag_up_to_date():
+    """test that an up to date dataset still has its lag reported"""
+    backup = _backup()
+    guids = zfs.util._LCR.snapshot_guids('tank/foo')
+    assert _remote_copy(backup, ['a', 'b', 'c'], guids) is None
+    assert backup.metrics.get('replication_lag_seconds',
+                              dataset='tank/foo') is not None
@@ -0,0 +1,157 @@
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import zfs.util
+from zfs import *
+from zfs.broker import ZfsBroker, BrokerZfsCommandRunner, check_command, \
+        using_broker
+from zfs.fake import FakeZfsCommandRunner
+from flexmock import flexmock
+from nose.tools import raises, assert_equal, with_setup
+
+_state = {}
+
+def _start_broker(**kwargs):
+    backend = FakeZfsCommandRunner(seed=1, clock=lambda: 1416355200)
+    backend.add_pool('tank', guid=1234)
+    backend.add_dataset('tank/foo')
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'broker.sock')
+    broker = ZfsBroker(path, runner=backend, **kwargs)
+    thread = threading.Thread(target=broker.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _state.update(backend=backend, broker=broker, path=path, tmpdir=tmpdir,
+                  thread=thread)
+
+def _stop_broker():
+    _state['broker'].shutdown()
+    _state['thread'].join()
+    shutil.rmtree(_state['tmpdir'])
+    _state.clear()
+
+@with_setup(_start_broker, _stop_broker)
+def test_broker_list():
+    """test listing datasets through the broker"""
+    runner = BrokerZfsCommandRunner(_state['path'])
+    r = list(runner.zfs_list(properties=['name'], datasets='tank',
+                             recursive=True))
+    assert_equal(r, [['tank'], ['tank/foo']])
+    assert_equal(list(runner.zpool_list(properties=['name', 'guid'])),
+                 [['tank', '1234']])
+    runner.close()
+
+@with_setup(_start_broker, _stop_broker)
+def test_broker_socket_mode():
+    """test that the socket is only open to its owner and group"""
+    mode = os.stat(_state['path']).st_mode
+    assert stat.S_ISSOCK(mode)
+    assert_equal(stat.S_IMODE(mode), 0660)
+
+@with_setup(_start_broker, _stop_broker)
+def test_broker_pipelined():
+    """test sending several commands before reading any responses"""
+    runner = BrokerZfsCommandRunner(_state['path'])
+    r = runner.run_cmds([
+        ('zfs', ['snapshot', 'tank/foo@a'], ZfsCommandNotFoundError),
+        ('zfs', ['list', '-H', '-o', 'name', '-t', 'snapshot'],
+         ZfsCommandNotFoundError),
+        ('zfs', ['list', '-H', 'tank/nonexistent'], ZfsCommandNotFoundError),
+    ])
+    assert_equal([rc for out,err,rc in r], [0, 0, 1])
+    assert_equal(r[1][0], 'tank/foo@a\n')
+    runner.close()
+
+@with_setup(_start_broker, _stop_broker)
+def test_broker_destroy_pipelined():
+    """test sending the batches of a destroy in one round trip"""
+    runner = BrokerZfsCommandRunner(_state['path'])
+    runner.zfs_snapshot('tank/foo', 'a')
+    runner.zfs_snapshot('tank/foo', 'b')
+    runner.zfs_snapshot('tank/foo', 'c')
+    # room for one snapshot per command
+    flexmock(runner).should_receive('max_args_len')\
+            .and_return(64 + len('tank/foo@a'))
+    flexmock(runner).should_call('run_cmds').once()
+    assert_equal(runner.zfs_destroy_snapshots('tank/foo', ['a', 'b', 'nope']),
+                 ['tank/foo@a', 'tank/foo@b'])
+    assert_equal(sorted(_state['backend']._datasets['tank/foo'].snapshots),
+                 ['c'])
+    runner.close()
+
+@with_setup(_start_broker, _stop_broker)
+@raises(ZfsBrokerError)
+def test_broker_refused_subcommand():
+    """test that subcommands outside the whitelist are refused"""
+    runner = BrokerZfsCommandRunner(_state['path'])
+    runner.run_cmd('zfs', ['rollback', 'tank/foo@a'])
+
+@with_setup(_start_broker, _stop_broker)
+def test_broker_refused_destroy():
+    """test that only snapshots may be destroyed"""
+    runner = BrokerZfsCommandRunner(_state['path'])
+    try:
+        runner.run_cmd('zfs', ['destroy', '-r', 'tank/foo'])
+    except ZfsBrokerError:
+        pass
+    else:
+        raise AssertionError('destroying a filesystem was not refused')
+    # the connection is still usable after a refusal
+    assert_equal(runner.run_cmd('zfs', ['list', '-H', '-o', 'name',
+                                        'tank/foo'])[0], 'tank/foo\n')
+    runner.close()
+
+@with_setup(_start_broker, _stop_broker)
+def test_using_broker():
+    """test running the functional methods through the broker"""
+    previous = zfs.util._LCR
+    with using_broker(_state['path']):
+        assert_equal(zfs.util._LCR.runner_type, 'broker')
+        assert_equal(zfs.util.get_pool_guid('tank'), '1234')
+    assert zfs.util._LCR is previous
+
+@raises(ZfsBrokerError)
+def test_broker_not_running():
+    """test connecting to a broker that isn't there"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        BrokerZfsCommandRunner(os.path.join(tmpdir, 'nothere')).run_cmd(
+            'zfs', ['list'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+@raises(ZfsBrokerError)
+def test_broker_refuses_non_socket():
+    """test that the broker won't replace a file that isn't a socket"""
+    f = tempfile.NamedTemporaryFile()
+    ZfsBroker(f.name, runner=FakeZfsCommandRunner())
+
+def test_check_command():
+    """test the command whitelist"""
+    check_command('zfs', ['destroy', '-r', 'tank/foo@a'])
+    check_command('zfs', ['destroy', 'tank/foo'], destroy_snapshots_only=False)
+    check_command('zfs', ['list', '-Hp', '-o', 'name,guid', '-t', 'snapshot',
+                          '-d1', '-s', 'createtxg', 'tank'])
+    check_command('zpool', ['list', '-H', '-o', 'name,guid'])
+    for cmd, args in [('zfs', []), ('zfs', 'list'), ('rm', ['-rf', '/']),
+                      ('zpool', ['destroy', 'tank']),
+                      ('zfs', ['list', 'tank\0']),
+                      ('zfs', ['create', '-o', 'mountpoint=/etc', 'tank/x']),
+                      ('zfs', ['create', 'tank/x']),
+                      ('zfs', ['destroy', '-R', 'tank/fs@s']),
+                      ('zfs', ['destroy', '-rf', 'tank/fs@s']),
+                      ('zfs', ['destroy', 'tank/fs@s', '-R']),
+                      ('zfs', ['destroy', '--', '-R', 'tank/fs@s']),
+                      ('zfs', ['snapshot', '-o', 'mountpoint=/etc',
+                               'tank/fs@s']),
+                      ('zfs', ['list', '-o', 'name', '-x', 'tank']),
+                      ('zfs', ['get', 'all', 'tank'])]:
+        try:
+            check_command(cmd, args)
+        except ZfsBrokerError:
+            pass
+        else:
+            raise AssertionError('%s %r was permitted' % (cmd, args))
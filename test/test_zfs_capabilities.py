@@ -0,0 +1,64 @@
+from zfs import *
+from zfs.capabilities import CapabilityCache, send_options
+from zfs.fake import FakeZfsCommandRunner
+from zfs.util import parse_usage_flags
+from nose.tools import assert_equal
+
+# The zfs send usage of ZFS on Linux 0.6, before -L, -e and -c
+OLD_USAGE = ('missing snapshot argument\n'
+             'usage:\n'
+             '\tsend [-DnPpRv] [-[iI] snapshot] <snapshot>\n')
+
+def _system(pool, usage=None, **features):
+    runner = FakeZfsCommandRunner(seed=1)
+    if usage is not None:
+        runner.send_usage = usage
+    runner.add_pool(pool, features=features)
+    return CapabilityCache(runner)
+
+def test_parse_usage_flags():
+    """test reading the options from the usage of zfs send"""
+    assert_equal(parse_usage_flags(FakeZfsCommandRunner.SEND_USAGE, 'send'),
+                 frozenset('DnPpRvLecwhb'))
+    assert_equal(parse_usage_flags(OLD_USAGE, 'send'), frozenset('DnPpRv'))
+    assert_equal(parse_usage_flags(OLD_USAGE, 'receive'), frozenset())
+
+def test_probe():
+    """test probing the send options and pool features once"""
+    source = _system('tank', encryption='disabled')
+    caps = source.get()
+    assert 'c' in caps.send_flags
+    assert_equal(caps.pool_features['tank'],
+                 frozenset(['large_blocks', 'embedded_data', 'lz4_compress']))
+    commands = source.runner.commands
+    assert source.get() is caps
+    assert_equal(source.runner.commands, commands)
+
+def test_send_options():
+    """test that every option both systems support is used"""
+    assert_equal(send_options(_system('tank'), _system('backup'), 'tank',
+                              'backup'),
+                 {'large_blocks': True, 'embed_data': True,
+                  'compressed': True})
+
+def test_send_options_old_target():
+    """test that an older receiving system gets a plain stream"""
+    assert_equal(send_options(_system('tank'),
+                              _system('backup', usage=OLD_USAGE), 'tank',
+                              'backup'), {})
+
+def test_send_options_target_features():
+    """test that options are dropped when the target pool lacks features"""
+    target = _system('backup', large_blocks='disabled')
+    assert_equal(send_options(_system('tank'), target, 'tank', 'backup'),
+                 {'embed_data': True, 'compressed': True})
+
+def test_send_options_raw():
+    """test that raw streams are only sent when asked for and supported"""
+    assert_equal(send_options(_system('tank'), _system('backup'), 'tank',
+                              'backup', raw=True), {'raw': True})
+    target = _system('backup', encryption='disabled')
+    assert_equal(send_options(_system('tank'), target, 'tank', 'backup',
+                              raw=True),
+                 {'large_blocks': True, 'embed_data': True,
+                  'compressed': True})
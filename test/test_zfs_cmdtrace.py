@@ -0,0 +1,146 @@
+import json
+import tempfile
+from StringIO import StringIO
+from nose.tools import assert_equal
+from zfs import *
+from zfs import asyncrunner
+from zfs.fake import FakeZfsCommandRunner
+from zfs.cmdtrace import MemoryTracer, JsonLinesTracer, HistogramTracer, \
+        CommandTrace, tracing
+from zfs.util import LocalZfsCommandRunner
+
+def _runner(**kwargs):
+    runner = FakeZfsCommandRunner(seed=1, **kwargs)
+    runner.add_pool('tank')
+    runner.add_dataset('tank/foo')
+    return runner
+
+def test_memory_tracer():
+    """test per-command totals"""
+    mem = MemoryTracer(keep=10)
+    runner = _runner(tracers=[mem])
+    runner.zfs_snapshot('tank/foo', 'a')
+    list(runner.zfs_list(datasets='tank', recursive=True))
+    rows = list(runner.zfs_list(datasets='tank', types=['snapshot'],
+                                recursive=True, stream=True))
+    try:
+        runner.zfs_snapshot('tank/foo', 'a')
+    except ZfsDatasetExistsError:
+        pass
+
+    assert_equal(sorted(mem.totals), [('fake', 'zfs list'),
+                                      ('fake', 'zfs snapshot')])
+    snap = mem.totals[('fake', 'zfs snapshot')]
+    assert_equal((snap['count'], snap['failures']), (2, 1))
+    assert snap['err_bytes'] > 0
+    assert_equal(mem.totals[('fake', 'zfs list')]['count'], 2)
+
+    t = mem.traces[2]
+    assert t.streamed
+    assert_equal((t.cmd, t.subcommand, t.rc), ('zfs', 'list', 0))
+    assert_equal(t.out_bytes, len('\t'.join(rows[0]) + '\n'))
+    assert t.spawn is not None and t.spawn <= t.wall
+
+def test_no_tracers():
+    """test that commands run as before without tracers"""
+    runner = _runner()
+    mem = MemoryTracer()
+    runner.add_tracer(mem)
+    runner.remove_tracer(mem)
+    runner.zfs_snapshot('tank/foo', 'a')
+    assert_equal(mem.totals, {})
+
+def test_stream_stopped_early():
+    """test tracing a streamed command whose output isn't all read"""
+    mem = MemoryTracer(keep=1)
+    runner = _runner(tracers=[mem])
+    rows = runner.zfs_list(datasets='tank', recursive=True, stream=True)
+    row = rows.next()
+    del rows
+    t = mem.traces[0]
+    assert_equal(t.rc, None)
+    assert_equal(t.out_bytes, len('\t'.join(row) + '\n'))
+
+def test_local_command_not_found():
+    """test tracing a command that couldn't be started"""
+    mem = MemoryTracer(keep=1)
+    runner = LocalZfsCommandRunner(
+        command_prefix='/nonexistent/pyzfsautosnap', tracers=[mem])
+    try:
+        runner.zfs_list()
+    except ZfsCommandNotFoundError:
+        pass
+    t = mem.traces[0]
+    assert_equal((t.runner, t.error, t.rc, t.spawn),
+                 ('local', 'ZfsCommandNotFoundError', None, None))
+
+def test_async_runner():
+    """test tracing the commands run by the event loop"""
+    mem = MemoryTracer(keep=10)
+    runner = asyncrunner.AsyncLocalZfsCommandRunner(
+        command_prefix=['sh', '-c', 'echo "$1"'], tracers=[mem])
+    runner.gather([runner.zfs_create_async('tank/%d' % i) for i in range(3)])
+    runner.zfs_create('tank/3')
+    assert_equal(len(mem.traces), 4)
+    for t in mem.traces:
+        assert_equal((t.runner, t.command, t.nargs, t.rc, t.out_bytes),
+                     ('local', 'zfs create', 1, 0, len('create\n')))
+        assert t.spawn is not None
+
+def test_json_lines_tracer():
+    """test writing traces as JSON lines"""
+    f = StringIO()
+    runner = _runner(tracers=[JsonLinesTracer(f)])
+    runner.zfs_create('tank/bar')
+    r = json.loads(f.getvalue())
+    assert_equal((r['runner'], r['cmd'], r['subcommand'], r['nargs'], r['rc']),
+                 ('fake', 'zfs', 'create', 1, 0))
+
+def test_histogram_tracer():
+    """test bucketing wall times"""
+    hist = HistogramTracer()
+    for wall in (0.0005, 0.001, 0.003, 0.003, 0.1):
+        t = CommandTrace('local', 'zfs', ['zfs', 'list', '-H'], 0)
+        t.wall = wall
+        t.rc = 0
+        hist.record(t)
+    assert_equal(hist.buckets[('local', 'zfs list')],
+                 {1: 2, 4: 2, 128: 1})
+    lines = hist.summary().splitlines()
+    assert lines[0].startswith('local zfs list: 5 commands')
+    assert_equal(len(lines), 4)
+
+def test_broken_tracer():
+    """test that a failing tracer doesn't stop the command"""
+    class Broken(object):
+        def record(self, trace):
+            raise RuntimeError('broken')
+    runner = _runner(tracers=[Broken()])
+    runner.zfs_create('tank/bar')
+    assert_equal([r[0] for r in runner.zfs_list(datasets='tank/bar')],
+                 ['tank/bar'])
+
+def test_trace_baseline():
+    """test tracing the cost of starting a command"""
+    mem = MemoryTracer(keep=1)
+    runner = LocalZfsCommandRunner(tracers=[mem])
+    runner.trace_baseline()
+    t = mem.traces[0]
+    assert_equal((t.runner, t.command, t.rc), ('local', 'true', 0))
+    assert t.spawn <= t.wall
+
+def test_tracing():
+    """test that tracing records the baseline before the commands"""
+    f = tempfile.NamedTemporaryFile()
+    runner = LocalZfsCommandRunner(command_prefix=['sh', '-c', 'echo "$1"'])
+    with tracing(f.name, runner):
+        runner.zfs_list()
+    assert_equal(runner.tracers, [])
+    commands = [json.loads(line)['subcommand'] for line in open(f.name)]
+    assert_equal(commands, ['', 'list'])
+
+def test_fake_baseline():
+    """test that simulated commands have no baseline"""
+    mem = MemoryTracer(keep=1)
+    _runner(tracers=[mem]).trace_baseline()
+    assert_equal(mem.totals, {})
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import zfs.zfsbuffer
+from zfs.compress import CODECS, Compression, CompressingWriter, \
+        CompressionStats, DecompressingWriter, parse_compression
+from nose.tools import raises, assert_equal
+
+def _data(n):
+    """Return n bytes that compress well but not trivially"""
+    words = [os.urandom(8).encode('hex') for i in range(64)]
+    data = ' '.join(words[ord(c) % 64] for c in os.urandom(n // 16 + 1))
+    return data[:n]
+
+def _compress(data, codec='zlib', threads=4, block_size=4096, chunk=1000):
+    out = []
+    writer = CompressingWriter(lambda v: out.append(v.tobytes()) or len(v),
+                               codec, threads=threads, block_size=block_size)
+    for off in range(0, len(data), chunk):
+        writer.write(memoryview(data[off:off + chunk]))
+    writer.close()
+    return ''.join(out), writer.stats
+
+def _decompress(stream, threads=4, chunk=777):
+    out = []
+    writer = DecompressingWriter(lambda v: out.append(v.tobytes()) or len(v),
+                                 threads)
+    for off in range(0, len(stream), chunk):
+        writer.write(stream[off:off + chunk])
+    writer.close()
+    return ''.join(out), writer.stats
+
+def test_round_trip():
+    """test compressing and decompressing with every codec installed"""
+    data = _data(100003)
+    for codec in CODECS:
+        stream, stats = _compress(data, codec)
+        assert len(stream) < len(data)
+        assert_equal(stats.raw_bytes, len(data))
+        assert_equal(stats.compressed_bytes, len(stream))
+        assert_equal(stats.blocks, 25)
+        assert stats.ratio() > 1
+        out, dstats = _decompress(stream)
+        assert out == data, 'round trip failed for %s' % codec
+        assert_equal(dstats.codec, codec)
+        assert_equal(dstats.raw_bytes, len(data))
+
+def test_round_trip_single_thread():
+    """test that block order is kept with one thread or many"""
+    data = _data(50000)
+    assert _decompress(_compress(data, threads=1)[0], threads=1)[0] == data
+    assert _decompress(_compress(data, threads=8)[0], threads=8)[0] == data
+
+def test_incompressible():
+    """test that blocks which don't compress are stored as they are"""
+    data = os.urandom(20000)
+    stream, stats = _compress(data)
+    # a header, 5 frame headers and an end frame
+    assert_equal(len(stream), len(data) + 6 + 5 * 9 + 9)
+    assert _decompress(stream)[0] == data
+
+def test_empty():
+    """test an empty stream"""
+    stream, stats = _compress('')
+    assert_equal(stats.blocks, 0)
+    assert_equal(_decompress(stream)[0], '')
+
+@raises(ValueError)
+def test_truncated():
+    """test that a stream missing its end is detected"""
+    stream, stats = _compress(_data(10000))
+    _decompress(stream[:-9])
+
+@raises(ValueError)
+def test_not_compressed():
+    """test that an uncompressed stream is refused"""
+    _decompress('x' * 100)
+
+@raises(ValueError)
+def test_corrupt():
+    """test that a damaged block is detected"""
+    stream, stats = _compress(_data(10000))
+    stream = stream[:20] + 'garbage' + stream[27:]
+    _decompress(stream)
+
+def test_parse_compression():
+    """test parsing the codec and level"""
+    assert_equal(parse_compression('zlib'), ('zlib', None))
+    assert_equal(parse_compression('bz2:3'), ('bz2', 3))
+    for text in ('rot13', 'zlib:x', 'zlib:42'):
+        try:
+            parse_compression(text)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('%r was parsed' % text)
+
+def test_compression_stats():
+    """test that the statistics of several streams are added up"""
+    compression = Compression('zlib', level=1, threads=2, block_size=4096)
+    data = _data(10000)
+    for n in range(2):
+        writer = compression.writer(lambda v: len(v))
+        writer.write(data)
+        writer.close()
+    assert_equal(compression.stats.raw_bytes, 20000)
+    assert_equal(compression.stats.blocks, 6)
+    assert_equal(compression.stats.level, 1)
+    assert 'zlib:1' in compression.stats.summary()
+    assert_equal(compression.stats.as_dict()['raw_bytes'], 20000)
+
+def test_compression_stats_concurrent():
+    """test that streams running at the same time share their wall time"""
+    total = CompressionStats('zlib', 1)
+    for start, end in ((100, 110), (105, 120), (130, 140)):
+        stream = CompressionStats('zlib', 1)
+        stream.raw_bytes = 1000
+        stream.add_span(start, end)
+        total.add(stream)
+    assert_equal(total.wall_time, 30)
+    assert_equal(total.throughput(), 100)
+
+def test_zfsbuffer_decompress():
+    """test the zfsbuffer command decompressing a stream without a buffer"""
+    data = _data(100000)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, 'in'), 'wb') as f:
+            f.write(_compress(data)[0])
+        stdin = open(os.path.join(tmpdir, 'in'), 'rb')
+        stdout = open(os.path.join(tmpdir, 'out'), 'wb')
+        class Options(object):
+            verbose = False
+            size = 0
+            block_size = 4096
+            decompress = True
+            threads = 2
+        ret = zfs.zfsbuffer.App(Options()).run(stdin, stdout)
+        stdout.close()
+        assert_equal(ret, 0)
+        with open(os.path.join(tmpdir, 'out'), 'rb') as f:
+            assert f.read() == data
+    finally:
+        shutil.rmtree(tmpdir)
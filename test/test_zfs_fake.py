@@ -0,0 +1,186 @@
+import time
+import threading
+import zfs.util
+import zfs.fake
+import zfs.snapshot as zfssnapshot
+from zfs import *
+from zfs.fake import FakeZfsCommandRunner
+from nose.tools import raises, assert_equal, with_setup
+
+def _runner(**kwargs):
+    runner = FakeZfsCommandRunner(seed=1, clock=lambda: 1416355200, **kwargs)
+    runner.add_pool('tank', guid=1234)
+    runner.add_dataset('tank/foo/bar',
+                       props={'com.sun:auto-snapshot': 'true'})
+    runner.add_dataset('tank/baz')
+    return runner
+
+def test_zfs_list():
+    """test listing the simulated datasets"""
+    runner = _runner()
+    r = list(runner.zfs_list(properties=['name', 'com.sun:auto-snapshot'],
+                             datasets='tank', recursive=True))
+    assert_equal(r, [['tank', '-'], ['tank/baz', '-'], ['tank/foo', '-'],
+                     ['tank/foo/bar', 'true']])
+    r = list(runner.zfs_list(datasets='tank/foo'))
+    assert_equal(r, [['tank/foo', '96K', '1024G', '96K', '/tank/foo']])
+    assert_equal(zfs.fake._human_size(1536), '1.50K')
+
+def test_zpool():
+    """test zpool list and status"""
+    runner = _runner()
+    r = list(runner.zpool_list(properties=['name', 'guid', 'health']))
+    assert_equal(r, [['tank', '1234', 'ONLINE']])
+    assert not runner.is_syncing('tank')
+    runner.set_scan('tank', 'scrub in progress since Sun Nov 23 2014')
+    assert runner.is_syncing('tank')
+
+@raises(ZfsNoPoolError)
+def test_zpool_status_nonexistent():
+    """test zpool status of a pool that doesn't exist"""
+    _runner().zpool_status('failboat')
+
+@raises(ZfsNoDatasetError)
+def test_zfs_list_nonexistent():
+    """test listing a dataset that doesn't exist"""
+    _runner().zfs_list(datasets='tank/nope')
+
+@raises(ZfsInvalidPropertyError)
+def test_zfs_list_bad_property():
+    """test listing an invalid property"""
+    _runner().zfs_list(properties=['name', 'bogus'])
+
+def test_snapshot_and_destroy():
+    """test taking and destroying snapshots"""
+    runner = _runner()
+    runner.zfs_snapshot(['tank/foo', 'tank/baz'], 'a', recursive=True)
+    runner.add_snapshots('tank/foo', ['b', 'c', 'd'])
+    r = [x.name for x in runner.zfs_list_records(
+        datasets='tank', types=['snapshot'], recursive=True,
+        sort='createtxg')]
+    assert_equal(r, ['tank/baz@a', 'tank/foo@a', 'tank/foo/bar@a',
+                     'tank/foo@b', 'tank/foo@c', 'tank/foo@d'])
+    # atomic snapshots share a transaction group
+    txgs = [x.createtxg for x in runner.zfs_list_records(
+        datasets='tank', types=['snapshot'], recursive=True,
+        properties=['createtxg'], sort='createtxg')]
+    assert_equal(len(set(txgs[:3])), 1)
+
+    removed = runner.zfs_destroy_snapshots(
+        'tank/foo', ['a', 'b', 'c'], allsnaps=['a', 'b', 'c', 'd'])
+    assert_equal(removed, ['tank/foo@a', 'tank/foo@b', 'tank/foo@c'])
+    r = [x[0] for x in runner.zfs_list(datasets='tank/foo',
+                                       types=['snapshot'])]
+    assert_equal(r, ['tank/foo@d'])
+    assert_equal(runner.commands, 5)
+
+@raises(ZfsDatasetExistsError)
+def test_snapshot_exists():
+    """test taking a snapshot that already exists"""
+    runner = _runner()
+    runner.add_snapshots('tank/foo/bar', 'a')
+    runner.zfs_snapshot('tank/foo', 'a', recursive=True)
+
+@raises(ZfsNoDatasetError)
+def test_destroy_nonexistent_snapshot():
+    """test destroying a snapshot that doesn't exist"""
+    _runner().zfs_destroy('tank/foo@nope')
+
+def test_create():
+    """test creating filesystems"""
+    runner = _runner()
+    runner.zfs_create('tank/new', props={'compression': 'lz4'})
+    runner.zfs_create('tank/a/b/c', create_parents=True)
+    r = list(runner.zfs_list(properties=['name', 'compression'],
+                             datasets=['tank/new', 'tank/a/b/c']))
+    assert_equal(r, [['tank/new', 'lz4'], ['tank/a/b/c', '-']])
+
+@raises(ZfsDatasetExistsError)
+def test_create_exists():
+    """test creating a filesystem that already exists"""
+    _runner().zfs_create('tank/foo')
+
+def test_latency():
+    """test that commands are delayed, but can overlap"""
+    runner = _runner(latency={'zfs list': 0.1})
+    start = time.time()
+    threads = [threading.Thread(target=lambda: runner.zfs_list())
+               for n in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    assert 0.1 <= elapsed < 0.4, elapsed
+    start = time.time()
+    runner.zpool_list()
+    assert time.time() - start < 0.1
+
+_saved_runner = []
+
+def _use_fake():
+    _saved_runner.append(zfs.util._LCR)
+    zfs.util._LCR = _runner()
+
+def _restore_runner():
+    zfs.util._LCR = _saved_runner.pop()
+
+@with_setup(_use_fake, _restore_runner)
+def test_rolling_snapshotter():
+    """test taking and expiring snapshots against the fake backend"""
+    fake = zfs.util._LCR
+    fake.add_snapshots('tank/foo', [
+        'zfs-auto-snap_daily-2014-11-%02d-0000' % d for d in range(1, 11)],
+        recursive=True)
+    snapper = zfssnapshot.RollingSnapshotter(label='daily', keep=3, jobs=2)
+    r = snapper.take_snapshot('//')
+    assert all(x.ok for x in r)
+    # the new snapshot counts towards the ones kept
+    r = list(fake.zfs_list(datasets='tank/foo/bar', types=['snapshot']))
+    assert_equal(len(r), 2)
+    assert_equal(r[0][0], 'tank/foo/bar@zfs-auto-snap_daily-2014-11-10-0000')
+    # tank/foo has auto-snapshot unset, so keeps all of its snapshots
+    assert_equal(len(list(fake.zfs_list(datasets='tank/foo',
+                                        types=['snapshot']))), 10)
+
+def test_zfs_receive_resume_token():
+    """test reading the resume token of a partially received filesystem"""
+    runner = _runner()
+    runner.add_dataset('tank/recv', props={'receive_resume_token': '1-ab'})
+    assert_equal(runner.zfs_receive_resume_token('tank/recv'), '1-ab')
+    assert runner.zfs_receive_resume_token('tank/baz') is None
+
+def test_zfs_send_size():
+    """test estimating send streams with a dry run"""
+    runner = _runner()
+    runner.add_snapshots('tank/foo', ['a', 'b', 'c'], recursive=True)
+    assert_equal(runner.zfs_send_size('tank/foo@c'),
+                 FakeZfsCommandRunner.REFER_SIZE)
+    assert_equal(runner.zfs_send_size('tank/foo@c', '@a'), 8192)
+    assert_equal(runner.zfs_send_size('tank/foo@c', '@b', recursive=True,
+                                      compressed=True), 8192)
+
+@raises(ZfsNoDatasetError)
+def test_zfs_send_size_missing():
+    """test estimating the stream of a snapshot that doesn't exist"""
+    _runner().zfs_send_size('tank/foo@nope')
+
+def test_parse_send_size():
+    """test reading the estimate of older and newer zfs send -nvP"""
+    assert_equal(zfs.util.parse_send_size(
+        'full\ttank/foo@a\t1000\nsize\t1000\n'), 1000)
+    assert_equal(zfs.util.parse_send_size(
+        'send from @ to tank/foo@a estimated size is 1K\n'
+        'incremental\ta\ttank/foo@b\t300\n'
+        'incremental\ta\ttank/foo/bar@b\t200\n'), 500)
+    assert zfs.util.parse_send_size('nothing here\n') is None
+
+def test_zfs_create_many():
+    """test creating only the deepest of several filesystems"""
+    runner = _runner()
+    assert_equal(runner.zfs_create_many(
+        ['tank/a', 'tank/a/b/c', 'tank/d', 'tank/a/b/c'], create_parents=True),
+        ['tank/a/b/c', 'tank/d'])
+    names = [r[0] for r in runner.zfs_list(recursive=True)]
+    assert 'tank/a/b' in names
+    assert 'tank/d' in names
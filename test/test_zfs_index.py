@@ -0,0 +1,163 @@
+import datetime
+import zfs.util
+from zfs import *
+from zfs.index import SnapshotIndex, ReplicaIndex, make_snapshot, \
+        newest_common_snapshot, INDEX_PROPERTIES as PROPERTIES
+from zfs.fake import FakeZfsCommandRunner
+from flexmock import flexmock
+from nose.tools import raises, assert_equal
+
+LISTING=[
+    ['tank', 'filesystem', '11', '1', '1416355200'],
+    ['tank/foo', 'filesystem', '12', '2', '1416355200'],
+    ['tank/foo/bar', 'filesystem', '13', '3', '1416355200'],
+    ['tank/vol', 'volume', '14', '4', '1416355200'],
+    ['tank/foo@zfs-auto-snap_hourly-2014-11-19-2300', 'snapshot', '15', '5',
+     '1416438000'],
+    ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-19-2300', 'snapshot', '16',
+     '5', '1416438000'],
+    ['tank/foo@manual', 'snapshot', '17', '6', '1416440000'],
+    ['tank/foo@zfs-auto-snap_daily-2014-11-20-0000', 'snapshot', '18', '7',
+     '1416441600'],
+]
+
+def _index():
+    flexmock(zfs.util).should_receive('zfs_list_records').with_args(
+        datasets='tank', types=['filesystem', 'volume', 'snapshot'],
+        properties=['name', 'type', 'guid', 'createtxg', 'creation'],
+        sort='createtxg', recursive=True, depth=None, stream=True
+    ).and_return(zfs.util.zfs_records(iter(LISTING), PROPERTIES)).once()
+    index = SnapshotIndex()
+    assert index.load('tank')
+    return index
+
+def test_load():
+    """test loading a pool into the index"""
+    index = _index()
+    assert_equal(index.datasets(),
+                 ['tank', 'tank/foo', 'tank/foo/bar', 'tank/vol'])
+    assert_equal(index.datasets(root='tank/foo'), ['tank/foo', 'tank/foo/bar'])
+    assert_equal(index.datasets(types=['volume']), ['tank/vol'])
+    assert_equal([s.name for s in index.snapshots('tank/foo')], [
+        'tank/foo@zfs-auto-snap_hourly-2014-11-19-2300',
+        'tank/foo@manual',
+        'tank/foo@zfs-auto-snap_daily-2014-11-20-0000'])
+    snap = index.snapshots('tank/foo')[0]
+    assert_equal(snap.createtxg, 5)
+    assert_equal(snap.creation, 1416438000)
+    assert_equal(snap.snapdate, datetime.datetime(2014, 11, 19, 23, 0))
+    assert_equal([s.name for s in
+                  index.labelled('tank/foo', 'zfs-auto-snap', 'daily')],
+                 ['tank/foo@zfs-auto-snap_daily-2014-11-20-0000'])
+    assert_equal(index.snapshots('tank/nonexistent'), [])
+
+    # loading again doesn't list again
+    assert not index.load('tank')
+
+def test_add_remove():
+    """test recording our own snapshots and destroys"""
+    index = _index()
+    index.add(['tank/foo'], 'zfs-auto-snap_hourly-2014-11-20-0100',
+              recursive=True, creation=1416445200)
+    assert_equal(index.snapshots('tank/foo/bar')[-1].name,
+                 'tank/foo/bar@zfs-auto-snap_hourly-2014-11-20-0100')
+    assert_equal(len(index.labelled('tank/foo', 'zfs-auto-snap', 'hourly')),
+                 2)
+    assert_equal(index.snapshots('tank/vol'), [])
+
+    index.remove(['tank/foo@zfs-auto-snap_hourly-2014-11-19-2300'],
+                 recursive=True)
+    assert_equal([s.snapname for s in
+                  index.labelled('tank/foo/bar', 'zfs-auto-snap', 'hourly')],
+                 ['zfs-auto-snap_hourly-2014-11-20-0100'])
+    assert_equal(len(index.snapshots('tank/foo')), 3)
+
+def test_make_snapshot():
+    """test parsing the label and date out of a snapshot name"""
+    s = make_snapshot('tank', 'my_prefix_weekly-2015-01-02-0304')
+    assert_equal((s.prefix, s.label), ('my_prefix', 'weekly'))
+    assert_equal(s.snapdate, datetime.datetime(2015, 1, 2, 3, 4))
+    s = make_snapshot('tank', 'zfs-auto-snap_daily-2015-13-02-0304')
+    assert_equal((s.prefix, s.label, s.snapdate), (None, None, None))
+    s = make_snapshot('tank', 'zfs-auto-snap_every_15min-2024-01-01-1200',
+                      prefix='zfs-auto-snap')
+    assert_equal((s.prefix, s.label), ('zfs-auto-snap', 'every_15min'))
+
+def test_labelled_underscores():
+    """test looking up labels and prefixes containing underscores"""
+    index = SnapshotIndex()
+    index.add(['tank'], 'zfs-auto-snap_every_15min-2024-01-01-1200')
+    index.add(['tank'], 'zfs-auto-snap_every_15min-2024-01-01-1215')
+    index.add(['tank'], 'zfs-auto-snap_every-2024-01-01-1215')
+    index.add(['tank'], 'my_prefix_daily-2024-01-01-0000')
+    index.add(['tank'], 'my_prefix_daily-manual')
+    assert_equal([s.snapname for s in
+                  index.labelled('tank', 'zfs-auto-snap', 'every_15min')],
+                 ['zfs-auto-snap_every_15min-2024-01-01-1200',
+                  'zfs-auto-snap_every_15min-2024-01-01-1215'])
+    assert_equal(len(index.labelled('tank', 'zfs-auto-snap', 'every')), 1)
+    assert_equal([s.snapname for s in
+                  index.labelled('tank', 'my_prefix', 'daily')],
+                 ['my_prefix_daily-2024-01-01-0000', 'my_prefix_daily-manual'])
+    index.remove(['tank@zfs-auto-snap_every_15min-2024-01-01-1200'])
+    assert_equal(len(index.labelled('tank', 'zfs-auto-snap', 'every_15min')),
+                 1)
+
+@raises(ZfsNoDatasetError)
+def test_load_missing():
+    """test loading a dataset that doesn't exist"""
+    flexmock(zfs.util).should_receive('zfs_list_records')\
+            .and_raise(ZfsNoDatasetError)
+    SnapshotIndex().load('nonexistent')
+
+def test_load_failed_part_way():
+    """test that a listing that fails part way adds nothing to the index"""
+    def records():
+        for record in zfs.util.zfs_records(iter(LISTING[:3]), PROPERTIES):
+            yield record
+        raise ZfsUnknownError('connection lost')
+    flexmock(zfs.util).should_receive('zfs_list_records')\
+            .and_return(records()).and_return(
+                zfs.util.zfs_records(iter(LISTING), PROPERTIES))
+    index = SnapshotIndex()
+    try:
+        index.load('tank')
+    except ZfsUnknownError:
+        pass
+    else:
+        raise AssertionError('the failed listing was not raised')
+    assert_equal(index.datasets(), [])
+    # loading again lists again, without duplicates
+    assert index.load('tank')
+    assert_equal(index.datasets(),
+                 ['tank', 'tank/foo', 'tank/foo/bar', 'tank/vol'])
+    assert_equal(len(index.snapshots('tank/foo')), 3)
+
+def test_replica_index():
+    """test indexing a backup host, with resume tokens"""
+    runner = FakeZfsCommandRunner(seed=1)
+    runner.add_pool('backup')
+    runner.add_dataset('backup/1234/tank/foo',
+                       props={'receive_resume_token': '1-ab'})
+    runner.add_dataset('backup/1234/tank/bar')
+    runner.add_snapshots('backup/1234/tank/bar', ['a', 'b'])
+    replicas = ReplicaIndex(runner)
+    assert replicas.load(['backup/1234', 'backup/5678'])
+    assert replicas.exists('backup/1234/tank/foo')
+    assert not replicas.exists('backup/5678/tank/foo')
+    assert_equal(replicas.resume_token('backup/1234/tank/foo'), '1-ab')
+    assert replicas.resume_token('backup/1234/tank/bar') is None
+    assert_equal([s.snapname for s in
+                  replicas.snapshots('backup/1234/tank/bar')], ['a', 'b'])
+    assert not replicas.load('backup/5678')
+
+def test_newest_common_snapshot():
+    """test matching two copies of a dataset by snapshot guid"""
+    local = [make_snapshot('tank/foo', n, guid=g)
+             for n, g in (('a', 1), ('b', 2), ('c', 3), ('new', None))]
+    remote = [make_snapshot('backup/foo', n, guid=g)
+              for n, g in (('a', 1), ('b2', 2), ('x', 9))]
+    l, r = newest_common_snapshot(local, remote)
+    assert_equal((l.snapname, r.snapname), ('b', 'b2'))
+    assert newest_common_snapshot(local, remote[2:]) is None
+    assert newest_common_snapshot(local, []) is None
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import zfs.util
+import zfs.snapshot as zfssnapshot
+from nose.tools import assert_equal, raises, with_setup
+from zfs.fake import FakeZfsCommandRunner
+from zfs.metrics import RunMetrics, write_metrics_file
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000
+    def __call__(self):
+        return self.now
+
+def test_render():
+    """test the Prometheus text format"""
+    clock = _Clock()
+    m = RunMetrics('zfsautosnap', clock=clock, label='hourly')
+    with m.phase('snapshot'):
+        clock.now += 2
+    m.inc('snapshots_created', 3)
+    m.set('replication_lag_seconds', 60, dataset='tank/"foo"')
+    clock.now += 1
+    m.finish(True)
+    lines = m.render().splitlines()
+    assert '# TYPE zfsautosnap_run_duration_seconds gauge' in lines
+    assert 'zfsautosnap_run_duration_seconds{app="zfsautosnap",'\
+        'label="hourly"} 3' in lines
+    assert 'zfsautosnap_run_success{app="zfsautosnap",label="hourly"} 1' \
+        in lines
+    assert 'zfsautosnap_phase_duration_seconds{app="zfsautosnap",'\
+        'label="hourly",phase="snapshot"} 2' in lines
+    assert 'zfsautosnap_snapshots_destroyed{app="zfsautosnap",'\
+        'label="hourly"} 0' in lines
+    assert 'zfsautosnap_replication_lag_seconds{app="zfsautosnap",'\
+        'dataset="tank/\\"foo\\"",label="hourly"} 60' in lines
+    assert not [l for l in lines if 'bytes_sent' in l]
+
+@raises(KeyError)
+def test_unknown_metric():
+    """test that metric names are checked"""
+    RunMetrics('zfsautosnap').inc('snapshots_taken')
+
+def test_write():
+    """test that the file is replaced without leaving temporary files"""
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'zfsautosnap.prom')
+        with open(path, 'w') as f:
+            f.write('old\n')
+        m = RunMetrics('zfsautosnap')
+        assert write_metrics_file(m, path)
+        assert_equal(os.listdir(d), ['zfsautosnap.prom'])
+        with open(path) as f:
+            assert_equal(f.read(), m.render())
+        assert not write_metrics_file(m, os.path.join(d, 'missing', 'x.prom'))
+        assert not write_metrics_file(m, None)
+    finally:
+        shutil.rmtree(d)
+
+_saved_runner = []
+
+def _use_fake():
+    _saved_runner.append(zfs.util._LCR)
+    fake = FakeZfsCommandRunner(seed=1)
+    fake.add_pool('tank')
+    fake.add_dataset('tank/foo/bar', props={'com.sun:auto-snapshot': 'true'})
+    fake.add_dataset('tank/foo/bar/baz')
+    fake.add_snapshots('tank/foo/bar', [
+        'zfs-auto-snap_daily-2014-11-%02d-0000' % d for d in range(1, 11)])
+    zfs.util._LCR = fake
+
+def _restore_runner():
+    zfs.util._LCR = _saved_runner.pop()
+
+@with_setup(_use_fake, _restore_runner)
+def test_rolling_snapshotter_metrics():
+    """test the counts from a snapshot run"""
+    m = RunMetrics('zfsautosnap')
+    snapper = zfssnapshot.RollingSnapshotter(label='daily', keep=3,
+                                             metrics=m)
+    snapper.take_snapshot('//')
+    assert_equal(m.get('datasets_processed'), 1)
+    assert_equal(m.get('snapshots_created'), 2)
+    assert_equal(m.get('snapshots_destroyed'), 9)
+    assert_equal(m.get('dataset_failures'), 0)
+    for phase in ('planning', 'snapshot', 'purge'):
+        assert m.get('phase_duration_seconds', phase=phase) >= 0
+
+@with_setup(_use_fake, _restore_runner)
+def test_purger_metrics():
+    """test the counts from a purge run"""
+    m = RunMetrics('zfspurgesnapshots')
+    purger = zfssnapshot.SnapshotPurger(label='daily', keep=4, baseds='tank',
+                                        metrics=m)
+    assert_equal(purger.run(), 0)
+    assert_equal(m.get('datasets_processed'), 4)
+    assert_equal(m.get('snapshots_destroyed'), 6)
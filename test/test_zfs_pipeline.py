@@ -0,0 +1,187 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import zfs.util
+from zfs import *
+from zfs.pipeline import pump, send_receive
+from zfs.ringbuffer import RingBuffer
+from zfs.compress import Compression, DecompressingWriter
+from nose.tools import raises, assert_equal
+
+# Produces 3 MiB and a bit, so the stream crosses several buffers
+_SEND_SCRIPT = "import sys; sys.stdout.write('x' * (3 * 1048576 + 17))"
+
+class FakeChannel(object):
+    """Just enough of a paramiko.Channel running zfs receive"""
+
+    def __init__(self, rc=0, err='', limit=None):
+        self.data = []
+        self.rc = rc
+        self.err = err
+        self.limit = limit
+        self.eof = threading.Event()
+        self.closed = False
+
+    def send(self, view):
+        if self.limit is not None and \
+           sum(len(d) for d in self.data) >= self.limit:
+            raise EnvironmentError('Socket is closed')
+        # like paramiko, send at most one packet's worth
+        data = view[:32768].tobytes()
+        self.data.append(data)
+        return len(data)
+
+    def recv(self, n):
+        self.eof.wait()
+        return ''
+
+    def recv_stderr(self, n):
+        self.eof.wait()
+        err, self.err = self.err, ''
+        return err
+
+    def shutdown_write(self):
+        self.eof.set()
+
+    def close(self):
+        self.closed = True
+        self.eof.set()
+
+    def recv_exit_status(self):
+        return self.rc
+
+def _sender(script=_SEND_SCRIPT):
+    return subprocess.Popen([sys.executable, '-c', script],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            bufsize=0)
+
+def test_pump():
+    """test copying a stream through one buffer with short writes"""
+    src = [b'abcdefgh', b'ij', b'']
+    out = []
+    def readinto(view):
+        data = src.pop(0)
+        view[:len(data)] = data
+        return len(data)
+    def write(view):
+        out.append(view[:3].tobytes())
+        return len(out[-1])
+    assert_equal(pump(readinto, write, bufsz=16), 10)
+    assert_equal(''.join(out), 'abcdefghij')
+
+def test_send_receive_channel():
+    """test streaming a local process into a channel"""
+    chan = FakeChannel()
+    assert_equal(send_receive(_sender(), chan, bufsz=65536), 3 * 1048576 + 17)
+    assert_equal(''.join(chan.data), 'x' * (3 * 1048576 + 17))
+
+def test_send_receive_process():
+    """test streaming a local process into another"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'stream')
+        receiver = subprocess.Popen(['sh', '-c', 'cat > "$0"', path],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, bufsize=0)
+        assert_equal(send_receive(_sender(), receiver), 3 * 1048576 + 17)
+        assert_equal(os.path.getsize(path), 3 * 1048576 + 17)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_send_receive_receive_failed():
+    """test that the exit status of both ends is reported"""
+    chan = FakeChannel(rc=1, err='cannot receive: destination exists\n')
+    try:
+        send_receive(_sender(), chan)
+    except ZfsReplicationError as e:
+        assert_equal((e.send_rc, e.recv_rc), (0, 1))
+        assert 'destination exists' in str(e)
+    else:
+        raise AssertionError('the failed receive was not reported')
+
+def test_send_receive_receiver_exited():
+    """test that the sender is stopped when the receiver goes away"""
+    chan = FakeChannel(rc=1, limit=65536)
+    try:
+        send_receive(_sender(), chan)
+    except ZfsReplicationError as e:
+        assert chan.closed
+        assert e.send_rc != 0
+        assert_equal(e.recv_rc, 1)
+    else:
+        raise AssertionError('the lost receiver was not reported')
+
+def test_send_receive_send_failed():
+    """test a zfs send that fails before sending anything"""
+    sender = _sender("import sys; sys.stderr.write('no such snapshot\\n'); "
+                     "sys.exit(1)")
+    try:
+        send_receive(sender, FakeChannel())
+    except ZfsReplicationError as e:
+        assert_equal((e.send_rc, e.recv_rc), (1, 0))
+        assert_equal(e.send_err, 'no such snapshot\n')
+    else:
+        raise AssertionError('the failed send was not reported')
+
+def test_zfs_send_receive_args():
+    """test building the zfs send and receive command lines"""
+    runner = zfs.util.ZfsCommandRunner()
+    assert_equal(runner._zfs_send_args('tank/foo@b'), ['send', 'tank/foo@b'])
+    assert_equal(runner._zfs_send_args('tank/foo@b', '@a', recursive=True),
+                 ['send', '-R', '-i', '@a', 'tank/foo@b'])
+    assert_equal(runner._zfs_send_args('tank/foo@c', '@a',
+                                       intermediates=True),
+                 ['send', '-I', '@a', 'tank/foo@c'])
+    assert_equal(runner._zfs_receive_args('backup/foo', force=True),
+                 ['receive', '-u', '-F', 'backup/foo'])
+    assert_equal(runner._zfs_receive_args('backup/foo', resumable=True),
+                 ['receive', '-u', '-s', 'backup/foo'])
+    assert_equal(runner._zfs_send_args(None, resume_token='1-abc'),
+                 ['send', '-t', '1-abc'])
+
+def test_send_receive_ring():
+    """test streaming through a ring buffer"""
+    chan = FakeChannel()
+    ring = RingBuffer(size=1 << 20, block_size=65536, spill=False)
+    assert_equal(send_receive(_sender(), chan, ring=ring), 3 * 1048576 + 17)
+    assert_equal(''.join(chan.data), 'x' * (3 * 1048576 + 17))
+    assert_equal(ring.stats.bytes, 3 * 1048576 + 17)
+
+def test_send_receive_ring_receiver_exited():
+    """test that a ring buffer is torn down when the receiver goes away"""
+    chan = FakeChannel(rc=1, limit=65536)
+    ring = RingBuffer(size=1 << 20, block_size=65536, spill=True)
+    try:
+        send_receive(_sender(), chan, ring=ring)
+    except ZfsReplicationError as e:
+        assert_equal(e.recv_rc, 1)
+    else:
+        raise AssertionError('the lost receiver was not reported')
+
+def test_send_receive_compressed():
+    """test streaming through a compressor"""
+    chan = FakeChannel()
+    compression = Compression('zlib', threads=2, block_size=65536)
+    assert_equal(send_receive(_sender(), chan, compression=compression),
+                 3 * 1048576 + 17)
+    out = []
+    writer = DecompressingWriter(lambda v: out.append(v.tobytes()) or len(v))
+    writer.write(''.join(chan.data))
+    writer.close()
+    assert_equal(''.join(out), 'x' * (3 * 1048576 + 17))
+    assert_equal(compression.stats.raw_bytes, 3 * 1048576 + 17)
+    assert compression.stats.ratio() > 100
+
+def test_zfs_send_format_args():
+    """test the stream format options of zfs send"""
+    runner = zfs.util.ZfsCommandRunner()
+    assert_equal(runner._zfs_send_args('tank/foo@b', '@a', large_blocks=True,
+                                       embed_data=True, compressed=True),
+                 ['send', '-L', '-e', '-c', '-i', '@a', 'tank/foo@b'])
+    assert_equal(runner._zfs_send_args('tank/foo@b', raw=True,
+                                       compressed=True),
+                 ['send', '-w', 'tank/foo@b'])
@@ -0,0 +1,47 @@
+from nose.tools import raises, assert_equal
+from zfs import *
+from zfs.fake import FakeZfsCommandRunner
+from zfs.poolstate import PoolStateCache
+import zfs.snapshot as zfssnapshot
+
+def _runner():
+    runner = FakeZfsCommandRunner(seed=1)
+    runner.add_pool('tank', guid=1234)
+    runner.add_pool('backup', guid=5678, size=1 << 30)
+    runner.add_dataset('backup/foo')
+    runner.set_scan('backup', 'scrub in progress since Sun Nov 23 2014')
+    return runner
+
+def test_pool_state_cache():
+    """test that every query is answered by one status and one listing"""
+    runner = _runner()
+    pools = PoolStateCache(runner)
+    assert_equal(pools.pools(), ['tank', 'backup'])
+    assert not pools.is_syncing('tank')
+    assert pools.is_syncing('backup')
+    assert_equal(pools.get_pool_guid('backup'), '5678')
+    assert_equal(pools.free('backup'),
+                 (1 << 30) - 2 * FakeZfsCommandRunner.REFER_SIZE)
+    assert_equal(pools.state('tank').health, 'ONLINE')
+    assert_equal(pools.status('tank').vdevs[0].name, 'tank')
+    assert_equal(runner.commands, 2)
+
+    runner.set_scan('backup', 'scrub repaired 0 in 0h1m with 0 errors')
+    assert pools.is_syncing('backup')
+    pools.refresh()
+    assert not pools.is_syncing('backup')
+    assert_equal(runner.commands, 4)
+
+@raises(ZfsNoPoolError)
+def test_pool_state_cache_nonexistent():
+    """test asking about a pool that doesn't exist"""
+    PoolStateCache(_runner()).get_pool_guid('failboat')
+
+def test_filter_syncing_pools():
+    """test filtering the filesystems of syncing pools with one status"""
+    runner = _runner()
+    r = zfssnapshot.filter_syncing_pools(
+        ['tank/foo', 'backup/foo', 'tank/bar', 'backup'],
+        PoolStateCache(runner))
+    assert_equal(r, ['tank/foo', 'tank/bar'])
+    assert_equal(runner.commands, 2)
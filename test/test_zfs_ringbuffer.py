@@ -0,0 +1,139 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zfs.zfsbuffer
+from zfs.ringbuffer import RingBuffer, parse_size
+from nose.tools import raises, assert_equal
+
+def _source(data, seed=1):
+    """Return a readinto handing out data in random sized pieces"""
+    rng = random.Random(seed)
+    pos = [0]
+    def readinto(view):
+        n = min(rng.randint(1, 40000), len(view), len(data) - pos[0])
+        view[:n] = data[pos[0]:pos[0] + n]
+        pos[0] += n
+        return n
+    return readinto
+
+def _sink(out, seed=2, delay=0):
+    """Return a write taking random sized pieces"""
+    rng = random.Random(seed)
+    def write(view):
+        if delay:
+            time.sleep(delay)
+        n = min(rng.randint(1, 40000), len(view))
+        out.append(view[:n].tobytes())
+        return n
+    return write
+
+def _data(size):
+    return os.urandom(size)
+
+def test_ring_buffer():
+    """test that a stream comes through a ring buffer intact"""
+    data = _data(1 << 20)
+    out = []
+    ring = RingBuffer(size=65536, block_size=16384, spill=False)
+    assert_equal(ring.run(_source(data), _sink(out)), len(data))
+    assert ''.join(out) == data
+    stats = ring.stats
+    assert_equal(stats.bytes, len(data))
+    assert not stats.spilled
+    assert 0 < stats.fill_max <= 65536
+    assert_equal(sum(stats.buckets), stats.samples)
+    assert 0 < stats.mean_fill() <= 1
+    assert 'buffer 0MiB' in stats.summary()
+    ring.close()
+
+def test_ring_buffer_spill():
+    """test a ring buffer kept in a memory-mapped file"""
+    data = _data(300000)
+    out = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ring = RingBuffer(size=32768, block_size=8192, spill=True,
+                          spill_dir=tmpdir)
+        # the file is unlinked as soon as it is created
+        assert_equal(os.listdir(tmpdir), [])
+        assert_equal(ring.run(_source(data), _sink(out)), len(data))
+        assert ''.join(out) == data
+        assert ring.stats.spilled
+        ring.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_ring_buffer_slow_sink():
+    """test that a slow sink leaves the buffer full"""
+    data = _data(200000)
+    out = []
+    ring = RingBuffer(size=65536, block_size=8192, spill=False)
+    ring.run(_source(data), _sink(out, delay=0.001))
+    assert ''.join(out) == data
+    assert ring.stats.full_waits > 0
+    assert ring.stats.mean_fill() > 0.5
+
+@raises(IOError)
+def test_ring_buffer_source_error():
+    """test that an error reading the source reaches the caller"""
+    def readinto(view):
+        raise IOError('read failed')
+    RingBuffer(size=65536, block_size=16384, spill=False).run(
+        readinto, _sink([]))
+
+def test_ring_buffer_sink_error():
+    """test that an error writing the sink stops the source"""
+    def write(view):
+        raise IOError('Broken pipe')
+    ring = RingBuffer(size=65536, block_size=16384, spill=False)
+    try:
+        ring.run(_source(_data(1 << 20)), write)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('the write error was lost')
+    # the producer stops once it sees the buffer was abandoned
+    ring.close()
+
+@raises(ValueError)
+def test_ring_buffer_too_small():
+    """test that a buffer must hold two blocks"""
+    RingBuffer(size=65536, block_size=65536)
+
+def test_parse_size():
+    """test parsing buffer sizes"""
+    assert_equal(parse_size('512'), 512)
+    assert_equal(parse_size('128k'), 128 << 10)
+    assert_equal(parse_size('1.5G'), 3 << 29)
+    assert_equal(parse_size('2MiB'), 2 << 20)
+    for text in ('', 'lots', '1X'):
+        try:
+            parse_size(text)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('%r was parsed' % text)
+
+def test_zfsbuffer_main():
+    """test the zfsbuffer command copying a file"""
+    data = _data(100000)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, 'in'), 'wb') as f:
+            f.write(data)
+        stdin = open(os.path.join(tmpdir, 'in'), 'rb')
+        stdout = open(os.path.join(tmpdir, 'out'), 'wb')
+        class Options(object):
+            verbose = False
+            size = 65536
+            block_size = 4096
+        ret = zfs.zfsbuffer.App(Options()).run(stdin, stdout)
+        stdout.close()
+        assert_equal(ret, 0)
+        with open(os.path.join(tmpdir, 'out'), 'rb') as f:
+            assert f.read() == data
+    finally:
+        shutil.rmtree(tmpdir)
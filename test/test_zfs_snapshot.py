@@ -1,9 +1,12 @@
 from zfs import *
 import zfs.snapshot as zfssnapshot
+import zfs.util
+from zfs.index import INDEX_PROPERTIES
 from flexmock import flexmock
 from nose.tools import raises, assert_equal
 
 import logging
+import random
 logging.basicConfig(level=logging.DEBUG)
 
 TESTEXCLUDES=['tank/nodaily','tank/snapnorecurse','chile/rt']
@@ -29,22 +32,73 @@ def test_autosnapshotter():
                       destroy_older_snapshots=5,
                      )
     mocksnap.should_receive('zfs_snapshot').and_return()
+    flexmock(zfssnapshot.SnapshotIndex).should_receive('load')\
+            .and_return(True)
     snapper=mocksnap.RollingSnapshotter(label="daily", keep=24)
     snapper.take_snapshot('//')
 
+def test_autosnapshotter_one_snapshot_call_per_pool():
+    """Test that each pool's filesystems are snapshotted with one call"""
+    mocksnap=flexmock(zfssnapshot,
+                      filter_syncing_pools=lambda x: x,
+                      destroy_older_snapshots=[],
+                     )
+    mocksnap.should_receive('zfs_snapshot').with_args(
+        ['tank/foo', 'tank/bar'], str, False).once()
+    mocksnap.should_receive('zfs_snapshot').with_args(
+        ['chile/rt'], str, False).once()
+    flexmock(zfssnapshot.SnapshotIndex).should_receive('load')\
+            .and_return(True).times(2)
+    snapper=mocksnap.RollingSnapshotter(label="daily", keep=24, jobs=4)
+    r = snapper.take_snapshot(['tank/foo', 'chile/rt', 'tank/bar'])
+    assert_equal(sorted(x.dataset for x in r),
+                 ['chile/rt', 'tank/bar', 'tank/foo'])
+    assert all(x.ok for x in r)
+
+def test_autosnapshotter_failed_pool():
+    """Test that filesystems on a pool that couldn't be snapshotted are
+    reported as failures, and not purged"""
+    mocksnap=flexmock(zfssnapshot, filter_syncing_pools=lambda x: x)
+    mocksnap.should_receive('zfs_snapshot').with_args(
+        ['tank/foo'], str, False).and_raise(ZfsDatasetExistsError)
+    mocksnap.should_receive('zfs_snapshot').with_args(
+        ['chile/rt'], str, False)
+    mocksnap.should_receive('destroy_older_snapshots').with_args(
+        'chile/rt', 23, 'daily', zfssnapshot.PREFIX, False,
+        index=zfssnapshot.SnapshotIndex
+    ).and_return(['chile/rt@old']).once()
+    flexmock(zfssnapshot.SnapshotIndex).should_receive('load')\
+            .and_return(True)
+    snapper=mocksnap.RollingSnapshotter(label="daily", keep=24, jobs=2)
+    r = dict((x.dataset, x) for x in
+             snapper.take_snapshot(['tank/foo', 'chile/rt']))
+    assert isinstance(r['tank/foo'].error, ZfsDatasetExistsError)
+    assert_equal(r['chile/rt'].result, ['chile/rt@old'])
+
 def testSnapshotPurger():
     """Test instanciation of the SnapshotPurger object"""
     mocksnap = flexmock(zfssnapshot)
-    mocksnap.should_receive('get_child_datasets')\
-            .and_return([
-                'zfsbackups/123',
-                'zfsbackups/123/abc',
-            ])
+    flexmock(zfs.util).should_receive('zfs_list_records')\
+            .with_args(datasets='zfsbackups', types=['filesystem', 'volume',
+                                                     'snapshot'],
+                       properties=['name', 'type', 'guid', 'createtxg',
+                                   'creation'],
+                       sort='createtxg', recursive=True, depth=None,
+                       stream=True)\
+            .and_return(zfs.util.zfs_records(iter([
+                ['zfsbackups', 'filesystem', '1', '1', '1416355200'],
+                ['zfsbackups/123', 'filesystem', '2', '2', '1416355200'],
+                ['zfsbackups/123/abc', 'filesystem', '3', '3', '1416355200'],
+                ['zfsbackups/123/vol', 'volume', '4', '4', '1416355200'],
+            ]), INDEX_PROPERTIES)).once()
     mocksnap.should_receive('destroy_older_snapshots')\
             .and_return(['zfsbackups/123@zfs-auto-snap-daily'])\
             .and_return(['zfsbackups/123/abc@zfs-auto-snap-daily'])
+    mocksnap.should_receive('destroy_older_snapshots')\
+            .with_args(filesys='zfsbackups/123/vol', keep=int, label=str,
+                       prefix=str, index=object).never()
     t=mocksnap.SnapshotPurger()
-    t.run()
+    assert_equal(t.run(), 0)
 
 def test_can_recursive_snapshot():
     """ test can_recursive snapshot
@@ -126,14 +180,71 @@ def test_get_userprop_datasets_hourly():
     r = myzfssnapshot.get_userprop_datasets(label='hourly')
     assert r
 
+def _legacy_userprop_plan(rows):
+    """The planning done by get_userprop_datasets before DatasetTree, using
+    can_recursive_snapshot and narrow_recursive_filesystems"""
+    exclude=[row[0] for row in rows
+             if row[2] == 'false' or (row[1] == 'false' and row[2] == '-') or
+             (row[1] == '-' and row[2] == '-')]
+    recursive_list=[]
+    single_list=[]
+    for row in rows:
+        ds=row[0]
+        if zfssnapshot.can_recursive_snapshot(ds,exclude):
+            recursive_list.append(ds)
+        elif ds not in exclude:
+            single_list.append(ds)
+    return (single_list,
+            zfssnapshot.narrow_recursive_filesystems(recursive_list))
+
+def _random_userprop_rows(rnd, size):
+    """Generate zfs list rows of a random dataset tree"""
+    names=[]
+    for i in range(size):
+        if not names or rnd.random() < 0.1:
+            names.append(rnd.choice(['tank', 'tan', 'rpool']))
+        else:
+            # reuse component names, so that siblings share prefixes
+            names.append('%s/%s' % (rnd.choice(names),
+                                    rnd.choice(['a', 'ab', 'b', 'a b'])))
+    names=sorted(set(names))
+    values=['true', 'false', '-']
+    return [[ds, rnd.choice(values), rnd.choice(values)] for ds in names]
+
+def test_dataset_tree_matches_legacy():
+    """test that DatasetTree plans the same lists as the quadratic functions
+    on random trees"""
+    rnd=random.Random(1234)
+    logger=logging.getLogger()
+    level=logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        for n in range(200):
+            rows=_random_userprop_rows(rnd, rnd.randint(1, 60))
+            mysnapshot=flexmock(zfssnapshot)
+            mysnapshot.should_receive('zfs_list').and_return(iter(rows))
+            assert_equal(mysnapshot.get_userprop_datasets(),
+                         _legacy_userprop_plan(rows))
+    finally:
+        logger.setLevel(level)
+
+def test_dataset_tree_can_recursive_snapshot():
+    """test DatasetTree.can_recursive_snapshot against the TESTEXCLUDES"""
+    tree=zfssnapshot.DatasetTree()
+    for ds in TESTEXCLUDES:
+        tree.add(ds, excluded=True)
+    for ds in ['chile', 'chile/rt/chile', 'tank', 'tankety', 'tan', 'rt',
+               'tank/nodaily', 'tank/other']:
+        assert_equal(tree.can_recursive_snapshot(ds),
+                     zfssnapshot.can_recursive_snapshot(ds, TESTEXCLUDES))
+
 def test_filter_syncing_pools():
     """test filter_syncing_pools
     """
 
-    myzfssnapshot=flexmock(zfssnapshot)
-    myzfssnapshot.should_receive('is_syncing').and_return(
-        False, True, False).one_by_one()
-    r = myzfssnapshot.filter_syncing_pools(['tank/foo',
+    flexmock(zfssnapshot.PoolStateCache).should_receive('is_syncing')\
+            .and_return(False, False, True, True, False).one_by_one()
+    r = zfssnapshot.filter_syncing_pools(['tank/foo',
                                             'tank/bar',
                                             'deadweight/foo',
                                             'deadweight/bar',
@@ -146,30 +257,31 @@ def test_filter_syncing_pools_badname():
 
     r = zfssnapshot.filter_syncing_pools(['/invalid'])
 
+def _snapshot_records(names):
+    """Turn a list of dataset and snapshot names, oldest first, into the
+    records of a SnapshotIndex listing"""
+    rows = []
+    for txg, name in enumerate(names):
+        rows.append([name, 'snapshot' if '@' in name else 'filesystem',
+                     str(1000 + txg), str(txg), str(1416355200 + txg)])
+    return zfs.util.zfs_records(iter(rows), INDEX_PROPERTIES)
+
 def test_destroy_older_snapshots():
     """test destroy_older_snapshots"""
 
-    # Test output below has 7 hourly snapshots of tank/foo and
-    # tank/foo/bar, one daily snapshot each of tank/foo and tank/foo/bar,
-    # and one manual snapshot.
+    # Test output below has 7 hourly snapshots of tank/foo,
+    # one daily snapshot and one manual snapshot.
     p=[
-        ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-19-2300'],
-        ['tank/foo@zfs-auto-snap_hourly-2014-11-19-2300'],
-        ['tank/foo/bar@zfs-auto-snap_daily-2014-11-19-0003'],
-        ['tank/foo@zfs-auto-snap_daily-2014-11-19-0003'],
-        ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-20-0000'],
-        ['tank/foo@zfs-auto-snap_hourly-2014-11-20-0000'],
-        ['tank/foo@manual-snapshot'],
-        ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-20-0100'],
-        ['tank/foo@zfs-auto-snap_hourly-2014-11-20-0100'],
-        ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-20-0200'],
-        ['tank/foo@zfs-auto-snap_hourly-2014-11-20-0200'],
-        ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-20-0300'],
-        ['tank/foo@zfs-auto-snap_hourly-2014-11-20-0300'],
-        ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-20-0400'],
-        ['tank/foo@zfs-auto-snap_hourly-2014-11-20-0400'],
-        ['tank/foo/bar@zfs-auto-snap_hourly-2014-11-20-0500'],
-        ['tank/foo@zfs-auto-snap_hourly-2014-11-20-0500'],
+        'tank/foo',
+        'tank/foo@zfs-auto-snap_hourly-2014-11-19-2300',
+        'tank/foo@zfs-auto-snap_daily-2014-11-19-0003',
+        'tank/foo@zfs-auto-snap_hourly-2014-11-20-0000',
+        'tank/foo@manual-snapshot',
+        'tank/foo@zfs-auto-snap_hourly-2014-11-20-0100',
+        'tank/foo@zfs-auto-snap_hourly-2014-11-20-0200',
+        'tank/foo@zfs-auto-snap_hourly-2014-11-20-0300',
+        'tank/foo@zfs-auto-snap_hourly-2014-11-20-0400',
+        'tank/foo@zfs-auto-snap_hourly-2014-11-20-0500',
     ]
     expected_result=[
         'tank/foo@zfs-auto-snap_hourly-2014-11-19-2300',
@@ -178,24 +290,66 @@ def test_destroy_older_snapshots():
         'tank/foo@zfs-auto-snap_hourly-2014-11-20-0200',
     ]
 
-    myzfssnapshot=flexmock(zfssnapshot)
-    myzfssnapshot.should_receive('zfs_list').with_args(
-        types=['snapshot'], sort='creation', properties=['name'],
-        datasets='tank/foo', recursive=True
-    ).and_return(iter(p))
+    flexmock(zfs.util).should_receive('zfs_list_records').with_args(
+        datasets='tank/foo', types=['filesystem', 'volume', 'snapshot'],
+        properties=['name', 'type', 'guid', 'createtxg', 'creation'],
+        sort='createtxg', recursive=False, depth=1, stream=True
+    ).and_return(_snapshot_records(p))
 
-    myzfssnapshot.should_receive('zfs_destroy').and_return()
+    myzfssnapshot=flexmock(zfssnapshot)
+    myzfssnapshot.should_receive('zfs_destroy_snapshots').with_args(
+        'tank/foo',
+        [x.split('@')[1] for x in expected_result],
+        recursive=False,
+        allsnaps=[x.split('@')[1] for x in p if '@' in x]
+    ).and_return(expected_result).once()
 
     r=myzfssnapshot.destroy_older_snapshots(
         filesys='tank/foo', keep=3, label='hourly', recursive=False)
     assert_equal(len(r), 4)
     assert_equal(r,expected_result)
 
-    myzfssnapshot2=flexmock(zfssnapshot)
-    myzfssnapshot2.should_receive('zfs_list').with_args(
-        types=['snapshot'], sort='creation', properties=['name'],
-        datasets='bad/fs', recursive=True
+    flexmock(zfs.util).should_receive('zfs_list_records').with_args(
+        datasets='bad/fs', types=['filesystem', 'volume', 'snapshot'],
+        properties=['name', 'type', 'guid', 'createtxg', 'creation'],
+        sort='createtxg', recursive=False, depth=1, stream=True
     ).and_raise(ZfsNoDatasetError)
-    r2=myzfssnapshot2.destroy_older_snapshots(
+    r2=myzfssnapshot.destroy_older_snapshots(
         filesys='bad/fs', keep=3, label='hourly', recursive=False)
     assert_equal(r2, None)
+
+def test_destroy_older_snapshots_index():
+    """test destroy_older_snapshots with a shared index"""
+    p=[
+        'tank',
+        'tank/foo',
+        'tank/foo/bar',
+        'tank/foo@zfs-auto-snap_daily-2014-11-18-0000',
+        'tank/foo/bar@zfs-auto-snap_daily-2014-11-18-0000',
+        'tank/foo@zfs-auto-snap_daily-2014-11-19-0000',
+        'tank/foo/bar@zfs-auto-snap_daily-2014-11-19-0000',
+        'tank/foo@zfs-auto-snap_daily-2014-11-20-0000',
+        'tank/foo/bar@zfs-auto-snap_daily-2014-11-20-0000',
+    ]
+    flexmock(zfs.util).should_receive('zfs_list_records')\
+            .and_return(_snapshot_records(p)).once()
+    index = zfssnapshot.SnapshotIndex()
+    index.load('tank')
+
+    myzfssnapshot=flexmock(zfssnapshot)
+    myzfssnapshot.should_receive('zfs_destroy_snapshots').with_args(
+        'tank/foo', ['zfs-auto-snap_daily-2014-11-18-0000'], recursive=True,
+        allsnaps=list
+    ).and_return(['tank/foo@zfs-auto-snap_daily-2014-11-18-0000']).once()
+    r=myzfssnapshot.destroy_older_snapshots('tank/foo', 2, 'daily',
+                                            recursive=True, index=index)
+    assert_equal(r, ['tank/foo@zfs-auto-snap_daily-2014-11-18-0000'])
+
+    # The destroyed snapshots of the parent and child are forgotten
+    assert_equal(len(index.snapshots('tank/foo')), 2)
+    assert_equal(len(index.labelled('tank/foo/bar', zfssnapshot.PREFIX,
+                                    'daily')), 2)
+    # Nothing is left to destroy, so the pool isn't listed again
+    r=myzfssnapshot.destroy_older_snapshots('tank/foo', 2, 'daily',
+                                            recursive=True, index=index)
+    assert_equal(r, [])
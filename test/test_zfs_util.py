@@ -1,10 +1,51 @@
+import os
 import subprocess
 from subprocess import PIPE
+from StringIO import StringIO
 import zfs.util
 from flexmock import flexmock
 from nose.tools import raises, assert_raises, assert_equal
 from zfs import *
 
+class FakeChannel(object):
+    """A stand-in for a paramiko channel that has already received all of its
+    data, with a fileno that is always ready for select"""
+
+    def __init__(self, out, err=None, rc=0):
+        self.out=''.join(out)
+        self.err=''.join(err or [])
+        self.rc=rc
+        self.reads=[]
+        self.eof_received=True
+        self.closed=False
+        self._r, w = os.pipe()
+        os.write(w, 'x')
+        os.close(w)
+
+    def fileno(self):
+        return self._r
+
+    def recv_ready(self):
+        return self.out != ''
+
+    def recv_stderr_ready(self):
+        return self.err != ''
+
+    def recv(self, n):
+        self.reads.append(n)
+        data, self.out = self.out[:n], self.out[n:]
+        return data
+
+    def recv_stderr(self, n):
+        data, self.err = self.err[:n], self.err[n:]
+        return data
+
+    def recv_exit_status(self):
+        return self.rc
+
+    def close(self):
+        self.closed=True
+
 class Test:
     """
     Test zfs.util
@@ -317,6 +358,120 @@ For more info, run: zfs help list"""
 
         r = util.zfs_list(datasets='failboat')
 
+    def test_zfs_list_stream(self):
+        """
+        test zfs_list in streaming mode
+        """
+        fake_p=flexmock(
+            stdout = StringIO(self.mockedoutnoargs),
+            stderr = StringIO(self.mockederr),
+            wait = lambda: 0)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').with_args(
+            [ 'sudo', 'zfs', 'list', '-H', '-r', '-t', 'filesystem,volume', 'tank'],
+            env=util.ZFS_ENV, stdout=PIPE, stderr=PIPE,
+            bufsize=util.LocalZfsCommandRunner.STREAM_BUF_SZ
+        ).and_return(fake_p)
+        r = util.zfs_list(datasets='tank', recursive=True, stream=True)
+        line = r.next()
+        assert_equal(line[0],'tank')
+        assert_equal(len(line), 5)
+        assert_equal(len(list(r)), 8)
+
+    def test_zfs_list_records(self):
+        """
+        test zfs_list_records converts numeric properties and splits names
+        """
+        out = ('tank/foo\t1416355200\t8192\t-\n'
+               'tank/foo@daily\t1416441600\t0\t-\n'
+               'tank/foo@hourly\t1416445200\t4096\tfalse\n')
+        fake_p=flexmock(
+            communicate = lambda: (out, ''),
+            returncode  = 0)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').with_args(
+            [ 'sudo', 'zfs', 'list', '-H', '-p', '-r', '-t', 'all',
+             '-o', 'name,creation,used,com.sun:auto-snapshot', 'tank/foo'],
+            env=util.ZFS_ENV,
+            stdout=PIPE, stderr=PIPE).and_return(fake_p)
+        r = list(util.zfs_list_records(
+            datasets='tank/foo', types=['all'], recursive=True,
+            properties=['creation', 'used', 'com.sun:auto-snapshot']))
+        assert_equal(len(r), 3)
+        assert_equal(r[0].name, 'tank/foo')
+        assert_equal(r[0].snapname, None)
+        assert_equal(r[0].com_sun_auto_snapshot, None)
+        assert_equal(r[2].name, 'tank/foo@hourly')
+        assert_equal((r[2].creation, r[2].used), (1416445200, 4096))
+        assert_equal(r[2].com_sun_auto_snapshot, 'false')
+        assert r[1].dataset is r[2].dataset
+        assert_equal(max(r, key=lambda x: x.creation).snapname, 'hourly')
+        assert type(r[0]) is util.zfs_record_class(
+            ['name', 'creation', 'used', 'com.sun:auto-snapshot'])
+
+    @raises(ZfsNoDatasetError)
+    def test_zfs_list_stream_with_nonexistent_dataset(self):
+        """
+        test zfs_list in streaming mode with a non-existent dataset
+        """
+        fake_p=flexmock(
+            stdout = StringIO(''),
+            stderr = StringIO(
+                "cannot open 'failboat': dataset does not exist\n"),
+            wait = lambda: 1)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').and_return(fake_p)
+        r = util.zfs_list(datasets='failboat', stream=True)
+        list(r)
+
+    @raises(ZfsNoPoolError)
+    def test_zpool_list_stream_with_nonexistent_pool(self):
+        """
+        test zpool_list in streaming mode with a non existent pool name
+        """
+        fake_p=flexmock(
+            stdout = StringIO(''),
+            stderr = StringIO("cannot open 'failboat': no such pool\n"),
+            wait = lambda: 1)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').and_return(fake_p)
+        r = util.zpool_list(pools='failboat', stream=True)
+        list(r)
+
+    def test_ssh_zfs_list_stream(self):
+        """
+        test zfs_list in streaming mode over SSH
+        """
+        fake_chan=FakeChannel(
+            [self.mockedoutnoargs[:10], self.mockedoutnoargs[10:]])
+        runner=util.SSHZfsCommandRunner(None)
+        flexmock(runner).should_receive('open_cmd_channel').with_args(
+            'zfs', ['list', '-H', '-t', 'filesystem,volume']
+        ).and_return(fake_chan)
+        r = list(runner.zfs_list(stream=True))
+        assert_equal(len(r), 9)
+        assert_equal(r[1][0], 'tank/crap with spaces')
+
+    def test_ssh_run_cmd(self):
+        """
+        test running a command over SSH with output on both streams
+        """
+        out=['x' * util.SSHZfsCommandRunner.RECV_BUF_SZ] * 4
+        fake_chan=FakeChannel(out, ['warning: ', 'something\n'], rc=1)
+        runner=util.SSHZfsCommandRunner(None)
+        flexmock(runner).should_receive('open_cmd_channel').and_return(
+            fake_chan)
+        r = runner.run_cmd('zfs', ['list'], ZfsCommandNotFoundError)
+        assert_equal(r, (''.join(out), 'warning: something\n', 1))
+        # the read size grows when reads fill the buffer
+        assert_equal(fake_chan.reads[-1],
+                     util.SSHZfsCommandRunner.RECV_BUF_SZ * 4)
+
+    def test_iter_lines(self):
+        """test splitting output chunks into lines"""
+        r = list(util._iter_lines(['a\nb', 'c\n', '', 'd\ne']))
+        assert_equal(r, ['a\n', 'bc\n', 'd\n', 'e'])
+
     @raises(ZfsNoPoolError)
     def test_zpool_status_with_nonexistent_pool(self):
         """
@@ -364,6 +519,89 @@ For more info, run: zfs help list"""
         r = util.zpool_status(pools=['pool1','pool2'])
         assert r
 
+    def test_parse_zpool_status(self):
+        """test parsing a degraded, resilvering pool"""
+        out = (
+            '  pool: tank\n'
+            ' state: DEGRADED\n'
+            'status: One or more devices is currently being resilvered.  The pool will\n'
+            '\tcontinue to function, possibly in a degraded state.\n'
+            'action: Wait for the resilver to complete.\n'
+            '  scan: resilver in progress since Sun Jul 25 16:07:49 2021\n'
+            '\t403G scanned at 100M/s, 68.4G issued at 10.6M/s, 405G total\n'
+            '\t68.4G resilvered, 16.91% done, 0 days 09:01:12 to go\n'
+            'config:\n'
+            '\n'
+            '\tNAME        STATE     READ WRITE CKSUM\n'
+            '\ttank        DEGRADED     0     0     0\n'
+            '\t  mirror-0  DEGRADED     0     0     0\n'
+            '\t    sda     ONLINE       0     0     0\n'
+            '\t    sdb     FAULTED      3   1.2K    0  too many errors  (resilvering)\n'
+            '\tlogs\n'
+            '\t  sdc       ONLINE       0     0     0\n'
+            '\tspares\n'
+            '\t  sdd       AVAIL\n'
+            '\n'
+            'errors: Permanent errors have been detected in the following files:\n'
+            '\n'
+            '        tank:<0x0>\n'
+            '        /tank/foo/bar\n'
+            '\n'
+            '  pool: rpool\n'
+            ' state: ONLINE\n'
+            '  scan: scrub repaired 0B in 0 days 00:05:23 with 0 errors on Sun Jul 11 00:29:24 2021\n'
+            'config:\n'
+            '\n'
+            '\tNAME        STATE     READ WRITE CKSUM\n'
+            '\trpool       ONLINE       0     0     0\n'
+            '\t  nvme0n1p3 ONLINE       0     0     0\n'
+            '\n'
+            'errors: No known data errors\n')
+        r = util.parse_zpool_status(out)
+        assert_equal([s.name for s in r], ['tank', 'rpool'])
+        tank, rpool = r
+        assert_equal(tank.state, 'DEGRADED')
+        assert tank.status.endswith('possibly in a degraded state.')
+        assert_equal((tank.scan_type, tank.scan_state, tank.scan_progress,
+                      tank.scan_eta),
+                     ('resilver', 'in progress', 16.91, 9 * 3600 + 72))
+        assert tank.syncing
+        assert_equal(tank.errors, 'Permanent errors have been detected in '
+                     'the following files:')
+        assert_equal(tank.error_files, ['tank:<0x0>', '/tank/foo/bar'])
+        assert_equal([v.name for v in tank.vdevs], ['tank', 'logs', 'spares'])
+        sdb = tank.vdevs[0].children[0].children[1]
+        assert_equal((sdb.name, sdb.state, sdb.read, sdb.write, sdb.cksum,
+                      sdb.note),
+                     ('sdb', 'FAULTED', '3', '1.2K', '0',
+                      'too many errors  (resilvering)'))
+        assert_equal(tank.vdevs[2].children[0].state, 'AVAIL')
+        assert_equal(tank.vdevs[1].state, None)
+
+        assert_equal((rpool.scan_type, rpool.scan_state, rpool.scan_eta),
+                     ('scrub', 'completed', None))
+        assert not rpool.syncing
+        assert_equal(rpool.status, None)
+        assert_equal(rpool.errors, 'No known data errors')
+        assert_equal(rpool.error_files, [])
+        assert_equal(rpool.vdevs[0].children[0].name, 'nvme0n1p3')
+
+    def test_parse_zpool_status_old_scrub(self):
+        """test parsing the scan line of older zpool versions"""
+        out = (
+            '  pool: tank\n'
+            ' state: ONLINE\n'
+            ' scan: scrub in progress since Sun Nov 23 00:00:01 2014\n'
+            '    18.5G scanned out of 49.4G at 21.6M/s, 0h24m to go\n'
+            '    0 repaired, 37.45% done\n'
+            'config:\n')
+        r = util.parse_zpool_status(out)
+        assert_equal((r[0].scan_state, r[0].scan_progress, r[0].scan_eta),
+                     ('in progress', 37.45, 24 * 60))
+        assert_equal(util.parse_zpool_status(
+            '  pool: tank\n state: ONLINE\n  scan: none requested\n')[0]
+            .scan_type, None)
+
     def test_zfs_create(self):
         """test zfs_create"""
         fake_p=flexmock(
@@ -393,6 +631,20 @@ For more info, run: zfs help list"""
         assert_equal(r, None)
 
 
+    def test_zfs_create_with_props(self):
+        """test zfs_create with properties"""
+        fake_p=flexmock(
+            communicate = lambda: ('', ''),
+            returncode = 0)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').with_args(
+            ['sudo', 'zfs', 'create', '-o', 'compression=lz4', 'tank/foo'],
+            env=util.ZFS_ENV, stdout=PIPE, stderr=PIPE
+        ).and_return(fake_p)
+
+        r = util.zfs_create('tank/foo', props={'compression': 'lz4'})
+        assert_equal(r, None)
+
     def test_zfs_destroy_one_existing_item(self):
         """test zfs_destroy with one existing snapshot"""
         fake_p=flexmock(
@@ -446,6 +698,73 @@ For more info, run: zfs help list"""
 
 
 
+    def test_zfs_destroy_snapshots(self):
+        """test zfs_destroy_snapshots batching snapshots into one command"""
+        fake_p=flexmock(
+            communicate = lambda: ('',''),
+            returncode  = 0)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').with_args(
+            ['sudo', 'zfs', 'destroy', 'tank/foo@a,c%e,g'], env=util.ZFS_ENV,
+            stdout=PIPE, stderr=PIPE
+        ).and_return(fake_p).once()
+
+        r = util.zfs_destroy_snapshots('tank/foo', ['a', 'c', 'd', 'e', 'g'],
+            allsnaps=['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'])
+        assert_equal(r, ['tank/foo@a', 'tank/foo@c', 'tank/foo@d',
+                         'tank/foo@e', 'tank/foo@g'])
+
+    def test_zfs_destroy_snapshots_recursive(self):
+        """test zfs_destroy_snapshots doesn't use ranges when recursive"""
+        fake_p=flexmock(
+            communicate = lambda: ('',''),
+            returncode  = 0)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').with_args(
+            ['sudo', 'zfs', 'destroy', '-r', 'tank/foo@a,b'], env=util.ZFS_ENV,
+            stdout=PIPE, stderr=PIPE
+        ).and_return(fake_p).once()
+
+        r = util.zfs_destroy_snapshots('tank/foo', ['a', 'b'], recursive=True,
+                                       allsnaps=['a', 'b'])
+        assert_equal(r, ['tank/foo@a', 'tank/foo@b'])
+
+    def test_zfs_destroy_snapshots_partial_failure(self):
+        """test zfs_destroy_snapshots when part of a batch can't be destroyed
+
+        The batch is retried one snapshot at a time"""
+        busy_p=flexmock(
+            communicate = lambda: (
+                '', "cannot destroy snapshot tank/foo@b: dataset is busy\n"),
+            returncode  = 1)
+        ok_p=flexmock(
+            communicate = lambda: ('',''),
+            returncode  = 0)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').with_args(
+            ['sudo', 'zfs', 'destroy', 'tank/foo@a,b,c'], env=util.ZFS_ENV,
+            stdout=PIPE, stderr=PIPE
+        ).and_return(busy_p).once()
+        mysubprocess.should_receive('Popen').with_args(
+            ['sudo', 'zfs', 'destroy', 'tank/foo@b'], env=util.ZFS_ENV,
+            stdout=PIPE, stderr=PIPE
+        ).and_return(busy_p).once()
+        for snap in ['tank/foo@a', 'tank/foo@c']:
+            mysubprocess.should_receive('Popen').with_args(
+                ['sudo', 'zfs', 'destroy', snap], env=util.ZFS_ENV,
+                stdout=PIPE, stderr=PIPE
+            ).and_return(ok_p).once()
+
+        r = util.zfs_destroy_snapshots('tank/foo', ['a', 'b', 'c'])
+        assert_equal(r, ['tank/foo@a', 'tank/foo@c'])
+
+    def test_snapshot_specs_split(self):
+        """test splitting snapshot destroy arguments to fit the length limit"""
+        r = util._snapshot_specs('tank', ['aaaa', 'bbbb', 'cccc', 'dddd'],
+                                 budget=len('tank@aaaa,bbbb'))
+        assert_equal(r, [('tank@aaaa,bbbb', ['tank@aaaa', 'tank@bbbb']),
+                         ('tank@cccc,dddd', ['tank@cccc', 'tank@dddd'])])
+
     @raises(ZfsPermissionError)
     def test_zfs_destroy_bad_perms_linux(self):
         """test zfs_destroy with bad permissions on /dev/zfs
@@ -580,6 +899,38 @@ For the delegated permission list, run: zfs allow|unallow
         r = util.zfs_snapshot('tank', snapname, True)
         assert_equal(r, None)
 
+    def test_zfs_snapshot_multiple(self):
+        """test zfs_snapshot of several datasets, one command per pool"""
+        fake_p=flexmock(
+            communicate = lambda: ('',''),
+            returncode  = 0)
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').with_args(
+            ['sudo', 'zfs', 'snapshot', 'tank@snap', 'tank/foo@snap',
+             'tank/bar@snap'], env=util.ZFS_ENV,
+            stdout=PIPE, stderr=PIPE
+        ).and_return(fake_p).once()
+        mysubprocess.should_receive('Popen').with_args(
+            ['sudo', 'zfs', 'snapshot', 'chile/rt@snap'], env=util.ZFS_ENV,
+            stdout=PIPE, stderr=PIPE
+        ).and_return(fake_p).once()
+
+        r = util.zfs_snapshot(['tank', 'tank/foo', 'chile/rt', 'tank/bar'],
+                              'snap')
+        assert_equal(r, None)
+
+    @raises(ZfsBadFsName)
+    def test_zfs_snapshot_multiple_bad_name(self):
+        """test zfs_snapshot validates every name before taking snapshots"""
+        mysubprocess=flexmock(subprocess)
+        mysubprocess.should_receive('Popen').never()
+        util.zfs_snapshot(['tank', 'tank//foo'], 'snap')
+
+    def test_split_args(self):
+        """test splitting arguments to fit the length limit"""
+        r = util._split_args(['aaa', 'bbb', 'ccc', 'dddddddd'], 8)
+        assert_equal(r, [['aaa', 'bbb'], ['ccc'], ['dddddddd']])
+
     def test_get_pool_from_fsname(self):
         """Test ability to get zpool name from fsname
         """
@@ -0,0 +1,139 @@
+import threading
+import time
+from nose.tools import raises, assert_equal
+from zfs.workers import DatasetWorkerPool, ReplicationJob, \
+        ReplicationScheduler, SendProgress, parse_duration
+
+def test_map_serial():
+    """test map with a single job"""
+    r = DatasetWorkerPool().map(lambda ds: ds.upper(), ['tank/a', 'tank/b'])
+    assert_equal([x.result for x in r], ['TANK/A', 'TANK/B'])
+
+def test_map_errors():
+    """test that exceptions are recorded per dataset"""
+    def fn(ds):
+        if ds == 'tank/bad':
+            raise ValueError(ds)
+        return ds
+    r = DatasetWorkerPool(jobs=4).map(fn, ['tank/a', 'tank/bad', 'tank/c'])
+    assert_equal([x.ok for x in r], [True, False, True])
+    assert_equal([x.dataset for x in r], ['tank/a', 'tank/bad', 'tank/c'])
+    assert isinstance(r[1].error, ValueError)
+
+def test_map_limits():
+    """test the overall and per-pool concurrency limits"""
+    lock = threading.Lock()
+    running = {}
+    peak = {}
+    def fn(ds):
+        pool = ds.split('/')[0]
+        with lock:
+            running[pool] = running.get(pool, 0) + 1
+            running['all'] = running.get('all', 0) + 1
+            for k in (pool, 'all'):
+                peak[k] = max(peak.get(k, 0), running[k])
+        time.sleep(0.02)
+        with lock:
+            running[pool] -= 1
+            running['all'] -= 1
+    datasets = ['tank/%d' % i for i in range(10)] + \
+               ['chile/%d' % i for i in range(10)]
+    r = DatasetWorkerPool(jobs=4, pool_jobs=2).map(fn, datasets)
+    assert all(x.ok for x in r)
+    assert_equal(peak['all'], 4)
+    assert_equal(peak['tank'], 2)
+    assert_equal(peak['chile'], 2)
+
+@raises(ValueError)
+def test_bad_jobs():
+    """test that a job limit below 1 is refused"""
+    DatasetWorkerPool(jobs=0)
+
+def test_scheduler_largest_first():
+    """test that jobs start largest first, unknown sizes last"""
+    started = []
+    jobs = [ReplicationJob('tank/a', size=10), ReplicationJob('tank/b'),
+            ReplicationJob('tank/c', size=300), ReplicationJob('tank/d', 20)]
+    r = ReplicationScheduler().map(lambda job: started.append(job.dataset),
+                                   jobs)
+    assert_equal(started, ['tank/c', 'tank/d', 'tank/a', 'tank/b'])
+    assert_equal([x.dataset for x in r], ['tank/a', 'tank/b', 'tank/c',
+                                          'tank/d'])
+
+def test_scheduler_limits():
+    """test the per source pool, target pool and host limits"""
+    lock = threading.Lock()
+    running = {}
+    peak = {}
+    def fn(job):
+        keys = ['all', 'src:' + job.source_pool, 'dst:' + job.target_pool,
+                'host:' + job.target_host]
+        with lock:
+            for k in keys:
+                running[k] = running.get(k, 0) + 1
+                peak[k] = max(peak.get(k, 0), running[k])
+        time.sleep(0.02)
+        with lock:
+            for k in keys:
+                running[k] -= 1
+        if job.dataset == 'tank/3' and job.target_pool == 'backup':
+            raise ValueError(job.dataset)
+        return job.size
+    jobs = [ReplicationJob('%s/%d' % (pool, i), size=i, source_pool=pool,
+                           target_pool=target, target_host=host)
+            for i in range(6)
+            for pool, target, host in (('tank', 'backup', 'b1'),
+                                       ('chile', 'backup', 'b1'),
+                                       ('tank', 'vault', 'b2'))]
+    r = ReplicationScheduler(jobs=6, source_pool_jobs=3, target_pool_jobs=2,
+                             host_jobs=3).map(fn, jobs)
+    assert_equal([x.ok for x in r].count(False), 1)
+    assert_equal(r[9].dataset, 'tank/3')
+    assert isinstance(r[9].error, ValueError)
+    assert_equal(peak['dst:backup'], 2)
+    assert_equal(peak['dst:vault'], 2)
+    assert peak['src:tank'] <= 3
+    assert peak['host:b1'] <= 2
+    assert_equal(peak['all'], 4)
+
+@raises(ValueError)
+def test_scheduler_bad_limit():
+    """test that a per-host limit below 1 is refused"""
+    ReplicationScheduler(jobs=2, host_jobs=0)
+
+def test_send_progress():
+    """test the time left, first at the link rate then as measured"""
+    now = [1000.0]
+    jobs = [ReplicationJob('tank/a', 600), ReplicationJob('tank/b', 400),
+            ReplicationJob('tank/c')]
+    progress = SendProgress(jobs, window=20, link_rate=100,
+                            clock=lambda: now[0])
+    assert_equal(progress.planned_bytes, 1000)
+    assert_equal(progress.eta(), 10)
+    assert progress.fits()
+    now[0] += 10
+    progress.job_done(jobs[0], 300)
+    # 300 bytes in 10 seconds leaves 400 bytes for 13.3 more
+    assert_equal(progress.rate(), 30)
+    assert abs(progress.eta() - 400 / 30.0) < 1e-9
+    assert not progress.fits()
+
+def test_send_progress_unknown_rate():
+    """test that a run with nothing to go by always fits"""
+    progress = SendProgress([ReplicationJob('tank/a', 600)], window=1)
+    assert progress.eta() is None
+    assert progress.fits()
+
+def test_parse_duration():
+    """test parsing backup windows"""
+    assert_equal(parse_duration('90'), 90)
+    assert_equal(parse_duration('90m'), 5400)
+    assert_equal(parse_duration('1.5h'), 5400)
+    assert_equal(parse_duration('2d'), 172800)
+    for text in ('', 'soon', '1y'):
+        try:
+            parse_duration(text)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('%r was parsed' % text)
@@ -1,3 +1,7 @@
+import os
+import shutil
+import tempfile
+import zfs.util
 from flexmock import flexmock
 from nose.tools import raises, assert_raises, assert_equal
 from optparse import Values
@@ -54,3 +58,55 @@ def test_main_enough_args():
     args=['testapp', 'stinkily', '5']
     r=main(args)
     assert_equal(r, 0)
+
+def test_main_jobs():
+    """test main with the jobs option
+    """
+
+    fakesnapper=flexmock(RollingSnapshotter)
+    fakesnapper.should_receive('take_snapshot').and_return([])
+    args=['testapp', '-j', '4', '--pool-jobs', '2', 'stinkily', '5']
+    r=main(args)
+    assert_equal(r, 0)
+
+@raises(SystemExit)
+def test_main_bad_jobs():
+    """test main with a bad jobs option
+    """
+
+    fakesnapper=flexmock(RollingSnapshotter)
+    fakesnapper.should_receive('take_snapshot').and_return()
+    args=['testapp', '-j', '0', 'stinkily', '5']
+    r=main(args)
+    assert(r)
+
+def test_main_trace():
+    """test main with the trace option
+    """
+
+    fakesnapper=flexmock(RollingSnapshotter)
+    fakesnapper.should_receive('take_snapshot').and_return([])
+    flexmock(zfs.util._LCR).should_receive('trace_baseline').once()
+    f=tempfile.NamedTemporaryFile()
+    args=['testapp', '--trace', f.name, 'stinkily', '5']
+    r=main(args)
+    assert_equal(r, 0)
+    assert_equal(zfs.util._LCR.tracers, [])
+
+def test_main_metrics_file():
+    """test main with the metrics-file option
+    """
+
+    fakesnapper=flexmock(RollingSnapshotter)
+    fakesnapper.should_receive('take_snapshot').and_return([])
+    d=tempfile.mkdtemp()
+    path=os.path.join(d, 'zfsautosnap.prom')
+    args=['testapp', '--metrics-file', path, 'stinkily', '5']
+    try:
+        r=main(args)
+        assert_equal(r, 0)
+        with open(path) as f:
+            assert 'zfsautosnap_run_success{app="zfsautosnap",'\
+                'label="stinkily"} 1\n' in f.read()
+    finally:
+        shutil.rmtree(d)
@@ -50,6 +50,27 @@ class ZfsPermissionError(ZfsOSError):
     """
     pass
 
+class ZfsBrokerError(ZfsError):
+    """The ZFS broker could not be reached, or refused a command"""
+    pass
+
+class ZfsReplicationError(ZfsError):
+    """A zfs send piped into a zfs receive failed
+
+    Attributes:
+        send_rc     the exit status of zfs send, or None if unknown
+        recv_rc     the exit status of zfs receive, or None if unknown
+        send_err    the error output of zfs send
+        recv_err    the error output of zfs receive
+    """
+    def __init__(self, message, send_rc=None, recv_rc=None, send_err='',
+                 recv_err=''):
+        super(ZfsReplicationError, self).__init__(message)
+        self.send_rc = send_rc
+        self.recv_rc = recv_rc
+        self.send_err = send_err
+        self.recv_err = recv_err
+
 class ZfsArgumentError(ValueError):
     """Zfs-specfic errors for parameters."""
     pass
@@ -0,0 +1,561 @@
+"""Run many ZFS commands concurrently from a single thread
+
+The runners in this module start commands without waiting for them to finish,
+returning a :py:class:`CommandFuture` for each one. The commands' output is
+collected by an event loop that waits on all of their pipes or SSH channels
+at once with poll (or select), so hundreds of commands can be in flight
+without a thread per command. The loop runs whenever the result of a future
+is requested, or explicitly with
+:py:func:`AsyncZfsCommandRunner.run_until_complete` and
+:py:func:`AsyncZfsCommandRunner.gather`.
+
+Example::
+
+    runner = AsyncLocalZfsCommandRunner(command_prefix='sudo',
+                                        max_concurrency=32)
+    futures = [runner.zfs_list_async(fs, types=['snapshot'])
+               for fs in filesystems]
+    for rows in runner.gather(futures):
+        ...
+
+The runners are also complete :py:class:`zfs.util.ZfsCommandRunner`
+implementations: the blocking methods such as `zfs_list` still work, each
+running the event loop until its own command is done.
+"""
+
+import collections
+import errno
+import logging
+import os
+import select
+import sys
+import time
+import cmdtrace
+from . import *
+import util
+
+class CommandFuture(object):
+    """The eventual result of a command started by an AsyncZfsCommandRunner
+
+    Asking for the result of a future that isn't done yet runs the runner's
+    event loop until it is.
+    """
+
+    def __init__(self, runner):
+        """Initialize a new CommandFuture
+
+        :param AsyncZfsCommandRunner runner: the runner whose event loop will
+        complete this future
+        """
+        self.runner = runner
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True if the future has a result or an exception"""
+        return self._done
+
+    def result(self):
+        """Return the result of the future, waiting for it if needed
+
+        :raises: the exception the command or its result parser raised
+        """
+        if not self._done:
+            self.runner.run_until_complete([self])
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        """Return the exception of the future, waiting for it if needed
+
+        :return: the exception, or None if the future completed successfully
+        """
+        if not self._done:
+            self.runner.run_until_complete([self])
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """Call fn with this future once it is done
+
+        If the future is already done, fn is called immediately.
+        """
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def then(self, fn):
+        """Chain a function onto this future
+
+        :param fn: called with the result of this future
+        :return: a new future for the return value of fn. If this future or
+        fn raise an exception, the new future raises it.
+        :rtype: CommandFuture
+        """
+        chained = CommandFuture(self.runner)
+        def callback(future):
+            try:
+                result = fn(future.result())
+            except Exception:
+                chained.set_exception(sys.exc_info())
+            else:
+                chained.set_result(result)
+        self.add_done_callback(callback)
+        return chained
+
+    def set_result(self, result):
+        """Mark the future done with the given result"""
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """Mark the future done with the exception from sys.exc_info()"""
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+def combine_futures(runner, futures):
+    """Return a future that is done when all of the given futures are
+
+    :param AsyncZfsCommandRunner runner: the runner the futures belong to
+    :param list futures: the futures to wait for
+    :return: a future for the list of results. If any of the futures raised
+    an exception, the combined future raises the first of them.
+    :rtype: CommandFuture
+    """
+    combined = CommandFuture(runner)
+    futures = list(futures)
+    remaining = [len(futures)]
+
+    def callback(future):
+        remaining[0] -= 1
+        if remaining[0] > 0:
+            return
+        for f in futures:
+            if f._exc_info is not None:
+                combined.set_exception(f._exc_info)
+                return
+        combined.set_result([f._result for f in futures])
+
+    if not futures:
+        combined.set_result([])
+    for f in futures:
+        f.add_done_callback(callback)
+    return combined
+
+class AsyncZfsCommandRunner(util.ZfsCommandRunner):
+    """Base class for running many Zfs commands concurrently
+
+    Subclasses implement `_start_job`, which starts a command and returns an
+    object with the following methods for the event loop to use:
+        * filenos() - the file descriptors to wait on for output
+        * read(fd) - read whatever output is ready on fd
+        * finished() - True once all of the output has been read
+        * result() - the (out, err, rc) tuple of the command
+
+    At most `max_concurrency` commands run at once. Commands submitted beyond
+    that are queued and started as earlier ones finish.
+    """
+
+    MAX_CONCURRENCY=16
+
+    def __init__(self, *args, **kwargs):
+        """Initialize a new AsyncZfsCommandRunner
+
+        Takes the same arguments as the runner it is mixed with, plus:
+
+        :param int max_concurrency: the maximum number of commands to run at
+        once
+        """
+        self.max_concurrency = kwargs.pop('max_concurrency',
+                                          self.MAX_CONCURRENCY)
+        if self.max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+        self._pending = collections.deque()
+        self._jobs = []
+        super(AsyncZfsCommandRunner, self).__init__(*args, **kwargs)
+
+    def _start_job(self, cmdargs, errorclass):
+        """Start a command without waiting for it
+
+        This must be overridden by subclasses
+
+        :param list cmdargs: the full command line to run
+        :param errorclass: the exeception that should be raised if the command
+        is not found
+        :raises NotImplementedError: this method must be overridden
+        :return: a job object, as described in the class documentation
+        """
+        raise NotImplementedError
+
+    def submit(self, cmd, args, errorclass=None):
+        """Start running a ZFS command
+
+        :param str cmd: The zfs command to run
+        :param args: Arguments to the zfs command
+        :param errorclass: the exeception that should be raised if the command
+        is not found
+        :return: a future for the (out, err, rc) tuple of the command
+        :rtype: CommandFuture
+        """
+        cmdargs = self.process_cmd_args(cmd, args)
+        future = CommandFuture(self)
+        self._pending.append((cmd, args, cmdargs, errorclass, future))
+        self._start_pending()
+        return future
+
+    def run_cmd(self, cmd, args, errorclass=None):
+        """Run a command, waiting for it to finish
+
+        See :py:func:`ZfsCommandRunner.run_cmd` for a description of the
+        parameters and the return values
+        """
+        return self.submit(cmd, args, errorclass).result()
+
+    def run_until_complete(self, futures=None):
+        """Run the event loop
+
+        :param futures: the futures to wait for. If None, run until every
+        submitted command has finished.
+        :type futures: list or None
+        """
+        while True:
+            if futures is None:
+                if not self._jobs and not self._pending:
+                    return
+            elif all(f.done() for f in futures):
+                return
+            if not self._jobs:
+                raise RuntimeError('waiting on futures with no commands '
+                                   'running to complete them')
+            self._poll()
+
+    def gather(self, futures, return_exceptions=False):
+        """Wait for all of the futures and return their results
+
+        :param list futures: the futures to wait for
+        :param bool return_exceptions: if true, exceptions are returned in
+        place of the results of the futures that raised them. Otherwise the
+        first exception is raised once all of the futures are done.
+        :return: the results, in the same order as `futures`
+        :rtype: list
+        """
+        futures = list(futures)
+        self.run_until_complete(futures)
+        results = []
+        for f in futures:
+            if return_exceptions and f.exception() is not None:
+                results.append(f.exception())
+            else:
+                results.append(f.result())
+        return results
+
+    def _start_pending(self):
+        """Start queued commands while there is room for them"""
+        while self._pending and len(self._jobs) < self.max_concurrency:
+            cmd, args, cmdargs, errorclass, future = self._pending.popleft()
+            t = None
+            if self.tracers:
+                cmdtrace.take_spawned()
+                t = cmdtrace.CommandTrace(self.runner_type, cmd, args,
+                                       time.time())
+            try:
+                job = self._start_job(cmdargs, errorclass)
+            except Exception as e:
+                if t is not None:
+                    t.error = type(e).__name__
+                    util._finish_trace(t)
+                    self._record_trace(t)
+                future.set_exception(sys.exc_info())
+                continue
+            if t is not None:
+                util._finish_spawn(t)
+            job.future = future
+            job.trace = t
+            self._jobs.append(job)
+
+    def _poll(self):
+        """Wait for output from the running commands and process it"""
+        fdmap = {}
+        idle = False
+        for job in self._jobs:
+            fds = job.filenos()
+            if not fds:
+                idle = True
+            for fd in fds:
+                fdmap[fd] = job
+
+        # A job with nothing left to read is waiting on something we can't
+        # poll for, such as an SSH exit status, so only wait briefly
+        for fd in self._wait(fdmap.keys(), 0.01 if idle else None):
+            fdmap[fd].read(fd)
+
+        for job in list(self._jobs):
+            if job.finished():
+                self._jobs.remove(job)
+                try:
+                    result = job.result()
+                except Exception as e:
+                    self._finish_job_trace(job, error=e)
+                    job.future.set_exception(sys.exc_info())
+                else:
+                    self._finish_job_trace(job, result=result)
+                    job.future.set_result(result)
+
+        self._start_pending()
+
+    def _finish_job_trace(self, job, result=None, error=None):
+        """Complete and record the trace of a finished job, if it has one"""
+        t = job.trace
+        if t is None:
+            return
+        if error is not None:
+            t.error = type(error).__name__
+        else:
+            out,err,rc = result
+            t.out_bytes = len(out)
+            t.err_bytes = len(err)
+            t.rc = rc
+        util._finish_trace(t)
+        self._record_trace(t)
+
+    def _run_traced(self, cmd, args, errorclass):
+        """Run a command, which is traced as a job by the event loop"""
+        return self.run_cmd(cmd, args, errorclass)
+
+    def _wait(self, fds, timeout=None):
+        """Wait until some of the file descriptors are readable
+
+        :param list fds: the file descriptors to wait on
+        :param timeout: seconds to wait, or None to wait indefinitely
+        :return: the readable file descriptors
+        :rtype: list
+        """
+        while True:
+            try:
+                if hasattr(select, 'poll'):
+                    poller = select.poll()
+                    for fd in fds:
+                        poller.register(fd, select.POLLIN | select.POLLPRI)
+                    ms = None if timeout is None else int(timeout * 1000)
+                    return [fd for fd, event in poller.poll(ms)]
+                r, w, x = select.select(fds, [], [], timeout)
+                return r
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def _submit_zfs(self, args):
+        """Start a zfs command, checking for permission errors like
+        :py:func:`ZfsCommandRunner.run_zfs`"""
+        def check(result):
+            out,err,rc = result
+            if rc > 0:
+                util._check_perm_err(err)
+            return result
+        return self.submit('zfs', args, ZfsCommandNotFoundError).then(check)
+
+    def zpool_list_async(self, pools=None, properties=None, parsable=False):
+        """Start listing properties about a pool or pools
+
+        See :py:func:`ZfsCommandRunner.zpool_list` for details.
+
+        :return: a future for the rows of the listing
+        :rtype: CommandFuture
+        """
+        args = self._zpool_list_args(pools, properties, parsable)
+        return self.submit('zpool', args, ZpoolCommandNotFoundError).then(
+            lambda r: self._zpool_list_result(*r))
+
+    def zfs_list_async(self, datasets=None, types=['filesystem','volume'],
+                       properties=None, sort=None, sortorder='asc',
+                       recursive=False, depth=None, parsable=False):
+        """Start listing properties about a ZFS dataset or datasets
+
+        See :py:func:`ZfsCommandRunner.zfs_list` for details.
+
+        :return: a future for the rows of the listing
+        :rtype: CommandFuture
+        """
+        args = self._zfs_list_args(datasets, types, properties, sort,
+                                   sortorder, recursive, depth, parsable)
+        return self._submit_zfs(args).then(
+            lambda r: self._zfs_list_result(*r))
+
+    def zfs_destroy_async(self, datasets, recursive=False):
+        """Start destroying datasets or snapshots
+
+        See :py:func:`ZfsCommandRunner.zfs_destroy` for details.
+
+        :return: a future that is done when the command has finished
+        :rtype: CommandFuture
+        """
+        args,datasets = self._zfs_destroy_args(datasets, recursive)
+        return self._submit_zfs(args).then(
+            lambda r: self._zfs_destroy_result(datasets, *r))
+
+    def zfs_create_async(self, filesystem, props=None, create_parents=False):
+        """Start creating a new ZFS file system
+
+        See :py:func:`ZfsCommandRunner.zfs_create` for details.
+
+        :return: a future that is done when the command has finished
+        :rtype: CommandFuture
+        """
+        args = self._zfs_create_args(filesystem, props, create_parents)
+        return self._submit_zfs(args).then(
+            lambda r: self._zfs_create_result(filesystem, *r))
+
+    def zfs_create_many(self, filesystems, create_parents=False,
+                        return_exceptions=False):
+        """Create several ZFS file systems concurrently
+
+        See :py:func:`zfs.util.ZfsCommandRunner.zfs_create_many`. Without
+        `return_exceptions`, the first error is raised once every command
+        has finished.
+        """
+        filesystems = util._leaf_filesystems(filesystems) if create_parents \
+                else list(filesystems)
+        results = self.gather(
+            [self.zfs_create_async(fs, create_parents=create_parents)
+             for fs in filesystems], return_exceptions=return_exceptions)
+        if return_exceptions:
+            return [(fs, r if isinstance(r, Exception) else None)
+                    for fs, r in zip(filesystems, results)]
+        return filesystems
+
+    def zfs_snapshot_async(self, dataset, snapname, recursive=False):
+        """Start snapshotting a ZFS filesystem or filesystems
+
+        The commands for each pool run concurrently. See
+        :py:func:`ZfsCommandRunner.zfs_snapshot` for details.
+
+        :return: a future that is done when all of the snapshots are taken
+        :rtype: CommandFuture
+        """
+        futures = []
+        for group in self._zfs_snapshot_groups(dataset, snapname):
+            args = self._zfs_snapshot_args(group, recursive)
+            futures.append(self._submit_zfs(args).then(
+                lambda r, group=group: self._zfs_snapshot_result(group, *r)))
+        return combine_futures(self, futures).then(lambda r: None)
+
+    def zpool_status_async(self, pools=None):
+        """Start checking the status of a pool or pools
+
+        See :py:func:`ZfsCommandRunner.zpool_status` for details.
+
+        :return: a future for the raw text output of zpool status
+        :rtype: CommandFuture
+        """
+        args = self._zpool_status_args(pools)
+        return self.submit('zpool', args, ZpoolCommandNotFoundError).then(
+            lambda r: self._zpool_status_result(*r))
+
+class _ProcessJob(object):
+    """A local command being run by AsyncLocalZfsCommandRunner"""
+
+    READ_SZ=65536
+
+    def __init__(self, p, cmdargs):
+        self.p = p
+        self.cmdargs = cmdargs
+        self.out = []
+        self.err = []
+        self.bufs = {
+            p.stdout.fileno() : self.out,
+            p.stderr.fileno() : self.err,
+        }
+        self.open = set(self.bufs)
+
+    def filenos(self):
+        return list(self.open)
+
+    def read(self, fd):
+        data = os.read(fd, self.READ_SZ)
+        if data == '':
+            self.open.discard(fd)
+        else:
+            self.bufs[fd].append(data)
+
+    def finished(self):
+        return not self.open
+
+    def result(self):
+        self.p.stdout.close()
+        self.p.stderr.close()
+        rc = self.p.wait()
+        logging.debug('command %s returned result code %d' % (
+            str([self.cmdargs]), rc))
+        return (''.join(self.out), ''.join(self.err), rc)
+
+class AsyncLocalZfsCommandRunner(AsyncZfsCommandRunner,
+                                 util.LocalZfsCommandRunner):
+    """Run many ZFS commands concurrently on the local system
+
+    Each command is a subprocess whose stdout and stderr pipes are watched by
+    the event loop.
+    """
+
+    def _start_job(self, cmdargs, errorclass):
+        """Start a local subprocess"""
+        return _ProcessJob(self._popen(cmdargs, errorclass), cmdargs)
+
+class _ChannelJob(object):
+    """A remote command being run by AsyncSSHZfsCommandRunner"""
+
+    def __init__(self, chan, bufsz):
+        self.chan = chan
+        self.bufsz = bufsz
+        self.out = []
+        self.err = []
+
+    def _drained(self):
+        return (self.chan.eof_received or self.chan.closed) and \
+            not self.chan.recv_ready() and not self.chan.recv_stderr_ready()
+
+    def filenos(self):
+        # The channel stays readable once it has reached EOF
+        if self._drained():
+            return []
+        return [self.chan.fileno()]
+
+    def read(self, fd):
+        if self.chan.recv_ready():
+            self.out.append(self.chan.recv(self.bufsz))
+        if self.chan.recv_stderr_ready():
+            self.err.append(self.chan.recv_stderr(self.bufsz))
+
+    def finished(self):
+        return self._drained() and self.chan.exit_status_ready()
+
+    def result(self):
+        rc = self.chan.recv_exit_status()
+        self.chan.close()
+        return (''.join(self.out), ''.join(self.err), rc)
+
+class AsyncSSHZfsCommandRunner(AsyncZfsCommandRunner,
+                               util.SSHZfsCommandRunner):
+    """Run many ZFS commands concurrently on a remote system
+
+    Every command gets its own channel, all multiplexed over the single SSH
+    transport of the client. Note that SSH servers limit the number of
+    channels per connection (OpenSSH's MaxSessions defaults to 10), so
+    `max_concurrency` defaults to a lower value than for local commands.
+    """
+
+    MAX_CONCURRENCY=8
+
+    def _start_job(self, cmdargs, errorclass):
+        """Start a command in a new channel"""
+        return _ChannelJob(self._exec_channel(cmdargs), self.RECV_BUF_SZ)
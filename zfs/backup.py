@@ -1,15 +1,61 @@
+import collections
 import logging
 import paramiko
 import snapshot
+import time
 import util
 import os
+from . import *
+from index import SnapshotIndex, ReplicaIndex, newest_common_snapshot
+from asyncrunner import AsyncSSHZfsCommandRunner
+from pipeline import send_receive, DEFAULT_BUF_SZ
+from ringbuffer import RingBuffer, DEFAULT_BLOCK_SZ
+from metrics import RunMetrics
+from poolstate import PoolStateCache
+from workers import DatasetResult, ReplicationJob, ReplicationScheduler, \
+        SendProgress
+from capabilities import CapabilityCache, send_options
+
+# Which of the local snapshots newer than the remote ones are sent: every
+# one, in a single `zfs send -I` stream; only the ones of the backup's
+# prefix and label, in a `zfs send -i` stream each; or just the newest
+HISTORY_MODES=['all', 'label', 'newest']
+
+class BackupPlan(collections.namedtuple('BackupPlan', [
+        'fs', 'snapshot', 'incremental_source', 'remote_backup_path',
+        'recursive', 'resume_token', 'creation', 'send_options',
+        'rollback', 'steps'])):
+    """What :py:class:`MbufferedSSHBackup` will send to back up a filesystem
+
+    Attributes:
+        fs          the local filesystem
+        snapshot    the local snapshot to bring the remote filesystem up to
+        incremental_source  the snapshot to send incrementally from, or None
+                    for a full send
+        remote_backup_path  the remote filesystem to receive into
+        recursive   true to send the child filesystems as well
+        resume_token  the token of an interrupted send to finish first, or
+                    None
+        creation    the creation time of snapshot, or None if unknown
+        send_options  the stream format, keyword arguments for
+                    :py:func:`zfs.util.ZfsCommandRunner.open_zfs_send`
+        rollback    true if the remote filesystem has snapshots newer than
+                    the incremental source, which the receive must roll
+                    back
+        steps       the snapshots to send one at a time before snapshot,
+                    each incrementally from the one before, a tuple
+    """
+    __slots__ = ()
 
 class Backup(object):
     def __init__(self, label, prefix=snapshot.PREFIX,
-                 userprop_name=snapshot.USERPROP_NAME ):
+                 userprop_name=snapshot.USERPROP_NAME, metrics=None ):
         self.label         = label
         self.prefix        = prefix
         self.userprop_name = userprop_name
+        if metrics is None:
+            metrics = RunMetrics('zfsbackup', label=label)
+        self.metrics       = metrics
 
     def take_backup(self, fsnames, snap_children=False):
         """backup the requested fsnames
@@ -24,7 +70,58 @@ class Backup(object):
         raise NotImplementedError
 
 class MbufferedSSHBackup(Backup):
+    # the size of the buffer the stream is copied through
+    STREAM_BUF_SZ=DEFAULT_BUF_SZ
+
     def __init__(self, backup_host, backup_dataset, backup_user, *args, **kwargs):
+        """Connect to the backup host
+
+        Besides the parameters of :py:class:`Backup`, the keyword arguments
+        buffer_size and remote_buffer_size set the sizes of the ring buffers
+        the stream is passed through on this system and on the backup host,
+        see :py:mod:`zfs.ringbuffer`. Either may be None for no buffer; the
+        remote buffer needs the `zfsbuffer` command on the backup host.
+        block_size sets the block size of both, and spill_dir the directory
+        for the local buffer if it has to be kept in a file.
+
+        compression is a :py:class:`zfs.compress.Compression` to compress
+        the streams with, or None; the backup host decompresses them with
+        `zfsbuffer -d`.
+
+        The streams are sent in the most efficient format both systems
+        support, see :py:mod:`zfs.capabilities`. raw_send allows raw
+        streams, which keep encrypted datasets encrypted on the backup host.
+
+        jobs is the number of datasets to send at once, and
+        source_pool_jobs, target_pool_jobs and host_jobs limit that number
+        per local pool, per remote pool and for the backup host, see
+        :py:class:`zfs.workers.ReplicationScheduler`.
+
+        window is the seconds a run should finish in, and link_rate the
+        throughput to the backup host in bytes per second. A run whose
+        planned sends are not expected to fit the window logs a warning; see
+        :py:class:`zfs.workers.SendProgress`.
+
+        history is one of :py:data:`HISTORY_MODES`, and says which of the
+        snapshots taken since the last backup reach the backup host. By
+        default all of them are sent, in one incremental stream.
+        """
+        self.buffer_size        = kwargs.pop('buffer_size', None)
+        self.remote_buffer_size = kwargs.pop('remote_buffer_size', None)
+        self.block_size         = kwargs.pop('block_size', DEFAULT_BLOCK_SZ)
+        self.spill_dir          = kwargs.pop('spill_dir', None)
+        self.compression        = kwargs.pop('compression', None)
+        self.raw_send           = kwargs.pop('raw_send', False)
+        self.window             = kwargs.pop('window', None)
+        self.link_rate          = kwargs.pop('link_rate', None)
+        self.history            = kwargs.pop('history', 'all')
+        if self.history not in HISTORY_MODES:
+            raise ValueError('Unknown history mode "%s"' % self.history)
+        self.scheduler = ReplicationScheduler(
+            jobs=kwargs.pop('jobs', 1),
+            source_pool_jobs=kwargs.pop('source_pool_jobs', None),
+            target_pool_jobs=kwargs.pop('target_pool_jobs', None),
+            host_jobs=kwargs.pop('host_jobs', None))
         super(MbufferedSSHBackup, self).__init__(*args,**kwargs)
         self.backup_host  = backup_host
         self.backup_dataset = backup_dataset
@@ -35,6 +132,13 @@ class MbufferedSSHBackup(Backup):
                          username=self.backup_user,
                          look_for_keys=True)
         self.runner=util.SSHZfsCommandRunner(self.ssh, command_prefix=util.SUDO_CMD)
+        # runs the commands of the planning phase concurrently, which is
+        # only done from one thread
+        self.batch_runner=AsyncSSHZfsCommandRunner(
+            self.ssh, command_prefix=util.SUDO_CMD)
+        # probed once per system, the first time a send is planned
+        self.source_capabilities = CapabilityCache()
+        self.target_capabilities = CapabilityCache(self.runner)
 
     def __del__(self):
         if self.runner:
@@ -43,90 +147,345 @@ class MbufferedSSHBackup(Backup):
             self.ssh.close()
             self.ssh=None
 
-    def take_backup(self, filesystems, snap_children=False):
+    def take_backup(self, filesystems, snap_children=False, index=None,
+                    pools=None):
         """Back up a filesystem using the mbuffered SSH method
 
-        This is a continual incremental setup. A full is only taken if the
-        receiving system doesn't contain any snapshots that match our
-        incremental window
+        This is a continual incremental setup. A full is only sent if the
+        remote filesystem has no snapshots; one whose snapshots have none in
+        common with the local filesystem is counted as a failure and left
+        alone.
 
         See :py:method:`Backup.take_backup` for details on the expected
-        parameters.
+        parameters. The local snapshots are looked up in `index`, a
+        :py:class:`zfs.index.SnapshotIndex`, which lists each pool once, and
+        the pool guids in `pools`, a :py:class:`zfs.poolstate.PoolStateCache`.
+
+        Every filesystem is planned first, from one listing of each local
+        pool and one of the backups of each pool on the backup host, and the
+        remote filesystems that are missing are created together. The size
+        of each send is estimated by a dry run, then the sends are run by this backup's
+        :py:class:`zfs.workers.ReplicationScheduler`, largest first. The
+        progress of the run and the time left are logged as each send
+        finishes.
+
+        :return: one result per filesystem planned
+        :rtype: list of :py:class:`zfs.workers.DatasetResult`
         """
 
+        if index is None:
+            index = SnapshotIndex()
+        if pools is None:
+            pools = PoolStateCache()
+
         if isinstance(filesystems, basestring) and filesystems == '//':
-            single_list,recursive_list = snapshot.get_userprop_datasets(
-                label = self.label, userprop_name=self.userprop_name)
+            with self.metrics.phase('planning'):
+                single_list,recursive_list = snapshot.get_userprop_datasets(
+                    label = self.label, userprop_name=self.userprop_name)
 
             logging.info("Taking non-recursive backups of: %s" %\
                          ', '.join(single_list))
-            single_state = self.take_backup(single_list, snap_children = False)
-
             logging.info("Taking recursive backups of: %s" %\
                          ', '.join(recursive_list))
-            recursive_state = self.take_backup(
-                recursive_list, snap_children = True)
-
-            return
-
-        if isinstance(filesystems, basestring):
-            filesystems = [ filesystems ]
-
-        for fs in filesystems:
-            logging.info("Looking for %s snapsnots of %s" % (
-                "recursive" if snap_children else "non-recursive",
-                fs))
-
-            # Get the current snapshots of the local fs
-            local_snaps=[ s[0] for s in util.zfs_list(fs,
-                                                          types=['snapshot'],
-                                                          depth=1,
-                                                          properties=['name'])
-                        ]
-
-            # Don't process this filesystem if it doesn't have any snapshots
-            if len(local_snaps) == 0:
-                logging.error('The filesystem %s fs does not have any snapshots.')
+            targets = [ (fs, False) for fs in single_list ] + \
+                    [ (fs, True) for fs in recursive_list ]
+        else:
+            if isinstance(filesystems, basestring):
+                filesystems = [ filesystems ]
+            targets = [ (fs, snap_children) for fs in filesystems ]
+
+        jobs = []
+        with self.metrics.phase('planning'):
+            index.load_pools([fs for fs, recursive in targets])
+            replicas = ReplicaIndex(self.runner)
+            bases = []
+            for fs, recursive in targets:
+                base = self.remote_base_path(fs, pools)
+                if base not in bases:
+                    bases.append(base)
+            replicas.load(bases)
+
+            for fs, recursive in targets:
+                self.metrics.inc('datasets_processed')
+                job = self.plan_backup(fs, recursive, index, pools, replicas)
+                if job is not None:
+                    jobs.append(job)
+
+            failed = self.create_remote_filesystems(jobs, replicas)
+
+        planned = jobs
+        jobs = [job for job in planned if id(job) not in failed]
+        progress = SendProgress(jobs, window=self.window,
+                                link_rate=self.link_rate)
+        self.metrics.set('bytes_planned', progress.planned_bytes)
+        progress.plan()
+
+        def run(job):
+            nbytes = 0
+            try:
+                nbytes = self.run_backup(job, index, pools)
+                return nbytes
+            finally:
+                progress.job_done(job, nbytes)
+
+        with self.metrics.phase('send'):
+            sent = iter(self.scheduler.map(run, jobs))
+        results = [failed[id(job)] if id(job) in failed else next(sent)
+                   for job in planned]
+        self.metrics.inc('dataset_failures',
+                         len([r for r in results if not r.ok]))
+        if self.compression is not None and self.compression.stats.blocks:
+            stats = self.compression.stats
+            self.metrics.set('compression_ratio', stats.ratio(),
+                             codec=stats.codec, level=stats.level)
+            self.metrics.set('compression_throughput_bytes_per_second',
+                             stats.throughput(), codec=stats.codec,
+                             level=stats.level)
+            logging.info('Compression %s' % stats.summary())
+        return results
+
+    def create_remote_filesystems(self, jobs, replicas):
+        """Create the remote filesystems that jobs will receive into
+
+        The filesystems are created in one batch. A job whose filesystem
+        could not be created is not sent, and is reported as failed.
+
+        :param list jobs: the :py:class:`zfs.workers.ReplicationJob` planned
+        :param replicas: the remote datasets
+        :type replicas: :py:class:`zfs.index.ReplicaIndex`
+        :return: a failed :py:class:`zfs.workers.DatasetResult` for each job
+        that can't be sent, keyed by the `id` of the job
+        :rtype: dict
+        """
+        missing = [job.plan.remote_backup_path for job in jobs
+                   if not replicas.exists(job.plan.remote_backup_path)]
+        if not missing:
+            return {}
+        logging.info('Creating %d filesystems on remote host %s' % (
+            len(missing), self.backup_host))
+        created = self.batch_runner.zfs_create_many(
+            missing, create_parents=True, return_exceptions=True)
+
+        failed = {}
+        for job in jobs:
+            path = job.plan.remote_backup_path
+            if path not in missing:
                 continue
-
-            pool = util.get_pool_from_fsname(fs)
-            guid = util.get_pool_guid(pool)
-
-            remote_base_path   = os.path.join( self.backup_dataset, guid)
-            remote_backup_path = os.path.join( remote_base_path, fs )
-
-            # check and create remote dataset
-            self.runner.zfs_create(remote_backup_path, create_parents=True)
-
-            # Get the current snapshots of the remote_fs
-            remote_snaps=[ s[0].lstrip(remote_base_path) for s in
-                          self.runner.zfs_list(remote_backup_path, types=['snapshot'],
-                                          depth=1) ]
-
-            want_remote_snapshot_purge = False
-            incremental_source = None
-            if len(remote_snaps) == 0:
-                backup_type = 'full'
-            elif len(local_snaps) == 1:
-                backup_type = 'full'
-            elif remote_snaps[-1] not in local_snaps:
-                backup_type = 'full'
-                want_remote_snapshot_purge = True
-            else:
-                backup_type = 'incremental'
-                # We only want the snapshot name itself
-                incremental_source = remote_snaps[-1].split('@', maxsplit=1)
-
-            newest_local_snap = local_snaps[-1]
-
-            # Now we're ready to send the backup to the remote system
-            self.send_backup(snapshot=newest_local_snap,
-                        incremental_source=incremental_source,
-                        remote_backup_path=remote_backup_path,
-                            recursive=snap_children)
+            # the path exists if any create it was part of succeeded
+            errors = [e for leaf, e in created
+                      if leaf == path or leaf.startswith(path + '/')]
+            if errors and None not in errors:
+                logging.error('Unable to create %s on %s, not backing up '
+                              '%s: %s' % (path, self.backup_host,
+                                          job.dataset, errors[0]))
+                failed[id(job)] = DatasetResult(job.dataset, error=errors[0])
+        return failed
+
+    def remote_base_path(self, fs, pools):
+        """Return the remote filesystem the backups of the pool of fs go
+        under, named after the pool's guid
+
+        :param str fs: a local filesystem
+        :param pools: the local pools
+        :type pools: :py:class:`zfs.poolstate.PoolStateCache`
+        :rtype: str
+        """
+        guid = pools.get_pool_guid(util.get_pool_from_fsname(fs))
+        return os.path.join(self.backup_dataset, guid)
+
+    def plan_backup(self, fs, snap_children, index, pools, replicas=None):
+        """Work out what has to be sent to back up fs
+
+        The snapshots of the remote filesystem are compared with the local
+        ones, without running any commands if both sides have been loaded.
+        The remote filesystem is not created here.
+
+        The newest snapshot the two have in common is the incremental
+        source. The replication_lag_seconds metric of fs is set from its
+        creation time here, so that datasets which are up to date, or whose
+        send fails, are reported too. With the history mode 'all', the snapshots after it are sent
+        in one stream with `zfs send -I`; with 'label' only the ones named
+        with this backup's prefix and label are, one stream each.
+
+        :param str fs: the filesystem to back up
+        :param bool snap_children: back up the child filesystems as well
+        :param index: the local snapshots
+        :type index: :py:class:`zfs.index.SnapshotIndex`
+        :param pools: the local pools
+        :type pools: :py:class:`zfs.poolstate.PoolStateCache`
+        :param replicas: the snapshots on the backup host. If None, the
+        remote filesystem is listed on its own.
+        :type replicas: :py:class:`zfs.index.ReplicaIndex` or None
+        :return: the job to run, or None if fs has no snapshots to send, is
+        up to date, or can't be sent because the remote filesystem has
+        snapshots but none in common with fs, which is counted as a failure
+        :rtype: :py:class:`zfs.workers.ReplicationJob` or None
+        """
+        logging.info("Looking for %s snapsnots of %s" % (
+            "recursive" if snap_children else "non-recursive",
+            fs))
+
+        # Get the current snapshots of the local fs
+        pool = util.get_pool_from_fsname(fs)
+        index.load(pool)
+        local_snapshots=index.snapshots(fs)
+        if self.history == 'label':
+            wanted = index.labelled(fs, self.prefix, self.label)
+        else:
+            wanted = local_snapshots
+
+        # Don't process this filesystem if it doesn't have any snapshots
+        if len(wanted) == 0:
+            logging.error('The filesystem %s does not have any %ssnapshots.'
+                          % (fs, '%s_%s ' % (self.prefix, self.label)
+                             if self.history == 'label' else ''))
+            return None
+        newest = wanted[-1]
+
+        remote_base_path   = self.remote_base_path(fs, pools)
+        remote_backup_path = os.path.join( remote_base_path, fs )
+
+        if replicas is None:
+            replicas = ReplicaIndex(self.runner)
+            replicas.load(remote_backup_path)
+
+        # Get the current snapshots of the remote_fs
+        remote_snapshots = replicas.snapshots(remote_backup_path)
+
+        resume_token = replicas.resume_token(remote_backup_path)
+
+        # Send incrementally from the newest snapshot both sides have
+        incremental_source = None
+        rollback = False
+        steps = ()
+        common = newest_common_snapshot(local_snapshots, remote_snapshots)
+        if common is not None:
+            local_base, remote_base = common
+            self._set_lag(fs, local_base.creation)
+            if local_base.createtxg >= newest.createtxg and \
+               resume_token is None:
+                logging.info('%s is up to date at %s' % (
+                    remote_backup_path, local_base.snapname))
+                return None
+            incremental_source = '@' + local_base.snapname
+            if self.history == 'label':
+                steps = tuple(s.name for s in wanted[:-1]
+                              if s.createtxg > local_base.createtxg)
+            # the remote snapshots after the common one are rolled back
+            rollback = remote_base is not remote_snapshots[-1]
+            if rollback:
+                logging.warning('%s has snapshots newer than %s, which will '
+                                'be destroyed' % (remote_backup_path,
+                                                  remote_base.snapname))
+        elif remote_snapshots:
+            # a full stream can't be received into a filesystem that has
+            # snapshots, so this needs someone to look at the target
+            logging.error('%s has snapshots, but none in common with %s, so '
+                          'it can\'t be backed up' % (remote_backup_path, fs))
+            self.metrics.inc('dataset_failures')
+            return None
+
+        target_pool = util.get_pool_from_fsname(self.backup_dataset)
+        options = send_options(self.source_capabilities,
+                               self.target_capabilities, pool, target_pool,
+                               raw=self.raw_send)
+        if incremental_source and self.history == 'all':
+            options['intermediates'] = True
+        logging.debug('Sending %s with options %s' % (fs, options))
+
+        plan = BackupPlan(fs, newest.name, incremental_source,
+                          remote_backup_path, snap_children, resume_token,
+                          newest.creation, options, rollback, steps)
+        size = 0
+        for snap, source in self._sends(plan):
+            step_size = self.estimate_send_size(snap, source, snap_children,
+                                                options)
+            if step_size is None:
+                size = None
+                break
+            size += step_size
+        return ReplicationJob(
+            fs, size=size, source_pool=pool, target_pool=target_pool,
+            target_host=self.backup_host, plan=plan)
+
+    def _sends(self, plan):
+        """Return the snapshot and incremental source of each send of plan,
+        in order"""
+        sends = []
+        source = plan.incremental_source
+        for snap in plan.steps + (plan.snapshot,):
+            sends.append((snap, source))
+            source = snap[snap.index('@'):]
+        return sends
+
+    def run_backup(self, job, index, pools):
+        """Run a job made by :py:meth:`plan_backup`
+
+        An interrupted send is resumed first, in which case the job is
+        planned again as the remote snapshots will have changed.
+
+        :return: the number of bytes sent
+        :rtype: int
+        """
+        plan = job.plan
+        sent = 0
+        if plan.resume_token is not None:
+            sent += self.resume_backup(plan.remote_backup_path)
+            self.metrics.inc('bytes_sent', sent)
+            job = self.plan_backup(plan.fs, plan.recursive, index, pools)
+            if job is None:
+                return sent
+            plan = job.plan
+
+        # Now we're ready to send the backup to the remote system
+        nbytes = 0
+        rollback = plan.rollback
+        for snap, source in self._sends(plan):
+            nbytes += self.send_backup(
+                snapshot=snap, incremental_source=source,
+                remote_backup_path=plan.remote_backup_path,
+                recursive=plan.recursive, send_options=plan.send_options,
+                rollback=rollback) or 0
+            # the later steps follow on from the one just received
+            rollback = False
+        self.metrics.inc('bytes_sent', nbytes)
+        self._set_lag(plan.fs, plan.creation)
+        return sent + nbytes
+
+    def _set_lag(self, fs, creation):
+        """Report how old the newest snapshot of fs on the backup host is"""
+        if creation is not None:
+            self.metrics.set('replication_lag_seconds',
+                             time.time() - creation, dataset=fs)
+
+    def estimate_send_size(self, snapshot, incremental_source=None,
+                           recursive=False, send_options=None):
+        """Estimate how many bytes sending snapshot would take
+
+        The stream is sized by a dry run of the same `zfs send`, see
+        :py:func:`zfs.util.ZfsCommandRunner.zfs_send_size`, so compressed
+        streams are sized as sent.
+
+        :param str snapshot: the filesystem@snapshot to send
+        :param incremental_source: the older snapshot of an incremental send
+        :type incremental_source: str or None
+        :param bool recursive: send the descendant filesystems as well
+        :param send_options: the stream format
+        :type send_options: dict or None
+        :return: the estimate in bytes, or None if it couldn't be made
+        :rtype: int or None
+        """
+        try:
+            return util.zfs_send_size(snapshot, incremental_source, recursive,
+                                      **(send_options or {}))
+        except ZfsError as e:
+            logging.warning('Unable to estimate the size of %s: %s' % (
+                snapshot, e))
+            return None
 
     def send_backup(self, snapshot, remote_backup_path,
-                    incremental_source=None, recursive=False):
+                    incremental_source=None, recursive=False,
+                    send_options=None, rollback=False):
         """Send a backup to the remote_backup_path on self.backup_host
 
         ZFS backups are performed using the `zfs send` command, which requires
@@ -139,6 +498,13 @@ class MbufferedSSHBackup(Backup):
         Otherwise, `incremental_source` is assumed to be the older of the pair
         of snapshots used to generate the incremental backup.
 
+        The local `zfs send` is streamed into a `zfs receive` run over this
+        backup's SSH connection, through the configured ring buffers, see
+        :py:mod:`zfs.pipeline`. A full backup is received with -F, as the
+        remote dataset has already been created. Non-recursive backups are
+        received with -s, so that if they are interrupted
+        :py:meth:`resume_backup` can finish them later.
+
         :param incremental_source: optional name of the source snapshot to use
         for an incremental backup. If specified, this can either be a bare
         snapshot name like "@snap" or "filesystem@snap". If the latter format
@@ -146,6 +512,17 @@ class MbufferedSSHBackup(Backup):
         the `snapshot` parameter.
         :type incremental_source: str or None
         :param str snapshot: the primary source filesystem@snapshot.
+        :param str remote_backup_path: the remote filesystem to receive into
+        :param bool recursive: send the descendant filesystems as well
+        :param send_options: the stream format, see
+        :py:func:`zfs.capabilities.send_options`. A plain stream is sent by
+        default.
+        :type send_options: dict or None
+        :param bool rollback: receive an incremental backup with -F, rolling
+        the remote filesystem back to the incremental source
+        :return: the number of bytes sent
+        :rtype: int
+        :raises ZfsReplicationError: if the send or the receive failed
         """
         # First, validate our params
         if '@' not in snapshot:
@@ -184,5 +561,72 @@ class MbufferedSSHBackup(Backup):
                           recursive)
             )
 
-        # TODO: Now actually send the snapshot
-        pass
+        # replication streams can't be resumed
+        return self._stream(remote_backup_path,
+                            force=rollback or not incremental_source,
+                            resumable=not recursive, snapshot=snapshot,
+                            incremental_source=incremental_source,
+                            recursive=recursive, **(send_options or {}))
+
+    def resume_backup(self, remote_backup_path):
+        """Finish an interrupted send to remote_backup_path, if there is one
+
+        If the remote filesystem has a `receive_resume_token`, the stream is
+        resumed with `zfs send -t`, carrying on from where it stopped. The
+        token is first checked with a dry run of the same `zfs send`; if the
+        local system can't resume it, for instance because the snapshot has
+        since been destroyed, the partial state is discarded so that the next
+        send can start afresh.
+
+        :param str remote_backup_path: the remote filesystem
+        :return: the number of bytes sent
+        :rtype: int
+        :raises ZfsReplicationError: if the resumed stream failed. The
+        partial state is kept for another try.
+        """
+        token = self.runner.zfs_receive_resume_token(remote_backup_path)
+        if token is None:
+            return 0
+
+        try:
+            util.zfs_send_size(None, resume_token=token)
+        except (ZfsNoDatasetError, ZfsUnknownError) as e:
+            logging.warning('Unable to resume the backup to %s, discarding '
+                            'the partial state: %s' % (remote_backup_path, e))
+            self.runner.zfs_receive_abort(remote_backup_path)
+            return 0
+
+        # a stream that fails from here on, even with zfs send killed when
+        # the transfer broke, can be resumed again next time
+        logging.info('Resuming the interrupted backup to %s on remote host %s'
+                     % (remote_backup_path, self.backup_host))
+        return self._stream(remote_backup_path, resumable=True,
+                            snapshot=None, resume_token=token)
+
+    def _stream(self, remote_backup_path, force=False, resumable=False,
+                **send_args):
+        """Stream a local zfs send, started with send_args, into a zfs
+        receive into remote_backup_path"""
+        ring = None
+        if self.buffer_size:
+            ring = RingBuffer(self.buffer_size, self.block_size,
+                              spill_dir=self.spill_dir)
+        remote_buffer = None
+        if self.remote_buffer_size or self.compression is not None:
+            remote_buffer = ['zfsbuffer', '-m',
+                             str(self.remote_buffer_size or 0),
+                             '-s', str(self.block_size)]
+            if self.compression is not None:
+                remote_buffer += ['-d', '-t', str(self.compression.threads)]
+        receiver = self.runner.open_zfs_receive(
+            remote_backup_path, force=force, resumable=resumable,
+            buffer=remote_buffer)
+        try:
+            sender = util.open_zfs_send(**send_args)
+        except:
+            receiver.close()
+            if ring is not None:
+                ring.close()
+            raise
+        return send_receive(sender, receiver, self.STREAM_BUF_SZ, ring,
+                            self.compression)
@@ -0,0 +1,483 @@
+"""Run zfs and zpool commands through a privileged broker
+
+Running every command through sudo costs a PAM session, a parse of the
+sudoers file and an extra fork and exec, which can take longer than the zfs
+command itself. The :py:class:`ZfsBroker` runs once with the privileges
+needed for ZFS and listens on a Unix socket, and the
+:py:class:`BrokerZfsCommandRunner` hands it commands over that socket.
+
+Each message is a 4 byte big-endian length followed by that many bytes of
+JSON. A request looks like::
+
+    {"id": 1, "cmd": "zfs", "args": ["list", "-H", "tank"]}
+
+and its response like::
+
+    {"id": 1, "out": "tank\\t...", "err": "", "rc": 0}
+
+with "error" set instead of "rc" if the command was refused or could not be
+run. The output is sent as latin-1 so that arbitrary bytes survive JSON.
+Requests on one connection are answered in order, so a client may send many
+requests before reading any responses. The runner does so for the several
+commands of one `zfs_snapshot` or `zfs_destroy_snapshots` call, see
+:py:meth:`BrokerZfsCommandRunner.run_zfs_many`; other commands are one
+round trip each.
+
+Only the subcommands in the broker's whitelist are run, with only the
+options this package gives them, and by default `zfs destroy` is limited
+to snapshots. The socket is created with mode 0660,
+so access is granted through its group, and the broker can further insist
+on particular peer uids.
+
+Example::
+
+    # as root
+    ZfsBroker('/var/run/zfsbroker.sock', group='zfsadmin').serve_forever()
+
+    # as a member of zfsadmin
+    runner = BrokerZfsCommandRunner('/var/run/zfsbroker.sock')
+    runner.zfs_list(datasets='tank')
+"""
+
+import contextlib
+import grp
+import itertools
+import json
+import logging
+import os
+import socket
+import SocketServer
+import stat
+import struct
+import threading
+import cmdtrace
+import util
+from . import *
+
+DEFAULT_SOCKET='/var/run/zfsbroker.sock'
+
+# The subcommands used by this package, with the letters of the options
+# they are given that take no value and of those that take one. Anything
+# else, such as the -o of zfs create or snapshot that could set a
+# mountpoint, or the -R of zfs destroy that also destroys clones, is
+# refused. zfs create and receive are only run on the backup host.
+ALLOWED_COMMANDS={
+    'zfs': {
+        'list': ('Hpr', 'odtsS'),
+        'snapshot': ('r', ''),
+        'destroy': ('r', ''),
+    },
+    'zpool': {
+        'list': ('Hp', 'o'),
+        'status': ('v', ''),
+    },
+}
+
+# Requests only carry arguments, so they are small. Responses can hold the
+# listing of a whole pool, so they aren't limited.
+MAX_REQUEST_SZ=4 << 20
+
+_HEADER=struct.Struct('>I')
+
+# Linux's SO_PEERCRED, which the socket module doesn't always define
+_SO_PEERCRED=getattr(socket, 'SO_PEERCRED', 17)
+_UCRED=struct.Struct('3i')
+
+def _send_message(sock, message):
+    data = json.dumps(message)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n:
+        data = sock.recv(min(n, 1 << 20))
+        if not data:
+            return None
+        chunks.append(data)
+        n -= len(data)
+    return ''.join(chunks)
+
+def _recv_message(sock, limit=None):
+    """Read one message, or return None if the connection was closed
+
+    :raises ValueError: if the message is longer than limit
+    """
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    size, = _HEADER.unpack(header)
+    if limit is not None and size > limit:
+        raise ValueError('message of %d bytes is too long' % size)
+    data = _recv_exactly(sock, size)
+    if data is None:
+        return None
+    return json.loads(data)
+
+def check_command(cmd, args, allowed=ALLOWED_COMMANDS,
+                  destroy_snapshots_only=True):
+    """Check that a command may be run by the broker
+
+    :param str cmd: zfs or zpool
+    :param list args: the arguments, starting with the subcommand
+    :param dict allowed: the permitted subcommands of each command and
+    their options, see :py:data:`ALLOWED_COMMANDS`
+    :param bool destroy_snapshots_only: if true, `zfs destroy` may only be
+    given snapshots
+    :raises ZfsBrokerError: if the command is not permitted
+    """
+    if not isinstance(args, list) or not args or \
+       not all(isinstance(a, basestring) for a in args):
+        raise ZfsBrokerError('args must be a non-empty list of strings')
+    if any('\0' in a for a in args):
+        raise ZfsBrokerError('args must not contain NUL characters')
+    if cmd not in allowed or args[0] not in allowed[cmd]:
+        raise ZfsBrokerError('%s %s is not permitted' % (cmd, args[0]))
+    flags, valued = allowed[cmd][args[0]]
+    operands = []
+    # zfs parses options with getopt, which on Linux also finds them after
+    # the operands, so every argument starting with - is checked
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if not arg.startswith('-'):
+            operands.append(arg)
+            continue
+        if arg == '-' or arg.startswith('--'):
+            raise ZfsBrokerError('%s %s argument %s is not permitted' % (
+                cmd, args[0], arg))
+        for j, c in enumerate(arg[1:]):
+            if c in valued:
+                # the value is the rest of the argument, or the next one
+                if j + 2 == len(arg):
+                    i += 1
+                break
+            if c not in flags:
+                raise ZfsBrokerError('%s %s -%s is not permitted' % (
+                    cmd, args[0], c))
+    if destroy_snapshots_only and cmd == 'zfs' and args[0] == 'destroy':
+        for arg in operands:
+            if '@' not in arg:
+                raise ZfsBrokerError('only snapshots may be destroyed, not %s'
+                                     % arg)
+
+class _BrokerHandler(SocketServer.BaseRequestHandler):
+    """Answer the requests of one client connection, in order"""
+
+    def handle(self):
+        broker = self.server.broker
+        if not broker._peer_allowed(self.request):
+            return
+        while True:
+            try:
+                request = _recv_message(self.request, MAX_REQUEST_SZ)
+            except ValueError as e:
+                logging.warning('Dropping broker client: %s' % e)
+                return
+            if request is None:
+                return
+            _send_message(self.request, broker.handle_request(request))
+
+class _BrokerServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class ZfsBroker(object):
+    """Run whitelisted zfs and zpool commands for clients on a Unix socket
+
+    Attributes:
+        path        the path of the socket
+        allowed     dict of the permitted subcommands of zfs and zpool and
+                    their options
+        destroy_snapshots_only  if true, `zfs destroy` is only run for
+                    snapshots
+        allowed_uids  the uids that may connect, or None for any that can
+                    open the socket
+        runner      the ZfsCommandRunner that runs the commands
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, mode=0660, group=None,
+                 allowed=ALLOWED_COMMANDS, destroy_snapshots_only=True,
+                 allowed_uids=None, runner=None):
+        """Create the broker's socket
+
+        :param str path: where to create the socket. An existing socket at
+        this path is replaced.
+        :raises ZfsBrokerError: if something other than a socket exists at
+        path
+        :param int mode: the permissions of the socket
+        :param group: the group name or gid to give the socket, or None to
+        keep the broker's group
+        :type group: str, int, or None
+        :param dict allowed: the permitted subcommands of zfs and zpool and
+        their options, see :py:data:`ALLOWED_COMMANDS`
+        :param bool destroy_snapshots_only: if true, `zfs destroy` is only
+        run for snapshots
+        :param allowed_uids: the uids that may connect, or None for any
+        :type allowed_uids: list or None
+        :param runner: the runner for the commands. Defaults to running them
+        directly, without sudo.
+        :type runner: ZfsCommandRunner or None
+        """
+        self.path = path
+        self.allowed = allowed
+        self.destroy_snapshots_only = destroy_snapshots_only
+        self.allowed_uids = None if allowed_uids is None \
+                else frozenset(allowed_uids)
+        if runner is None:
+            runner = util.LocalZfsCommandRunner()
+        self.runner = runner
+
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ZfsBrokerError('%s exists and is not a socket' % path)
+            os.unlink(path)
+        # Don't let the socket be reachable before its permissions are set
+        umask = os.umask(0177)
+        try:
+            self._server = _BrokerServer(path, _BrokerHandler)
+        finally:
+            os.umask(umask)
+        self._server.broker = self
+        if group is not None:
+            if isinstance(group, basestring):
+                group = grp.getgrnam(group).gr_gid
+            os.chown(path, -1, group)
+        os.chmod(path, mode)
+
+    def _peer_allowed(self, sock):
+        if self.allowed_uids is None:
+            return True
+        try:
+            pid, uid, gid = _UCRED.unpack(
+                sock.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, _UCRED.size))
+        except socket.error as e:
+            logging.warning('Unable to check broker client credentials: %s'
+                            % e)
+            return False
+        if uid not in self.allowed_uids:
+            logging.warning('Refusing broker client with uid %d' % uid)
+            return False
+        return True
+
+    def handle_request(self, request):
+        """Run one request, returning the response
+
+        :param dict request: the decoded request
+        :rtype: dict
+        """
+        response = {'id': request.get('id') if isinstance(request, dict)
+                    else None}
+        try:
+            if not isinstance(request, dict):
+                raise ZfsBrokerError('requests must be objects')
+            cmd = request.get('cmd')
+            args = [a.encode('utf-8') if isinstance(a, unicode) else a
+                    for a in request.get('args') or []]
+            check_command(cmd, args, self.allowed,
+                          self.destroy_snapshots_only)
+            errorclass = ZpoolCommandNotFoundError if cmd == 'zpool' \
+                    else ZfsCommandNotFoundError
+            out,err,rc = self.runner.run_cmd(cmd, args, errorclass)
+        except ZfsBrokerError as e:
+            logging.warning('Refused broker request: %s' % e)
+            response['error'] = 'refused'
+            response['message'] = str(e)
+        except (ZfsCommandNotFoundError, ZpoolCommandNotFoundError):
+            response['error'] = 'notfound'
+        except Exception as e:
+            logging.exception('Failed running broker request')
+            response['error'] = 'failed'
+            response['message'] = str(e)
+        else:
+            response['out'] = out.decode('latin-1')
+            response['err'] = err.decode('latin-1')
+            response['rc'] = rc
+        return response
+
+    def serve_forever(self):
+        """Answer requests until :py:meth:`shutdown` is called"""
+        logging.info('ZFS broker listening on %s' % self.path)
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stop serving and remove the socket"""
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class BrokerZfsCommandRunner(util.ZfsCommandRunner):
+    """Run ZFS commands through a :py:class:`ZfsBroker`
+
+    A drop-in replacement for :py:class:`zfs.util.LocalZfsCommandRunner`
+    that needs no sudo. Each thread gets its own connection to the broker,
+    so the runner can be shared by a :py:class:`zfs.workers.DatasetWorkerPool`.
+    Output is not streamed: `stream_cmd` waits for the whole of it. The
+    broker doesn't carry send streams, so `zfs send` and `zfs receive` are
+    still run locally through sudo.
+    """
+
+    runner_type='broker'
+
+    def __init__(self, path=DEFAULT_SOCKET, command_prefix=None,
+                 tracers=None):
+        """Initialize a new BrokerZfsCommandRunner
+
+        :param str path: the path of the broker's socket
+        :param command_prefix: ignored, as the broker already runs with the
+        privileges needed. Accepted for compatibility with the other runners.
+        :param tracers: Optional list of tracers, see :py:mod:`zfs.cmdtrace`
+        """
+        super(BrokerZfsCommandRunner, self).__init__(None, tracers)
+        self.path = path
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._streams = util.LocalZfsCommandRunner(
+            command_prefix=util.SUDO_CMD, tracers=self.tracers)
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except socket.error as e:
+                sock.close()
+                raise ZfsBrokerError('Unable to connect to the ZFS broker at '
+                                     '%s: %s' % (self.path, e))
+            self._local.sock = sock
+        return sock
+
+    def close(self):
+        """Close this thread's connection to the broker"""
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def open_zfs_send(self, *args, **kwargs):
+        """Start `zfs send` locally through sudo
+
+        See :py:func:`zfs.util.LocalZfsCommandRunner.open_zfs_send`
+        """
+        return self._streams.open_zfs_send(*args, **kwargs)
+
+    def open_zfs_receive(self, *args, **kwargs):
+        """Start `zfs receive` locally through sudo
+
+        See :py:func:`zfs.util.LocalZfsCommandRunner.open_zfs_receive`
+        """
+        return self._streams.open_zfs_receive(*args, **kwargs)
+
+    def zfs_send_flags(self):
+        """Return the options `zfs send` takes, asking it locally through
+        sudo as the broker doesn't run it
+
+        See :py:func:`zfs.util.ZfsCommandRunner.zfs_send_flags`
+        """
+        return self._streams.zfs_send_flags()
+
+    def zfs_send_size(self, *args, **kwargs):
+        """Estimate the size of a send stream locally through sudo, as the
+        broker doesn't run zfs send
+
+        See :py:func:`zfs.util.ZfsCommandRunner.zfs_send_size`
+        """
+        return self._streams.zfs_send_size(*args, **kwargs)
+
+    def trace_baseline(self):
+        """Do nothing, as the broker starts commands without sudo and
+        would refuse to run `true`"""
+        pass
+
+    def run_cmd(self, cmd, args, errorclass=None):
+        """Run a command through the broker
+
+        See :py:func:`ZfsCommandRunner.run_cmd` for a description of the
+        parameters and the return values
+
+        :raises ZfsBrokerError: if the broker can't be reached or refuses the
+        command
+        """
+        return self.run_cmds([(cmd, args, errorclass)])[0]
+
+    def run_zfs_many(self, argvs):
+        """Run several zfs commands, sending them all before waiting for
+        any, so that they take one round trip to the broker
+
+        See :py:func:`zfs.util.ZfsCommandRunner.run_zfs_many`. With tracers
+        the commands are run one at a time instead, so that each trace has
+        its own times.
+        """
+        if self.tracers or not argvs:
+            return super(BrokerZfsCommandRunner, self).run_zfs_many(argvs)
+        return self.run_cmds([('zfs', args, ZfsCommandNotFoundError)
+                              for args in argvs])
+
+    def run_cmds(self, commands):
+        """Run several commands, sending them all before waiting for any
+
+        :param list commands: tuples of (cmd, args, errorclass)
+        :return: the (out, err, rc) tuple of each command, in order
+        :rtype: list
+        :raises ZfsBrokerError: if the broker can't be reached or refuses a
+        command
+        """
+        requests = []
+        for cmd, args, errorclass in commands:
+            cmdargs = self.process_cmd_args(cmd, args)
+            requests.append(({'id': next(self._ids), 'cmd': cmd,
+                              'args': cmdargs[1:]}, errorclass))
+
+        sock = self._connection()
+        try:
+            for request, errorclass in requests:
+                _send_message(sock, request)
+            cmdtrace.mark_spawned()
+            responses = [_recv_message(sock) for r in requests]
+        except (socket.error, ValueError) as e:
+            self.close()
+            raise ZfsBrokerError('Lost the connection to the ZFS broker: %s'
+                                 % e)
+        if None in responses:
+            self.close()
+            raise ZfsBrokerError('The ZFS broker closed the connection')
+
+        results = []
+        for (request, errorclass), response in zip(requests, responses):
+            error = response.get('error')
+            if error == 'notfound' and errorclass is not None:
+                raise errorclass()
+            if error is not None:
+                raise ZfsBrokerError('%s %s: %s' % (
+                    request['cmd'], ' '.join(request['args'][:1]),
+                    response.get('message', error)))
+            rc = response['rc']
+            logging.debug('command %s returned result code %d' % (
+                str([request['cmd']] + request['args']), rc))
+            results.append((response['out'].encode('latin-1'),
+                            response['err'].encode('latin-1'), rc))
+        return results
+
+@contextlib.contextmanager
+def using_broker(path):
+    """Run the functional methods of :py:mod:`zfs.util` through the broker
+    at path within a with block
+
+    Does nothing if path is None, so that a command line option can be passed
+    straight through.
+
+    :param path: the path of the broker's socket, or None
+    :type path: str or None
+    """
+    if path is None:
+        yield
+        return
+    runner = BrokerZfsCommandRunner(path)
+    previous = util.set_default_runner(runner)
+    try:
+        yield
+    finally:
+        util.set_default_runner(previous)
+        runner.close()
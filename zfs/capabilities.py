@@ -0,0 +1,162 @@
+"""Which send stream formats a pair of systems support
+
+A plain `zfs send` stream carries every block uncompressed and unencrypted,
+splitting large blocks into 128K ones, so data already compressed on disk
+is decompressed to be sent and compressed again when it is received. Newer
+versions of ZFS can send blocks as they are stored instead:
+
+    -L  records larger than 128K, which the receiving pool needs the
+        large_blocks feature for
+    -e  blocks embedded in their block pointers, which needs embedded_data
+    -c  compressed blocks, which needs lz4_compress for lz4 blocks
+    -w  raw blocks, encrypted ones staying encrypted, which needs all of the
+        above and the encryption feature
+
+What each system can do is probed once, with one `zfs send` to read the
+options it accepts and one `zpool list` of the pool features, and kept in
+a :py:class:`CapabilityCache`. :py:func:`send_options` then picks the most
+efficient format both ends of a transfer support.
+
+Example::
+
+    local = CapabilityCache()
+    remote = CapabilityCache(ssh_runner)
+    options = send_options(local, remote, 'tank', 'backup')
+    sender = util.open_zfs_send('tank/foo@b', **options)
+"""
+
+import collections
+import logging
+import threading
+import util
+from . import *
+
+# The pool features the stream formats depend on
+FEATURES=['large_blocks', 'embedded_data', 'lz4_compress', 'encryption']
+
+# The feature states meaning a pool can receive blocks using the feature
+_USABLE_STATES=frozenset(['enabled', 'active'])
+
+# For each send option, the option letter and the features the receiving
+# pool needs
+_SEND_OPTIONS=[
+    ('large_blocks', 'L', ['large_blocks']),
+    ('embed_data', 'e', ['embedded_data']),
+    ('compressed', 'c', ['lz4_compress']),
+]
+_RAW_FEATURES=['large_blocks', 'embedded_data', 'lz4_compress', 'encryption']
+
+class HostCapabilities(collections.namedtuple('HostCapabilities', [
+        'send_flags', 'pool_features'])):
+    """What the ZFS on one system supports
+
+    Attributes:
+        send_flags      the option letters `zfs send` accepts, a frozenset
+        pool_features   for each pool, the set of :py:data:`FEATURES` it has
+                        enabled or active
+    """
+    __slots__ = ()
+
+    def pool_has(self, pool, features):
+        """Check that a pool has all of the features listed
+
+        :param str pool: the pool name
+        :param list features: the feature names, without `feature@`
+        :rtype: bool
+        """
+        have = self.pool_features.get(pool, frozenset())
+        return all(f in have for f in features)
+
+class CapabilityCache(object):
+    """The capabilities of one system, probed the first time they are needed
+
+    It is safe to share a cache between threads.
+
+    Attributes:
+        runner      the ZfsCommandRunner used to probe, or None to run zfs
+                    and zpool locally
+    """
+
+    def __init__(self, runner=None):
+        """Create a new, empty CapabilityCache
+
+        :param runner: the runner used to probe. Defaults to running the
+        commands locally through sudo.
+        :type runner: ZfsCommandRunner or None
+        """
+        self.runner = runner
+        self._lock = threading.Lock()
+        self._caps = None
+
+    def _run(self, method, *args, **kwargs):
+        if self.runner is not None:
+            return getattr(self.runner, method)(*args, **kwargs)
+        return getattr(util, method)(*args, **kwargs)
+
+    def probe(self):
+        """Probe the system again
+
+        :rtype: :py:class:`HostCapabilities`
+        """
+        try:
+            flags = self._run('zfs_send_flags')
+        except ZfsError as e:
+            logging.warning('Unable to probe the zfs send options: %s' % e)
+            flags = frozenset()
+        features = {}
+        for row in self._run(
+                'zpool_list',
+                properties=['name'] + ['feature@' + f for f in FEATURES]):
+            features[row[0]] = frozenset(
+                f for f, state in zip(FEATURES, row[1:])
+                if state in _USABLE_STATES)
+        caps = HostCapabilities(flags, features)
+        with self._lock:
+            self._caps = caps
+        return caps
+
+    def get(self):
+        """Return the capabilities, probing the system if it hasn't been
+
+        :rtype: :py:class:`HostCapabilities`
+        """
+        with self._lock:
+            caps = self._caps
+        if caps is None:
+            caps = self.probe()
+        return caps
+
+def send_options(source, target, source_pool, target_pool, raw=False):
+    """Choose the stream format for sending from one pool to another
+
+    An option is used when the sending `zfs send` accepts it and the
+    receiving pool has the features its blocks need. The receiving system
+    must be as new as one whose `zfs send` accepts the option too, or its
+    `zfs receive` might not understand the stream.
+
+    :param source: the sending system
+    :type source: :py:class:`CapabilityCache`
+    :param target: the receiving system
+    :type target: :py:class:`CapabilityCache`
+    :param str source_pool: the pool sent from
+    :param str target_pool: the pool received into
+    :param bool raw: send raw streams when possible, so that encrypted
+    datasets reach the target still encrypted. A dataset once sent raw has
+    to be sent raw from then on, so this is only done when asked for.
+    :return: keyword arguments for
+    :py:func:`zfs.util.ZfsCommandRunner.open_zfs_send`
+    :rtype: dict
+    """
+    src = source.get()
+    dst = target.get()
+    both = src.send_flags & dst.send_flags
+
+    if raw and 'w' in both and src.pool_has(source_pool, ['encryption']) \
+       and dst.pool_has(target_pool, _RAW_FEATURES):
+        return {'raw': True}
+
+    options = {}
+    for name, flag, features in _SEND_OPTIONS:
+        if flag in both and dst.pool_has(target_pool, features):
+            options[name] = True
+    return options
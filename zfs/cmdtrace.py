@@ -0,0 +1,257 @@
+"""Trace the zfs and zpool commands run by a ZfsCommandRunner
+
+Every :py:class:`zfs.util.ZfsCommandRunner` has a list of tracers. When
+the list isn't empty, each zfs or zpool command is described by a
+:py:class:`CommandTrace` which is handed to every tracer once the command
+finishes. A tracer is any object with a `record(trace)` method. This module
+provides three:
+
+* :py:class:`MemoryTracer` keeps totals per command in memory
+* :py:class:`JsonLinesTracer` writes every trace to a file as a JSON object
+* :py:class:`HistogramTracer` counts the wall times of each command in
+  power of two buckets, for a summary of where the time went
+
+Example::
+
+    hist = HistogramTracer()
+    util.add_tracer(JsonLinesTracer('/var/tmp/zfsautosnap.trace'))
+    util.add_tracer(hist)
+    ...
+    hist.log_summary()
+
+`spawn` is the time taken for the process to exist locally, or for the
+channel to open remotely. A local process exists as soon as sudo has been
+exec'd, so sudo's authentication and its fork and exec of zfs are counted
+in `wall` instead. To tell them apart, :py:func:`tracing` first traces
+`true` run the same way, see
+:py:func:`zfs.util.ZfsCommandRunner.trace_baseline`: its wall time is what
+starting any command costs, and the rest of a zfs command's wall time is
+ZFS itself.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import math
+import threading
+import time
+
+class CommandTrace(object):
+    """Measurements of one command
+
+    Attributes:
+        runner      the kind of runner, e.g. 'local', 'ssh' or 'fake'
+        cmd         'zfs' or 'zpool'
+        subcommand  the subcommand, e.g. 'list' or 'snapshot'
+        nargs       the number of arguments after the subcommand
+        start       when the command was started, in seconds since the epoch
+        wall        seconds from starting the command until it finished
+        spawn       seconds taken to start the command, or None if unknown
+        out_bytes   bytes of standard output
+        err_bytes   bytes of error output
+        rc          the exit code, or None if the command couldn't be run
+        error       name of the exception raised while running the command,
+                    or None
+        streamed    True if the output was streamed rather than collected
+    """
+    __slots__ = ('runner', 'cmd', 'subcommand', 'nargs', 'start', 'wall',
+                 'spawn', 'out_bytes', 'err_bytes', 'rc', 'error', 'streamed')
+
+    def __init__(self, runner, cmd, args, start):
+        self.runner = runner
+        self.cmd = cmd
+        # The cmd may be repeated at the start of args
+        if args and args[0] == cmd:
+            args = args[1:]
+        self.subcommand = args[0] if args else ''
+        self.nargs = max(len(args) - 1, 0)
+        self.start = start
+        self.wall = None
+        self.spawn = None
+        self.out_bytes = 0
+        self.err_bytes = 0
+        self.rc = None
+        self.error = None
+        self.streamed = False
+
+    @property
+    def command(self):
+        """The command and subcommand, e.g. 'zfs list'"""
+        if not self.subcommand:
+            return self.cmd
+        return '%s %s' % (self.cmd, self.subcommand)
+
+    def as_dict(self):
+        """Return the trace as a dict, e.g. for JSON"""
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __repr__(self):
+        return 'CommandTrace(%s)' % ', '.join(
+            '%s=%r' % (k, getattr(self, k)) for k in self.__slots__)
+
+class MemoryTracer(object):
+    """Keep per-command totals, and optionally the traces themselves
+
+    Attributes:
+        totals  dict of (runner, command) to a dict of the count, failures,
+                wall, spawn, out_bytes and err_bytes totals
+        traces  the most recent traces, up to `keep` of them
+    """
+
+    def __init__(self, keep=0):
+        """Create a new MemoryTracer
+
+        :param int keep: how many of the most recent traces to keep
+        """
+        self._lock = threading.Lock()
+        self.totals = {}
+        self.traces = collections.deque(maxlen=keep)
+
+    def record(self, trace):
+        with self._lock:
+            t = self.totals.setdefault((trace.runner, trace.command), {
+                'count': 0, 'failures': 0, 'wall': 0.0, 'spawn': 0.0,
+                'out_bytes': 0, 'err_bytes': 0})
+            t['count'] += 1
+            if trace.rc != 0:
+                t['failures'] += 1
+            t['wall'] += trace.wall or 0.0
+            t['spawn'] += trace.spawn or 0.0
+            t['out_bytes'] += trace.out_bytes
+            t['err_bytes'] += trace.err_bytes
+            if self.traces.maxlen:
+                self.traces.append(trace)
+
+class JsonLinesTracer(object):
+    """Write each trace as a JSON object on its own line"""
+
+    def __init__(self, f):
+        """Create a new JsonLinesTracer
+
+        :param f: a file name, which is appended to, or an open file
+        :type f: str or file
+        """
+        self._lock = threading.Lock()
+        if isinstance(f, basestring):
+            self._file = open(f, 'a')
+            self._close = True
+        else:
+            self._file = f
+            self._close = False
+
+    def record(self, trace):
+        line = json.dumps(trace.as_dict(), sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        """Close the file, if we opened it"""
+        if self._close:
+            self._file.close()
+
+class HistogramTracer(object):
+    """Count the wall time of each command in power of two buckets
+
+    The bucket of a trace is the smallest power of two number of
+    milliseconds at least as long as its wall time, so bucket 1 counts
+    commands that took up to 1ms, bucket 2 those between 1 and 2ms, and so
+    on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (runner, command) -> {bucket: count}
+        self.buckets = {}
+        # (runner, command) -> [count, wall total, spawn total]
+        self.sums = {}
+
+    def record(self, trace):
+        wall = trace.wall or 0.0
+        bucket = 1 << max(0, int(math.ceil(math.log(max(wall * 1000, 1), 2))))
+        key = (trace.runner, trace.command)
+        with self._lock:
+            counts = self.buckets.setdefault(key, {})
+            counts[bucket] = counts.get(bucket, 0) + 1
+            sums = self.sums.setdefault(key, [0, 0.0, 0.0])
+            sums[0] += 1
+            sums[1] += wall
+            sums[2] += trace.spawn or 0.0
+
+    def summary(self):
+        """Return a text summary, with the commands taking the most time
+        first
+
+        :rtype: str
+        """
+        with self._lock:
+            keys = sorted(self.sums, key=lambda k: -self.sums[k][1])
+            lines = []
+            for key in keys:
+                count, wall, spawn = self.sums[key]
+                lines.append('%s %s: %d commands, %.3fs total, %.1fms mean, '
+                             '%.1fms mean spawn' % (
+                                 key[0], key[1], count, wall,
+                                 1000 * wall / count, 1000 * spawn / count))
+                for bucket in sorted(self.buckets[key]):
+                    lines.append('  <= %6dms %d' % (
+                        bucket, self.buckets[key][bucket]))
+            return '\n'.join(lines)
+
+    def log_summary(self, level=logging.INFO):
+        """Log the summary"""
+        for line in self.summary().splitlines():
+            logging.log(level, line)
+
+@contextlib.contextmanager
+def tracing(path, runner=None):
+    """Trace the commands run within a with block to a JSON lines file,
+    logging a histogram summary at the end
+
+    Does nothing if path is None, so that a command line option can be passed
+    straight through. The first trace is of `true`, which measures the cost
+    of starting a command.
+
+    :param path: the file to append the traces to, or None
+    :type path: str or None
+    :param runner: the runner to trace. Defaults to the runner used by the
+    functional methods of :py:mod:`zfs.util`.
+    :type runner: ZfsCommandRunner or None
+    """
+    if path is None:
+        yield
+        return
+    if runner is None:
+        import util
+        runner = util._LCR
+    tracers = [JsonLinesTracer(path), HistogramTracer()]
+    for tracer in tracers:
+        runner.add_tracer(tracer)
+    try:
+        runner.trace_baseline()
+        yield
+    finally:
+        for tracer in tracers:
+            runner.remove_tracer(tracer)
+        tracers[0].close()
+        tracers[1].log_summary()
+
+_spawned = threading.local()
+
+def mark_spawned():
+    """Note that the command being run by this thread has been started
+
+    Called by the runners as soon as the process or channel exists, so that
+    the time taken to start it can be told apart from the time it ran for.
+    """
+    _spawned.time = time.time()
+
+def take_spawned():
+    """Return and clear the time set by :py:func:`mark_spawned`
+
+    :return: the time the current thread's command was started, or None
+    """
+    t = getattr(_spawned, 'time', None)
+    _spawned.time = None
+    return t
@@ -0,0 +1,568 @@
+"""Compress send streams in parallel blocks
+
+Over a slow link a send stream is worth compressing, but a single
+compressor thread can't keep up with even a modest link. A
+:py:class:`CompressingWriter` cuts the stream into blocks and compresses
+them on a pool of threads (the compressors release the GIL while they
+work), then writes them out in their original order. Each block is framed
+with its sizes, so the receiving side can decompress in parallel as well
+with a :py:class:`DecompressingWriter`, which `zfsbuffer -d` runs in front
+of `zfs receive`.
+
+The stream starts with a header naming the codec, so only the sender has to
+choose it. Each block follows as a frame::
+
+    flags (1 byte) | raw length (4 bytes) | payload length (4 bytes) | payload
+
+all big-endian, with the payload stored uncompressed when compressing
+didn't make it smaller. A frame with both lengths 0 ends the stream, so a
+truncated stream can be told from a complete one.
+
+zlib and bz2 are always available. lzma needs the backports.lzma package,
+and zstd the zstandard package.
+
+Example::
+
+    compression = Compression('zlib', level=3, threads=4)
+    writer = compression.writer(channel.sendall)
+    writer.write(data)
+    writer.close()
+    logging.info(compression.stats.summary())
+"""
+
+import bz2
+import collections
+import logging
+import Queue
+import struct
+import threading
+import time
+import zlib
+
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_BLOCK_SZ=1 << 20
+
+_MAGIC='ZFSC'
+_VERSION=1
+_HEADER=struct.Struct('>4sBB')
+_FRAME=struct.Struct('>BII')
+_FLAG_STORED=1
+
+class Codec(object):
+    """A compression method usable in a stream
+
+    Attributes:
+        name            the name used to choose the codec
+        id              the number identifying the codec in a stream
+        default_level   the level used when none is given
+        levels          the (lowest, highest) levels accepted
+    """
+
+    def __init__(self, name, id, compress, decompress, default_level,
+                 levels):
+        self.name = name
+        self.id = id
+        self._compress = compress
+        self._decompress = decompress
+        self.default_level = default_level
+        self.levels = levels
+
+    def compress(self, data, level):
+        """Compress a block
+
+        :param str data: the block
+        :param int level: the compression level
+        :rtype: str
+        """
+        return self._compress(data, level)
+
+    def decompress(self, data):
+        """Decompress a block
+
+        :param str data: the compressed block
+        :rtype: str
+        """
+        return self._decompress(data)
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+def _lzma_compress(data, level):
+    return lzma.compress(data, preset=level)
+
+# The codecs usable on this system, by name
+CODECS=collections.OrderedDict()
+CODECS['zlib'] = Codec('zlib', 1, zlib.compress, zlib.decompress, 6, (1, 9))
+CODECS['bz2'] = Codec('bz2', 2, bz2.compress, bz2.decompress, 9, (1, 9))
+if lzma is not None:
+    CODECS['lzma'] = Codec('lzma', 3, _lzma_compress, lzma.decompress, 6,
+                           (0, 9))
+if zstandard is not None:
+    CODECS['zstd'] = Codec('zstd', 4, _zstd_compress, _zstd_decompress, 3,
+                           (1, 22))
+
+_CODEC_IDS=dict((c.id, c) for c in CODECS.values())
+
+def get_codec(name):
+    """Return the codec called name
+
+    :param str name: the codec name, one of the keys of :py:data:`CODECS`
+    :rtype: :py:class:`Codec`
+    :raises ValueError: if there is no such codec, or it isn't installed
+    """
+    if name not in CODECS:
+        raise ValueError('unknown or unavailable codec %s, choose from %s' % (
+            name, ', '.join(CODECS.keys())))
+    return CODECS[name]
+
+def parse_compression(text):
+    """Parse a codec and optional level written as codec or codec:level
+
+    :param str text: for example zlib or zstd:9
+    :return: the codec name and the level, or None for the default level
+    :rtype: tuple
+    :raises ValueError: if the codec or the level is invalid
+    """
+    name, sep, level = text.partition(':')
+    codec = get_codec(name)
+    if not sep:
+        return name, None
+    try:
+        level = int(level)
+    except ValueError:
+        raise ValueError('invalid compression level %s' % level)
+    if not codec.levels[0] <= level <= codec.levels[1]:
+        raise ValueError('%s levels range from %d to %d' % (
+            name, codec.levels[0], codec.levels[1]))
+    return name, level
+
+class CompressionStats(object):
+    """The amount of data a codec compressed, and how fast
+
+    Attributes:
+        codec       the codec name
+        level       the compression level, or None on the decompressing side
+        raw_bytes   the bytes before compression
+        compressed_bytes  the bytes after compression, including framing
+        blocks      the number of blocks
+        cpu_time    the seconds spent compressing or decompressing, summed
+                    over all threads
+        wall_time   the seconds during which any of the streams counted was
+                    running, from its first block to its end. Streams that
+                    ran at the same time are only counted once.
+    """
+
+    def __init__(self, codec, level=None):
+        self.codec = codec
+        self.level = level
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.blocks = 0
+        self.cpu_time = 0.0
+        # the (start, end) time of each stream
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, start, end):
+        """Record that a stream ran from start to end, in seconds since the
+        epoch"""
+        with self._lock:
+            self._spans.append((start, end))
+
+    @property
+    def wall_time(self):
+        with self._lock:
+            spans = sorted(self._spans)
+        total = 0.0
+        last = None
+        for start, end in spans:
+            if last is not None and start < last:
+                start = last
+            if end > start:
+                total += end - start
+            last = end if last is None else max(last, end)
+        return total
+
+    def add(self, other):
+        """Add the counts of another CompressionStats to this one"""
+        with other._lock:
+            spans = list(other._spans)
+        with self._lock:
+            self.raw_bytes += other.raw_bytes
+            self.compressed_bytes += other.compressed_bytes
+            self.blocks += other.blocks
+            self.cpu_time += other.cpu_time
+            self._spans.extend(spans)
+
+    def ratio(self):
+        """Return the raw size divided by the compressed size
+
+        :rtype: float
+        """
+        if not self.compressed_bytes:
+            return 1.0
+        return float(self.raw_bytes) / self.compressed_bytes
+
+    def throughput(self):
+        """Return the raw bytes handled per second of wall time
+
+        :rtype: float
+        """
+        if self.wall_time <= 0:
+            return 0.0
+        return self.raw_bytes / self.wall_time
+
+    def cpu_throughput(self):
+        """Return the raw bytes handled per second of one thread's time
+
+        :rtype: float
+        """
+        if self.cpu_time <= 0:
+            return 0.0
+        return self.raw_bytes / self.cpu_time
+
+    def as_dict(self):
+        """Return the statistics as a dict, suitable for JSON"""
+        return {
+            'codec': self.codec,
+            'level': self.level,
+            'raw_bytes': self.raw_bytes,
+            'compressed_bytes': self.compressed_bytes,
+            'blocks': self.blocks,
+            'ratio': self.ratio(),
+            'cpu_time': self.cpu_time,
+            'wall_time': self.wall_time,
+            'throughput': self.throughput(),
+            'cpu_throughput': self.cpu_throughput(),
+        }
+
+    def summary(self):
+        """Return a one line description of the statistics
+
+        :rtype: str
+        """
+        name = self.codec
+        if self.level is not None:
+            name += ':%d' % self.level
+        return ('%s: %d bytes to %d, ratio %.2f, %.1f MiB/s, %.1f MiB/s per '
+                'thread' % (name, self.raw_bytes, self.compressed_bytes,
+                            self.ratio(), self.throughput() / (1 << 20),
+                            self.cpu_throughput() / (1 << 20)))
+
+class _Block(object):
+    __slots__ = ('data', 'raw_len', 'result', 'error', 'cpu_time', 'done')
+
+    def __init__(self, data, raw_len):
+        self.data = data
+        self.raw_len = raw_len
+        self.result = None
+        self.error = None
+        self.cpu_time = 0.0
+        self.done = threading.Event()
+
+def _write_all(write, data):
+    """Write all of data with a write that may take only part of it"""
+    view = memoryview(data)
+    while view:
+        n = write(view)
+        view = view[n:]
+
+class _BlockWriter(object):
+    """Transform blocks on a pool of threads, writing them out in order
+
+    Subclasses provide _transform, run on the worker threads, and _emit,
+    which writes a finished block.
+    """
+
+    def __init__(self, write, threads, stats):
+        if threads < 1:
+            raise ValueError('threads must be at least 1')
+        self._write = write
+        self.stats = stats
+        self._queue = Queue.Queue()
+        # enough blocks in flight to keep every thread busy while the
+        # oldest is written out
+        self._max_pending = threads * 2
+        self._pending = collections.deque()
+        self._start = None
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work)
+                         for n in range(threads)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            start = time.time()
+            try:
+                block.result = self._transform(block)
+            except Exception as e:
+                block.error = e
+            block.cpu_time = time.time() - start
+            block.data = None
+            block.done.set()
+
+    def _submit(self, block):
+        if self._start is None:
+            self._start = time.time()
+        self._queue.put(block)
+        self._pending.append(block)
+        while len(self._pending) > self._max_pending:
+            self._finish(self._pending.popleft())
+
+    def _finish(self, block):
+        block.done.wait()
+        if block.error is not None:
+            self.abort()
+            raise block.error
+        self.stats.blocks += 1
+        self.stats.cpu_time += block.cpu_time
+        self._emit(block)
+
+    def _flush(self):
+        while self._pending:
+            self._finish(self._pending.popleft())
+        if self._start is not None:
+            self.stats.add_span(self._start, time.time())
+
+    def abort(self):
+        """Stop the worker threads without writing anything more"""
+        self._pending.clear()
+        self._stop()
+
+    def _stop(self):
+        if not self._closed:
+            self._closed = True
+            for t in self._threads:
+                self._queue.put(None)
+
+class CompressingWriter(_BlockWriter):
+    """Compress a stream written to it, writing the framed result to write
+
+    Call :py:meth:`close` at the end of the stream to write the last block
+    and the end marker.
+
+    Attributes:
+        stats   the :py:class:`CompressionStats` of this stream
+    """
+
+    def __init__(self, write, codec='zlib', level=None, threads=1,
+                 block_size=DEFAULT_BLOCK_SZ):
+        """Start the compression threads and write the stream header
+
+        :param write: callable writing some or all of a buffer and returning
+        how many bytes it wrote
+        :param str codec: the codec name
+        :param level: the compression level, or None for the codec's default
+        :type level: int or None
+        :param int threads: the number of compression threads
+        :param int block_size: the size of the blocks compressed
+        :raises ValueError: if the codec is unavailable
+        """
+        self.codec = get_codec(codec)
+        self.level = self.codec.default_level if level is None else level
+        self.block_size = block_size
+        self._buf = bytearray()
+        super(CompressingWriter, self).__init__(
+            write, threads, CompressionStats(self.codec.name, self.level))
+        header = _HEADER.pack(_MAGIC, _VERSION, self.codec.id)
+        _write_all(self._write, header)
+        self.stats.compressed_bytes += len(header)
+
+    def _transform(self, block):
+        data = self.codec.compress(block.data, self.level)
+        if len(data) >= block.raw_len:
+            return _FLAG_STORED, block.data
+        return 0, data
+
+    def _emit(self, block):
+        flags, payload = block.result
+        frame = _FRAME.pack(flags, block.raw_len, len(payload))
+        _write_all(self._write, frame)
+        _write_all(self._write, payload)
+        self.stats.raw_bytes += block.raw_len
+        self.stats.compressed_bytes += len(frame) + len(payload)
+
+    def write(self, data):
+        """Add data to the stream
+
+        :param data: the data
+        :type data: str, bytearray or memoryview
+        :return: the number of bytes taken, always all of them
+        :rtype: int
+        """
+        self._buf.extend(data)
+        while len(self._buf) >= self.block_size:
+            self._submit(_Block(str(self._buf[:self.block_size]),
+                                self.block_size))
+            del self._buf[:self.block_size]
+        return len(data)
+
+    def close(self):
+        """Compress and write what is left, then end the stream"""
+        if self._buf:
+            self._submit(_Block(str(self._buf), len(self._buf)))
+            self._buf = bytearray()
+        self._flush()
+        self._stop()
+        end = _FRAME.pack(0, 0, 0)
+        _write_all(self._write, end)
+        self.stats.compressed_bytes += len(end)
+
+class DecompressingWriter(_BlockWriter):
+    """Decompress a stream made by a :py:class:`CompressingWriter` that is
+    written to it, writing the original stream to write
+
+    Attributes:
+        stats   the :py:class:`CompressionStats` of this stream, available
+                once the header has been read
+    """
+
+    def __init__(self, write, threads=1):
+        """Start the decompression threads
+
+        :param write: callable writing some or all of a buffer and returning
+        how many bytes it wrote
+        :param int threads: the number of decompression threads
+        """
+        self.codec = None
+        self._buf = bytearray()
+        self._ended = False
+        super(DecompressingWriter, self).__init__(
+            write, threads, CompressionStats(None))
+
+    def _transform(self, block):
+        flags, raw_len, payload = block.data
+        if flags & _FLAG_STORED:
+            data = payload
+        else:
+            try:
+                data = self.codec.decompress(payload)
+            except Exception as e:
+                raise ValueError('unable to decompress a block: %s' % e)
+        if len(data) != raw_len:
+            raise ValueError('block decompressed to %d bytes, expected %d'
+                             % (len(data), raw_len))
+        return data
+
+    def _emit(self, block):
+        _write_all(self._write, block.result)
+        self.stats.raw_bytes += block.raw_len
+
+    def write(self, data):
+        """Add compressed data
+
+        :param data: the data
+        :type data: str, bytearray or memoryview
+        :return: the number of bytes taken, always all of them
+        :rtype: int
+        :raises ValueError: if the data isn't a valid compressed stream
+        """
+        self._buf.extend(data)
+        self.stats.compressed_bytes += len(data)
+        off = 0
+        if self.codec is None:
+            if len(self._buf) < _HEADER.size:
+                return len(data)
+            magic, version, codec_id = _HEADER.unpack_from(
+                str(self._buf[:_HEADER.size]))
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError('not a compressed send stream')
+            if codec_id not in _CODEC_IDS:
+                raise ValueError('the stream uses codec %d, which is not '
+                                 'available here' % codec_id)
+            self.codec = _CODEC_IDS[codec_id]
+            self.stats.codec = self.codec.name
+            off = _HEADER.size
+        while len(self._buf) - off >= _FRAME.size:
+            if self._ended:
+                raise ValueError('data after the end of the stream')
+            flags, raw_len, payload_len = _FRAME.unpack_from(
+                str(self._buf[off:off + _FRAME.size]))
+            if not raw_len and not payload_len:
+                self._ended = True
+                off += _FRAME.size
+                continue
+            end = off + _FRAME.size + payload_len
+            if len(self._buf) < end:
+                break
+            self._submit(_Block((flags, raw_len,
+                                 str(self._buf[off + _FRAME.size:end])),
+                                raw_len))
+            off = end
+        if self._ended and len(self._buf) > off:
+            raise ValueError('data after the end of the stream')
+        del self._buf[:off]
+        return len(data)
+
+    def close(self):
+        """Write what is left of the stream
+
+        :raises ValueError: if the stream was cut short
+        """
+        self._flush()
+        self._stop()
+        if not self._ended:
+            raise ValueError('the compressed stream was truncated')
+
+class Compression(object):
+    """The compression settings for a number of streams
+
+    The statistics of every stream compressed are added up in `stats`.
+
+    Attributes:
+        codec       the codec name
+        level       the compression level
+        threads     the number of compression threads per stream
+        block_size  the size of the blocks compressed
+        stats       the :py:class:`CompressionStats` of all of the streams
+    """
+
+    def __init__(self, codec='zlib', level=None, threads=1,
+                 block_size=DEFAULT_BLOCK_SZ):
+        """Check the settings
+
+        :raises ValueError: if the codec is unavailable
+        """
+        c = get_codec(codec)
+        self.codec = codec
+        self.level = c.default_level if level is None else level
+        self.threads = threads
+        self.block_size = block_size
+        self.stats = CompressionStats(codec, self.level)
+
+    def writer(self, write):
+        """Start compressing a new stream written to write
+
+        :rtype: :py:class:`CompressingWriter`
+        """
+        return _CountingWriter(self, write)
+
+class _CountingWriter(CompressingWriter):
+    """A CompressingWriter adding its statistics to a Compression's"""
+
+    def __init__(self, compression, write):
+        self._compression = compression
+        super(_CountingWriter, self).__init__(
+            write, compression.codec, compression.level, compression.threads,
+            compression.block_size)
+
+    def close(self):
+        super(_CountingWriter, self).close()
+        self._compression.stats.add(self.stats)
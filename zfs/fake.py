@@ -0,0 +1,700 @@
+"""A simulated ZFS backend for testing at scale without any pools
+
+The :py:class:`FakeZfsCommandRunner` keeps pools, datasets and snapshots in
+memory and answers the zfs and zpool commands run through it with the same
+output and error messages as the real commands, so all of the parsing and
+error handling in :py:mod:`zfs.util` is exercised. A delay can be added to
+each command to mimic a slow or busy system.
+
+    runner = FakeZfsCommandRunner(latency={'zfs snapshot': 0.2})
+    runner.add_pool('tank')
+    runner.add_dataset('tank/home', props={'com.sun:auto-snapshot': 'true'})
+    runner.zfs_snapshot('tank/home', 'now', recursive=True)
+
+Only the options used by this package are understood.
+"""
+
+import bisect
+import collections
+import random
+import threading
+import time
+import cmdtrace
+import util
+from . import *
+
+# Columns printed by zpool list without -o
+ZPOOL_LIST_DEFAULT=['name', 'size', 'alloc', 'free', 'cap', 'dedup', 'health',
+                    'altroot']
+# Columns printed by zfs list without -o
+ZFS_LIST_DEFAULT=['name', 'used', 'avail', 'refer', 'mountpoint']
+
+# Native properties that can be listed. Those without a simulated value
+# are printed as set with -o, inherited from a parent, or as -
+ZFS_NATIVE_PROPERTIES=frozenset([
+    'name', 'type', 'guid', 'createtxg', 'creation', 'used', 'available',
+    'avail', 'referenced', 'refer', 'written', 'mountpoint', 'origin',
+    'receive_resume_token', 'compression', 'compressratio', 'recordsize',
+    'atime', 'canmount', 'readonly', 'sync', 'checksum', 'dedup', 'copies',
+    'mounted', 'logbias', 'quota', 'refquota', 'reservation',
+    'refreservation', 'volsize',
+])
+
+class _FakePool(object):
+    __slots__ = ('name', 'guid', 'size', 'health', 'scan', 'ndatasets',
+                 'features')
+
+    def __init__(self, name, guid, size, features):
+        self.name = name
+        self.guid = guid
+        self.size = size
+        self.health = 'ONLINE'
+        self.scan = 'none requested'
+        self.ndatasets = 0
+        self.features = features
+
+class _FakeDataset(object):
+    __slots__ = ('name', 'type', 'guid', 'createtxg', 'creation', 'props',
+                 'parent', 'children', 'snapshots')
+
+    def __init__(self, name, dstype, guid, createtxg, creation, props,
+                 parent):
+        self.name = name
+        self.type = dstype
+        self.guid = guid
+        self.createtxg = createtxg
+        self.creation = creation
+        self.props = props
+        self.parent = parent
+        # sorted names of the child datasets
+        self.children = []
+        # snapname -> _FakeSnapshot, in creation order
+        self.snapshots = collections.OrderedDict()
+
+class _FakeSnapshot(object):
+    __slots__ = ('dataset', 'snapname', 'guid', 'createtxg', 'creation')
+
+    def __init__(self, dataset, snapname, guid, createtxg, creation):
+        self.dataset = dataset
+        self.snapname = snapname
+        self.guid = guid
+        self.createtxg = createtxg
+        self.creation = creation
+
+class _CommandError(Exception):
+    """Raised while simulating a command to exit with an error"""
+
+    def __init__(self, err, rc=1):
+        Exception.__init__(self, err)
+        self.err = err
+        self.rc = rc
+
+class FakeZfsCommandRunner(util.ZfsCommandRunner):
+    """A ZfsCommandRunner that simulates zfs and zpool in memory
+
+    The simulated system is safe to use from several threads at once. Each
+    command is delayed by its configured latency before it runs, without
+    holding any lock, so slow commands overlap as they would on a real
+    system.
+
+    Attributes:
+        latency     seconds to wait before each command. Either a number for
+                    every command, or a dict keyed by "zfs list",
+                    "zpool status" etc., with "default" for the rest
+        commands    the number of commands run
+    """
+
+    # Space reported for every dataset and pool, in bytes
+    REFER_SIZE=98304
+    POOL_SIZE=1 << 40
+
+    # The usage printed by zfs send without a snapshot, as by OpenZFS 2
+    SEND_USAGE=('missing snapshot argument\n'
+                'usage:\n'
+                '\tsend [-DnPpRvLecwhb] [-[i|I] snapshot] <snapshot>\n'
+                '\tsend [-nvPLecw] [-i snapshot|bookmark] '
+                '<filesystem|volume|snapshot>\n'
+                '\tsend [-DnPpvLec] [-i bookmark|snapshot] --redact '
+                '<bookmark> <snapshot>\n'
+                '\tsend [-nvPe] -t <receive_resume_token>\n')
+
+    runner_type='fake'
+
+    def __init__(self, latency=0, seed=None, clock=time.time,
+                 command_prefix=None, tracers=None):
+        """Create a new, empty simulated system
+
+        :param latency: seconds to wait before running each command
+        :type latency: float or dict
+        :param seed: seed for the generated guids
+        :param clock: returns the current time in seconds since the epoch,
+        used for the creation time of new datasets and snapshots
+        :param command_prefix: ignored, accepted for compatibility with the
+        other runners
+        :param tracers: Optional list of tracers, see :py:mod:`zfs.cmdtrace`
+        """
+        super(FakeZfsCommandRunner, self).__init__(command_prefix, tracers)
+        self.latency = latency
+        self.commands = 0
+        self._clock = clock
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._txg = 1
+        self._pools = collections.OrderedDict()
+        self._datasets = {}
+        self.send_usage = self.SEND_USAGE
+
+    # Setting up the simulated system
+
+    def add_pool(self, name, guid=None, size=None, props=None,
+                 features=None):
+        """Create a pool and its root filesystem
+
+        :param str name: the pool name
+        :param guid: the pool guid. A random one is used by default.
+        :type guid: int or None
+        :param size: the pool size in bytes
+        :type size: int or None
+        :param dict props: properties to set on the root filesystem
+        :param dict features: the state of pool features, such as
+        {'encryption': 'disabled'}. Features not given are enabled.
+        """
+        util._validate_poolname(name)
+        with self._lock:
+            if name in self._pools:
+                raise ZfsPoolExistsError(name)
+            self._pools[name] = _FakePool(
+                name, guid or self._guid(), size or self.POOL_SIZE,
+                dict(features or {}))
+            self._create(name, props or {}, 'filesystem', None)
+
+    def add_dataset(self, name, props=None, dstype='filesystem',
+                    create_parents=True):
+        """Create a filesystem or volume without running a command
+
+        :param str name: the dataset name
+        :param dict props: properties to set on the dataset
+        :param str dstype: either `filesystem` or `volume`
+        :param bool create_parents: create missing parent filesystems
+        """
+        util._validate_fsname(name)
+        with self._lock:
+            self._create_dataset(name, props or {}, dstype, create_parents)
+
+    def add_snapshots(self, dataset, snapnames, recursive=False,
+                      creation=None, guids=None):
+        """Create snapshots without running a command
+
+        Each snapshot is created in its own transaction group, in the order
+        given, which makes it quick to build up a long history.
+
+        :param str dataset: the dataset to snapshot
+        :param list snapnames: the snapshot names, oldest first
+        :param bool recursive: also snapshot the descendants of dataset
+        :param creation: creation time of the snapshots, now by default
+        :type creation: int or None
+        :param guids: the guid of each snapshot, as kept by a snapshot
+        received from another system. Random ones are used by default.
+        :type guids: list or None
+        """
+        if isinstance(snapnames, basestring):
+            snapnames = [snapnames]
+        with self._lock:
+            for n, snapname in enumerate(snapnames):
+                self._snapshot(['%s@%s' % (dataset, snapname)], recursive,
+                               creation, guids[n] if guids else None)
+
+    def snapshot_guids(self, dataset):
+        """Return the guids of the snapshots of a dataset, oldest first
+
+        :param str dataset: the dataset name
+        :rtype: list of int
+        """
+        with self._lock:
+            return [s.guid for s in
+                    self._datasets[dataset].snapshots.values()]
+
+    def set_scan(self, pool, scan):
+        """Set the scan line of zpool status, e.g. to start a scrub
+
+        :param str pool: the pool name
+        :param str scan: the status text, such as "none requested" or
+        "scrub in progress since Sun Nov 23 12:00:00 2014"
+        """
+        with self._lock:
+            self._pools[pool].scan = scan
+
+    def set_health(self, pool, health):
+        """Set the health of a pool, e.g. DEGRADED
+
+        :param str pool: the pool name
+        :param str health: the new health
+        """
+        with self._lock:
+            self._pools[pool].health = health
+
+    # Running commands
+
+    def run_cmd(self, cmd, args, errorclass=None):
+        """Simulate a zfs or zpool command
+
+        :return: A tuple containing the output, error output, and result code
+        :rtype: tuple
+        """
+        cmdargs = self.process_cmd_args(cmd, args)
+        cmdargs = cmdargs[cmdargs.index(cmd):]
+        subcmd = cmdargs[1] if len(cmdargs) > 1 else ''
+        delay = self._latency('%s %s' % (cmd, subcmd))
+        cmdtrace.mark_spawned()
+        if delay:
+            time.sleep(delay)
+
+        handler = getattr(self, '_%s_%s' % (cmd, subcmd), None)
+        with self._lock:
+            self.commands += 1
+            if handler is None:
+                return ('', "unrecognized command '%s'\n" % subcmd, 2)
+            try:
+                return (handler(cmdargs[2:]), '', 0)
+            except _CommandError as e:
+                return ('', e.err, e.rc)
+
+    def trace_baseline(self):
+        """Do nothing, as simulated commands aren't started"""
+        pass
+
+    def _latency(self, command):
+        if isinstance(self.latency, dict):
+            return self.latency.get(command, self.latency.get('default', 0))
+        return self.latency
+
+    # zpool
+
+    def _zpool_list(self, args):
+        opts, pools = _getopt(args, 'Hp', 'o')
+        props = opts['o'][-1].split(',') if 'o' in opts else \
+                ZPOOL_LIST_DEFAULT
+        parsable = 'p' in opts
+        lines = []
+        for pool in self._find_pools(pools):
+            row = [self._pool_prop(pool, p, parsable) for p in props]
+            lines.append('\t'.join(row) + '\n')
+        return ''.join(lines)
+
+    def _zpool_status(self, args):
+        opts, pools = _getopt(args, 'vx', '')
+        blocks = []
+        for pool in self._find_pools(pools):
+            blocks.append(
+                '  pool: %(name)s\n'
+                ' state: %(health)s\n'
+                '  scan: %(scan)s\n'
+                'config:\n'
+                '\n'
+                '\tNAME        STATE     READ WRITE CKSUM\n'
+                '\t%(name)-11s %(health)-9s    0     0     0\n'
+                '\n'
+                'errors: No known data errors\n' % {
+                    'name': pool.name, 'health': pool.health,
+                    'scan': pool.scan})
+        return '\n'.join(blocks)
+
+    def _find_pools(self, names):
+        if not names:
+            return list(self._pools.values())
+        pools = []
+        for name in names:
+            if name not in self._pools:
+                raise _CommandError("cannot open '%s': no such pool\n" % name)
+            pools.append(self._pools[name])
+        return pools
+
+    def _pool_prop(self, pool, prop, parsable=False):
+        size = str if parsable else _human_size
+        if prop == 'name':
+            return pool.name
+        if prop == 'guid':
+            return str(pool.guid)
+        if prop == 'size':
+            return size(pool.size)
+        if prop in ('alloc', 'allocated'):
+            return size(self._pool_used(pool))
+        if prop == 'free':
+            return size(pool.size - self._pool_used(pool))
+        if prop in ('cap', 'capacity'):
+            pct = 100 * self._pool_used(pool) // pool.size
+            return str(pct) if parsable else '%d%%' % pct
+        if prop in ('dedup', 'dedupratio'):
+            return '1.00' if parsable else '1.00x'
+        if prop == 'health':
+            return pool.health
+        if prop == 'altroot':
+            return '-'
+        if prop.startswith('feature@'):
+            return pool.features.get(prop[len('feature@'):], 'enabled')
+        raise _CommandError("bad property list: invalid property '%s'\n" %
+                            prop, 2)
+
+    def _pool_used(self, pool):
+        return self.REFER_SIZE * pool.ndatasets
+
+    # zfs
+
+    def _zfs_list(self, args):
+        opts, names = _getopt(args, 'Hpr', 'dtosS')
+        parsable = 'p' in opts
+        props = opts['o'][-1].split(',') if 'o' in opts else ZFS_LIST_DEFAULT
+        for prop in props:
+            if ':' not in prop and prop not in ZFS_NATIVE_PROPERTIES:
+                raise _CommandError(
+                    "bad property list: invalid property '%s'\n" % prop, 2)
+        types = set(opts['t'][-1].split(',')) if 't' in opts else \
+                set(['filesystem', 'volume'])
+        if 'all' in types:
+            types = set(['filesystem', 'volume', 'snapshot'])
+        if 'snap' in types:
+            types.add('snapshot')
+
+        if 'd' in opts:
+            depth = int(opts['d'][-1])
+        elif 'r' in opts or not names:
+            depth = None
+        elif types == set(['snapshot']):
+            # zfs list -t snapshot fs lists the snapshots of fs
+            depth = 1
+        else:
+            depth = 0
+
+        items = []
+        if not names:
+            names = list(self._pools.keys())
+        for name in names:
+            if '@' in name:
+                ds, snapname = name.split('@', 1)
+                snap = self._datasets[ds].snapshots.get(snapname) \
+                        if ds in self._datasets else None
+                if snap is None:
+                    raise _CommandError(
+                        "cannot open '%s': dataset does not exist\n" % name)
+                items.append(snap)
+                continue
+            if name not in self._datasets:
+                raise _CommandError(
+                    "cannot open '%s': dataset does not exist\n" % name)
+            self._walk(self._datasets[name], 0, depth, types, items)
+
+        sorts = []
+        for opt, value in opts.get('sort', []):
+            sorts.append((value, opt == 'S'))
+        # sort by the last key first, so that the first key takes precedence
+        for prop, reverse in reversed(sorts):
+            items.sort(key=lambda item: self._sort_key(item, prop),
+                       reverse=reverse)
+
+        lines = []
+        for item in items:
+            lines.append('\t'.join([self._prop(item, p, parsable)
+                                    for p in props]) + '\n')
+        return ''.join(lines)
+
+    def _walk(self, ds, level, depth, types, items):
+        if ds.type in types:
+            items.append(ds)
+        if depth is not None and level >= depth:
+            return
+        if 'snapshot' in types:
+            items.extend(ds.snapshots.values())
+        for child in ds.children:
+            self._walk(self._datasets[child], level + 1, depth, types, items)
+
+    def _sort_key(self, item, prop):
+        value = self._prop(item, prop, True)
+        if prop in util.ZFS_NUMERIC_PROPERTIES:
+            try:
+                return int(value)
+            except ValueError:
+                return -1
+        return value
+
+    def _prop(self, item, prop, parsable):
+        snapshot = isinstance(item, _FakeSnapshot)
+        ds = self._datasets[item.dataset] if snapshot else item
+        if prop == 'name':
+            if snapshot:
+                return '%s@%s' % (item.dataset, item.snapname)
+            return item.name
+        if prop == 'type':
+            return 'snapshot' if snapshot else item.type
+        if prop in ('guid', 'createtxg'):
+            return str(getattr(item, prop))
+        if prop == 'creation':
+            if parsable:
+                return str(item.creation)
+            return time.strftime('%a %b %d %H:%M %Y',
+                                 time.localtime(item.creation))
+        if prop in ('used', 'written'):
+            size = 0 if snapshot else self.REFER_SIZE
+        elif prop in ('referenced', 'refer'):
+            size = self.REFER_SIZE
+        elif prop in ('available', 'avail'):
+            if snapshot:
+                return '-'
+            pool = self._pools[util.get_pool_from_fsname(ds.name)]
+            size = pool.size - self._pool_used(pool)
+        elif prop == 'mountpoint':
+            if snapshot or ds.type != 'filesystem':
+                return '-'
+            return ds.props.get('mountpoint', '/' + ds.name)
+        else:
+            # properties are inherited, also by snapshots
+            while ds is not None:
+                if prop in ds.props:
+                    return ds.props[prop]
+                ds = self._datasets.get(ds.parent)
+            return '-'
+        return str(size) if parsable else _human_size(size)
+
+    def _zfs_create(self, args):
+        opts, names = _getopt(args, 'p', 'o')
+        if len(names) != 1:
+            raise _CommandError('missing filesystem argument\n', 2)
+        name = names[0]
+        props = {}
+        for opt in opts.get('o', []):
+            k, v = opt.split('=', 1)
+            props[k] = v
+        if name in self._datasets:
+            raise _CommandError(
+                "cannot create '%s': dataset already exists\n" % name)
+        self._create_dataset(name, props, 'filesystem', 'p' in opts)
+        return ''
+
+    def _zfs_send(self, args):
+        if not args:
+            raise _CommandError(self.send_usage, 2)
+        opts, names = _getopt(args, 'DnPpRvLecwhb', 'iI')
+        if 'n' not in opts:
+            raise _CommandError('cannot send: streams are not simulated\n')
+        if len(names) != 1:
+            raise _CommandError('missing snapshot argument\n', 2)
+        snap = self._find_snapshot(names[0])
+        datasets = [snap.dataset]
+        if 'R' in opts:
+            datasets = self._descendants(snap.dataset)
+        base = (opts.get('i') or opts.get('I') or [None])[-1]
+        lines = []
+        total = 0
+        for ds in (self._datasets[d] for d in datasets):
+            if snap.snapname not in ds.snapshots:
+                continue
+            # a full stream is the size of the dataset, an incremental one
+            # grows with the transaction groups it covers
+            if base is None:
+                size = self.REFER_SIZE
+                lines.append('full\t%s@%s\t%d\n' % (ds.name, snap.snapname,
+                                                      size))
+            else:
+                src = self._find_snapshot(ds.name + base[base.index('@'):])
+                size = 4096 * max(ds.snapshots[snap.snapname].createtxg -
+                                  src.createtxg, 0)
+                lines.append('incremental\t%s\t%s@%s\t%d\n' % (
+                    src.snapname, ds.name, snap.snapname, size))
+            total += size
+        lines.append('size\t%d\n' % total)
+        return ''.join(lines)
+
+    def _find_snapshot(self, name):
+        fsname, snapname = name.split('@', 1)
+        ds = self._datasets.get(fsname)
+        if ds is None or snapname not in ds.snapshots:
+            raise _CommandError("cannot open '%s': dataset does not exist\n"
+                                % name)
+        return ds.snapshots[snapname]
+
+    def _create_dataset(self, name, props, dstype, create_parents):
+        pool = util.get_pool_from_fsname(name)
+        if pool not in self._pools:
+            raise _CommandError("cannot create '%s': no such pool '%s'\n" %
+                                (name, pool))
+        parent = name.rsplit('/', 1)[0]
+        if parent not in self._datasets:
+            if not create_parents:
+                raise _CommandError(
+                    "cannot create '%s': parent does not exist\n" % name)
+            self._create_dataset(parent, {}, 'filesystem', True)
+        if name in self._datasets:
+            return
+        self._create(name, props, dstype, parent)
+
+    def _create(self, name, props, dstype, parent):
+        self._txg += 1
+        self._datasets[name] = _FakeDataset(
+            name, dstype, self._guid(), self._txg, int(self._clock()),
+            dict(props), parent)
+        self._pools[util.get_pool_from_fsname(name)].ndatasets += 1
+        if parent is not None:
+            bisect.insort(self._datasets[parent].children, name)
+
+    def _zfs_snapshot(self, args):
+        opts, names = _getopt(args, 'r', 'o')
+        if not names:
+            raise _CommandError('missing snapshot argument\n', 2)
+        self._snapshot(names, 'r' in opts)
+        return ''
+
+    def _snapshot(self, fullsnapnames, recursive, creation=None, guid=None):
+        """Atomically create snapshots, all in one transaction group"""
+        new = []
+        for fullsnapname in fullsnapnames:
+            ds, snapname = fullsnapname.split('@', 1)
+            if ds not in self._datasets:
+                raise _CommandError(
+                    "cannot open '%s': dataset does not exist\n" % ds)
+            targets = self._descendants(ds) if recursive else [ds]
+            for target in targets:
+                if snapname in self._datasets[target].snapshots:
+                    raise _CommandError(
+                        "cannot create snapshot '%s@%s': dataset already "
+                        "exists\n" % (target, snapname))
+                new.append((target, snapname))
+
+        self._txg += 1
+        if creation is None:
+            creation = int(self._clock())
+        for target, snapname in new:
+            self._datasets[target].snapshots[snapname] = _FakeSnapshot(
+                target, snapname, guid or self._guid(), self._txg, creation)
+
+    def _zfs_destroy(self, args):
+        opts, names = _getopt(args, 'rRnpvf', '')
+        recursive = 'r' in opts or 'R' in opts
+        if not names:
+            raise _CommandError('missing dataset argument\n', 2)
+        for name in names:
+            if '@' in name:
+                self._destroy_snapshots(name, recursive)
+            else:
+                self._destroy_dataset(name, recursive)
+        return ''
+
+    def _destroy_dataset(self, name, recursive):
+        if name not in self._datasets:
+            raise _CommandError(
+                "cannot open '%s': dataset does not exist\n" % name)
+        ds = self._datasets[name]
+        if not recursive and (ds.children or ds.snapshots):
+            dependents = [d for d in self._descendants(name) if d != name]
+            dependents.extend('%s@%s' % (name, s) for s in ds.snapshots)
+            raise _CommandError(
+                "cannot destroy '%s': filesystem has children\n"
+                "use '-r' to destroy the following datasets:\n%s\n" % (
+                    name, '\n'.join(dependents)))
+        if ds.parent is None:
+            raise _CommandError(
+                "cannot destroy '%s': operation does not apply to pools\n"
+                "use 'zpool destroy %s' to destroy the pool\n" % (name, name))
+        pool = self._pools[util.get_pool_from_fsname(name)]
+        for target in reversed(self._descendants(name)):
+            del self._datasets[target]
+            pool.ndatasets -= 1
+        self._datasets[ds.parent].children.remove(name)
+
+    def _destroy_snapshots(self, name, recursive):
+        """Destroy fs@snap, fs@a,b or fs@a%c, optionally recursively"""
+        ds, spec = name.split('@', 1)
+        targets = []
+        if ds in self._datasets:
+            targets = self._descendants(ds) if recursive else [ds]
+        found = []
+        for target in targets:
+            snapshots = self._datasets[target].snapshots
+            snapnames = list(snapshots.keys())
+            for part in spec.split(','):
+                if '%' in part:
+                    first, last = part.split('%', 1)
+                    if (first and first not in snapshots) or \
+                       (last and last not in snapshots):
+                        continue
+                    start = snapnames.index(first) if first else 0
+                    end = snapnames.index(last) if last else \
+                            len(snapnames) - 1
+                    found.extend((target, s) for s in snapnames[start:end + 1])
+                elif part in snapshots:
+                    found.append((target, part))
+        if not found:
+            raise _CommandError(util.ZFS_ERROR_STRINGS['nosnaplinux'])
+        for target, snapname in found:
+            self._datasets[target].snapshots.pop(snapname, None)
+
+    def _descendants(self, name):
+        """name and all of its descendant datasets, parents first"""
+        result = [name]
+        i = 0
+        while i < len(result):
+            result.extend(self._datasets[result[i]].children)
+            i += 1
+        return result
+
+    def _guid(self):
+        return self._random.getrandbits(64)
+
+def _getopt(args, flags, valued):
+    """Parse the options of a simulated command
+
+    Options may be grouped, as in -rH, and the value of an option may be
+    attached, as in -d1. The -s and -S sort options are also collected, in
+    order, under 'sort'.
+
+    :param list args: the arguments after the subcommand
+    :param str flags: letters of the options without a value
+    :param str valued: letters of the options that take a value
+    :return: a dict of the values of each option present, and the remaining
+    arguments
+    :rtype: tuple
+    """
+    opts = {}
+    i = 0
+    while i < len(args) and args[i].startswith('-') and len(args[i]) > 1:
+        arg = args[i]
+        j = 1
+        while j < len(arg):
+            c = arg[j]
+            if c in valued:
+                if j + 1 < len(arg):
+                    value = arg[j + 1:]
+                else:
+                    i += 1
+                    if i >= len(args):
+                        raise _CommandError(
+                            "missing argument for '%s' option\n" % c, 2)
+                    value = args[i]
+                opts.setdefault(c, []).append(value)
+                if c in 'sS':
+                    opts.setdefault('sort', []).append((c, value))
+                break
+            elif c in flags:
+                opts.setdefault(c, []).append(True)
+            else:
+                raise _CommandError("invalid option '%s'\n" % c, 2)
+            j += 1
+        i += 1
+    return opts, args[i:]
+
+def _human_size(size):
+    """Format a number of bytes the way zfs does without -p
+
+    Whole numbers of a unit are printed without decimals, otherwise as many
+    decimals as fit in five characters are used, as in 1.50K or 1024G.
+    """
+    units = ['B', 'K', 'M', 'G', 'T', 'P']
+    u = 0
+    while size >= 1024 ** (u + 1) and u < len(units) - 1:
+        u += 1
+    if u == 0 or size % (1024 ** u) == 0:
+        return '%d%s' % (size // (1024 ** u), units[u])
+    value = float(size) / (1024 ** u)
+    for precision in (2, 1, 0):
+        text = '%.*f%s' % (precision, value, units[u])
+        if len(text) <= 5:
+            break
+    return text
@@ -0,0 +1,399 @@
+"""An in-memory inventory of the snapshots on one or more zpools
+
+Listing the snapshots of every dataset separately means running one `zfs
+list` per dataset, and a recursive listing of a parent also lists the
+snapshots of all of its children only for them to be thrown away. The
+:py:class:`SnapshotIndex` instead loads everything with a single recursive
+listing per pool, and answers the per-dataset and per-label questions from
+memory. Snapshots created or destroyed through the index are applied to it
+directly, so it stays accurate without listing again.
+"""
+
+import collections
+import datetime
+import logging
+import re
+import threading
+import time
+import util
+from . import *
+
+# The columns listed for each dataset and snapshot
+INDEX_PROPERTIES=['name', 'type', 'guid', 'createtxg', 'creation']
+INDEX_TYPES=['filesystem', 'volume', 'snapshot']
+
+# Snapshots taken by RollingSnapshotter are named prefix_label-YYYY-MM-DD-HHMM.
+# Either part may contain an underscore, so without the prefix the split at
+# the last one is only a guess; SnapshotIndex.labelled doesn't rely on it.
+_SNAPNAME_RE=re.compile(
+    r'^(?P<prefix>.+)_(?P<label>.+)-(?P<date>\d{4}-\d{2}-\d{2}-\d{4})$')
+
+class Snapshot(collections.namedtuple('Snapshot', [
+        'dataset', 'snapname', 'guid', 'createtxg', 'creation',
+        'prefix', 'label', 'snapdate'])):
+    """A snapshot known to a :py:class:`SnapshotIndex`
+
+    Attributes:
+        dataset     the name of the snapshotted filesystem or volume, shared
+                    by all of its snapshots
+        snapname    the part of the name after the @
+        guid        the guid of the snapshot as an int, or None if we
+                    created it
+        createtxg   the transaction group the snapshot was created in, or
+                    None if we created it
+        creation    the creation time in seconds since the epoch
+        prefix      the prefix part of the name, or None if the snapshot
+                    wasn't named by a RollingSnapshotter
+        label       the label part of the name, or None
+        snapdate    the date in the name as a datetime, or None
+    """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        """The full dataset@snapname name of the snapshot"""
+        return '%s@%s' % (self.dataset, self.snapname)
+
+def make_snapshot(dataset, snapname, guid=None, createtxg=None,
+                  creation=None, prefix=None):
+    """Create a :py:class:`Snapshot`, parsing the prefix, label and date out
+    of the snapshot name
+
+    :param str dataset: the snapshotted dataset
+    :param str snapname: the part of the snapshot name after the @
+    :param prefix: the prefix the snapshot is expected to have. If the name
+    starts with it, the rest up to the date is the label, even if the label
+    has an underscore in it. Otherwise the name is split at the last
+    underscore.
+    :type prefix: str or None
+    :return: the new snapshot
+    :rtype: :py:class:`Snapshot`
+    """
+    known = prefix
+    prefix = label = snapdate = None
+    m = _SNAPNAME_RE.match(snapname)
+    if m:
+        # strptime is slow enough to dominate loading a large index
+        d = m.group('date')
+        try:
+            snapdate = datetime.datetime(int(d[0:4]), int(d[5:7]),
+                                         int(d[8:10]), int(d[11:13]),
+                                         int(d[13:15]))
+            prefix = m.group('prefix')
+            label = m.group('label')
+            if known is not None and snapname.startswith(known + '_'):
+                prefix = known
+                label = snapname[len(known) + 1:m.start('date') - 1]
+        except ValueError:
+            pass
+    return Snapshot(dataset, snapname, guid, createtxg, creation,
+                    prefix, label, snapdate)
+
+def newest_common_snapshot(local, remote):
+    """Find the newest snapshot that two copies of a dataset have in common
+
+    A received snapshot keeps the guid of the snapshot it was sent from, so
+    the copies are matched by guid, which holds even if a snapshot has
+    been renamed on either side. The local guids are put in a dict, so the
+    search takes time linear in the number of snapshots.
+
+    :param list local: the :py:class:`Snapshot` of the sending dataset
+    :param list remote: the :py:class:`Snapshot` of the receiving dataset,
+    oldest first
+    :return: the local and the remote copy of the newest common snapshot, or
+    None if there is none
+    :rtype: tuple or None
+    """
+    by_guid = dict((s.guid, s) for s in local if s.guid is not None)
+    for snap in reversed(remote):
+        if snap.guid is not None and snap.guid in by_guid:
+            return by_guid[snap.guid], snap
+    return None
+
+class SnapshotIndex(object):
+    """Snapshots of one or more zpools, indexed by dataset and by label
+
+    The index is filled with :py:meth:`load`, which lists a whole pool (or
+    the tree below any dataset) with one command. Snapshots are kept in
+    creation order, oldest first. It is safe to share an index between
+    threads.
+
+    Attributes:
+        runner      the ZfsCommandRunner used to list the snapshots, or None
+                    to use the local zfs commands
+    """
+
+    # The columns listed, which subclasses may extend
+    PROPERTIES=INDEX_PROPERTIES
+
+    def __init__(self, runner=None):
+        """Create a new, empty SnapshotIndex
+
+        :param runner: the runner used to list snapshots. Defaults to
+        running zfs locally through sudo.
+        :type runner: ZfsCommandRunner or None
+        """
+        self.runner = runner
+        self._lock = threading.RLock()
+        self._loaded = set()
+        # dataset -> type
+        self._types = collections.OrderedDict()
+        # dataset -> [child dataset]
+        self._children = {}
+        # dataset -> [Snapshot]
+        self._snapshots = {}
+
+    def _zfs_list_records(self, *args, **kwargs):
+        if self.runner is not None:
+            return self.runner.zfs_list_records(*args, **kwargs)
+        return util.zfs_list_records(*args, **kwargs)
+
+    def load(self, datasets, depth=None):
+        """List the datasets and snapshots below each of datasets
+
+        Usually datasets is a pool name. Datasets that have already been
+        loaded are not listed again.
+
+        :param datasets: the dataset or datasets to list
+        :type datasets: str or list
+        :param depth: if specified, limit the listing to this many levels
+        below each dataset. 1 lists only the dataset and its own snapshots.
+        :type depth: int or None
+        :return: True if any dataset was listed, False if all were already
+        loaded
+        :rtype: bool
+        :raises ZfsNoDatasetError: if a dataset does not exist
+        """
+        if isinstance(datasets, basestring):
+            datasets = [ datasets ]
+
+        listed = False
+        for ds in datasets:
+            with self._lock:
+                if (ds, depth) in self._loaded or (ds, None) in self._loaded:
+                    continue
+            logging.debug('Indexing snapshots of %s' % ds)
+            # read the whole listing before taking the lock, so other
+            # threads aren't held up by the command, and a listing that
+            # fails part way adds nothing
+            records = list(self._zfs_list_records(
+                datasets=ds, types=INDEX_TYPES, properties=self.PROPERTIES,
+                sort='createtxg', recursive=depth is None, depth=depth,
+                stream=True))
+            with self._lock:
+                if (ds, depth) in self._loaded or (ds, None) in self._loaded:
+                    # another thread loaded it while we were listing
+                    continue
+                for record in records:
+                    self._add_record(record)
+                self._loaded.add((ds, depth))
+            listed = True
+        return listed
+
+    def load_pools(self, fsnames):
+        """Load the pools containing each of fsnames
+
+        :param list fsnames: names of filesystems
+        :return: True if any pool was listed
+        :rtype: bool
+        """
+        pools = []
+        for fs in fsnames:
+            pool = util.get_pool_from_fsname(fs)
+            if pool not in pools:
+                pools.append(pool)
+        return self.load(pools)
+
+    def _add_record(self, record):
+        if record.snapname is None:
+            if record.dataset not in self._types:
+                self._types[record.dataset] = record.type
+                if '/' in record.dataset:
+                    parent = record.dataset.rsplit('/', 1)[0]
+                    self._children.setdefault(parent, []).append(
+                        record.dataset)
+            self._snapshots.setdefault(record.dataset, [])
+            return
+        self._append(make_snapshot(record.dataset, record.snapname,
+                                   record.guid, record.createtxg,
+                                   record.creation))
+
+    def _append(self, snap):
+        self._snapshots.setdefault(snap.dataset, []).append(snap)
+
+    def datasets(self, root=None, types=None):
+        """Return the names of the indexed filesystems and volumes
+
+        :param root: if given, only return root and its descendants
+        :type root: str or None
+        :param types: if given, only return datasets of these types, for
+        example ['filesystem']
+        :type types: list or None
+        :rtype: list of str
+        """
+        with self._lock:
+            if root is None:
+                found = list(self._types.keys())
+            else:
+                found = self._descendants(root)
+            if types is None:
+                return found
+            return [ds for ds in found if self._types.get(ds) in types]
+
+    def _descendants(self, root):
+        """root, if it is indexed, and its indexed descendants, parents
+        first"""
+        found = [root] if root in self._types else []
+        stack = list(reversed(self._children.get(root, [])))
+        while stack:
+            ds = stack.pop()
+            found.append(ds)
+            stack.extend(reversed(self._children.get(ds, [])))
+        return found
+
+    def snapshots(self, dataset):
+        """Return the snapshots of one dataset, oldest first
+
+        :param str dataset: the filesystem or volume name
+        :rtype: list of :py:class:`Snapshot`
+        """
+        with self._lock:
+            return list(self._snapshots.get(dataset, []))
+
+    def labelled(self, dataset, prefix, label):
+        """Return the snapshots of dataset whose names start with
+        prefix_label-, oldest first
+
+        The name is matched as a string, so prefixes and labels containing
+        underscores work, and the rest of the name needn't be a date.
+
+        :param str dataset: the filesystem or volume name
+        :param str prefix: the snapshot name prefix, e.g. zfs-auto-snap
+        :param str label: the snapshot label, e.g. daily
+        :rtype: list of :py:class:`Snapshot`
+        """
+        stem = '%s_%s-' % (prefix, label)
+        with self._lock:
+            return [s for s in self._snapshots.get(dataset, [])
+                    if s.snapname.startswith(stem)]
+
+    def add(self, datasets, snapname, recursive=False, creation=None):
+        """Record snapshots we have just taken
+
+        :param datasets: the snapshotted dataset or datasets
+        :type datasets: str or list
+        :param str snapname: the part of the new snapshot names after the @
+        :param bool recursive: if true, the descendants of datasets were also
+        snapshotted
+        :param creation: the creation time in seconds since the epoch.
+        Defaults to now.
+        :type creation: int or None
+        """
+        if isinstance(datasets, basestring):
+            datasets = [ datasets ]
+        if creation is None:
+            creation = int(time.time())
+        with self._lock:
+            targets = []
+            for ds in datasets:
+                if recursive:
+                    targets.extend(self.datasets(root=ds))
+                if ds not in targets:
+                    targets.append(ds)
+            for ds in targets:
+                self._append(make_snapshot(ds, snapname, creation=creation))
+
+    def remove(self, fullsnapnames, recursive=False):
+        """Forget snapshots we have just destroyed
+
+        :param list fullsnapnames: the dataset@snapname names destroyed
+        :param bool recursive: if true, the snapshots of the same name of the
+        descendants of each dataset were also destroyed
+        """
+        with self._lock:
+            gone = {}
+            descendants = {}
+            for fullname in fullsnapnames:
+                ds, snapname = fullname.split('@', 1)
+                if ds not in descendants:
+                    targets = self.datasets(root=ds) if recursive else []
+                    if ds not in targets:
+                        targets.append(ds)
+                    descendants[ds] = targets
+                for target in descendants[ds]:
+                    gone.setdefault(target, set()).add(snapname)
+            for ds, snapnames in gone.items():
+                if ds not in self._snapshots:
+                    continue
+                self._snapshots[ds] = [s for s in self._snapshots[ds]
+                                       if s.snapname not in snapnames]
+
+class ReplicaIndex(SnapshotIndex):
+    """Snapshots received on a backup host, with the state of interrupted
+    receives
+
+    The same single listing that fills a :py:class:`SnapshotIndex` also
+    fetches the `receive_resume_token` of every dataset, so planning the
+    sends to a backup host takes one round trip however many datasets it
+    holds.
+    """
+
+    PROPERTIES=INDEX_PROPERTIES + ['receive_resume_token']
+
+    def __init__(self, runner=None):
+        """Create a new, empty ReplicaIndex
+
+        See :py:class:`SnapshotIndex`.
+        """
+        super(ReplicaIndex, self).__init__(runner)
+        # dataset -> token
+        self._tokens = {}
+
+    def load(self, datasets, depth=None):
+        """List the datasets and snapshots below each of datasets
+
+        See :py:meth:`SnapshotIndex.load`. Datasets that don't exist yet
+        are indexed as empty rather than raising an error, and versions of
+        ZFS that can't resume receives are listed without the tokens.
+        """
+        if isinstance(datasets, basestring):
+            datasets = [ datasets ]
+        listed = False
+        for ds in datasets:
+            try:
+                listed = super(ReplicaIndex, self).load(ds, depth) or listed
+            except ZfsInvalidPropertyError:
+                self.PROPERTIES = INDEX_PROPERTIES
+                listed = super(ReplicaIndex, self).load(ds, depth) or listed
+            except ZfsNoDatasetError:
+                logging.debug('%s does not exist yet' % ds)
+                with self._lock:
+                    self._loaded.add((ds, depth))
+        return listed
+
+    def _add_record(self, record):
+        super(ReplicaIndex, self)._add_record(record)
+        token = getattr(record, 'receive_resume_token', None)
+        if record.snapname is None and token:
+            self._tokens[record.dataset] = token
+
+    def exists(self, dataset):
+        """Check whether a filesystem or volume was listed
+
+        :param str dataset: the dataset name
+        :rtype: bool
+        """
+        with self._lock:
+            return dataset in self._types
+
+    def resume_token(self, dataset):
+        """Return the token for resuming an interrupted receive into dataset
+
+        See :py:func:`zfs.util.ZfsCommandRunner.zfs_receive_resume_token`.
+
+        :param str dataset: the dataset name
+        :return: the token, or None if there is no partial state
+        :rtype: str or None
+        """
+        with self._lock:
+            return self._tokens.get(dataset)
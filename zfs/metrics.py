@@ -0,0 +1,222 @@
+"""Run metrics in the Prometheus text format
+
+The applications are run from cron, so rather than serving metrics they write
+them to a file for node_exporter's textfile collector to pick up. A
+:py:class:`RunMetrics` collects the timings and counts of one run and
+:py:meth:`RunMetrics.write` replaces the file atomically, so node_exporter
+never reads a half written file.
+
+Example::
+
+    metrics = RunMetrics('zfsautosnap', label='hourly')
+    with metrics.phase('snapshot'):
+        ...
+    metrics.inc('snapshots_created', 12)
+    metrics.write('/var/lib/node_exporter/textfile/zfsautosnap_hourly.prom')
+
+Every sample carries an `app` label and any labels given to the
+constructor, so several applications and labels can write to the same
+directory without their metrics clashing.
+"""
+
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+METRIC_PREFIX='zfsautosnap_'
+
+# (name, help text), in the order they are written. All of the metrics are
+# gauges describing the last run.
+METRICS=[
+    ('run_start_timestamp_seconds', 'When the last run started'),
+    ('run_duration_seconds', 'How long the last run took'),
+    ('run_success', '1 if the last run succeeded, 0 if it failed'),
+    ('phase_duration_seconds', 'Time spent in each phase of the last run'),
+    ('datasets_processed', 'Datasets worked on by the last run'),
+    ('dataset_failures', 'Datasets the last run failed to process'),
+    ('snapshots_created', 'Snapshots created by the last run'),
+    ('snapshots_destroyed', 'Snapshots destroyed by the last run'),
+    ('bytes_planned',
+     'Estimated bytes of the send streams planned by the last run'),
+    ('bytes_sent', 'Bytes of send streams sent by the last run'),
+    ('replication_lag_seconds',
+     'Age of the newest snapshot of each dataset on the backup target'),
+    ('compression_ratio',
+     'Bytes before compression per byte sent by the last run'),
+    ('compression_throughput_bytes_per_second',
+     'Bytes compressed per second of streaming by the last run'),
+]
+_HELP=dict(METRICS)
+
+# Counts reported even when nothing happened, so a quiet run shows up as 0
+# rather than as a missing series
+_COUNTS=['datasets_processed', 'dataset_failures', 'snapshots_created',
+         'snapshots_destroyed']
+
+class RunMetrics(object):
+    """The timings and counts of one application run
+
+    It is safe to update the metrics from several threads at once.
+
+    Attributes:
+        app     the application name, used as the `app` label
+        labels  dict of labels added to every sample
+        start   when the run started, in seconds since the epoch
+    """
+
+    def __init__(self, app, clock=time.time, **labels):
+        """Start collecting metrics for a run
+
+        :param str app: the application name, e.g. 'zfsautosnap'
+        :param clock: returns the current time in seconds since the epoch
+        :param labels: labels added to every sample, e.g. label='hourly'
+        """
+        self.app = app
+        self.labels = labels
+        self._clock = clock
+        self._lock = threading.Lock()
+        # name -> {sorted label items: value}
+        self._values = {}
+        self.start = clock()
+        self.set('run_start_timestamp_seconds', self.start)
+        for name in _COUNTS:
+            self.inc(name, 0)
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def set(self, name, value, **labels):
+        """Set a metric
+
+        :param str name: the metric name, without the prefix
+        :param value: the new value
+        :type value: int or float
+        :param labels: labels of this sample, e.g. dataset='tank/foo'
+        :raises KeyError: if the metric is unknown
+        """
+        _check_name(name)
+        with self._lock:
+            self._values.setdefault(name, {})[self._key(labels)] = value
+
+    def inc(self, name, value=1, **labels):
+        """Add to a metric
+
+        See :py:meth:`RunMetrics.set` for the parameters.
+        """
+        _check_name(name)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            key = self._key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def get(self, name, **labels):
+        """Return the value of a metric, or None if it hasn't been set"""
+        with self._lock:
+            return self._values.get(name, {}).get(self._key(labels))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in a with block to the duration of a phase
+
+        :param str name: the phase, e.g. 'planning', 'snapshot', 'purge' or
+        'send'
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.inc('phase_duration_seconds', self._clock() - start,
+                     phase=name)
+
+    def finish(self, success):
+        """Record the duration and outcome of the run
+
+        :param bool success: whether the run succeeded
+        """
+        self.set('run_duration_seconds', self._clock() - self.start)
+        self.set('run_success', 1 if success else 0)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format
+
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            for name, help in METRICS:
+                if name not in self._values:
+                    continue
+                fullname = METRIC_PREFIX + name
+                lines.append('# HELP %s %s' % (fullname, help))
+                lines.append('# TYPE %s gauge' % fullname)
+                for key in sorted(self._values[name]):
+                    labels = dict(self.labels, app=self.app)
+                    labels.update(key)
+                    lines.append('%s{%s} %s' % (
+                        fullname, _format_labels(labels),
+                        _format_value(self._values[name][key])))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Atomically replace the file at path with the metrics
+
+        The metrics are written to a temporary file in the same directory,
+        which is then renamed over path. The temporary file doesn't end in
+        .prom, so node_exporter ignores it.
+
+        :param str path: the file to write, usually ending in .prom
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp',
+                                   prefix='.%s.' % os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+def _check_name(name):
+    if name not in _HELP:
+        raise KeyError('unknown metric %s' % name)
+
+def _format_labels(labels):
+    return ','.join('%s="%s"' % (k, _escape(v))
+                    for k, v in sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n')\
+            .replace('"', '\\"')
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def write_metrics_file(metrics, path):
+    """Write metrics to path, logging rather than raising any error
+
+    A run shouldn't fail just because its metrics couldn't be written.
+
+    :param metrics: the metrics to write
+    :type metrics: :py:class:`RunMetrics`
+    :param path: the file to write, or None to do nothing
+    :type path: str or None
+    :return: True if the file was written
+    :rtype: bool
+    """
+    if path is None:
+        return False
+    try:
+        metrics.write(path)
+    except (IOError, OSError) as e:
+        logging.error('Unable to write metrics to %s: %s' % (path, e))
+        return False
+    return True
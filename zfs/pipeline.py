@@ -0,0 +1,237 @@
+"""Stream a zfs send into a zfs receive
+
+Either end may be a local process, as returned by
+:py:func:`zfs.util.LocalZfsCommandRunner.open_zfs_send`, or a command in an
+SSH channel, as returned by
+:py:func:`zfs.util.SSHZfsCommandRunner.open_zfs_receive`. The stream is
+copied by one thread through a single preallocated buffer: reads from a
+local process fill the buffer in place, and each write hands the process or
+channel a memoryview of the part that was filled, so Python makes no copies
+of its own beyond the one paramiko needs to build each packet. The error
+output of both commands is drained by helper threads so that neither
+can block on a full pipe.
+
+Example::
+
+    sender = util.open_zfs_send('tank/foo@b', incremental_source='@a')
+    receiver = ssh_runner.open_zfs_receive('backup/1234/tank/foo')
+    nbytes = send_receive(sender, receiver)
+"""
+
+import io
+import logging
+import subprocess
+import threading
+import time
+from . import *
+
+# Reads are as large as a pipe will hand over at once on Linux with a
+# raised pipe size, and big enough that the per-call overhead is noise
+DEFAULT_BUF_SZ=1 << 20
+
+class _Drain(threading.Thread):
+    """Read a stream to its end in the background, keeping what was read"""
+
+    CHUNK_SZ=65536
+
+    def __init__(self, read):
+        super(_Drain, self).__init__()
+        self.daemon = True
+        self._read = read
+        self._chunks = []
+
+    def run(self):
+        try:
+            for data in iter(lambda: self._read(self.CHUNK_SZ), ''):
+                self._chunks.append(data)
+        except (EnvironmentError, EOFError):
+            pass
+
+    def output(self):
+        """Wait for the end of the stream and return everything read"""
+        self.join()
+        return ''.join(self._chunks)
+
+class _ProcessEnd(object):
+    """One end of the pipeline running as a local process"""
+
+    def __init__(self, process):
+        self.process = process
+        self._drains = [_Drain(process.stderr.read)]
+        if process.stdin is not None:
+            self._file = io.open(process.stdin.fileno(), 'wb', buffering=0,
+                                 closefd=False)
+            # zfs receive prints next to nothing, but it must never block
+            if process.stdout is not None:
+                self._drains.append(_Drain(process.stdout.read))
+        else:
+            self._file = io.open(process.stdout.fileno(), 'rb', buffering=0,
+                                 closefd=False)
+        for drain in self._drains:
+            drain.start()
+
+    def readinto(self, view):
+        return self._file.readinto(view)
+
+    def write(self, view):
+        return self._file.write(view)
+
+    def close_write(self):
+        self.process.stdin.close()
+
+    def abort(self):
+        # stdout of a receiver is being drained by another thread
+        f = self.process.stdin or self.process.stdout
+        if not f.closed:
+            f.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+
+    def finish(self):
+        """Wait for the process, returning its exit status and errors"""
+        rc = self.process.wait()
+        err = self._drains[0].output()
+        for drain in self._drains[1:]:
+            drain.output()
+        return rc, err
+
+class _ChannelEnd(object):
+    """One end of the pipeline running in an SSH channel"""
+
+    def __init__(self, chan, sink):
+        self.chan = chan
+        self._drains = [_Drain(chan.recv_stderr)]
+        if sink:
+            self._drains.append(_Drain(chan.recv))
+        for drain in self._drains:
+            drain.start()
+
+    def readinto(self, view):
+        data = self.chan.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def write(self, view):
+        return self.chan.send(view)
+
+    def close_write(self):
+        self.chan.shutdown_write()
+
+    def abort(self):
+        self.chan.close()
+
+    def finish(self):
+        """Wait for the command, returning its exit status and errors"""
+        rc = self.chan.recv_exit_status()
+        err = self._drains[0].output()
+        for drain in self._drains[1:]:
+            drain.output()
+        return rc, err
+
+def _end(obj, sink):
+    if isinstance(obj, subprocess.Popen):
+        return _ProcessEnd(obj)
+    return _ChannelEnd(obj, sink)
+
+def pump(readinto, write, bufsz=DEFAULT_BUF_SZ):
+    """Copy a stream until the source runs out, through one buffer
+
+    :param readinto: callable filling a memoryview in place and returning
+    how many bytes it read, 0 at the end of the stream
+    :param write: callable writing some or all of a memoryview and returning
+    how many bytes it wrote
+    :param int bufsz: the size of the buffer
+    :return: the number of bytes copied
+    :rtype: int
+    """
+    view = memoryview(bytearray(bufsz))
+    total = 0
+    while True:
+        n = readinto(view)
+        if not n:
+            return total
+        off = 0
+        while off < n:
+            off += write(view[off:n])
+        total += n
+
+def _abort(src, dst, writer):
+    if writer is not None:
+        writer.abort()
+    src.abort()
+    dst.abort()
+
+def send_receive(sender, receiver, bufsz=DEFAULT_BUF_SZ, ring=None,
+                 compression=None):
+    """Stream a running zfs send into a running zfs receive
+
+    Both commands are always waited for, and their exit statuses logged.
+
+    :param sender: the running zfs send
+    :type sender: subprocess.Popen or paramiko.Channel
+    :param receiver: the running zfs receive
+    :type receiver: subprocess.Popen or paramiko.Channel
+    :param int bufsz: the size of the copy buffer
+    :param ring: a ring buffer to read the sender into from its own thread,
+    or None to copy directly. The buffer is closed once the stream is done.
+    :type ring: :py:class:`zfs.ringbuffer.RingBuffer` or None
+    :param compression: the settings to compress the stream with, or None
+    to send it as it is. The receiver must decompress it.
+    :type compression: :py:class:`zfs.compress.Compression` or None
+    :return: the number of bytes sent, before compression
+    :rtype: int
+    :raises ZfsReplicationError: if either command failed, or the stream
+    could not be copied
+    """
+    src = _end(sender, sink=False)
+    dst = _end(receiver, sink=True)
+
+    start = time.time()
+    error = None
+    nbytes = 0
+    writer = None
+    try:
+        write = dst.write
+        if compression is not None:
+            writer = compression.writer(dst.write)
+            write = writer.write
+        if ring is None:
+            nbytes = pump(src.readinto, write, bufsz)
+        else:
+            nbytes = ring.run(src.readinto, write)
+        if writer is not None:
+            writer.close()
+        dst.close_write()
+    except EnvironmentError as e:
+        # most likely the receiver exited early, its error output says why
+        error = e
+        _abort(src, dst, writer)
+    except:
+        _abort(src, dst, writer)
+        raise
+    finally:
+        send_rc, send_err = src.finish()
+        recv_rc, recv_err = dst.finish()
+        if ring is not None:
+            ring.close()
+
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info('Streamed %d bytes in %.1fs (%.1f MiB/s); zfs send '
+                 'exited %s, zfs receive exited %s' % (
+                     nbytes, elapsed, nbytes / elapsed / (1 << 20),
+                     send_rc, recv_rc))
+    if ring is not None:
+        logging.info('Send %s' % ring.stats.summary())
+    if writer is not None:
+        logging.info('Compressed %s' % writer.stats.summary())
+    if error is not None or send_rc != 0 or recv_rc != 0:
+        message = 'zfs send exited %s, zfs receive exited %s' % (
+            send_rc, recv_rc)
+        if error is not None:
+            message += ': %s' % error
+        for err in (send_err, recv_err):
+            if err.strip():
+                message += ': %s' % err.strip()
+        raise ZfsReplicationError(message, send_rc, recv_rc, send_err,
+                                  recv_err)
+    return nbytes
@@ -0,0 +1,146 @@
+"""The state of every zpool, fetched once
+
+Checking each pool separately means a `zpool status` per pool to see if it
+is scrubbing, and a `zpool list` per dataset to find the guid of its pool.
+The :py:class:`PoolStateCache` instead runs one `zpool status` and one
+`zpool list` covering every pool, the first time any pool is asked about,
+and answers from memory after that.
+"""
+
+import collections
+import threading
+import util
+from . import *
+
+# The columns listed for each pool
+POOL_PROPERTIES=['name', 'guid', 'health', 'size', 'allocated', 'free']
+
+class PoolState(collections.namedtuple('PoolState', [
+        'name', 'guid', 'health', 'size', 'allocated', 'free', 'status'])):
+    """The state of one zpool
+
+    Attributes:
+        name        the pool name
+        guid        the pool guid, as a string
+        health      the pool health, e.g. ONLINE or DEGRADED
+        size        the size of the pool in bytes
+        allocated   the bytes allocated in the pool
+        free        the bytes free in the pool
+        status      the parsed zpool status, a
+                    :py:class:`zfs.util.ZpoolStatus`, or None if the pool
+                    appeared between the two commands
+    """
+    __slots__ = ()
+
+class PoolStateCache(object):
+    """The state of all of the zpools of a system, fetched with one zpool
+    status and one zpool list
+
+    The state is fetched the first time it is needed, and kept until
+    :py:meth:`refresh` is called. It is safe to share a cache between
+    threads.
+
+    Attributes:
+        runner      the ZfsCommandRunner used to fetch the state, or None to
+                    use the local zpool commands
+    """
+
+    def __init__(self, runner=None):
+        """Create a new, empty PoolStateCache
+
+        :param runner: the runner used to run zpool. Defaults to running
+        zpool locally through sudo.
+        :type runner: ZfsCommandRunner or None
+        """
+        self.runner = runner
+        self._lock = threading.Lock()
+        self._pools = None
+
+    def _run(self, method, *args, **kwargs):
+        if self.runner is not None:
+            return getattr(self.runner, method)(*args, **kwargs)
+        return getattr(util, method)(*args, **kwargs)
+
+    def refresh(self):
+        """Fetch the state of every pool again"""
+        statuses = dict((s.name, s) for s in
+                        self._run('zpool_status_records'))
+        pools = collections.OrderedDict()
+        for row in self._run('zpool_list', properties=POOL_PROPERTIES,
+                             parsable=True):
+            name, guid, health, size, allocated, free = row
+            pools[name] = PoolState(name, guid, health, util._to_int(size),
+                                    util._to_int(allocated),
+                                    util._to_int(free), statuses.get(name))
+        with self._lock:
+            self._pools = pools
+
+    def _get(self):
+        with self._lock:
+            pools = self._pools
+        if pools is None:
+            self.refresh()
+            with self._lock:
+                pools = self._pools
+        return pools
+
+    def pools(self):
+        """Return the names of all of the pools
+
+        :rtype: list of str
+        """
+        return list(self._get().keys())
+
+    def state(self, pool):
+        """Return the state of a pool
+
+        :param str pool: the pool name
+        :rtype: :py:class:`PoolState`
+        :raises ZfsNoPoolError: if the pool does not exist
+        """
+        pools = self._get()
+        if pool not in pools:
+            raise ZfsNoPoolError("cannot open '%s': no such pool" % pool)
+        return pools[pool]
+
+    def status(self, pool):
+        """Return the parsed zpool status of a pool
+
+        :param str pool: the pool name
+        :rtype: :py:class:`zfs.util.ZpoolStatus` or None
+        :raises ZfsNoPoolError: if the pool does not exist
+        """
+        return self.state(pool).status
+
+    def is_syncing(self, pool):
+        """Check if a pool is scrubbing or resilvering
+
+        See :py:func:`zfs.util.ZfsCommandRunner.is_syncing`.
+
+        :param str pool: the pool name
+        :rtype: bool
+        :raises ZfsNoPoolError: if the pool does not exist
+        """
+        status = self.status(pool)
+        return status is not None and status.syncing
+
+    def get_pool_guid(self, pool):
+        """Return the guid of a pool
+
+        See :py:func:`zfs.util.get_pool_guid`.
+
+        :param str pool: the pool name
+        :rtype: str
+        :raises ZfsNoPoolError: if the pool does not exist
+        """
+        return self.state(pool).guid
+
+    def free(self, pool):
+        """Return the free space of a pool
+
+        :param str pool: the pool name
+        :return: the free space in bytes
+        :rtype: int
+        :raises ZfsNoPoolError: if the pool does not exist
+        """
+        return self.state(pool).free
@@ -0,0 +1,322 @@
+"""An mbuffer-style ring buffer to decouple a send stream from its reader
+
+`zfs receive` reads its stream in one large burst per transaction group,
+and between bursts the network backs up and stalls; likewise `zfs send`
+pauses while it reads from disk. A :py:class:`RingBuffer` between the two
+absorbs the bursts: a producer thread keeps reading from the source while
+the consumer keeps writing to the sink, so the transfer streams steadily
+instead of alternating between network and disk activity.
+
+The buffer is held in memory, or optionally in a memory-mapped temporary
+file so that a large buffer doesn't have to compete for RAM. How full the
+buffer ran is recorded in a :py:class:`RingBufferStats`: a buffer that is
+mostly empty means the sender is the bottleneck, one that is mostly full
+means the receiver or the network is.
+
+The same buffer runs on the remote side of a backup as the `zfsbuffer`
+command, placed in front of `zfs receive`.
+
+Example::
+
+    ring = RingBuffer(size=512 << 20, block_size=128 << 10)
+    nbytes = ring.run(source.readinto, sink.write)
+    logging.info(ring.stats.summary())
+"""
+
+import ctypes
+import mmap
+import re
+import tempfile
+import threading
+import time
+
+DEFAULT_SIZE=256 << 20
+DEFAULT_BLOCK_SZ=128 << 10
+
+# Spill to a file when the buffer would take more than this fraction of the
+# memory available
+SPILL_MEMORY_FRACTION=0.5
+
+# The number of buckets the fill level is counted in
+FILL_BUCKETS=10
+
+_SIZE_RE=re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.I)
+_SIZE_UNITS={'': 0, 'k': 10, 'm': 20, 'g': 30, 't': 40}
+
+def parse_size(text):
+    """Parse a size such as 512M or 1.5G, with binary units
+
+    :param str text: the size, optionally followed by K, M, G or T
+    :return: the size in bytes
+    :rtype: int
+    :raises ValueError: if the size can't be parsed
+    """
+    m = _SIZE_RE.match(text)
+    if m is None:
+        raise ValueError('invalid size: %s' % text)
+    return int(float(m.group(1)) * (1 << _SIZE_UNITS[m.group(2).lower()]))
+
+def available_memory():
+    """Return how much memory can be allocated without swapping
+
+    :return: the available memory in bytes, or None if unknown
+    :rtype: int or None
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (EnvironmentError, ValueError, IndexError):
+        pass
+    return None
+
+class RingBufferStats(object):
+    """How full a ring buffer ran during a transfer
+
+    The fill level is sampled before every write to the sink.
+
+    Attributes:
+        size        the size of the buffer in bytes
+        spilled     true if the buffer was a memory-mapped file
+        bytes       the number of bytes that passed through
+        samples     the number of fill level samples
+        fill_min    the lowest fill level seen, in bytes
+        fill_max    the highest fill level seen, in bytes
+        fill_sum    the sum of the samples, for the mean
+        buckets     the number of samples in each tenth of the buffer
+        empty_waits the number of times the sink waited for data
+        empty_time  the seconds the sink spent waiting for data
+        full_waits  the number of times the source waited for space
+        full_time   the seconds the source spent waiting for space
+    """
+
+    def __init__(self, size, spilled=False):
+        self.size = size
+        self.spilled = spilled
+        self.bytes = 0
+        self.samples = 0
+        self.fill_min = None
+        self.fill_max = 0
+        self.fill_sum = 0
+        self.buckets = [0] * FILL_BUCKETS
+        self.empty_waits = 0
+        self.empty_time = 0.0
+        self.full_waits = 0
+        self.full_time = 0.0
+
+    def sample(self, fill):
+        """Record the fill level"""
+        self.samples += 1
+        self.fill_sum += fill
+        self.fill_max = max(self.fill_max, fill)
+        if self.fill_min is None or fill < self.fill_min:
+            self.fill_min = fill
+        self.buckets[min(fill * FILL_BUCKETS // self.size,
+                         FILL_BUCKETS - 1)] += 1
+
+    def mean_fill(self):
+        """Return the mean fill level as a fraction of the size
+
+        :rtype: float
+        """
+        if not self.samples:
+            return 0.0
+        return float(self.fill_sum) / self.samples / self.size
+
+    def as_dict(self):
+        """Return the statistics as a dict, suitable for JSON"""
+        return {
+            'size': self.size,
+            'spilled': self.spilled,
+            'bytes': self.bytes,
+            'samples': self.samples,
+            'fill_min': self.fill_min or 0,
+            'fill_max': self.fill_max,
+            'fill_mean': self.mean_fill(),
+            'buckets': list(self.buckets),
+            'empty_waits': self.empty_waits,
+            'empty_time': self.empty_time,
+            'full_waits': self.full_waits,
+            'full_time': self.full_time,
+        }
+
+    def summary(self):
+        """Return a one line description of the statistics
+
+        :rtype: str
+        """
+        return ('buffer %dMiB%s: %d bytes, fill mean %.0f%% max %.0f%%, '
+                'sink waited %.1fs for data, source waited %.1fs for space' % (
+                    self.size >> 20, ' (spilled)' if self.spilled else '',
+                    self.bytes, 100 * self.mean_fill(),
+                    100.0 * self.fill_max / self.size, self.empty_time,
+                    self.full_time))
+
+class RingBuffer(object):
+    """A fixed size buffer between a producer thread and a consumer
+
+    A buffer can be used for one transfer, see :py:meth:`run`.
+
+    Attributes:
+        size        the size of the buffer in bytes
+        block_size  the most read or written in one call, and the amount
+                    of data or space each side waits for
+        stats       the :py:class:`RingBufferStats` of the transfer
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, block_size=DEFAULT_BLOCK_SZ,
+                 spill='auto', spill_dir=None):
+        """Allocate a new RingBuffer
+
+        :param int size: the size of the buffer in bytes
+        :param int block_size: the size of each read and write
+        :param spill: True to keep the buffer in a memory-mapped temporary
+        file, False to keep it in memory, or 'auto' to use a file when the
+        buffer would take more than half of the available memory
+        :type spill: bool or str
+        :param spill_dir: the directory for the temporary file, or None for
+        the system default
+        :type spill_dir: str or None
+        :raises ValueError: if the sizes are not positive, or the buffer
+        can't hold two blocks
+        """
+        if size <= 0 or block_size <= 0:
+            raise ValueError('size and block_size must be positive')
+        # with room for two blocks, either a block of data or a block of
+        # space is always available, so neither side can wait forever
+        if block_size * 2 > size:
+            raise ValueError('size must be at least twice block_size')
+        self.size = size
+        self.block_size = block_size
+
+        if spill == 'auto':
+            avail = available_memory()
+            spill = avail is not None and size > avail * SPILL_MEMORY_FRACTION
+        self._file = None
+        self._map = None
+        if spill:
+            # the file is unlinked at once, so the space is freed however
+            # the transfer ends
+            self._file = tempfile.TemporaryFile(prefix='zfsbuffer',
+                                                dir=spill_dir)
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+            self._view = memoryview((ctypes.c_char * size).from_buffer(
+                self._map))
+        else:
+            self._view = memoryview(bytearray(size))
+
+        self.stats = RingBufferStats(size, spilled=bool(spill))
+        self._cond = threading.Condition()
+        # the total bytes written into and read out of the buffer
+        self._head = 0
+        self._tail = 0
+        self._eof = False
+        self._aborted = False
+        self._error = None
+        self._producer = None
+
+    def close(self):
+        """Release the buffer, and its file if it spilled
+
+        If :py:meth:`run` failed, the source must have been closed first so
+        that the thread reading it can finish.
+        """
+        if self._producer is not None:
+            self._producer.join()
+            self._producer = None
+        self._view = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _free(self):
+        return self.size - (self._head - self._tail)
+
+    def _produce(self, readinto):
+        try:
+            while True:
+                with self._cond:
+                    if self._free() < self.block_size and not self._aborted:
+                        self.stats.full_waits += 1
+                        start = time.time()
+                        while self._free() < self.block_size and \
+                              not self._aborted:
+                            self._cond.wait()
+                        self.stats.full_time += time.time() - start
+                    if self._aborted:
+                        return
+                    off = self._head % self.size
+                    n = min(self.block_size, self.size - off)
+                n = readinto(self._view[off:off + n])
+                with self._cond:
+                    if not n:
+                        self._eof = True
+                    else:
+                        self._head += n
+                    self._cond.notify()
+                if not n:
+                    return
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify()
+
+    def run(self, readinto, write):
+        """Copy a stream through the buffer until the source runs out
+
+        The source is read by a new thread, and the sink is written by the
+        calling thread. If the sink fails, the source thread stops at its
+        next read; close the source to interrupt a read in progress.
+
+        :param readinto: callable filling a memoryview in place and returning
+        how many bytes it read, 0 at the end of the stream
+        :param write: callable writing some or all of a memoryview and returning
+        how many bytes it wrote
+        :return: the number of bytes copied
+        :rtype: int
+        :raises: any exception raised by readinto or write
+        """
+        if self._producer is not None:
+            raise ValueError('a RingBuffer can only be run once')
+        producer = threading.Thread(target=self._produce, args=(readinto,))
+        producer.daemon = True
+        self._producer = producer
+        producer.start()
+        try:
+            while True:
+                with self._cond:
+                    fill = self._head - self._tail
+                    if fill < self.block_size and not self._eof and \
+                       self._error is None:
+                        self.stats.empty_waits += 1
+                        start = time.time()
+                        while self._head - self._tail < self.block_size and \
+                              not self._eof and self._error is None:
+                            self._cond.wait()
+                        self.stats.empty_time += time.time() - start
+                        fill = self._head - self._tail
+                    if self._error is not None:
+                        raise self._error
+                    if not fill:
+                        break
+                    self.stats.sample(fill)
+                    off = self._tail % self.size
+                    n = min(fill, self.block_size, self.size - off)
+                n = write(self._view[off:off + n])
+                with self._cond:
+                    self._tail += n
+                    self.stats.bytes += n
+                    self._cond.notify()
+        except:
+            with self._cond:
+                self._aborted = True
+                self._cond.notify()
+            raise
+        producer.join()
+        self._producer = None
+        return self.stats.bytes
@@ -1,8 +1,13 @@
+import collections
 import logging
 import datetime
 from . import *
-from util import (zfs_list, is_syncing, zfs_destroy, zfs_snapshot,
+from util import (zfs_list, zfs_destroy_snapshots, zfs_snapshot,
                   get_pool_from_fsname)
+from workers import DatasetResult, DatasetWorkerPool, log_failures
+from index import SnapshotIndex
+from metrics import RunMetrics
+from poolstate import PoolStateCache
 
 PREFIX="zfs-auto-snap"
 USERPROP_NAME='com.sun:auto-snapshot'
@@ -43,6 +48,11 @@ class RollingSnapshotter():
         avoidsync       Avoid fs on zpools in scrub/resilver state
         prefix          First part of snapshot name
         userprop_name   name of the ZFS user property to check
+        jobs            Number of datasets to work on at once
+        pool_jobs       Number of datasets of one zpool to work on at once,
+                        or None for no limit beyond jobs
+        metrics         :py:class:`zfs.metrics.RunMetrics` updated with the
+                        timings and counts of each run
     """
     def __init__(
         self,
@@ -50,7 +60,10 @@ class RollingSnapshotter():
         keep='all',
         avoidsync=False,
         prefix=PREFIX,
-        userprop_name=USERPROP_NAME
+        userprop_name=USERPROP_NAME,
+        jobs=1,
+        pool_jobs=None,
+        metrics=None
     ):
         """Create new RollingSnapshotter instance
         """
@@ -61,13 +74,33 @@ class RollingSnapshotter():
         self.avoidsync     = avoidsync
         self.prefix        = prefix
         self.userprop_name = userprop_name
+        self.workers       = DatasetWorkerPool(jobs, pool_jobs)
+        if metrics is None:
+            metrics = RunMetrics('zfsautosnap', label=label)
+        self.metrics       = metrics
 
-    def take_snapshot(self, fsnames, snap_children=False):
+    def take_snapshot(self, fsnames, snap_children=False, index=None,
+                      pools=None):
         """Take a snapshot of all eligible filesystems given in fsnames
 
         If fsnames is the special value '//', use the #{self.userprop_name} or
         the #{self.userprop_name}:#{self.label} property to determine which
         filesystems to snapshot
+
+        The snapshots of each zpool are taken with one command, and the pools
+        are snapshotted in parallel. Older snapshots are then purged, with the
+        filesystems in parallel. A filesystem is only purged once its new
+        snapshot exists.
+
+        The existing snapshots are found with one listing per pool, which is
+        kept in `index`. Pass the same :py:class:`zfs.index.SnapshotIndex`
+        to later calls to avoid listing the pools again. Likewise the state of
+        the pools, used to avoid those that are syncing, is kept in `pools`,
+        a :py:class:`zfs.poolstate.PoolStateCache`.
+
+        Returns a list of :py:class:`zfs.workers.DatasetResult`, one per
+        filesystem, with the snapshots removed from it or the error that
+        stopped it from being snapshotted or purged.
         """
 
         today = datetime.datetime.now()
@@ -78,45 +111,85 @@ class RollingSnapshotter():
         # the '//' filesystem is special. We use it as a keyword to determine
         # whether to poll the ZFS user properties.
         # Determine what these are, call ourselves again, then return.
+        if index is None:
+            index = SnapshotIndex()
+        if pools is None:
+            pools = PoolStateCache()
+
         if isinstance(fsnames, basestring) and fsnames == '//':
-            single_list,recursive_list = get_userprop_datasets(
-                label=self.label, userprop_name=self.userprop_name)
+            with self.metrics.phase('planning'):
+                single_list,recursive_list = get_userprop_datasets(
+                    label=self.label, userprop_name=self.userprop_name)
 
             logging.info("Taking non-recursive snapshots of: %s" %\
                            ', '.join(single_list))
-            single_state = self.take_snapshot(single_list, snap_children=False)
+            single_state = self.take_snapshot(single_list, snap_children=False,
+                                              index=index, pools=pools)
 
             logging.info("Taking recursive snapshots of: %s" %\
                            ', '.join(recursive_list))
             recursive_state = self.take_snapshot(
-                recursive_list, snap_children=True)
+                recursive_list, snap_children=True, index=index, pools=pools)
 
-            return
+            return single_state + recursive_state
 
         if isinstance(fsnames, basestring):
             fsnames = [ fsnames ]
 
         if self.avoidsync == True:
-            fsnames=filter_syncing_pools(fsnames)
+            with self.metrics.phase('planning'):
+                fsnames=filter_syncing_pools(fsnames, pools)
+        self.metrics.inc('datasets_processed', len(fsnames))
 
         keep=validate_keep(self.keep)
         # Since we are about to take a new snapshot, get rid of 1 extra
         if keep != 'all':
             keep = keep - 1
 
+        by_pool=collections.OrderedDict()
         for fs in fsnames:
-            # Ok, now say cheese!
-            logging.info("Taking %s snapshot %s@%s" % (
-                "recursive" if snap_children else "non-recursive",
-                fs,
-                snapname))
-            zfs_snapshot(fs,snapname,snap_children)
+            by_pool.setdefault(get_pool_from_fsname(fs), []).append(fs)
 
-            # If we're taking recursive snapshots,
-            # walk through the children, destroying old ones if required.
-            destroy_older_snapshots(fs, keep, self.label,
-                                    self.prefix, snap_children)
-        pass
+        # Ok, now say cheese! All of the snapshots on a pool are taken at once
+        def snap_pool(pool):
+            logging.info("Taking %s snapshot %s of %s" % (
+                "recursive" if snap_children else "non-recursive",
+                snapname,
+                ', '.join(by_pool[pool])))
+            zfs_snapshot(by_pool[pool],snapname,snap_children)
+            # A fresh listing already includes the new snapshots
+            if not index.load(pool):
+                index.add(by_pool[pool], snapname, recursive=snap_children)
+            if snap_children:
+                created = sum(len(index.datasets(root=fs)) or 1
+                              for fs in by_pool[pool])
+            else:
+                created = len(by_pool[pool])
+            self.metrics.inc('snapshots_created', created)
+
+        with self.metrics.phase('snapshot'):
+            snapped=self.workers.map(snap_pool, by_pool.keys(),
+                                     pool_of=lambda pool: pool)
+
+        results=[]
+        to_purge=[]
+        for r in snapped:
+            if r.ok:
+                to_purge.extend(by_pool[r.dataset])
+            else:
+                results.extend([DatasetResult(fs, error=r.error)
+                                for fs in by_pool[r.dataset]])
+
+        # If we're taking recursive snapshots,
+        # walk through the children, destroying old ones if required.
+        with self.metrics.phase('purge'):
+            results.extend(self.workers.map(
+                lambda fs: destroy_older_snapshots(fs, keep, self.label,
+                                                   self.prefix, snap_children,
+                                                   index=index),
+                to_purge))
+        _count_results(self.metrics, results)
+        return results
 
 class SnapshotPurger(object):
     """Recursively purge old snapshot
@@ -128,33 +201,62 @@ class SnapshotPurger(object):
     """
 
     def __init__(self, label='daily', keep=KEEP['daily'], prefix=PREFIX,
-                 baseds='zfsbackups'):
+                 baseds='zfsbackups', jobs=1, pool_jobs=None, metrics=None):
         validate_keep(keep)
 
         self.keep  = keep
         self.label  = label
         self.prefix = prefix
         self.baseds = baseds
+        self.workers = DatasetWorkerPool(jobs, pool_jobs)
+        if metrics is None:
+            metrics = RunMetrics('zfspurgesnapshots', label=label)
+        self.metrics = metrics
 
     def run(self):
-        datasets=[ds[0] for ds in get_child_datasets(self.baseds)]
-        removed = [ destroy_older_snapshots( filesys=ds,
-                                            keep=self.keep,
-                                            label=self.label,
-                                            prefix=self.prefix,
-                                           ) for ds in datasets ]
+        """Purge the old snapshots of every child dataset
+
+        All of the datasets and snapshots below baseds are listed at once.
+
+        Returns 0 if every dataset was purged, or 1 if any failed
+        """
+        index = SnapshotIndex()
+        with self.metrics.phase('planning'):
+            index.load(self.baseds)
+            datasets = index.datasets(root=self.baseds, types=['filesystem'])
+        self.metrics.inc('datasets_processed', len(datasets))
+        with self.metrics.phase('purge'):
+            results = self.workers.map(
+                lambda ds: destroy_older_snapshots( filesys=ds,
+                                                   keep=self.keep,
+                                                   label=self.label,
+                                                   prefix=self.prefix,
+                                                   index=index,
+                                                  ), datasets)
+        _count_results(self.metrics, results)
+        removed = [ r.result or [] for r in results ]
         nremoved = len([x for y in removed for x in y])
         logging.info('Removed %d snapshots' % nremoved)
         logging.info(removed)
+        if log_failures(results):
+            return 1
         return 0
 
+def _count_results(metrics, results):
+    """Add the snapshots destroyed and the failures in a list of
+    :py:class:`zfs.workers.DatasetResult` to metrics"""
+    metrics.inc('snapshots_destroyed',
+                sum(len(r.result) for r in results
+                    if r.ok and isinstance(r.result, list)))
+    metrics.inc('dataset_failures', len([r for r in results if not r.ok]))
+
 def get_child_datasets(ds):
     """get child datasets of the specified ds"""
-    return zfs_list(types=['filesystem'], properties=['name'], ds=ds,
+    return zfs_list(types=['filesystem'], properties=['name'], datasets=ds,
                     recursive=True)
 
 def destroy_older_snapshots(filesys, keep, label, prefix=PREFIX,
-                            recursive=False, dryrun=False):
+                            recursive=False, dryrun=False, index=None):
     """Destroy old snapshots, keeping 'keep' newest around.
 
     Given a filesystem name, the number of snapshots we want to keep, along
@@ -168,31 +270,36 @@ def destroy_older_snapshots(filesys, keep, label, prefix=PREFIX,
     Note that unlike the original ksh function, we actually keep around the
     requested number of snapshots, rather than "keep - 1".
 
+    The snapshots are looked up in `index`, a
+    :py:class:`zfs.index.SnapshotIndex` that already holds the pool of
+    filesys, and the destroyed snapshots are removed from it. Without an
+    index, only the snapshots of filesys itself are listed.
+
     Returns a list containing all of the snapshots removed
     """
 
     if keep == 'all':
         return None
 
-    snappre="%s@%s_%s-" % (filesys, prefix, label)
-    try:
-        r = zfs_list(types=['snapshot'], sort='creation', properties=['name'],
-                     datasets=filesys, recursive=True)
-    except ZfsNoDatasetError as e:
-        logging.warning(e)
-        return None
-
-    logging.debug("Subsetting for snapshots starting with %s" % snappre)
-    # Remove all snapshots for child filesystems and those that aren't for
-    # our given label
-    rs = [x[0] for x in r if x[0][:len(snappre)] == snappre]
-
-    logging.debug("All snapshots matching %s for %s: %s" % (snappre, filesys,
+    if index is None:
+        index = SnapshotIndex()
+        try:
+            index.load(filesys, depth=1)
+        except ZfsNoDatasetError as e:
+            logging.warning(e)
+            return None
+
+    labelpre="%s_%s-" % (prefix, label)
+    logging.debug("Looking up snapshots of %s starting with %s" % (
+        filesys, labelpre))
+    allsnaps = [s.snapname for s in index.snapshots(filesys)]
+    rs = [s.name for s in index.labelled(filesys, prefix, label)]
+
+    logging.debug("All snapshots matching %s for %s: %s" % (labelpre, filesys,
                                                             rs))
     to_remove=list(reversed(rs))[keep:]
     # reverse to_remove again to delete the oldest ones first
     to_remove=list(reversed(to_remove))
-    removed=[]
     logging.debug(
         "Should remove %d of %d snapshots for filesys %s (keep=%d)" % (
         len(to_remove), len(rs), filesys, keep))
@@ -201,18 +308,20 @@ def destroy_older_snapshots(filesys, keep, label, prefix=PREFIX,
     if dryrun:
         return to_remove
 
-    for snapshot in to_remove:
-        try:
-            zfs_destroy(snapshot, recursive=recursive)
-        # Not catching ZfsArgumentErrors because those are programming problems
-        except (ZfsOSError) as e:
-            logger.warning('Unable to destroy %s' % snapshot)
-        else:
-            removed.append(snapshot)
+    if not to_remove:
+        return []
+
+    # Destroy them in as few zfs commands as possible. The full list of
+    # snapshots lets runs of expired snapshots be passed as ranges.
+    fspre="%s@" % filesys
+    removed = zfs_destroy_snapshots(filesys,
+                                    [x[len(fspre):] for x in to_remove],
+                                    recursive=recursive, allsnaps=allsnaps)
+    index.remove(removed, recursive=recursive)
 
     return removed
 
-def filter_syncing_pools(fsnames):
+def filter_syncing_pools(fsnames, pools=None):
     """filter out filesys on pools that are scrubbing/resilvering
 
     Given a list of fsnames, filter out the filesystems that are on pools
@@ -220,27 +329,20 @@ def filter_syncing_pools(fsnames):
 
     Sync operations would be interrupted/restarted by a snapshot.
 
-    This function attempts to cache calls to zfs.utils.is_syncing. There is a
-    risk that a scrub/resilver will be started just after this check completes,
-    and also the risk that a running scrub will complete just after this check.
+    The state of every pool is fetched at once and kept in `pools`, a
+    :py:class:`zfs.poolstate.PoolStateCache`. There is a risk that a
+    scrub/resilver will be started just after this check completes, and also
+    the risk that a running scrub will complete just after this check.
     """
 
-    poolcache={}
+    if pools is None:
+        pools = PoolStateCache()
     nosyncfilesys=[]
 
     for fs in fsnames:
         pool=get_pool_from_fsname(fs)
 
-        if pool in poolcache.keys():
-            if poolcache[pool]==True:
-                sync=True
-            else:
-                sync=False
-        else:
-            sync = is_syncing(pool)
-            poolcache[pool]=sync
-
-        if sync==True:
+        if pools.is_syncing(pool):
             logging.info("The pool containing %s is being scrubbed/resilvered." % fs)
             logging.info("Not taking snapshots for %s." % fs)
         else:
@@ -287,6 +389,104 @@ def narrow_recursive_filesystems(recursive_list):
             final_list.append(ds)
     return final_list
 
+class _DatasetNode(object):
+    """A node of a :py:class:`DatasetTree`"""
+    __slots__ = ('children', 'listed', 'excluded', 'excluded_below')
+
+    def __init__(self):
+        self.children = {}
+        # True if this dataset was added, rather than being only a parent
+        self.listed = False
+        self.excluded = False
+        # True if this dataset or any of its descendants is excluded
+        self.excluded_below = False
+
+class DatasetTree(object):
+    """A tree of dataset names for planning recursive snapshots
+
+    Datasets are stored by their path components, so a dataset's ancestors
+    and descendants can be found without comparing it to every other
+    dataset. Marking a dataset as excluded also marks each of its ancestors,
+    so whether a whole subtree can be snapshotted recursively is known
+    without searching it.
+
+    This gives the same answers as :py:func:`can_recursive_snapshot` and
+    :py:func:`narrow_recursive_filesystems` in time linear in the number of
+    datasets.
+    """
+
+    def __init__(self):
+        self._root = _DatasetNode()
+        self._order = []
+
+    def add(self, ds, excluded=False):
+        """Add a dataset to the tree
+
+        :param str ds: the dataset name
+        :param bool excluded: if true, ds must not be snapshotted
+        """
+        node = self._root
+        path = [node]
+        for comp in ds.split('/'):
+            node = node.children.setdefault(comp, _DatasetNode())
+            path.append(node)
+        if not node.listed:
+            node.listed = True
+            self._order.append(ds)
+        if excluded:
+            node.excluded = True
+            # Once an ancestor is marked, all of its ancestors already are
+            for n in reversed(path):
+                if n.excluded_below:
+                    break
+                n.excluded_below = True
+
+    def _find(self, ds):
+        node = self._root
+        for comp in ds.split('/'):
+            node = node.children.get(comp)
+            if node is None:
+                return None
+        return node
+
+    def can_recursive_snapshot(self, ds):
+        """Check if a dataset can be recursively snapshotted
+
+        See :py:func:`can_recursive_snapshot`.
+        """
+        node = self._find(ds)
+        return node is None or not node.excluded_below
+
+    def plan(self):
+        """Split the datasets into those to snapshot alone and recursively
+
+        :return: a tuple of the list of datasets to snapshot individually and
+        the narrowed list of datasets to snapshot recursively, both in the
+        order they were added
+        :rtype: tuple
+        """
+        single_list=[]
+        recursive_list=[]
+        for ds in self._order:
+            node = self._root
+            covered = False
+            for comp in ds.split('/'):
+                if node.listed and not node.excluded_below:
+                    covered = True
+                node = node.children[comp]
+            if not node.excluded_below:
+                if covered:
+                    logging.debug("%s is covered by a recursive parent" % ds)
+                else:
+                    logging.debug("OK to recursive snapshot %s" % ds)
+                    recursive_list.append(ds)
+            elif not node.excluded:
+                logging.debug("OK to snapshot sole dataset %s" % ds)
+                single_list.append(ds)
+            else:
+                logging.debug("NOT OK to snapshot %s" % ds)
+        return (single_list, recursive_list)
+
 def get_userprop_datasets(label="daily", userprop_name=USERPROP_NAME):
     """ This builds two lists of datasets - RECURSIVE_LIST and SINGLE_LIST
     based on the value of ZFS user properties com.sun:auto-snapshot and
@@ -300,33 +500,13 @@ def get_userprop_datasets(label="daily", userprop_name=USERPROP_NAME):
            SEP.join([userprop_name,label]) ]
 
     r=zfs_list(sort='name', properties=props)
-    save=[]
-    exclude=[]
+    tree=DatasetTree()
     for row in r:
-        save.append(row)
-        if row[2] == 'false' or (row[1] == 'false' and row[2] == '-') or \
-           (row[1] == '-' and row[2] == '-'):
-            exclude.append(row[0])
-
-    recursive_list=[]
-    single_list=[]
-
-    # find recursive snapshot sets
-    for row in save:
-        ds=row[0]
-        logging.debug("checking %s" % ds)
-        if can_recursive_snapshot(ds,exclude):
-            logging.debug("OK to recursive snapshot %s" % ds)
-            recursive_list.append(ds)
-        elif ds not in exclude:
-            logging.debug("OK to snapshot sole dataset %s" % ds)
-            single_list.append(ds)
-        else:
-            logging.debug("NOT OK to snapshot %s" % ds)
+        excluded = row[2] == 'false' or \
+                (row[1] == 'false' and row[2] == '-') or \
+                (row[1] == '-' and row[2] == '-')
+        tree.add(row[0], excluded)
 
-    logging.debug("Pre-Narrowed recursive list is %s" % recursive_list)
-    final_recursive_list=narrow_recursive_filesystems(recursive_list)
+    single_list,final_recursive_list=tree.plan()
     logging.debug("Final recursive list is %s" % final_recursive_list)
     return (single_list,final_recursive_list)
-
-
@@ -1,9 +1,14 @@
+import collections
 import logging
+import os
 import subprocess
 import re
 import csv
 import errno
-import socket
+import select
+import threading
+import time
+import cmdtrace
 from . import *
 from StringIO import StringIO
 
@@ -15,10 +20,25 @@ ZFS_ERROR_STRINGS={
     'nosnaplinux': "could not find any snapshots to destroy; check snapshot names.\n",
 }
 ZFS_CMDS=['zpool', 'zfs']
+# Run in place of zfs to measure the cost of starting a command
+BASELINE_CMD='true'
 _FS_COMP='[a-zA-Z0-9\-_.]+'
 
 SUDO_CMD='sudo'
 
+# Linux refuses any single argument longer than this, regardless of ARG_MAX
+MAX_ARG_STRLEN=131072
+
+# Properties that `zfs list -p` prints as exact integers
+ZFS_NUMERIC_PROPERTIES=frozenset([
+    'used', 'available', 'avail', 'referenced', 'refer', 'written',
+    'creation', 'createtxg', 'guid', 'logicalused', 'logicalreferenced',
+    'usedbysnapshots', 'usedbydataset', 'usedbychildren',
+    'usedbyrefreservation', 'quota', 'refquota', 'reservation',
+    'refreservation', 'volsize', 'userrefs', 'objsetid', 'filesystem_count',
+    'snapshot_count',
+])
+
 
 """The zfs.util class contains both a functional and Object oriented interface for the various zfs and zpool subcommands.
 
@@ -57,16 +77,126 @@ def get_pool_guid(pool):
 class ZfsCommandRunner(object):
     """Base class for running a Zfs command, either locally or on a remote
     system
+
+    Attributes:
+        runner_type the kind of runner, as reported in command traces
+        tracers     objects whose `record` method is called with a
+                    :py:class:`zfs.cmdtrace.CommandTrace` for each command run
     """
 
-    def __init__(self, command_prefix=None):
+    runner_type='generic'
+
+    def __init__(self, command_prefix=None, tracers=None):
         """Initialize a new ZfsCommandRunner
 
         :param command_prefix: Optional command to prepend to any call to a zfs
         or zpool command. Useful for injecting calls to `sudo` or `pfexec`
         :type command_prefix: str, list, or None
+        :param tracers: Optional list of tracers, see :py:mod:`zfs.cmdtrace`
+        :type tracers: list or None
         """
         self.command_prefix=command_prefix
+        self.tracers=list(tracers or [])
+
+    def add_tracer(self, tracer):
+        """Start tracing the commands run by this runner
+
+        :param tracer: an object with a `record(trace)` method, such as one
+        of the tracers in :py:mod:`zfs.cmdtrace`
+        """
+        self.tracers.append(tracer)
+
+    def remove_tracer(self, tracer):
+        """Stop passing command traces to tracer
+
+        :raises ValueError: if tracer was not added
+        """
+        self.tracers.remove(tracer)
+
+    def _record_trace(self, t):
+        """Hand a finished trace to every tracer"""
+        for tracer in list(self.tracers):
+            try:
+                tracer.record(t)
+            except Exception:
+                logging.warning('Failed recording a trace with %r' % tracer,
+                                exc_info=True)
+
+    def trace_baseline(self):
+        """Trace `true`, run the way this runner runs zfs commands
+
+        A process is spawned as soon as sudo is, so the spawn time of a
+        trace leaves out sudo's authentication and its own fork and exec of
+        zfs. Those are part of the wall time of the `true` trace as they are
+        of every other, so comparing it with the wall times of the zfs
+        commands shows how much of them ZFS itself took.
+
+        Does nothing if there are no tracers.
+        """
+        if not self.tracers:
+            return
+        try:
+            self._run_traced(BASELINE_CMD, [], None)
+        except (ZfsError, OSError) as e:
+            logging.warning('Unable to trace the cost of starting a command: '
+                            '%s' % e)
+
+    def _run_traced(self, cmd, args, errorclass):
+        """Call run_cmd, tracing the command if there are any tracers"""
+        if not self.tracers:
+            return self.run_cmd(cmd, args, errorclass)
+
+        cmdtrace.take_spawned()
+        t = cmdtrace.CommandTrace(self.runner_type, cmd, args, time.time())
+        try:
+            out,err,rc = self.run_cmd(cmd, args, errorclass)
+        except Exception as e:
+            t.error = type(e).__name__
+            raise
+        else:
+            t.out_bytes = len(out)
+            t.err_bytes = len(err)
+            t.rc = rc
+        finally:
+            _finish_trace(t)
+            self._record_trace(t)
+        return out,err,rc
+
+    def _stream_traced(self, cmd, args, errorclass, check=None):
+        """Call stream_cmd, tracing the command if there are any tracers
+
+        The wall time of a streamed command includes the time the caller spent
+        consuming its output.
+        """
+        if not self.tracers:
+            return self.stream_cmd(cmd, args, errorclass, check=check)
+        return self._stream_traced_gen(cmd, args, errorclass, check)
+
+    def _stream_traced_gen(self, cmd, args, errorclass, check):
+        cmdtrace.take_spawned()
+        t = cmdtrace.CommandTrace(self.runner_type, cmd, args, time.time())
+        t.streamed = True
+
+        def traced_check(err, rc):
+            t.err_bytes = len(err)
+            t.rc = rc
+            if check is not None:
+                check(err, rc)
+
+        lines = self.stream_cmd(cmd, args, errorclass, check=traced_check)
+        try:
+            for line in lines:
+                if t.spawn is None:
+                    _finish_spawn(t)
+                t.out_bytes += len(line)
+                yield line
+        except Exception as e:
+            t.error = type(e).__name__
+            raise
+        finally:
+            lines.close()
+            _finish_trace(t)
+            self._record_trace(t)
 
     def run_cmd(self, cmd, args, errorclass=None):
         """Base method to run a command ZFS command.
@@ -97,6 +227,35 @@ class ZfsCommandRunner(object):
         """
         raise NotImplementedError
 
+    def stream_cmd(self, cmd, args, errorclass=None, check=None):
+        """Run a ZFS command, yielding its output one line at a time
+
+        Unlike :py:func:`ZfsCommandRunner.run_cmd`, the lines of stdout are
+        handed back while the command is still running, so the output never
+        has to be held in memory all at once. Once stdout has been exhausted
+        the command is reaped and `check` is called with the error output and
+        result code, giving it the chance to raise an exception.
+
+        This default implementation falls back to `run_cmd`, so it only saves
+        memory when overridden by subclasses.
+
+        :param str cmd: The zfs command to run
+        :param args: Arguments to the zfs command
+        :param errorclass: the exeception that should be raised if the command
+        is not found
+        :type errorclass: Execption or None
+        :param check: callable taking the error output and the result code,
+        called after the last line has been yielded
+        :type check: callable or None
+        :return: generator of output lines, including the trailing newline
+        :rtype: iter
+        """
+        out,err,rc = self.run_cmd(cmd, args, errorclass)
+        for line in StringIO(out):
+            yield line
+        if check is not None:
+            check(err, rc)
+
     def run_zpool(self, zpoolargs):
         """run zpool with the args specified
 
@@ -105,7 +264,7 @@ class ZfsCommandRunner(object):
         :return: A tuple containing the outpet, error output, and result code
         :rtype: tuple
         """
-        return self.run_cmd('zpool', zpoolargs, ZpoolCommandNotFoundError)
+        return self._run_traced('zpool', zpoolargs, ZpoolCommandNotFoundError)
 
     def run_zfs(self, zfsargs):
         """run zfs with the args specified
@@ -116,13 +275,31 @@ class ZfsCommandRunner(object):
         :rtype: tuple
         """
         cmd='zfs'
-        out,err,rc = self.run_cmd(cmd, zfsargs, ZfsCommandNotFoundError)
+        out,err,rc = self._run_traced(cmd, zfsargs, ZfsCommandNotFoundError)
         if rc > 0:
             _check_perm_err(err)
 
         return out,err,rc
 
-    def zpool_list(self, pools=None, properties=None):
+    def run_zfs_many(self, argvs):
+        """Run several zfs commands, returning the result of each
+
+        Unlike :py:meth:`run_zfs`, the results aren't checked for permission
+        errors, so that the caller can handle each command's failure on its
+        own. This runner runs the commands one at a time;
+        :py:class:`zfs.broker.BrokerZfsCommandRunner` sends them all before
+        waiting for any.
+
+        :param list argvs: the arguments of each zfs command
+        :raises ZfsCommandNotFoundError: if it can't find the zfs command
+        :return: an (out, err, rc) tuple for each command, in order
+        :rtype: list
+        """
+        return [self._run_traced('zfs', args, ZfsCommandNotFoundError)
+                for args in argvs]
+
+    def zpool_list(self, pools=None, properties=None, stream=False,
+                   parsable=False):
         """List the specified properties about a pool or pools
 
         Run the zpool list command, optionally retrieving only the specified
@@ -139,6 +316,11 @@ class ZfsCommandRunner(object):
         :param pools: name of pool or pools to check
         :type pools: list or str
         :param list properties: the properties to retrieve
+        :param bool stream: if true, parse the rows as the command produces
+        them instead of waiting for it to exit. Errors reported by the command
+        are raised once the last row has been consumed.
+        :param bool parsable: if true, pass -p so that sizes are printed as
+        exact numbers of bytes
         :return: `iterable` of `list`s with each requested property occupying
         one field of the list. This is performed under the hood by relying on
         the -H option to output a tab-delimited field of properties, and
@@ -147,7 +329,22 @@ class ZfsCommandRunner(object):
         instead of 'foo'
         :rtype: iterable
         """
+        args=self._zpool_list_args(pools, properties, parsable)
+
+        if stream:
+            lines = self._stream_traced('zpool', args,
+                                        ZpoolCommandNotFoundError,
+                                        check=_check_zpool_list_err)
+            return csv.reader(lines, delimiter="\t")
+
+        out,err,rc = self.run_zpool(args)
+        return self._zpool_list_result(out, err, rc)
+
+    def _zpool_list_args(self, pools=None, properties=None, parsable=False):
+        """Build the arguments for :py:func:`ZfsCommandRunner.zpool_list`"""
         args=['list', '-H' ]
+        if parsable:
+            args.append('-p')
         if properties is not None:
             if isinstance(properties, basestring):
                 cmd_columns=properties
@@ -161,25 +358,19 @@ class ZfsCommandRunner(object):
                 args.append(pools)
             else:
                 args.extend(pools)
+        return args
 
-        out,err,rc = self.run_zpool(args)
-
-        if rc > 0:
-            _check_perm_err(err)
-            _check_prop_err(err)
-            if "no such pool" in err:
-                raise ZfsNoPoolError(err)
-            else:
-                raise ZfsUnknownError(err)
+    def _zpool_list_result(self, out, err, rc):
+        """Parse the output of :py:func:`ZfsCommandRunner.zpool_list`"""
+        _check_zpool_list_err(err, rc)
 
         r=csv.reader(StringIO(out), delimiter="\t")
 
         return r
 
-
     def zfs_list(self, datasets=None, types=['filesystem','volume'],
                  properties=None, sort=None, sortorder='asc', recursive=False,
-                 depth=None):
+                 depth=None, stream=False, parsable=False):
         """List the specified properties about a ZFS dataset or datasets
 
         Run the zfs list command, optionally retrieving only the specified
@@ -204,6 +395,13 @@ class ZfsCommandRunner(object):
         `datasets` and their immediate children. Note: this parameter may not
         be supported on all platforms.
         :depth type: int or None
+        :param bool parsable: if true, print numeric properties such as
+        `creation` and `used` as exact numbers instead of human readable
+        values
+        :param bool stream: if true, parse the rows as the command produces
+        them instead of waiting for it to exit, so that memory use stays flat
+        for very large listings. Errors reported by the command are raised
+        once the last row has been consumed.
         :return: an `iterable` of `list`s with each of the specified `field`
         entries occupying one field of the list. This is performed under the
         hood by relying on the `zfs list -H` option to output a tab-delimited
@@ -215,11 +413,29 @@ class ZfsCommandRunner(object):
         :raise ValueError: if a parameter has an unexpected value
         :raise ZfsNoDatasetError: if the remote dataset doesn't exist
         """
+        args=self._zfs_list_args(datasets, types, properties, sort,
+                                 sortorder, recursive, depth, parsable)
+
+        if stream:
+            lines = self._stream_traced('zfs', args, ZfsCommandNotFoundError,
+                                        check=_check_zfs_list_err)
+            return csv.reader(lines, delimiter="\t")
+
+        out,err,rc = self.run_zfs(args)
+        return self._zfs_list_result(out, err, rc)
+
+    def _zfs_list_args(self, datasets=None, types=['filesystem','volume'],
+                       properties=None, sort=None, sortorder='asc',
+                       recursive=False, depth=None, parsable=False):
+        """Build the arguments for :py:func:`ZfsCommandRunner.zfs_list`"""
         SORTORDERS={'asc': '-s',
                     'desc': '-S',
                    }
         args=[ 'list', '-H' ]
 
+        if parsable:
+            args.append('-p')
+
         if not isinstance(recursive, bool):
             raise TypeError('recursive must be a boolean')
 
@@ -254,17 +470,47 @@ class ZfsCommandRunner(object):
             else:
                 args.extend(datasets)
 
-        out,err,rc = self.run_zfs(args)
+        return args
 
+    def _zfs_list_result(self, out, err, rc):
+        """Parse the output of :py:func:`ZfsCommandRunner.zfs_list`"""
         r=csv.reader(StringIO(out), delimiter="\t")
-        if rc > 0:
-            _check_prop_err(err)
-            if "dataset does not exist" in err:
-                raise ZfsNoDatasetError(err)
-            else:
-                raise ZfsUnknownError(err)
+        _check_zfs_list_err(err, rc)
         return r
 
+    def zfs_list_records(self, datasets=None, types=['filesystem','volume'],
+                         properties=None, sort=None, sortorder='asc',
+                         recursive=False, depth=None, stream=False):
+        """List ZFS datasets as typed records instead of lists of strings
+
+        This runs `zfs list -p`, so that numeric properties such as `used`,
+        `creation` and `guid` are converted to ints once, and can be
+        compared and sorted without any further parsing. Other properties
+        are left as strings, and `-` values become None.
+
+        The name of each dataset is split into a `dataset` field, which is
+        interned so that the many snapshots of one dataset share a single
+        string, and a `snapname` field holding the part after the @ (None
+        for filesystems and volumes). The full name is available as the
+        `name` attribute.
+
+        See :py:func:`ZfsCommandRunner.zfs_list` for the parameters.
+        `properties` defaults to ['name'], and `name` is always listed.
+
+        :return: an iterable of records, one per dataset
+        :rtype: iter of :py:func:`zfs_record_class` instances
+        """
+        if properties is None:
+            properties = ['name']
+        elif 'name' not in properties:
+            properties = ['name'] + list(properties)
+
+        rows=self.zfs_list(datasets=datasets, types=types,
+                           properties=properties, sort=sort,
+                           sortorder=sortorder, recursive=recursive,
+                           depth=depth, stream=stream, parsable=True)
+        return zfs_records(rows, properties)
+
     def zfs_destroy(self, datasets, recursive=False):
         """Destroy datasets or snapshots
 
@@ -272,7 +518,9 @@ class ZfsCommandRunner(object):
         snapshots of child filesystems with the same snapshot name.
 
         Note that the underlying `zfs destroy` command can only handle a single
-        snapshot at a time.
+        dataset argument at a time. Use
+        :py:func:`ZfsCommandRunner.zfs_destroy_snapshots` to destroy many
+        snapshots of one filesystem.
         :param datasets: the name of the dataset(s) to remove
         :type datasets: list or str
         :param bool recursive: recursively remove snapshots of child
@@ -284,6 +532,17 @@ class ZfsCommandRunner(object):
         :raises ZfsUnknownError: if an unknown ZFS-related error occured
         running the command
         """
+        args,datasets = self._zfs_destroy_args(datasets, recursive)
+
+        out,err,rc=self.run_zfs(args)
+        self._zfs_destroy_result(datasets, out, err, rc)
+
+    def _zfs_destroy_args(self, datasets, recursive=False):
+        """Build the arguments for :py:func:`ZfsCommandRunner.zfs_destroy`
+
+        :return: a tuple of the arguments and the list of datasets
+        :rtype: tuple
+        """
         args = ['destroy']
 
         if recursive:
@@ -294,9 +553,10 @@ class ZfsCommandRunner(object):
         if isinstance(datasets, basestring):
             datasets = [datasets]
         args.extend(datasets)
+        return args,datasets
 
-        out,err,rc=self.run_zfs(args)
-
+    def _zfs_destroy_result(self, datasets, out, err, rc):
+        """Check the result of :py:func:`ZfsCommandRunner.zfs_destroy`"""
         if rc > 0:
             _check_perm_err(err)
             if (err == ZFS_ERROR_STRINGS['nosnaplinux']
@@ -305,7 +565,83 @@ class ZfsCommandRunner(object):
             else:
                 raise ZfsUnknownError(err)
 
-        pass
+    def zfs_destroy_snapshots(self, filesystem, snapnames, recursive=False,
+                              allsnaps=None):
+        """Destroy many snapshots of one filesystem with as few commands as
+        possible
+
+        The snapshots are passed to `zfs destroy` in the comma separated
+        `filesystem@snap1,snap2` form, split across as many commands as needed
+        to stay within the argument length limit. When `allsnaps` is given,
+        runs of snapshots that are adjacent in it are shortened to the
+        `snap1%snap3` range form. Ranges are never used with `recursive`, as
+        the snapshots between the two ends may differ in the children.
+
+        If a batch fails, its snapshots are destroyed one at a time, so that
+        the result lists exactly the snapshots that were removed. Failures
+        destroying individual snapshots are logged and skipped. The batches,
+        and then the retries, are each run with :py:meth:`run_zfs_many`.
+
+        :param str filesystem: the filesystem the snapshots belong to
+        :param list snapnames: the snapshot names, without the `filesystem@`
+        :param bool recursive: recursively remove snapshots of child
+        filesystems
+        :param allsnaps: every snapshot name of `filesystem`, in creation
+        order
+        :type allsnaps: list or None
+        :raises ZfsBadFsName: if the filesystem name is malformed
+        :return: the full names of the snapshots that were destroyed
+        :rtype: list
+        """
+        _validate_fsname(filesystem)
+        if isinstance(snapnames, basestring):
+            snapnames = [snapnames]
+        if recursive:
+            allsnaps = None
+
+        # leave room for the destroy subcommand and its options
+        budget = self.max_args_len() - 64
+
+        specs = _snapshot_specs(filesystem, snapnames, allsnaps, budget)
+        done = set()
+        retry = []
+        for (spec, snaps), e in zip(specs, self._zfs_destroy_many(
+                [spec for spec, snaps in specs], recursive)):
+            if e is None:
+                done.update(snaps)
+            elif len(snaps) == 1:
+                logging.warning('Unable to destroy %s: %s' % (snaps[0], e))
+            else:
+                logging.warning(
+                    'Unable to destroy %d snapshots of %s at once, ' \
+                    'retrying one at a time: %s' % (len(snaps), filesystem, e))
+                retry.extend(snaps)
+        for snap, e in zip(retry, self._zfs_destroy_many(retry, recursive)):
+            if e is None:
+                done.add(snap)
+            else:
+                logging.warning('Unable to destroy %s: %s' % (snap, e))
+
+        return [snap for spec, snaps in specs for snap in snaps
+                if snap in done]
+
+    def _zfs_destroy_many(self, specs, recursive):
+        """Destroy each of specs with its own command
+
+        :return: for each spec, None if it was destroyed, or the error
+        :rtype: list
+        """
+        results = self.run_zfs_many(
+            [self._zfs_destroy_args(spec, recursive)[0] for spec in specs])
+        errors = []
+        for spec, (out, err, rc) in zip(specs, results):
+            try:
+                self._zfs_destroy_result([spec], out, err, rc)
+            except (ZfsError, ZfsOSError) as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
 
     def zfs_create(self, filesystem, props=None, create_parents=False):
         """Creates a new ZFS file system.
@@ -334,35 +670,87 @@ class ZfsCommandRunner(object):
         :raises ZfsNoDatasetError: if the parent dataset to `filesystem` does
         not exist and `create_parents` is false
         """
+        args = self._zfs_create_args(filesystem, props, create_parents)
+
+        out,err,rc=self.run_zfs(args)
+        self._zfs_create_result(filesystem, out, err, rc)
+
+    def zfs_create_many(self, filesystems, create_parents=False,
+                        return_exceptions=False):
+        """Create several ZFS file systems
+
+        This runner creates them one at a time; runners that can run
+        commands concurrently override this to create them all at once. A
+        filesystem whose parent is also in the list is left to be created
+        as a parent, so with `create_parents` only the deepest filesystems
+        need a command.
+
+        See :py:func:`ZfsCommandRunner.zfs_create` for the parameters.
+
+        :param list filesystems: the names of the datasets to create
+        :param bool return_exceptions: if true, every filesystem is
+        attempted and the error of each is returned. Otherwise the first
+        error is raised.
+        :return: the filesystems a command was run for, or with
+        `return_exceptions` a (filesystem, error or None) tuple for each
+        :rtype: list
+        """
+        filesystems = _leaf_filesystems(filesystems) if create_parents \
+                else list(filesystems)
+        results = []
+        for fs in filesystems:
+            try:
+                self.zfs_create(fs, create_parents=create_parents)
+            except (ZfsError, ZfsOSError) as e:
+                if not return_exceptions:
+                    raise
+                results.append((fs, e))
+            else:
+                results.append((fs, None))
+        if return_exceptions:
+            return results
+        return filesystems
+
+    def _zfs_create_args(self, filesystem, props=None, create_parents=False):
+        """Build the arguments for :py:func:`ZfsCommandRunner.zfs_create`"""
         args = ['create']
 
         if create_parents:
             args.append('-p')
 
         if props:
-            for k,v in props:
+            for k,v in props.items():
                 args.append('-o')
-                args.append(':'.join(k,v))
+                args.append('='.join([k,v]))
 
         args.append(filesystem)
+        return args
 
-        out,err,rc=self.run_zfs(args)
-
+    def _zfs_create_result(self, filesystem, out, err, rc):
+        """Check the result of :py:func:`ZfsCommandRunner.zfs_create`"""
         if rc > 0:
             if 'dataset already exists' in err:
-                raise ZfsDatasetExistsError(errno.EEXIST, err, fullsnapname)
+                raise ZfsDatasetExistsError(errno.EEXIST, err, filesystem)
             elif 'dataset does not exist' in err:
-                raise ZfsNoDatasetError(errno.ENOENT, err, dataset)
+                raise ZfsNoDatasetError(errno.ENOENT, err, filesystem)
             elif 'permission denied' in err:
-                raise ZfsPermissionError(errno.EPERM, err, dataset)
+                raise ZfsPermissionError(errno.EPERM, err, filesystem)
             else:
                 raise ZfsUnknownError(err)
-        pass
 
     def zfs_snapshot(self, dataset, snapname, recursive=False):
-        """Snapshot a ZFS filesystem
-
-        :param str dataset: the name of the dataset to snapshot
+        """Snapshot a ZFS filesystem or filesystems
+
+        When given a list of datasets, the snapshots are taken with as few
+        `zfs snapshot` commands as possible. ZFS creates every snapshot named
+        in one command atomically in a single transaction group, but only
+        within one pool, so the datasets are grouped by pool and one command
+        is run per pool. A pool's group is only split further if its names
+        don't fit within the argument length limit. The commands are run
+        with :py:meth:`run_zfs_many`, and the first to fail is raised.
+
+        :param dataset: the name of the dataset or datasets to snapshot
+        :type dataset: str or list
         :param str snapname: the name to use for the snapshot
         :param bool recursive: if true, recursively snapshot child filesystems
         using the same `snapname`
@@ -372,34 +760,67 @@ class ZfsCommandRunner(object):
         :raises ZfsPermissionError: if we couldn't run the command
         :raises ZfsUnknownError: if an undetermined Zfs-related error occurred
         """
-        args = ['snapshot']
-
-        if recursive==True:
-            args.append('-r')
+        groups = self._zfs_snapshot_groups(dataset, snapname)
+        results = self.run_zfs_many(
+            [self._zfs_snapshot_args(group, recursive) for group in groups])
+        for group, (out, err, rc) in zip(groups, results):
+            if rc > 0:
+                _check_perm_err(err)
+            self._zfs_snapshot_result(group, out, err, rc)
+
+    def _zfs_snapshot_groups(self, dataset, snapname):
+        """Group the snapshots for :py:func:`ZfsCommandRunner.zfs_snapshot`
+        into one list of `dataset@snapname` names per command
 
-        if not isinstance(dataset, basestring):
+        :rtype: list
+        """
+        if isinstance(dataset, basestring):
+            datasets = [dataset]
+        elif isinstance(dataset, (list, tuple)):
+            datasets = dataset
+        else:
             raise TypeError(
-                'not sure how to handle filesys with type %s' % type(filesys))
+                'not sure how to handle dataset with type %s' % type(dataset))
         if not isinstance(snapname, basestring):
             raise TypeError(
                 'not sure how to handle snapname with type %s' % type(snapname))
 
-        fullsnapname="%s@%s" % (dataset, snapname)
-        _validate_snapname(fullsnapname)
-        args.append(fullsnapname)
+        # validate everything before taking any snapshots
+        pools=collections.OrderedDict()
+        for ds in datasets:
+            fullsnapname="%s@%s" % (ds, snapname)
+            _validate_snapname(fullsnapname)
+            pools.setdefault(get_pool_from_fsname(ds), []).append(fullsnapname)
 
-        out,err,rc=self.run_zfs(args)
+        # leave room for the snapshot subcommand and its options
+        budget = self.max_args_len() - 64
 
+        return [group for fullsnapnames in pools.values()
+                for group in _split_args(fullsnapnames, budget)]
+
+    def _zfs_snapshot_args(self, fullsnapnames, recursive=False):
+        """Build the arguments for a single zfs snapshot command"""
+        args = ['snapshot']
+
+        if recursive==True:
+            args.append('-r')
+
+        args.extend(fullsnapnames)
+        return args
+
+    def _zfs_snapshot_result(self, fullsnapnames, out, err, rc):
+        """Check the result of a single zfs snapshot command"""
         if rc > 0:
+            names=' '.join(fullsnapnames)
+            datasets=' '.join(x.split('@')[0] for x in fullsnapnames)
             if 'dataset already exists' in err:
-                raise ZfsDatasetExistsError(errno.EEXIST, err, fullsnapname)
+                raise ZfsDatasetExistsError(errno.EEXIST, err, names)
             elif 'dataset does not exist' in err:
-                raise ZfsNoDatasetError(errno.ENOENT, err, dataset)
+                raise ZfsNoDatasetError(errno.ENOENT, err, datasets)
             elif 'permission denied' in err:
-                raise ZfsPermissionError(errno.EPERM, err, dataset)
+                raise ZfsPermissionError(errno.EPERM, err, datasets)
             else:
                 raise ZfsUnknownError(err)
-        pass
 
     def is_syncing(self, pool):
         """Check if the named pool is currently scrubbing or resilvering
@@ -408,22 +829,36 @@ class ZfsCommandRunner(object):
         :return: true if pool is syncing, false otherwise
         :rtype: bool
         """
-        s = self.zpool_status(pool)
-        if " in progress" in s:
-            return True
-        return False
+        return any(s.syncing for s in self.zpool_status_records(pool))
+
+    def zpool_status_records(self, pools=None):
+        """Return the parsed zpool status of a pool or pools
+
+        :param pools: name of pool or pools to check, or None for all pools
+        :type pools: list, str, or None
+        :return: the status of each pool, in the order zpool printed them
+        :rtype: list of :py:class:`ZpoolStatus`
+        :raises ZfsNoPoolError: if a pool does not exist
+        """
+        return parse_zpool_status(self.zpool_status(pools))
 
     def zpool_status(self, pools=None):
         """Call zpool status to check the status of a pool or pools
 
         :param pools: name of pool or pools to check
         :type pools: list, str, or None
-        :return: the raw text output of the zpool status command.  It
-        might be worth the time to attempt to parse the big blob of text into the
-        various fields in the status statement, and return them as a list of
-        ZpoolStatus objects.
+        :return: the raw text output of the zpool status command. Use
+        :py:func:`ZfsCommandRunner.zpool_status_records` or
+        :py:func:`parse_zpool_status` to have it parsed.
         :rtype: str
         """
+        args=self._zpool_status_args(pools)
+
+        out,err,rc=self.run_zpool(args)
+        return self._zpool_status_result(out, err, rc)
+
+    def _zpool_status_args(self, pools=None):
+        """Build the arguments for :py:func:`ZfsCommandRunner.zpool_status`"""
         args=[ 'zpool', 'status', '-v' ]
 
         if pools is not None:
@@ -431,9 +866,10 @@ class ZfsCommandRunner(object):
                 args.append(pools)
             else:
                 args.extend(pools)
+        return args
 
-        out,err,rc=self.run_zpool(args)
-
+    def _zpool_status_result(self, out, err, rc):
+        """Check the result of :py:func:`ZfsCommandRunner.zpool_status`"""
         if rc > 0:
             _check_perm_err(err)
             if "no such pool" in err:
@@ -443,6 +879,202 @@ class ZfsCommandRunner(object):
 
         return out
 
+    def open_zfs_send(self, snapshot, incremental_source=None,
+                      recursive=False, resume_token=None, large_blocks=False,
+                      embed_data=False, compressed=False, raw=False,
+                      intermediates=False):
+        """Start `zfs send`, returning the running command for its stream to
+        be read from
+
+        This must be overridden by subclasses that can stream, see
+        :py:mod:`zfs.pipeline` for how the result is used.
+
+        :param str snapshot: the filesystem@snapshot to send
+        :param incremental_source: the older snapshot of an incremental
+        stream, either "@snap" or "filesystem@snap", or None for a full
+        stream
+        :type incremental_source: str or None
+        :param bool recursive: send the descendant filesystems as well
+        :param resume_token: a token from
+        :py:func:`ZfsCommandRunner.zfs_receive_resume_token` to resume an
+        interrupted stream with. The other parameters are then ignored.
+        :type resume_token: str or None
+        :param bool large_blocks: send blocks larger than 128K as they are
+        (-L), rather than splitting them
+        :param bool embed_data: send blocks embedded in their block pointers
+        as they are (-e)
+        :param bool compressed: send compressed blocks without
+        decompressing them (-c)
+        :param bool raw: send blocks exactly as they are on disk (-w),
+        encrypted blocks staying encrypted. For an unencrypted dataset this
+        is the same as all of the above.
+        :param bool intermediates: send every snapshot between
+        incremental_source and snapshot as well (-I), rather than just the
+        difference between the two (-i)
+        :raises NotImplementedError: if this runner can't stream
+
+        See :py:mod:`zfs.capabilities` for which of these a pair of systems
+        support.
+        """
+        raise NotImplementedError
+
+    def open_zfs_receive(self, filesystem, force=False, resumable=False):
+        """Start `zfs receive`, returning the running command for a stream
+        to be written to
+
+        This must be overridden by subclasses that can stream, see
+        :py:mod:`zfs.pipeline` for how the result is used.
+
+        :param str filesystem: the filesystem to receive into
+        :param bool force: roll back or overwrite filesystem as needed to
+        receive the stream
+        :param bool resumable: keep the partial state if the stream is
+        interrupted, so that it can be resumed
+        :raises NotImplementedError: if this runner can't stream
+        """
+        raise NotImplementedError
+
+    def _zfs_send_args(self, snapshot, incremental_source=None,
+                       recursive=False, resume_token=None, large_blocks=False,
+                       embed_data=False, compressed=False, raw=False,
+                       intermediates=False):
+        """Build the arguments for :py:func:`ZfsCommandRunner.open_zfs_send`"""
+        if resume_token:
+            # the token names the snapshots and options of the original send
+            return ['send', '-t', resume_token]
+
+        args = ['send']
+
+        if raw:
+            args.append('-w')
+        else:
+            if large_blocks:
+                args.append('-L')
+            if embed_data:
+                args.append('-e')
+            if compressed:
+                args.append('-c')
+
+        if recursive:
+            args.append('-R')
+
+        if incremental_source:
+            args.extend(['-I' if intermediates else '-i',
+                         incremental_source])
+
+        args.append(snapshot)
+        return args
+
+    def _zfs_receive_args(self, filesystem, force=False, resumable=False):
+        """Build the arguments for
+        :py:func:`ZfsCommandRunner.open_zfs_receive`"""
+        args = ['receive', '-u']
+
+        if force:
+            args.append('-F')
+
+        if resumable:
+            args.append('-s')
+
+        args.append(filesystem)
+        return args
+
+    def zfs_receive_resume_token(self, filesystem):
+        """Return the token for resuming an interrupted receive
+
+        A stream received with `zfs receive -s` leaves its partial state
+        behind if it is interrupted, and sets the `receive_resume_token`
+        property of the filesystem it was received into. Passing the token
+        to `zfs send -t` continues the stream where it stopped.
+
+        :param str filesystem: the filesystem that was being received into
+        :return: the token, or None if there is no partial state, or if this
+        version of ZFS can't resume
+        :rtype: str or None
+        :raises ZfsNoDatasetError: if the filesystem does not exist
+        """
+        try:
+            rows = list(self.zfs_list(filesystem,
+                                      properties=['receive_resume_token']))
+        except ZfsInvalidPropertyError:
+            return None
+        if not rows or rows[0][0] in ('', '-'):
+            return None
+        return rows[0][0]
+
+    def zfs_receive_abort(self, filesystem):
+        """Discard the partial state of an interrupted receive
+
+        :param str filesystem: the filesystem that was being received into
+        :raises ZfsNoDatasetError: if the filesystem does not exist
+        """
+        out,err,rc = self.run_zfs(['receive', '-A', filesystem])
+        if rc > 0:
+            if 'does not exist' in err:
+                raise ZfsNoDatasetError(errno.ENOENT, err, filesystem)
+            elif 'does not have any resumable receive state' in err:
+                return
+            raise ZfsUnknownError(err)
+
+    def zfs_send_size(self, snapshot, incremental_source=None,
+                      recursive=False, large_blocks=False, embed_data=False,
+                      compressed=False, raw=False, intermediates=False,
+                      resume_token=None):
+        """Estimate the size of a send stream with a dry run
+
+        Runs `zfs send -nvP` with the same arguments as
+        :py:func:`ZfsCommandRunner.open_zfs_send`, which walks the snapshots
+        to size the stream without reading the data. Given a resume_token,
+        it also checks that the stream can still be resumed.
+
+        :return: the estimated stream size in bytes, or None if zfs send
+        didn't report one
+        :rtype: int or None
+        :raises ZfsNoDatasetError: if a snapshot does not exist
+        :raises ZfsUnknownError: if the dry run failed for another reason,
+        such as a resume token whose snapshot has been destroyed
+        """
+        args = self._zfs_send_args(snapshot, incremental_source, recursive,
+                                   resume_token, large_blocks, embed_data,
+                                   compressed, raw, intermediates)
+        args[1:1] = ['-n', '-v', '-P']
+        out,err,rc = self.run_zfs(args)
+        if rc > 0:
+            if 'does not exist' in err:
+                raise ZfsNoDatasetError(errno.ENOENT, err, snapshot)
+            raise ZfsUnknownError(err)
+        # older versions print the estimate on stderr
+        return parse_send_size(out + err)
+
+    def zfs_send_flags(self):
+        """Return the single letter options this system's `zfs send` takes
+
+        `zfs send` run without a snapshot prints its usage, which lists the
+        options it understands, e.g. `send [-DnPpRvLecwhb] ...`.
+
+        :return: the option letters, such as 'L' and 'c'
+        :rtype: frozenset
+        :raises ZfsCommandNotFoundError: if it can't find the zfs command
+        """
+        out,err,rc = self.run_zfs(['send'])
+        return parse_usage_flags(out + err, 'send')
+
+    def max_args_len(self):
+        """Return how many bytes of arguments a single command can be given
+
+        Half of the system ARG_MAX is used to leave room for the environment,
+        capped at the limit for a single argument.
+
+        :rtype: int
+        """
+        try:
+            arg_max = os.sysconf('SC_ARG_MAX')
+        except (AttributeError, ValueError, OSError):
+            arg_max = -1
+        if arg_max <= 0:
+            arg_max = MAX_ARG_STRLEN
+        return min(arg_max // 2, MAX_ARG_STRLEN - 1)
+
     def process_cmd_args(self, cmd, args):
         """Process the cmd and args, returning a cmdargs array
 
@@ -455,12 +1087,13 @@ class ZfsCommandRunner(object):
         :rtype: list
         :raises TypeError: if args is not a list
         :raises TypeError: if cmd is not a string
-        :raises ValueError: if cmd is not one of the expected Zfs commands
+        :raises ValueError: if cmd is not one of the expected Zfs commands, or
+        BASELINE_CMD
         """
         if isinstance(args, basestring):
             raise TypeError("args must be a list.")
 
-        if cmd not in ZFS_CMDS:
+        if cmd not in ZFS_CMDS and cmd != BASELINE_CMD:
             raise ValueError('cmd must be one of: %s' % ZFS_CMDS)
 
         cmdargs=[]
@@ -471,7 +1104,7 @@ class ZfsCommandRunner(object):
                 cmdargs.extend(self.command_prefix)
 
         cmdargs.append(cmd)
-        if args[0] == cmd:
+        if args and args[0] == cmd:
             cmdargs.extend(args[1:])
         else:
             cmdargs.extend(args)
@@ -484,7 +1117,10 @@ class SSHZfsCommandRunner(ZfsCommandRunner):
     Uses paramiko to run a Zfs command on a remote system via SSH
     """
 
-    RECV_BUF_SZ=4096
+    runner_type='ssh'
+
+    RECV_BUF_SZ=32768
+    RECV_BUF_MAX=1048576
 
     def __init__(self, ssh_client, *args, **kwargs):
         """Initialize a new SSHZfsCommandRunner
@@ -501,61 +1137,172 @@ class SSHZfsCommandRunner(ZfsCommandRunner):
         See :py:func:`ZfsCommandRunner.run_cmd` for a description of the
         parameters and the return values
         """
-        cmdargs = self.process_cmd_args(cmd, args)
+        chan = self.open_cmd_channel(cmd, args)
+
+        # Simulate the behavior of subprocess.Popen.communicate, collecting
+        # the pieces in lists so the join at the end is linear in the size of
+        # the output
+        out=[]
+        err=[]
+        for stream, data in self._recv_channel(chan):
+            if stream == 'out':
+                out.append(data)
+            else:
+                err.append(data)
+        out=''.join(out)
+        err=''.join(err)
+
+        rc=chan.recv_exit_status()
+
+        logging.debug('out: ' + out)
+        logging.debug('err: ' + err)
+        logging.debug('rc:  ' + str(rc))
+        return (out,err,rc)
+
+    def open_cmd_channel(self, cmd, args):
+        """Start a command on the remote system in a new SSH channel
+
+        :param str cmd: The zfs command to run
+        :param list args: Arguments to the zfs command
+        :return: the channel the command is running in
+        :rtype: paramiko.Channel
+        """
+        return self._exec_channel(self.process_cmd_args(cmd, args))
+
+    def _exec_channel(self, cmdargs, feed=None):
+        """Run an already processed command line in a new SSH channel
 
+        If feed is given, it is a command line whose output is piped into
+        the command by the remote shell.
+        """
         # paramiko doesn't take a list, convert it to a shell compatible string
         command = subprocess.list2cmdline(cmdargs)
+        if feed:
+            command = subprocess.list2cmdline(feed) + ' | ' + command
 
         transport=self.ssh.get_transport()
         chan=transport.open_session()
         chan.exec_command(command)
+        cmdtrace.mark_spawned()
+        return chan
 
-        out=''
-        err=''
-        done={
-            'out' : False,
-            'err' : False,
-        }
-        # Simulate the behavior of subprocess.Popen.communicate
-        # Alternate reads between recv and recv_error until we've got all of
-        # the data.
-        # Note that paramiko channels will return a zero-length string to
-        # indicate that the channel stream has closed
-        while True:
-            if done['out']==False:
-                try:
-                    t_out=chan.recv(self.RECV_BUF_SZ)
-                    if t_out=='':
-                        # done receiving from out
-                        done['out']=True
-                    else:
-                        out += t_out
-                except socket.timeout:
-                    pass
-            if done['err']==False:
-                try:
-                    t_err=chan.recv_stderr(self.RECV_BUF_SZ)
-                    if t_err=='':
-                        # done receiving from err
-                        done['err']=True
-                    else:
-                        err += t_err
-                except socket.timeout:
-                    pass
-            if not False in done.values():
-                # We're done reading from both channels
-                break
+    def stream_cmd(self, cmd, args, errorclass=None, check=None):
+        """run a command on a remote system, yielding output as it arrives
 
-        rc=chan.recv_exit_status()
+        See :py:func:`ZfsCommandRunner.stream_cmd` for a description of the
+        parameters and the return values
+        """
+        chan = self.open_cmd_channel(cmd, args)
 
-        logging.debug('out: ' + out)
-        logging.debug('err: ' + err)
+        err=[]
+        def chunks():
+            for stream, data in self._recv_channel(chan):
+                if stream == 'out':
+                    yield data
+                else:
+                    err.append(data)
+
+        completed=False
+        try:
+            for line in _iter_lines(chunks()):
+                yield line
+            completed=True
+        finally:
+            if not completed:
+                chan.close()
+
+        rc=chan.recv_exit_status()
         logging.debug('rc:  ' + str(rc))
-        return (out,err,rc)
+        if check is not None:
+            check(''.join(err), rc)
+
+    def open_zfs_send(self, snapshot, incremental_source=None,
+                      recursive=False, resume_token=None, large_blocks=False,
+                      embed_data=False, compressed=False, raw=False,
+                      intermediates=False):
+        """Start `zfs send` on the remote system
+
+        See :py:func:`ZfsCommandRunner.open_zfs_send`
+
+        :return: the channel the stream can be read from
+        :rtype: paramiko.Channel
+        """
+        return self.open_cmd_channel('zfs', self._zfs_send_args(
+            snapshot, incremental_source, recursive, resume_token,
+            large_blocks, embed_data, compressed, raw, intermediates))
+
+    def open_zfs_receive(self, filesystem, force=False, resumable=False,
+                         buffer=None):
+        """Start `zfs receive` on the remote system
+
+        See :py:func:`ZfsCommandRunner.open_zfs_receive`
+
+        :param buffer: a command line, such as `zfsbuffer -m 1G`, to pass
+        the stream through on the remote system before it reaches zfs
+        receive. It is run without the command prefix.
+        :type buffer: list or None
+        :return: the channel the stream can be written to
+        :rtype: paramiko.Channel
+        """
+        cmdargs = self.process_cmd_args('zfs', self._zfs_receive_args(
+            filesystem, force, resumable))
+        return self._exec_channel(cmdargs, feed=buffer)
+
+    def max_args_len(self):
+        """Return how many bytes of arguments a single command can be given
+
+        The remote shell receives the whole command line as one argument, so
+        the limit for a single argument applies to all of them together.
+
+        :rtype: int
+        """
+        return MAX_ARG_STRLEN // 2
+
+    def _recv_channel(self, chan):
+        """Read stdout and stderr from a channel until the command finishes
+
+        Waits on the channel with select rather than polling it, so an idle
+        remote command costs no CPU. Each stream starts with a read size of
+        `RECV_BUF_SZ`, which doubles up to `RECV_BUF_MAX` whenever a read
+        fills the whole buffer.
+
+        :param paramiko.Channel chan: a channel running a command
+        :return: generator of tuples of the stream name (`out` or `err`) and
+        the data read from it
+        :rtype: iter
+        """
+        bufsz={
+            'out' : self.RECV_BUF_SZ,
+            'err' : self.RECV_BUF_SZ,
+        }
+        readers=(
+            ('out', chan.recv_ready, chan.recv),
+            ('err', chan.recv_stderr_ready, chan.recv_stderr),
+        )
+        while True:
+            # the channel's fileno becomes readable when either stream has
+            # data, and stays readable once the remote end has closed
+            select.select([chan], [], [])
+            for stream, ready, recv in readers:
+                if ready():
+                    data=recv(bufsz[stream])
+                    if len(data) == bufsz[stream] and \
+                       bufsz[stream] < self.RECV_BUF_MAX:
+                        bufsz[stream] *= 2
+                    yield stream, data
+            # paramiko signals EOF for both streams at once, so we're done
+            # when it has arrived and nothing is left buffered
+            if (chan.eof_received or chan.closed) and \
+               not chan.recv_ready() and not chan.recv_stderr_ready():
+                return
 
 class LocalZfsCommandRunner(ZfsCommandRunner):
     """Run ZFS commands on the local system"""
 
+    runner_type='local'
+
+    STREAM_BUF_SZ=65536
+
     def run_cmd(self, cmd, args, errorclass):
         """wrap subprocess.Popen with the ZFS environment
 
@@ -566,24 +1313,99 @@ class LocalZfsCommandRunner(ZfsCommandRunner):
         parameters and the return values
         """
         cmdargs = self.process_cmd_args(cmd, args)
+        p = self._popen(cmdargs, errorclass)
+
+        out,err=p.communicate()
+        rc=p.returncode
+        logging.debug('command %s returned result code %d' % (str([cmdargs]),rc))
+        return (out,err,rc)
+
+    def stream_cmd(self, cmd, args, errorclass=None, check=None):
+        """run a command locally, yielding output as it is produced
+
+        stderr is drained by a helper thread so that a command writing a lot
+        of error output can't block while we are reading stdout.
+
+        See :py:func:`ZfsCommandRunner.stream_cmd` for a description of the
+        parameters and the return values
+        """
+        cmdargs = self.process_cmd_args(cmd, args)
+        p = self._popen(cmdargs, errorclass, bufsize=self.STREAM_BUF_SZ)
+
+        err=[]
+        t=threading.Thread(target=lambda: err.append(p.stderr.read()))
+        t.daemon=True
+        t.start()
+
+        completed=False
+        try:
+            for line in iter(p.stdout.readline, ''):
+                yield line
+            completed=True
+        finally:
+            # If the caller stopped early, closing stdout makes the command
+            # exit with SIGPIPE rather than leaving it blocked on a write
+            p.stdout.close()
+            rc=p.wait()
+            t.join()
+            logging.debug('command %s returned result code %d' % (
+                str([cmdargs]),rc))
+
+        if completed and check is not None:
+            check(''.join(err), rc)
+
+    def open_zfs_send(self, snapshot, incremental_source=None,
+                      recursive=False, resume_token=None, large_blocks=False,
+                      embed_data=False, compressed=False, raw=False,
+                      intermediates=False):
+        """Start `zfs send` locally
+
+        See :py:func:`ZfsCommandRunner.open_zfs_send`
+
+        :return: the process, with the stream on its unbuffered stdout
+        :rtype: subprocess.Popen
+        :raises ZfsCommandNotFoundError: if it can't find the zfs command
+        """
+        cmdargs = self.process_cmd_args('zfs', self._zfs_send_args(
+            snapshot, incremental_source, recursive, resume_token,
+            large_blocks, embed_data, compressed, raw, intermediates))
+        return self._popen(cmdargs, ZfsCommandNotFoundError, bufsize=0)
+
+    def open_zfs_receive(self, filesystem, force=False, resumable=False):
+        """Start `zfs receive` locally
+
+        See :py:func:`ZfsCommandRunner.open_zfs_receive`
+
+        :return: the process, reading the stream from its unbuffered stdin
+        :rtype: subprocess.Popen
+        :raises ZfsCommandNotFoundError: if it can't find the zfs command
+        """
+        cmdargs = self.process_cmd_args('zfs', self._zfs_receive_args(
+            filesystem, force, resumable))
+        return self._popen(cmdargs, ZfsCommandNotFoundError, bufsize=0,
+                           stdin=subprocess.PIPE)
+
+    def _popen(self, cmdargs, errorclass, **kwargs):
+        """wrap subprocess.Popen with the ZFS environment
+
+        Raises the specified errorclass if the subprocess call raises an
+        OSError with errno of 2 (ENOENT)
+        """
         try:
             p=subprocess.Popen(
                 cmdargs,
                 env=ZFS_ENV,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
+                **kwargs
             )
+            cmdtrace.mark_spawned()
         except OSError as e:
             if errorclass != None and e.errno == errno.ENOENT:
                 raise errorclass()
             else:
                 raise e
-
-        #return p
-        out,err=p.communicate()
-        rc=p.returncode
-        logging.debug('command %s returned result code %d' % (str([cmdargs]),rc))
-        return (out,err,rc)
+        return p
 
 # The local command runner object, used for the functional methods
 _LCR=LocalZfsCommandRunner(command_prefix=SUDO_CMD)
@@ -608,6 +1430,15 @@ def zfs_list(*args, **kwargs):
     """
     return _LCR.zfs_list(*args, **kwargs)
 
+def zfs_list_records(*args, **kwargs):
+    """List Zfs datasets as typed records
+
+    Uses the sudo command to run zfs.
+
+    See :py:func:`ZfsCommandRunner.zfs_list_records` for details.
+    """
+    return _LCR.zfs_list_records(*args, **kwargs)
+
 def zfs_create(*args, **kwargs):
     """Creates a new ZFS file system.
 
@@ -626,6 +1457,15 @@ def zfs_destroy(*args, **kwargs):
     """
     return _LCR.zfs_destroy(*args, **kwargs)
 
+def zfs_destroy_snapshots(*args, **kwargs):
+    """Destroy many snapshots of one filesystem
+
+    Uses the sudo command to run zfs.
+
+    See :py:func:`ZfsCommandRunner.zfs_destroy_snapshots` for details.
+    """
+    return _LCR.zfs_destroy_snapshots(*args, **kwargs)
+
 def zfs_snapshot(*args, **kwargs):
     """Snapshot a ZFS filesystem
 
@@ -651,6 +1491,137 @@ def zpool_status(*args, **kwargs):
     """
     return _LCR.zpool_status(*args, **kwargs)
 
+def zpool_status_records(*args, **kwargs):
+    """Return the parsed zpool status of a pool or pools
+
+    Uses the sudo command to run zpool.
+
+    See :py:func:`ZfsCommandRunner.zpool_status_records` for details.
+    """
+    return _LCR.zpool_status_records(*args, **kwargs)
+
+def open_zfs_send(*args, **kwargs):
+    """Start `zfs send` on the local system
+
+    See :py:func:`LocalZfsCommandRunner.open_zfs_send` for details.
+    """
+    return _LCR.open_zfs_send(*args, **kwargs)
+
+def zfs_send_size(*args, **kwargs):
+    """Estimate the size of a local send stream
+
+    See :py:func:`ZfsCommandRunner.zfs_send_size` for details.
+    """
+    return _LCR.zfs_send_size(*args, **kwargs)
+
+def zfs_send_flags(*args, **kwargs):
+    """Return the options the local `zfs send` takes
+
+    See :py:func:`ZfsCommandRunner.zfs_send_flags` for details.
+    """
+    return _LCR.zfs_send_flags(*args, **kwargs)
+
+def open_zfs_receive(*args, **kwargs):
+    """Start `zfs receive` on the local system
+
+    See :py:func:`LocalZfsCommandRunner.open_zfs_receive` for details.
+    """
+    return _LCR.open_zfs_receive(*args, **kwargs)
+
+def set_default_runner(runner):
+    """Replace the runner used by the functional methods
+
+    For example, to run the commands through a
+    :py:class:`zfs.broker.BrokerZfsCommandRunner` rather than sudo.
+
+    :param ZfsCommandRunner runner: the new runner
+    :return: the previous runner
+    :rtype: ZfsCommandRunner
+    """
+    global _LCR
+    previous = _LCR
+    _LCR = runner
+    return previous
+
+def add_tracer(*args, **kwargs):
+    """Trace the commands run by the functional methods
+
+    See :py:func:`ZfsCommandRunner.add_tracer` for details.
+    """
+    return _LCR.add_tracer(*args, **kwargs)
+
+def remove_tracer(*args, **kwargs):
+    """Stop tracing the commands run by the functional methods
+
+    See :py:func:`ZfsCommandRunner.remove_tracer` for details.
+    """
+    return _LCR.remove_tracer(*args, **kwargs)
+
+def parse_send_size(text):
+    """Read the estimated stream size from the output of `zfs send -nvP`
+
+    Each snapshot in the stream is listed on a line of its own, such as
+    `incremental<TAB>a<TAB>tank/foo@b<TAB>4096`, followed by a line
+    `size<TAB>4096` with the total. Versions that don't print the total
+    have it summed from the lines of the snapshots.
+
+    :param str text: the output
+    :return: the size in bytes, or None if the output has no sizes
+    :rtype: int or None
+    """
+    total = None
+    for line in text.splitlines():
+        fields = line.split('\t')
+        if len(fields) < 2:
+            continue
+        size = _to_int(fields[-1])
+        if not isinstance(size, (int, long)):
+            continue
+        if fields[0] == 'size':
+            return size
+        if fields[0] in ('full', 'incremental'):
+            total = (total or 0) + size
+    return total
+
+_USAGE_FLAGS_RE=re.compile(r'\[-([a-zA-Z]+)\]')
+
+def parse_usage_flags(text, subcommand):
+    """Collect the single letter options in the usage of a zfs subcommand
+
+    :param str text: the usage message, as printed by `zfs send`
+    :param str subcommand: the subcommand whose usage lines to read
+    :return: the option letters in the `[-abc]` groups of every usage line
+    of subcommand
+    :rtype: frozenset
+    """
+    flags = set()
+    for line in text.splitlines():
+        words = line.split(None, 1)
+        if len(words) == 2 and words[0] == subcommand:
+            for group in _USAGE_FLAGS_RE.findall(words[1]):
+                flags.update(group)
+    return frozenset(flags)
+
+def _leaf_filesystems(filesystems):
+    """Drop each filesystem that is an ancestor of another in the list
+
+    :param list filesystems: dataset names
+    :return: the remaining names, in their original order, without
+    duplicates
+    :rtype: list
+    """
+    names = set(filesystems)
+    ancestors = set()
+    for fs in names:
+        parts = fs.split('/')
+        for i in range(1, len(parts)):
+            ancestors.add('/'.join(parts[:i]))
+    leaves = []
+    for fs in filesystems:
+        if fs not in ancestors and fs not in leaves:
+            leaves.append(fs)
+    return leaves
+
 def _check_perm_err(errstring):
     """Check if the error string is a /dev/zfs permission error
 
@@ -667,6 +1638,360 @@ def _check_perm_err(errstring):
     if ': permission denied' in errstring:
         raise ZfsPermissionError(errno.EPERM, errstring)
 
+def _check_zfs_list_err(errstring, rc):
+    """Raise the appropriate exception for a failed zfs list command"""
+    if rc > 0:
+        _check_perm_err(errstring)
+        _check_prop_err(errstring)
+        if "dataset does not exist" in errstring:
+            raise ZfsNoDatasetError(errstring)
+        else:
+            raise ZfsUnknownError(errstring)
+
+def _check_zpool_list_err(errstring, rc):
+    """Raise the appropriate exception for a failed zpool list command"""
+    if rc > 0:
+        _check_perm_err(errstring)
+        _check_prop_err(errstring)
+        if "no such pool" in errstring:
+            raise ZfsNoPoolError(errstring)
+        else:
+            raise ZfsUnknownError(errstring)
+
+def _split_args(args, budget):
+    """Split a list of arguments into groups that fit within budget
+
+    Each argument is counted with one extra byte for its separator. An
+    argument that is too long on its own still gets a group of its own.
+
+    :param list args: the arguments to split
+    :param int budget: the maximum total length of each group
+    :return: list of lists of arguments
+    :rtype: list
+    """
+    groups=[]
+    cur=[]
+    curlen=0
+    for arg in args:
+        if cur and curlen + len(arg) + 1 > budget:
+            groups.append(cur)
+            cur=[]
+            curlen=0
+        cur.append(arg)
+        curlen += len(arg) + 1
+    if cur:
+        groups.append(cur)
+    return groups
+
+def _snapshot_specs(filesystem, snapnames, allsnaps=None,
+                    budget=MAX_ARG_STRLEN - 1):
+    """Pack snapshot names into `filesystem@a,b%d` destroy arguments
+
+    :param str filesystem: the filesystem the snapshots belong to
+    :param list snapnames: the snapshot names, without the `filesystem@`
+    :param allsnaps: every snapshot name of `filesystem`, in creation order.
+    If given, runs of `snapnames` that are adjacent in it become ranges.
+    :type allsnaps: list or None
+    :param int budget: the maximum length of each argument
+    :return: list of tuples of the argument and the full names of the
+    snapshots it covers
+    :rtype: list
+    """
+    if allsnaps is not None:
+        pos=dict((snap, i) for i, snap in enumerate(allsnaps))
+        if all(snap in pos for snap in snapnames):
+            snapnames=sorted(snapnames, key=pos.get)
+        else:
+            pos=None
+    else:
+        pos=None
+
+    # group into runs of adjacent snapshots
+    runs=[]
+    for snap in snapnames:
+        if pos is not None and runs and pos[runs[-1][-1]] + 1 == pos[snap]:
+            runs[-1].append(snap)
+        else:
+            runs.append([snap])
+
+    items=[]
+    for run in runs:
+        if len(run) > 1:
+            items.append(('%s%%%s' % (run[0], run[-1]), run))
+        else:
+            items.append((run[0], run))
+
+    head='%s@' % filesystem
+    specs=[]
+    cur=[]
+    curlen=len(head)
+    for item, run in items:
+        if cur and curlen + 1 + len(item) > budget:
+            specs.append(cur)
+            cur=[]
+            curlen=len(head)
+        curlen += len(item) + (1 if cur else 0)
+        cur.append((item, run))
+    if cur:
+        specs.append(cur)
+
+    return [(head + ','.join(item for item, run in spec),
+             [head + snap for item, run in spec for snap in run])
+            for spec in specs]
+
+def _finish_spawn(t):
+    """Set the spawn time of a trace from the time marked by the runner"""
+    spawned = cmdtrace.take_spawned()
+    if spawned is not None:
+        t.spawn = max(spawned - t.start, 0.0)
+
+def _finish_trace(t):
+    """Set the wall time, and the spawn time if not yet known, of a trace"""
+    if t.spawn is None:
+        _finish_spawn(t)
+    t.wall = time.time() - t.start
+
+def _iter_lines(chunks):
+    """Split an iterable of arbitrarily sized strings into lines
+
+    Lines keep their trailing newline. A final line without a newline is
+    yielded once the chunks run out.
+    """
+    partial=''
+    for chunk in chunks:
+        lines=(partial + chunk).split('\n')
+        partial=lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if partial:
+        yield partial
+
+_RECORD_CLASSES={}
+
+def zfs_record_class(properties):
+    """Return the record class for rows listing the given properties
+
+    The class is a namedtuple with the fields `dataset` and `snapname` in
+    place of `name`, followed by the other properties in order. Characters
+    that aren't valid in an attribute name, such as the : and . of user
+    properties, are replaced with _. Classes are cached, so rows of the same
+    properties share one class.
+
+    :param list properties: the listed properties, including `name`
+    :rtype: type
+    """
+    key = tuple(properties)
+    cls = _RECORD_CLASSES.get(key)
+    if cls is None:
+        fields = ['dataset', 'snapname'] + [
+            re.sub('[^a-zA-Z0-9_]', '_', p) for p in properties if p != 'name']
+        base = collections.namedtuple('ZfsRecord', fields)
+        cls = type('ZfsRecord', (base,), {
+            '__slots__': (),
+            'name': property(_record_name,
+                             doc='The full name of the dataset or snapshot'),
+        })
+        _RECORD_CLASSES[key] = cls
+    return cls
+
+def _record_name(record):
+    if record.snapname is None:
+        return record.dataset
+    return record.dataset + '@' + record.snapname
+
+def zfs_records(rows, properties):
+    """Convert rows of `zfs list -p` output into typed records
+
+    :param rows: an iterable of rows, each a list of strings
+    :param list properties: the properties of each row, including `name`
+    :return: a generator of records
+    :rtype: iter of :py:func:`zfs_record_class` instances
+    """
+    cls = zfs_record_class(properties)
+    nameidx = properties.index('name')
+    converters = [_to_int if p in ZFS_NUMERIC_PROPERTIES else _to_str
+                  for p in properties]
+    others = [i for i in range(len(properties)) if i != nameidx]
+    new = tuple.__new__
+    for row in rows:
+        dataset, sep, snapname = row[nameidx].partition('@')
+        values = [intern(dataset), snapname if sep else None]
+        values.extend([converters[i](row[i]) for i in others])
+        yield new(cls, values)
+
+def _to_int(value):
+    if value == '-':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def _to_str(value):
+    if value == '-':
+        return None
+    return value
+
+class ZpoolVdev(collections.namedtuple('ZpoolVdev', [
+        'name', 'state', 'read', 'write', 'cksum', 'note', 'children'])):
+    """A line of the config section of zpool status
+
+    Attributes:
+        name        the vdev name, e.g. the pool, mirror-0, sda or the
+                    logs, cache and spares group headings
+        state       the state, e.g. ONLINE or DEGRADED, or None for the
+                    group headings
+        read        the read error count as printed, e.g. '0' or '1.2K', or
+                    None if not shown
+        write       the write error count as printed, or None
+        cksum       the checksum error count as printed, or None
+        note        any text after the counts, e.g. '(resilvering)', or None
+        children    list of the child :py:class:`ZpoolVdev` objects
+    """
+    __slots__ = ()
+
+class ZpoolStatus(collections.namedtuple('ZpoolStatus', [
+        'name', 'state', 'status', 'action', 'scan', 'scan_type',
+        'scan_state', 'scan_progress', 'scan_eta', 'errors', 'error_files',
+        'vdevs', 'fields'])):
+    """The parsed zpool status of one pool
+
+    Attributes:
+        name            the pool name
+        state           the pool state, e.g. ONLINE or DEGRADED
+        status          the status explanation, or None if the pool is
+                        healthy
+        action          the recommended action, or None
+        scan            the text of the scan field, or None
+        scan_type       'scrub' or 'resilver', or None if the pool has never
+                        been scanned
+        scan_state      'in progress', 'paused', 'completed' or 'canceled',
+                        or None
+        scan_progress   the percentage done of a scan in progress, or None
+        scan_eta        the estimated seconds until a scan in progress
+                        finishes, or None if zpool didn't estimate it
+        errors          the errors summary, e.g. 'No known data errors'
+        error_files     the files with permanent errors listed by -v
+        vdevs           the root :py:class:`ZpoolVdev` objects of the config
+                        section, starting with the pool itself
+        fields          dict of every field by name, including any not
+                        parsed further, such as `see` or `remove`
+    """
+    __slots__ = ()
+
+    @property
+    def syncing(self):
+        """True if the pool is being scrubbed or resilvered"""
+        return self.scan_state == 'in progress'
+
+# A field line, e.g. "  scan: none requested". Continuation lines and the
+# config section are indented with a tab, and the files listed under errors
+# with 8 spaces.
+_STATUS_FIELD_RE=re.compile(r'^ {0,6}([a-z]+): ?(.*)$')
+_SCAN_PROGRESS_RE=re.compile(r'([\d.]+)% done')
+_SCAN_ETA_RE=re.compile(r'(?:(\d+) days? )?(\d+):(\d\d):(\d\d) to go')
+_SCAN_ETA_OLD_RE=re.compile(r'(\d+)h(\d+)m to go')
+
+def parse_zpool_status(text):
+    """Parse the output of zpool status into one record per pool
+
+    Handles the output of both the illumos and the Linux zpool commands,
+    with or without -v.
+
+    :param str text: the output of zpool status
+    :return: the status of each pool, in the order they were printed
+    :rtype: list of :py:class:`ZpoolStatus`
+    """
+    pools = []
+    fields = None
+    field = None
+    for line in text.splitlines():
+        m = None if line.startswith('\t') else _STATUS_FIELD_RE.match(line)
+        if m:
+            field = m.group(1)
+            if field == 'pool':
+                fields = collections.OrderedDict()
+                pools.append(fields)
+            if fields is not None:
+                fields[field] = [m.group(2)] if m.group(2) else []
+        elif fields is not None and field is not None and line.strip():
+            fields[field].append(line)
+    return [_zpool_status_record(f) for f in pools]
+
+def _zpool_status_record(lines):
+    """Build a ZpoolStatus from the lines of each field of one pool"""
+    def text(field):
+        if not lines.get(field):
+            return None
+        return ' '.join(l.strip() for l in lines[field])
+
+    fields = dict((k, text(k)) for k in lines)
+    scan = fields.get('scan') or fields.get('scrub')
+    scan_type = scan_state = scan_progress = scan_eta = None
+    if scan and not scan.startswith('none requested'):
+        scan_type = 'resilver' if scan.startswith('resilver') else 'scrub'
+        if ' in progress' in scan:
+            scan_state = 'in progress'
+        elif ' paused' in scan:
+            scan_state = 'paused'
+        elif ' canceled' in scan:
+            scan_state = 'canceled'
+        else:
+            scan_state = 'completed'
+    if scan_state in ('in progress', 'paused'):
+        m = _SCAN_PROGRESS_RE.search(scan)
+        if m:
+            scan_progress = float(m.group(1))
+        m = _SCAN_ETA_RE.search(scan)
+        if m:
+            scan_eta = (int(m.group(1) or 0) * 86400 + int(m.group(2)) * 3600
+                        + int(m.group(3)) * 60 + int(m.group(4)))
+        else:
+            m = _SCAN_ETA_OLD_RE.search(scan)
+            if m:
+                scan_eta = int(m.group(1)) * 3600 + int(m.group(2)) * 60
+
+    errors = lines.get('errors', [])
+    return ZpoolStatus(
+        name=fields.get('pool'), state=fields.get('state'),
+        status=fields.get('status'), action=fields.get('action'),
+        scan=scan, scan_type=scan_type, scan_state=scan_state,
+        scan_progress=scan_progress, scan_eta=scan_eta,
+        errors=errors[0].strip() if errors else None,
+        error_files=[l.strip() for l in errors[1:]],
+        vdevs=_parse_vdevs(lines.get('config', [])),
+        fields=fields)
+
+def _parse_vdevs(lines):
+    """Build the vdev tree from the lines of the config section"""
+    roots = []
+    # (indent, vdev) of the current vdev at each level
+    stack = []
+    header = True
+    for line in lines:
+        body = line.lstrip('\t')
+        stripped = body.lstrip(' ')
+        if header:
+            # the NAME STATE READ WRITE CKSUM heading
+            header = not stripped.startswith('NAME')
+            continue
+        indent = len(body) - len(stripped)
+        words = stripped.split(None, 5)
+        counts = words[2:5] + [None] * (3 - len(words[2:5]))
+        vdev = ZpoolVdev(name=words[0],
+                         state=words[1] if len(words) > 1 else None,
+                         read=counts[0], write=counts[1], cksum=counts[2],
+                         note=words[5] if len(words) > 5 else None,
+                         children=[])
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        if stack:
+            stack[-1][1].children.append(vdev)
+        else:
+            roots.append(vdev)
+        stack.append((indent, vdev))
+    return roots
+
 def _check_prop_err(errstring):
     """Check if the errstring is a zfs invalid property error"""
     if 'bad property list: invalid property' in errstring:
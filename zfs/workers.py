@@ -0,0 +1,456 @@
+"""Run per-dataset work concurrently
+
+The :py:class:`DatasetWorkerPool` runs a function for each of a list of
+datasets on a pool of threads. Besides the overall limit on the number of
+threads, it can limit how many datasets of the same zpool are worked on at
+once, so that a busy pool isn't swamped while the others sit idle.
+
+The :py:class:`ReplicationScheduler` does the same for sends to a backup
+host, where each job loads a source pool, a target pool and the link to the
+target host, each with its own limit. The largest jobs are started first,
+so that one big dataset doesn't hold up the end of the run. How far a run
+has got, and when it will finish, is followed by a :py:class:`SendProgress`.
+"""
+
+import collections
+import logging
+import re
+import threading
+import time
+from util import get_pool_from_fsname
+
+class DatasetResult(object):
+    """The outcome of running a function for one dataset
+
+    Attributes:
+        dataset     the dataset the function was run for
+        result      the return value of the function, or None if it failed
+        error       the exception raised by the function, or None
+    """
+    __slots__ = ('dataset', 'result', 'error')
+
+    def __init__(self, dataset, result=None, error=None):
+        self.dataset = dataset
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        """True if the function completed without raising an exception"""
+        return self.error is None
+
+    def __repr__(self):
+        return 'DatasetResult(%r, result=%r, error=%r)' % (
+            self.dataset, self.result, self.error)
+
+class DatasetWorkerPool(object):
+    """Run a function for many datasets on a pool of threads
+
+    Attributes:
+        jobs        the maximum number of datasets to work on at once
+        pool_jobs   the maximum number of datasets of any one zpool to work
+                    on at once, or None for no limit beyond `jobs`
+    """
+
+    def __init__(self, jobs=1, pool_jobs=None):
+        """Create a new DatasetWorkerPool
+
+        :param int jobs: the maximum number of datasets to work on at once
+        :param pool_jobs: the maximum number of datasets of one zpool to work
+        on at once
+        :type pool_jobs: int or None
+        :raises ValueError: if a limit is less than 1
+        """
+        jobs = int(jobs)
+        if jobs < 1:
+            raise ValueError('jobs must be at least 1')
+        if pool_jobs is not None:
+            pool_jobs = int(pool_jobs)
+            if pool_jobs < 1:
+                raise ValueError('pool_jobs must be at least 1')
+        self.jobs = jobs
+        self.pool_jobs = pool_jobs
+
+    def map(self, fn, datasets, pool_of=get_pool_from_fsname):
+        """Call fn for each dataset, concurrently where the limits allow
+
+        Exceptions raised by fn are caught and recorded in the results rather
+        than stopping the remaining work.
+
+        :param fn: called with each dataset as its only argument
+        :param list datasets: the datasets to work on
+        :param pool_of: returns the zpool a dataset belongs to, used for the
+        per-pool limit
+        :return: one result per dataset, in the same order as `datasets`
+        :rtype: list of :py:class:`DatasetResult`
+        """
+        datasets = list(datasets)
+        results = [None] * len(datasets)
+
+        if self.jobs == 1 or len(datasets) <= 1:
+            for i, ds in enumerate(datasets):
+                results[i] = _call(fn, ds)
+            return results
+
+        # Queue the work per pool, and hand it out round-robin
+        queues = collections.OrderedDict()
+        for i, ds in enumerate(datasets):
+            queues.setdefault(pool_of(ds), collections.deque()).append((i, ds))
+        running = dict((pool, 0) for pool in queues)
+        cond = threading.Condition()
+
+        def next_item():
+            """Pick the next dataset whose pool has room, or None when done.
+            Must be called with cond held."""
+            while True:
+                waiting = False
+                for pool, queue in queues.items():
+                    if not queue:
+                        continue
+                    if self.pool_jobs is not None and \
+                       running[pool] >= self.pool_jobs:
+                        waiting = True
+                        continue
+                    running[pool] += 1
+                    # move the pool to the back for fairness
+                    del queues[pool]
+                    queues[pool] = queue
+                    return pool, queue.popleft()
+                if not waiting:
+                    return None
+                cond.wait()
+
+        def worker():
+            while True:
+                with cond:
+                    item = next_item()
+                if item is None:
+                    return
+                pool, (i, ds) = item
+                results[i] = _call(fn, ds)
+                with cond:
+                    running[pool] -= 1
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=worker)
+                   for n in range(min(self.jobs, len(datasets)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+class ReplicationJob(object):
+    """A dataset to be sent by a :py:class:`ReplicationScheduler`
+
+    Attributes:
+        dataset     the dataset being sent
+        size        the estimated size of the send in bytes, or None if
+                    unknown
+        source_pool the zpool the dataset is sent from
+        target_pool the zpool on the target host it is received into
+        target_host the host it is sent to
+        plan        anything else the function running the job needs
+    """
+    __slots__ = ('dataset', 'size', 'source_pool', 'target_pool',
+                 'target_host', 'plan')
+
+    def __init__(self, dataset, size=None, source_pool=None,
+                 target_pool=None, target_host=None, plan=None):
+        self.dataset = dataset
+        self.size = size
+        self.source_pool = source_pool
+        self.target_pool = target_pool
+        self.target_host = target_host
+        self.plan = plan
+
+    def __repr__(self):
+        return 'ReplicationJob(%r, size=%r, %r -> %r:%r)' % (
+            self.dataset, self.size, self.source_pool, self.target_host,
+            self.target_pool)
+
+class ReplicationScheduler(object):
+    """Run replication jobs on a pool of threads, largest first
+
+    A job is only started while its source pool, target pool and target
+    host are each running fewer jobs than their limit. Of the jobs that can
+    start, the one with the largest estimated size goes first; jobs of
+    unknown size go last.
+
+    Attributes:
+        jobs        the maximum number of jobs to run at once
+        source_pool_jobs  the maximum number of jobs reading from one source
+                    pool, or None for no limit beyond `jobs`
+        target_pool_jobs  the maximum number of jobs writing to one target
+                    pool, or None
+        host_jobs   the maximum number of jobs sending to one host, or None
+    """
+
+    def __init__(self, jobs=1, source_pool_jobs=None, target_pool_jobs=None,
+                 host_jobs=None):
+        """Create a new ReplicationScheduler
+
+        :param int jobs: the maximum number of jobs to run at once
+        :param source_pool_jobs: the limit per source pool
+        :type source_pool_jobs: int or None
+        :param target_pool_jobs: the limit per target pool
+        :type target_pool_jobs: int or None
+        :param host_jobs: the limit per target host
+        :type host_jobs: int or None
+        :raises ValueError: if a limit is less than 1
+        """
+        jobs = int(jobs)
+        if jobs < 1:
+            raise ValueError('jobs must be at least 1')
+        limits = []
+        for name, limit in (('source_pool_jobs', source_pool_jobs),
+                            ('target_pool_jobs', target_pool_jobs),
+                            ('host_jobs', host_jobs)):
+            if limit is not None:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError('%s must be at least 1' % name)
+            limits.append(limit)
+        self.jobs = jobs
+        self.source_pool_jobs, self.target_pool_jobs, self.host_jobs = limits
+
+    def order(self, jobs):
+        """Return the jobs in the order they would be started without limits
+
+        :param list jobs: list of :py:class:`ReplicationJob`
+        :rtype: list of :py:class:`ReplicationJob`
+        """
+        return sorted(jobs, key=lambda job: (job.size is None,
+                                             -(job.size or 0)))
+
+    def _keys(self, job):
+        """The limited resources a job uses, with their limits"""
+        return [(key, limit) for key, limit in (
+            (('source', job.source_pool), self.source_pool_jobs),
+            (('target', job.target_pool), self.target_pool_jobs),
+            (('host', job.target_host), self.host_jobs))
+                if limit is not None]
+
+    def map(self, fn, jobs):
+        """Call fn for each job, concurrently where the limits allow
+
+        Exceptions raised by fn are caught and recorded in the results rather
+        than stopping the remaining jobs.
+
+        :param fn: called with each :py:class:`ReplicationJob` as its only
+        argument
+        :param list jobs: the jobs to run
+        :return: one result per job, for its dataset, in the same order as
+        `jobs`
+        :rtype: list of :py:class:`DatasetResult`
+        """
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        index = dict((id(job), i) for i, job in enumerate(jobs))
+        pending = self.order(jobs)
+
+        if self.jobs == 1 or len(jobs) <= 1:
+            for job in pending:
+                results[index[id(job)]] = _call(fn, job, job.dataset)
+            return results
+
+        running = collections.defaultdict(int)
+        cond = threading.Condition()
+
+        def next_job():
+            """Take the first pending job with room on all of its resources,
+            or None when done. Must be called with cond held."""
+            while pending:
+                for n, job in enumerate(pending):
+                    keys = self._keys(job)
+                    if all(running[key] < limit for key, limit in keys):
+                        for key, limit in keys:
+                            running[key] += 1
+                        del pending[n]
+                        return job
+                cond.wait()
+            return None
+
+        def worker():
+            while True:
+                with cond:
+                    job = next_job()
+                if job is None:
+                    return
+                results[index[id(job)]] = _call(fn, job, job.dataset)
+                with cond:
+                    for key, limit in self._keys(job):
+                        running[key] -= 1
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=worker)
+                   for n in range(min(self.jobs, len(jobs)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+_DURATION_RE=re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$', re.I)
+_DURATION_UNITS={'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(text):
+    """Parse a duration such as 90m or 6h
+
+    :param str text: the duration, in seconds unless followed by s, m, h
+    or d
+    :return: the duration in seconds
+    :rtype: float
+    :raises ValueError: if the duration can't be parsed
+    """
+    m = _DURATION_RE.match(text)
+    if m is None:
+        raise ValueError('invalid duration: %s' % text)
+    return float(m.group(1)) * _DURATION_UNITS[m.group(2).lower()]
+
+def format_duration(seconds):
+    """Format a number of seconds as hours, minutes and seconds
+
+    :rtype: str
+    """
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+class SendProgress(object):
+    """The progress of a run of replication jobs, and when it will end
+
+    The rate the remaining bytes are expected to go at is the throughput
+    measured so far in the run, or the configured link rate until anything
+    has been sent. It is safe to report jobs from several threads at once.
+
+    Attributes:
+        planned_bytes   the estimated size of all of the jobs
+        planned_jobs    the number of jobs
+        window          the seconds the run should finish in, or None
+        link_rate       the expected throughput in bytes per second, or None
+        sent_bytes      the bytes sent so far
+        done_bytes      the estimated size of the jobs finished so far
+        done_jobs       the number of jobs finished so far
+    """
+
+    def __init__(self, jobs, window=None, link_rate=None, clock=time.time):
+        """Start following a run
+
+        :param list jobs: the :py:class:`ReplicationJob` to run. Jobs of
+        unknown size count as 0 bytes.
+        :param window: the seconds the run should finish in
+        :type window: float or None
+        :param link_rate: the expected throughput in bytes per second
+        :type link_rate: float or None
+        :param clock: returns the current time in seconds
+        """
+        self.planned_bytes = sum(job.size or 0 for job in jobs)
+        self.planned_jobs = len(jobs)
+        self.window = window
+        self.link_rate = link_rate
+        self.sent_bytes = 0
+        self.done_bytes = 0
+        self.done_jobs = 0
+        self._clock = clock
+        self._start = clock()
+        self._warned = False
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        """Return the seconds since the run started"""
+        return self._clock() - self._start
+
+    def rate(self):
+        """Return the expected throughput in bytes per second, or None if
+        there is nothing to go by"""
+        elapsed = self.elapsed()
+        if self.sent_bytes and elapsed > 0:
+            return self.sent_bytes / elapsed
+        return self.link_rate
+
+    def eta(self):
+        """Return the seconds until the run is expected to finish, or None
+        if unknown"""
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(self.planned_bytes - self.done_bytes, 0) / float(rate)
+
+    def fits(self):
+        """Check whether the run is expected to finish within its window
+
+        :return: False if it is expected to overrun, True otherwise,
+        including when there is no window or no rate to go by
+        :rtype: bool
+        """
+        eta = self.eta()
+        if self.window is None or eta is None:
+            return True
+        return self.elapsed() + eta <= self.window
+
+    def plan(self):
+        """Log the planned size of the run, and warn if it won't fit its
+        window at the link rate"""
+        message = 'Planned %d sends of %.1f MiB' % (
+            self.planned_jobs, self.planned_bytes / float(1 << 20))
+        eta = self.eta()
+        if eta is not None:
+            message += ', expected to take %s' % format_duration(eta)
+        logging.info(message)
+        self._check()
+
+    def job_done(self, job, nbytes):
+        """Record a finished job, logging the progress of the run
+
+        :param job: the job, whether it succeeded or not
+        :type job: :py:class:`ReplicationJob`
+        :param int nbytes: the bytes the job sent
+        """
+        with self._lock:
+            self.done_jobs += 1
+            self.done_bytes += job.size or 0
+            self.sent_bytes += nbytes or 0
+            eta = self.eta()
+            logging.info('Sent %d of %d datasets, %.1f of %.1f MiB%s' % (
+                self.done_jobs, self.planned_jobs,
+                self.done_bytes / float(1 << 20),
+                self.planned_bytes / float(1 << 20),
+                '' if eta is None else ', %s to go' % format_duration(eta)))
+            self._check()
+
+    def _check(self):
+        if self._warned or self.fits():
+            return
+        self._warned = True
+        logging.warning('The backup is expected to take %s, beyond its '
+                        'window of %s: %.1f MiB left to send at %.1f MiB/s' %
+                        (format_duration(self.elapsed() + self.eta()),
+                         format_duration(self.window),
+                         (self.planned_bytes - self.done_bytes) /
+                         float(1 << 20), self.rate() / float(1 << 20)))
+
+def _call(fn, arg, dataset=None):
+    """Call fn for arg, capturing any exception in the result for dataset,
+    which defaults to arg"""
+    if dataset is None:
+        dataset = arg
+    try:
+        return DatasetResult(dataset, result=fn(arg))
+    except Exception as e:
+        logging.debug('Failed working on %s' % dataset, exc_info=True)
+        return DatasetResult(dataset, error=e)
+
+def log_failures(results):
+    """Log the failed results
+
+    :param list results: list of :py:class:`DatasetResult`
+    :return: the number of failures
+    :rtype: int
+    """
+    failures = [r for r in results if not r.ok]
+    for r in failures:
+        logging.error('%s: %s' % (r.dataset, r.error))
+    return len(failures)
@@ -5,7 +5,11 @@ import logging
 import sys
 from optparse import OptionParser
 from zfs import *
+from zfs.cmdtrace import tracing
+from zfs.broker import using_broker
+from zfs.metrics import RunMetrics, write_metrics_file
 from zfs.snapshot import RollingSnapshotter, validate_keep
+from zfs.workers import log_failures
 
 class App(object):
     """The ZFS automatic snapshotter application
@@ -25,6 +29,13 @@ class App(object):
             keep  - number of total snapshots to retain, including the one we
                     have just created.
 
+        Optionally, options.jobs and options.pool_jobs limit how many datasets
+        are worked on at once, overall and per zpool, options.trace names
+        a file to append a trace of every zfs and zpool command to,
+        options.metrics_file names a node_exporter textfile to write the run
+        metrics to, and options.broker names the socket of a ZFS broker to
+        run the commands through instead of sudo.
+
         Additionally, if options.dataset is defined, it will be used instead
         of the default value of '//' (which means check the user properties for
         which filesystems to snapshot).
@@ -42,6 +53,16 @@ class App(object):
 
         if not hasattr(self.options, 'dataset'):
             self.options.dataset='//'
+        if not hasattr(self.options, 'jobs'):
+            self.options.jobs=1
+        if not hasattr(self.options, 'pool_jobs'):
+            self.options.pool_jobs=None
+        if not hasattr(self.options, 'trace'):
+            self.options.trace=None
+        if not hasattr(self.options, 'metrics_file'):
+            self.options.metrics_file=None
+        if not hasattr(self.options, 'broker'):
+            self.options.broker=None
 
     def run(self):
         """Run this application
@@ -51,12 +72,27 @@ class App(object):
 
         ret = 0
 
-        snapper=RollingSnapshotter(self.options.label, self.options.keep)
+        metrics=RunMetrics('zfsautosnap', label=self.options.label)
+        snapper=RollingSnapshotter(self.options.label, self.options.keep,
+                                   jobs=self.options.jobs,
+                                   pool_jobs=self.options.pool_jobs,
+                                   metrics=metrics)
         try:
-            snapper.take_snapshot(self.options.dataset)
+            with using_broker(self.options.broker), \
+                    tracing(self.options.trace):
+                results = snapper.take_snapshot(self.options.dataset)
         except ZfsDatasetExistsError as e:
             logging.critical(e)
             ret=1
+        except:
+            ret=1
+            raise
+        else:
+            if results and log_failures(results):
+                ret=1
+        finally:
+            metrics.finish(ret == 0)
+            write_metrics_file(metrics, self.options.metrics_file)
 
         return ret
 
@@ -78,6 +114,19 @@ def main(args=None):
 
     op = OptionParser(usage='usage: %prog [options] label keep')
     op.add_option('-v', '--verbose', dest='verbose', action='store_true')
+    op.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                  help='number of datasets to work on at once')
+    op.add_option('--pool-jobs', dest='pool_jobs', type='int', default=None,
+                  help='number of datasets of one zpool to work on at once')
+    op.add_option('--trace', dest='trace', metavar='FILE', default=None,
+                  help='append a JSON trace of each zfs command to FILE')
+    op.add_option('--metrics-file', dest='metrics_file', metavar='FILE',
+                  default=None,
+                  help='write run metrics to FILE for the node_exporter '
+                  'textfile collector')
+    op.add_option('--broker', dest='broker', metavar='SOCKET', default=None,
+                  help='run zfs commands through the ZFS broker listening '
+                  'on SOCKET instead of sudo')
     (options,args) = op.parse_args(args[1:])
     if len(args) != 2:
         op.error('Not enough arguments provided')
@@ -90,6 +139,10 @@ def main(args=None):
         options.keep=validate_keep(options.keep)
     except ValueError:
         op.error('Keep must be either a number or "all"')
+    if options.jobs < 1:
+        op.error('jobs must be at least 1')
+    if options.pool_jobs is not None and options.pool_jobs < 1:
+        op.error('pool-jobs must be at least 1')
 
     app=App(options)
     return app.run()
@@ -5,7 +5,12 @@ import logging
 import sys
 from optparse import OptionParser
 from zfs import *
-from zfs.backup import MbufferedSSHBackup
+from zfs.backup import MbufferedSSHBackup, HISTORY_MODES
+from zfs.metrics import RunMetrics, write_metrics_file
+from zfs.broker import using_broker
+from zfs.workers import log_failures, parse_duration
+from zfs.ringbuffer import DEFAULT_SIZE, DEFAULT_BLOCK_SZ, parse_size
+from zfs.compress import Compression, CODECS, parse_compression
 
 class App(object):
     """The ZFS backup application
@@ -28,6 +33,24 @@ class App(object):
             * targetdataset - the base dataset on the remote system under which
             all backups will be stored. Usually this is a dedicated zpool.
 
+        Optionally, options.metrics_file names a node_exporter textfile to
+        write the run metrics to, and options.broker names the socket of a
+        ZFS broker to run the local commands through instead of sudo.
+        options.buffer_size and options.remote_buffer_size give the sizes in
+        bytes of the ring buffers on each side of the transfer, or None for
+        none, options.block_size their block size, and options.spill_dir
+        where to put the local buffer if memory is short. options.jobs is the
+        number of datasets to send at once, limited per local pool, remote
+        pool and target host by options.source_pool_jobs,
+        options.target_pool_jobs and options.host_jobs. options.compress is
+        a (codec, level) tuple to compress the streams with on
+        options.compress_threads threads, or None to send them as they are.
+        options.raw sends raw streams where both systems support them.
+        options.window is the seconds the run should finish in, and
+        options.link_rate the expected throughput in bytes per second, or
+        None for either to go without. options.history is which of the new
+        snapshots are sent, one of :py:data:`zfs.backup.HISTORY_MODES`.
+
         "options" is implemented as a generic object with properties so that
         the output of an OptionParser can be passed directly to the app.
         """
@@ -39,6 +62,36 @@ class App(object):
 
         logging.basicConfig(level=level)
 
+        if not hasattr(self.options, 'metrics_file'):
+            self.options.metrics_file=None
+        if not hasattr(self.options, 'broker'):
+            self.options.broker=None
+        if not hasattr(self.options, 'buffer_size'):
+            self.options.buffer_size=DEFAULT_SIZE
+        if not hasattr(self.options, 'remote_buffer_size'):
+            self.options.remote_buffer_size=None
+        if not hasattr(self.options, 'block_size'):
+            self.options.block_size=DEFAULT_BLOCK_SZ
+        if not hasattr(self.options, 'spill_dir'):
+            self.options.spill_dir=None
+        if not hasattr(self.options, 'jobs'):
+            self.options.jobs=1
+        for limit in ('source_pool_jobs', 'target_pool_jobs', 'host_jobs'):
+            if not hasattr(self.options, limit):
+                setattr(self.options, limit, None)
+        if not hasattr(self.options, 'compress'):
+            self.options.compress=None
+        if not hasattr(self.options, 'compress_threads'):
+            self.options.compress_threads=1
+        if not hasattr(self.options, 'raw'):
+            self.options.raw=False
+        if not hasattr(self.options, 'window'):
+            self.options.window=None
+        if not hasattr(self.options, 'link_rate'):
+            self.options.link_rate=None
+        if not hasattr(self.options, 'history'):
+            self.options.history='all'
+
     def run(self):
         """Run this application
 
@@ -47,16 +100,47 @@ class App(object):
 
         ret = 0
 
-        backerupper=MbufferedSSHBackup(
-            label=self.options.label,
-            backup_host=self.options.targethost,
-            backup_dataset=self.options.targetdataset,
-            backup_user=self.options.targetuser)
+        metrics=RunMetrics('zfsbackup', label=self.options.label,
+                           target=self.options.targethost)
+        compression=None
+        if self.options.compress is not None:
+            codec, level = self.options.compress
+            compression=Compression(codec, level,
+                                    threads=self.options.compress_threads)
         try:
-            backerupper.take_backup('//')
+            backerupper=MbufferedSSHBackup(
+                label=self.options.label,
+                backup_host=self.options.targethost,
+                backup_dataset=self.options.targetdataset,
+                backup_user=self.options.targetuser,
+                metrics=metrics,
+                buffer_size=self.options.buffer_size,
+                remote_buffer_size=self.options.remote_buffer_size,
+                block_size=self.options.block_size,
+                spill_dir=self.options.spill_dir,
+                jobs=self.options.jobs,
+                source_pool_jobs=self.options.source_pool_jobs,
+                target_pool_jobs=self.options.target_pool_jobs,
+                host_jobs=self.options.host_jobs,
+                compression=compression,
+                raw_send=self.options.raw,
+                window=self.options.window,
+                link_rate=self.options.link_rate,
+                history=self.options.history)
+            with using_broker(self.options.broker):
+                results = backerupper.take_backup('//')
         except ZfsDatasetExistsError as e:
             logging.critical(e)
             ret=1
+        except:
+            ret=1
+            raise
+        else:
+            if results and log_failures(results):
+                ret=1
+        finally:
+            metrics.finish(ret == 0)
+            write_metrics_file(metrics, self.options.metrics_file)
 
         return ret
 
@@ -78,6 +162,67 @@ def main(args=None):
 
     op = OptionParser(usage='usage: %prog [options] label targethost targetusername targetdataset')
     op.add_option('-v', '--verbose', dest='verbose', action='store_true')
+    op.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                  help='number of datasets to send at once')
+    op.add_option('--source-pool-jobs', dest='source_pool_jobs', type='int',
+                  default=None,
+                  help='number of datasets of one local zpool to send at once')
+    op.add_option('--target-pool-jobs', dest='target_pool_jobs', type='int',
+                  default=None,
+                  help='number of datasets to receive into one remote zpool '
+                  'at once')
+    op.add_option('--host-jobs', dest='host_jobs', type='int', default=None,
+                  help='number of datasets to send to the target host at once')
+    op.add_option('--metrics-file', dest='metrics_file', metavar='FILE',
+                  default=None,
+                  help='write run metrics to FILE for the node_exporter '
+                  'textfile collector')
+    op.add_option('--broker', dest='broker', metavar='SOCKET', default=None,
+                  help='run local zfs commands through the ZFS broker '
+                  'listening on SOCKET instead of sudo')
+    op.add_option('--buffer-size', dest='buffer_size', metavar='SIZE',
+                  default=str(DEFAULT_SIZE),
+                  help='buffer the send stream locally in SIZE bytes, e.g. '
+                  '512M, or 0 for no buffer (default 256M)')
+    op.add_option('--remote-buffer-size', dest='remote_buffer_size',
+                  metavar='SIZE', default='0',
+                  help='buffer the stream in SIZE bytes on the target host '
+                  'with zfsbuffer, which must be installed there (default 0, '
+                  'no buffer)')
+    op.add_option('--block-size', dest='block_size', metavar='SIZE',
+                  default=str(DEFAULT_BLOCK_SZ),
+                  help='size of each read and write of the buffers '
+                  '(default 128K)')
+    op.add_option('--spill-dir', dest='spill_dir', metavar='DIR',
+                  default=None,
+                  help='keep the local buffer in a memory-mapped file in DIR '
+                  'when memory is short')
+    op.add_option('--compress', dest='compress', metavar='CODEC[:LEVEL]',
+                  default=None,
+                  help='compress the send streams with CODEC, one of %s, '
+                  'decompressing them with zfsbuffer on the target host'
+                  % ', '.join(CODECS.keys()))
+    op.add_option('--compress-threads', dest='compress_threads', type='int',
+                  default=1, metavar='N',
+                  help='compress and decompress each stream on N threads '
+                  '(default 1)')
+    op.add_option('--raw', dest='raw', action='store_true', default=False,
+                  help='send raw streams (zfs send -w) where both systems '
+                  'support them, so encrypted datasets stay encrypted on the '
+                  'target. A dataset sent raw must always be sent raw')
+    op.add_option('--window', dest='window', metavar='DURATION',
+                  default=None,
+                  help='warn when the sends are not expected to finish '
+                  'within DURATION, e.g. 6h')
+    op.add_option('--link-rate', dest='link_rate', metavar='SIZE',
+                  default=None,
+                  help='expected throughput to the target host per second, '
+                  'e.g. 100M, used until the run has measured its own')
+    op.add_option('--history', dest='history', type='choice',
+                  choices=HISTORY_MODES, default='all',
+                  help='which snapshots taken since the last backup to '
+                  'send: all of them in one stream (default), only the ones '
+                  'of LABEL, or only the newest')
     (options,args) = op.parse_args(args[1:])
     if len(args) != 4:
         op.error('Not enough arguments provided')
@@ -91,6 +236,31 @@ def main(args=None):
         op.error('target username not provided')
     if not options.targetdataset:
         op.error('target dataset not provided')
+    try:
+        options.buffer_size=parse_size(options.buffer_size) or None
+        options.remote_buffer_size=parse_size(
+            options.remote_buffer_size) or None
+        options.block_size=parse_size(options.block_size)
+        if options.compress is not None:
+            options.compress=parse_compression(options.compress)
+        if options.window is not None:
+            options.window=parse_duration(options.window)
+        if options.link_rate is not None:
+            options.link_rate=parse_size(options.link_rate) or None
+    except ValueError as e:
+        op.error(str(e))
+    if options.jobs < 1:
+        op.error('jobs must be at least 1')
+    for limit in ('source_pool_jobs', 'target_pool_jobs', 'host_jobs'):
+        if getattr(options, limit) is not None and getattr(options, limit) < 1:
+            op.error('%s must be at least 1' % limit.replace('_', '-'))
+    if options.block_size < 1:
+        op.error('block-size must be at least 1')
+    if options.compress_threads < 1:
+        op.error('compress-threads must be at least 1')
+    for size in (options.buffer_size, options.remote_buffer_size):
+        if size is not None and size < 2 * options.block_size:
+            op.error('buffer sizes must be at least twice block-size')
 
     app=App(options)
     return app.run()
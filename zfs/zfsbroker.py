@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Run the privileged ZFS command broker"""
+
+import logging
+import signal
+import sys
+from optparse import OptionParser
+from zfs import *
+from zfs.broker import ZfsBroker, DEFAULT_SOCKET
+
+class App(object):
+    """The ZFS command broker application
+
+    Usage:
+
+        myapp = App(options)
+        app.run()
+    """
+
+    def __init__(self, options):
+        """Initialize the App
+
+        "options" is an object that has at least the following properties
+        defined:
+            socket - the path to listen on
+
+        Optionally, options.mode gives the permissions of the socket,
+        options.group the group to give it, and options.uids the list of uids
+        allowed to connect.
+
+        "options" is implemented as a generic object with properties so that
+        the output of an OptionParser can be passed directly to the app.
+        """
+        self.options=options
+        if options.verbose:
+            level=logging.DEBUG
+        else:
+            level=logging.INFO
+
+        logging.basicConfig(level=level)
+
+        if not hasattr(self.options, 'mode'):
+            self.options.mode=0660
+        if not hasattr(self.options, 'group'):
+            self.options.group=None
+        if not hasattr(self.options, 'uids'):
+            self.options.uids=None
+
+    def run(self):
+        """Run this application until it is sent SIGTERM or SIGINT
+
+        Returns: a result code suitable for passing to exit()
+        """
+        try:
+            broker=ZfsBroker(self.options.socket, mode=self.options.mode,
+                             group=self.options.group,
+                             allowed_uids=self.options.uids)
+        except (ZfsBrokerError, EnvironmentError, KeyError) as e:
+            logging.critical('Unable to start the ZFS broker: %s' % e)
+            return 1
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            broker.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            broker.shutdown()
+        return 0
+
+def main(args=None):
+    """Main function for zfsbroker
+
+    This function parses and validates command line arguments, constructs
+    an options object, and instanciates an instance of App.
+
+    It is as simple to use as:
+        exit(main())
+
+    However, the args parameter can be defined in order to construct your own
+    command line. This is useful for testing.
+    """
+
+    if args is None:
+        args = sys.argv
+
+    op = OptionParser(usage='usage: %prog [options]')
+    op.add_option('-v', '--verbose', dest='verbose', action='store_true')
+    op.add_option('-s', '--socket', dest='socket', metavar='PATH',
+                  default=DEFAULT_SOCKET,
+                  help='listen on PATH (default %default)')
+    op.add_option('-m', '--mode', dest='mode', default='0660',
+                  help='permissions of the socket, in octal (default '
+                  '%default)')
+    op.add_option('-g', '--group', dest='group', default=None,
+                  help='give the socket to GROUP')
+    op.add_option('-u', '--uid', dest='uids', type='int', action='append',
+                  default=None, metavar='UID',
+                  help='only answer clients running as UID, may be repeated')
+    (options,args) = op.parse_args(args[1:])
+    if args:
+        op.error('unexpected arguments provided')
+    try:
+        options.mode=int(options.mode, 8)
+    except ValueError:
+        op.error('mode must be an octal number')
+
+    app=App(options)
+    return app.run()
+
+# ---------------- MAIN ---------------
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Buffer a stream from stdin to stdout, like mbuffer
+
+With -d, the stream is decompressed as well, as compressed by
+:py:class:`zfs.compress.CompressingWriter`.
+"""
+
+import io
+import logging
+import sys
+from optparse import OptionParser
+from zfs.compress import DecompressingWriter
+from zfs.pipeline import pump
+from zfs.ringbuffer import RingBuffer, DEFAULT_SIZE, DEFAULT_BLOCK_SZ, \
+        parse_size
+
+class App(object):
+    """The stream buffer application
+
+    Usage:
+
+        myapp = App(options)
+        app.run()
+    """
+
+    def __init__(self, options):
+        """Initialize the App
+
+        "options" is an object that has at least the following properties
+        defined:
+            size       - the size of the buffer in bytes, or 0 to copy the
+                         stream without a ring buffer
+            block_size - the size of each read and write in bytes
+
+        Optionally, options.spill forces the buffer into a memory-mapped
+        file, and options.spill_dir names the directory for it.
+        options.decompress decompresses the stream, on options.threads
+        threads.
+
+        "options" is implemented as a generic object with properties so that
+        the output of an OptionParser can be passed directly to the app.
+        """
+        self.options=options
+        if options.verbose:
+            level=logging.DEBUG
+        else:
+            level=logging.INFO
+
+        # stdout carries the stream, so log to stderr
+        logging.basicConfig(level=level, stream=sys.stderr)
+
+        if not hasattr(self.options, 'spill'):
+            self.options.spill='auto'
+        if not hasattr(self.options, 'spill_dir'):
+            self.options.spill_dir=None
+        if not hasattr(self.options, 'decompress'):
+            self.options.decompress=False
+        if not hasattr(self.options, 'threads'):
+            self.options.threads=1
+
+    def run(self, stdin=None, stdout=None):
+        """Run this application
+
+        :param stdin: the file to read, defaults to standard input
+        :param stdout: the file to write, defaults to standard output
+
+        Returns: a result code suitable for passing to exit()
+        """
+        if stdin is None:
+            stdin = sys.stdin
+        if stdout is None:
+            stdout = sys.stdout
+        source = io.open(stdin.fileno(), 'rb', buffering=0, closefd=False)
+        sink = io.open(stdout.fileno(), 'wb', buffering=0, closefd=False)
+
+        write = sink.write
+        decompressor = None
+        if self.options.decompress:
+            decompressor = DecompressingWriter(sink.write,
+                                               self.options.threads)
+            write = decompressor.write
+
+        ring = None
+        if self.options.size:
+            ring = RingBuffer(self.options.size, self.options.block_size,
+                              spill=self.options.spill,
+                              spill_dir=self.options.spill_dir)
+        try:
+            if ring is None:
+                pump(source.readinto, write, self.options.block_size)
+            else:
+                ring.run(source.readinto, write)
+            if decompressor is not None:
+                decompressor.close()
+        except (EnvironmentError, ValueError) as e:
+            # the thread reading stdin may be blocked for good, so leave the
+            # buffer to be freed on exit
+            if decompressor is not None:
+                decompressor.abort()
+            logging.critical('zfsbuffer: %s' % e)
+            return 1
+        if ring is not None:
+            ring.close()
+            logging.info('zfsbuffer: %s' % ring.stats.summary())
+        if decompressor is not None:
+            logging.info('zfsbuffer: decompressed %s' %
+                         decompressor.stats.summary())
+        return 0
+
+def main(args=None):
+    """Main function for zfsbuffer
+
+    This function parses and validates command line arguments, constructs
+    an options object, and instanciates an instance of App.
+
+    It is as simple to use as:
+        exit(main())
+
+    However, the args parameter can be defined in order to construct your own
+    command line. This is useful for testing.
+    """
+
+    if args is None:
+        args = sys.argv
+
+    op = OptionParser(usage='usage: %prog [options] < input > output')
+    op.add_option('-v', '--verbose', dest='verbose', action='store_true')
+    op.add_option('-m', '--size', dest='size', default=str(DEFAULT_SIZE),
+                  help='size of the buffer, e.g. 1G, or 0 for none '
+                  '(default 256M)')
+    op.add_option('-s', '--block-size', dest='block_size',
+                  default=str(DEFAULT_BLOCK_SZ),
+                  help='size of each read and write (default 128K)')
+    op.add_option('--spill', dest='spill', action='store_true',
+                  default='auto',
+                  help='always keep the buffer in a memory-mapped file, '
+                  'rather than only when memory is short')
+    op.add_option('--spill-dir', dest='spill_dir', metavar='DIR',
+                  default=None,
+                  help='create the memory-mapped file in DIR')
+    op.add_option('-d', '--decompress', dest='decompress',
+                  action='store_true', default=False,
+                  help='decompress a stream compressed by zfsbackup '
+                  '--compress')
+    op.add_option('-t', '--threads', dest='threads', type='int', default=1,
+                  help='number of threads to decompress with (default 1)')
+    (options,args) = op.parse_args(args[1:])
+    if args:
+        op.error('unexpected arguments provided')
+    try:
+        options.size=parse_size(options.size)
+        options.block_size=parse_size(options.block_size)
+    except ValueError as e:
+        op.error(str(e))
+    if options.block_size < 1 or \
+       (options.size and options.size < 2 * options.block_size):
+        op.error('size must be 0 or at least twice block-size')
+    if options.threads < 1:
+        op.error('threads must be at least 1')
+
+    app=App(options)
+    return app.run()
+
+# ---------------- MAIN ---------------
+if __name__ == "__main__":
+    exit(main())